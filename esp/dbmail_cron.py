@@ -26,6 +26,7 @@
 import django
 django.setup()
 from esp.dbmail.cronmail import process_messages, send_email_requests
+from esp.mailman import process_queued_list_changes
 
 # This import must be after the evaluation of the Django settings, because
 # esp.settings modifies tempfile to avoid collisions between sites.
@@ -46,7 +47,9 @@
 try:
     logger.info('dbmail_cron: beginning to process messages.')
     process_messages()
-    logger.info('dbmail_cron: message processing complete; sending emails.')
+    logger.info('dbmail_cron: message processing complete; applying mailing list changes.')
+    process_queued_list_changes()
+    logger.info('dbmail_cron: applied mailing list changes; sending emails.')
     send_email_requests()
     logger.info('dbmail_cron: sent emails.')
 except Exception as e:
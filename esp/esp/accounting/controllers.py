@@ -45,11 +45,72 @@
 
 from django.db import transaction
 from django.db.models import Sum, Q
+from django.db.models.signals import post_save
 from django.template.defaultfilters import slugify
 
 from decimal import Decimal
 
 
+def finaid_amount(amount_requested, amount_siblingdiscount, grant):
+    """ The amount of financial aid given by a grant (or None, if there is
+        no grant) toward amount_requested, the cost of the items covered by
+        financial aid, after the sibling discount. """
+    aid_amount = Decimal('0')
+    if grant is not None:
+        if grant.amount_max_dec is not None:
+            if amount_requested - amount_siblingdiscount > grant.amount_max_dec:
+                aid_amount = grant.amount_max_dec
+            else:
+                aid_amount = amount_requested - amount_siblingdiscount
+
+        if grant.percent is not None:
+            discount_aid_amount = (Decimal('0.01') * grant.percent) * (amount_requested - amount_siblingdiscount - aid_amount)
+            aid_amount += discount_aid_amount
+
+    return aid_amount
+
+
+@python_2_unicode_compatible
+class AccountingSummary(object):
+    """ One user's totals for a program, as computed in bulk by
+        ProgramAccountingController.summarize().  Has the same methods for
+        reading them as IndividualAccountingController. """
+
+    def __init__(self, user_id, requested=None, requested_finaid=None, paid=None, siblingdiscount=None, grant=None):
+        self.user_id = user_id
+        self.requested = requested or Decimal('0')
+        self.requested_finaid = requested_finaid or Decimal('0')
+        self.paid = paid or Decimal('0')
+        self.siblingdiscount = siblingdiscount or Decimal('0')
+        self.finaid = finaid_amount(self.requested_finaid, self.siblingdiscount, grant)
+
+    def amount_requested(self, for_finaid_only=False):
+        if for_finaid_only:
+            return self.requested_finaid
+        return self.requested
+
+    def amount_finaid(self):
+        return self.finaid
+
+    def amount_siblingdiscount(self):
+        return self.siblingdiscount
+
+    def amount_paid(self):
+        return self.paid
+
+    def amount_due(self):
+        return self.requested - self.finaid - self.siblingdiscount - self.paid
+
+    def has_paid(self, in_full=False):
+        if in_full:
+            return (self.amount_paid() > 0) and (self.amount_due() <= 0)
+        else:
+            return (self.amount_paid() > 0)
+
+    def __str__(self):
+        return 'Accounting summary for user %d: $%s due' % (self.user_id, self.amount_due())
+
+
 class BaseAccountingController(object):
 
     def default_source_account(self):
@@ -255,6 +316,96 @@ def payments_summary(self):
         payments = Transfer.objects.filter(line_item=payment_li_type)
         return (payments.count(), payments.aggregate(total=Sum('amount_dec'))['total'])
 
+    @transaction.atomic
+    def bulk_ensure_required_transfers(self, user_ids):
+        """ Does what IndividualAccountingController.ensure_required_transfers()
+            does for each of the given users, with a few queries in all. """
+
+        user_ids = list(user_ids)
+        program_account = self.default_program_account()
+        source_account = self.default_source_account()
+        required_line_items = list(self.get_lineitemtypes(required_only=True))
+
+        existing_transfers = {(t.user_id, t.line_item_id): t for t in Transfer.objects.filter(
+            user__in=user_ids, line_item__in=required_line_items).order_by('id')}
+
+        new_transfers = []
+        changed_transfers = []
+        for item in required_line_items:
+            outdated_ids = []
+            for user_id in user_ids:
+                transfer = existing_transfers.get((user_id, item.id))
+                if transfer is None:
+                    new_transfers.append(Transfer(source=source_account,
+                                                  destination=program_account,
+                                                  user_id=user_id,
+                                                  line_item=item,
+                                                  amount_dec=item.amount_dec))
+                elif transfer.paid_in_id is None and transfer.amount_dec != item.amount_dec:
+                    #   Not paid yet, so bring the amount up to date.
+                    transfer.amount_dec = item.amount_dec
+                    outdated_ids.append(transfer.id)
+                    changed_transfers.append(transfer)
+            if outdated_ids:
+                Transfer.objects.filter(id__in=outdated_ids).update(amount_dec=item.amount_dec)
+        new_transfers = Transfer.objects.bulk_create(new_transfers)
+
+        #   bulk_create() and update() don't send signals.  The caches that
+        #   depend on transfers are keyed by program or by user, and none of
+        #   the per-user ones care about required costs, so one signal is
+        #   enough to expire them.
+        if new_transfers:
+            post_save.send(sender=Transfer, instance=new_transfers[0], created=True)
+        elif changed_transfers:
+            post_save.send(sender=Transfer, instance=changed_transfers[0], created=False)
+
+    def summarize(self, users, ensure_required=True):
+        """ Compute the totals that an IndividualAccountingController would
+            give for each of the given users, with a few grouped queries
+            rather than several queries per user.  Returns a dict mapping
+            each user's id to an AccountingSummary.
+
+            If ensure_required is True, first create or update their
+            required transfers, as amount_requested() and amount_due() do.
+        """
+
+        user_ids = {user.id for user in users}
+        if ensure_required:
+            self.bulk_ensure_required_transfers(user_ids)
+
+        #   Costs, costs covered by financial aid, and payments from outside
+        #   are all summed in one query.
+        Q_requested = Q(destination=self.default_program_account())
+        Q_paid = Q(line_item=self.default_payments_lineitemtype(), source__isnull=True)
+        totals = Transfer.objects.filter(Q_requested | Q_paid, user__in=user_ids).values('user').annotate(
+            requested=Sum('amount_dec', filter=Q_requested),
+            requested_finaid=Sum('amount_dec', filter=Q_requested & Q(line_item__for_finaid=True)),
+            paid=Sum('amount_dec', filter=Q_paid),
+        ).order_by()
+        totals = {row['user']: row for row in totals}
+
+        siblings = set()
+        if self.program.sibling_discount:
+            siblings = set(SplashInfo.objects.filter(program=self.program, student__in=user_ids, siblingdiscount=True).values_list('student', flat=True))
+
+        #   Use the latest grant, if a user somehow has several.
+        grants = {}
+        for grant in FinancialAidGrant.objects.filter(request__program=self.program, request__user__in=user_ids).select_related('request').order_by('id'):
+            grants[grant.request.user_id] = grant
+
+        result = {}
+        for user_id in user_ids:
+            row = totals.get(user_id, {})
+            result[user_id] = AccountingSummary(
+                user_id,
+                requested=row.get('requested'),
+                requested_finaid=row.get('requested_finaid'),
+                paid=row.get('paid'),
+                siblingdiscount=self.program.sibling_discount if user_id in siblings else None,
+                grant=grants.get(user_id),
+            )
+        return result
+
     def classify_transfer(self, transfer):
         """Give a short human-readable description of a transfer.
 
@@ -559,20 +710,7 @@ def amount_finaid(self, amount_siblingdiscount=None):
         if amount_siblingdiscount is None:
             amount_siblingdiscount = self.amount_siblingdiscount()
 
-        aid_amount = Decimal('0')
-        latest_grant = self.latest_finaid_grant()
-        if latest_grant is not None:
-            if latest_grant.amount_max_dec is not None:
-                if amount_requested - amount_siblingdiscount > latest_grant.amount_max_dec:
-                    aid_amount = latest_grant.amount_max_dec
-                else:
-                    aid_amount = amount_requested - amount_siblingdiscount
-
-            if latest_grant.percent is not None:
-                discount_aid_amount = (Decimal('0.01') * latest_grant.percent) * (amount_requested - amount_siblingdiscount - aid_amount)
-                aid_amount += discount_aid_amount
-
-        return aid_amount
+        return finaid_amount(amount_requested, amount_siblingdiscount, self.latest_finaid_grant())
 
     def amount_donation(self):
         lit = self.donation_lineitemtype()
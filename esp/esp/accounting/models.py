@@ -42,7 +42,7 @@
 from esp.db.fields import AjaxForeignKey
 
 from django.db import models
-from django.db.models import Sum
+from django.db.models import Q, Sum
 
 from decimal import Decimal
 
@@ -201,12 +201,11 @@ class Account(models.Model):
 
     @property
     def balance(self):
-        result = 0
-        if Transfer.objects.filter(source=self).exists():
-            result -= Transfer.objects.filter(source=self).aggregate(Sum('amount_dec'))['amount_dec__sum']
-        if Transfer.objects.filter(destination=self).exists():
-            result += Transfer.objects.filter(destination=self).aggregate(Sum('amount_dec'))['amount_dec__sum']
-        return result
+        Q_out = Q(source=self)
+        Q_in = Q(destination=self)
+        totals = Transfer.objects.filter(Q_out | Q_in).aggregate(
+            total_out=Sum('amount_dec', filter=Q_out), total_in=Sum('amount_dec', filter=Q_in))
+        return (totals['total_in'] or 0) - (totals['total_out'] or 0)
 
     @property
     def pending_balance(self):
@@ -226,12 +225,18 @@ def balance_breakdown(self):
         transfers_in_context = []
         transfers_out_context = []
 
+        #   Fetch all of the accounts on the other side at once.
+        transfers_in = list(transfers_in)
+        transfers_out = list(transfers_out)
+        targets = Account.objects.in_bulk({t['source'] for t in transfers_in if t['source'] is not None} |
+                                          {t['destination'] for t in transfers_out if t['destination'] is not None})
+
         for transfer in transfers_in:
             target_name = "none"
             target_title = "External payer[s]"
 
             if transfer['source'] is not None:
-                target = Account.objects.get(id=transfer['source'])
+                target = targets[transfer['source']]
                 target_name = target.name
                 target_title = target.description_title
 
@@ -242,7 +247,7 @@ def balance_breakdown(self):
             target_title = "External payee[s]"
 
             if transfer['destination'] is not None:
-                target = Account.objects.get(id=transfer['destination'])
+                target = targets[transfer['destination']]
                 target_name = target.name
                 target_title = target.description_title
 
@@ -22,6 +22,7 @@
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from esp.middleware import ESPError
+from esp.utils.streaming import iter_csv, iter_xlsx
 
 from datetime import datetime
 
@@ -622,16 +623,13 @@ def deleteForm(self):
         dyn.deleteTable()
         self.form.delete() # Cascading Foreign Keys should take care of everything
 
-    # IMPORTANT -> *NEED* TO REGISTER A CACHE DEPENDENCY ON THE RESPONSE MODEL
-    # @cache_function
-    def getResponseData(self, form):
+    def _getResponseQuestions(self, form):
         """
-        Returns the response data for this form, along with the questions
+        Returns the questions (columns) of the response data for this form,
+        along with the form's link model (or None) and a dict mapping the
+        names of link field questions to [model, model_field].
         """
-        dmh = DMH(form=form)
-        dyn = dmh.createDynModel()
-        response_data = {'questions': [], 'answers': []}
-        responses = list(dyn.objects.all().order_by('id').values())
+        questions = []
         fields = Field.objects.filter(form=form).order_by('section__page__seq', 'section__seq', 'seq').values('id', 'field_type', 'label')
 
         # Let's first do a bit of introspection to figure out
@@ -643,15 +641,15 @@ def getResponseData(self, form):
 
         # Add in the user column if form is not anonymous
         if not form.anonymous:
-            response_data['questions'].append(['user_id', 'User ID', 'fk'])
-            response_data['questions'].append(['user_display', 'User', 'textField'])
-            response_data['questions'].append(['user_email', 'User email', 'textField'])
-            response_data['questions'].append(['username', 'Username', 'textField'])
+            questions.append(['user_id', 'User ID', 'fk'])
+            questions.append(['user_display', 'User', 'textField'])
+            questions.append(['user_email', 'User email', 'textField'])
+            questions.append(['username', 'Username', 'textField'])
 
         # Add in the column for link fields, if any
         if form.link_type != "-1":
             only_fkey_model = cf_cache.only_fkey_models[form.link_type]
-            response_data['questions'].append(["link_%s_id" % only_fkey_model.__name__, form.link_type, 'fk'])
+            questions.append(["link_%s_id" % only_fkey_model.__name__, form.link_type, 'fk'])
         else:
             only_fkey_model = None
 
@@ -665,68 +663,119 @@ def getResponseData(self, form):
 
                 # Now let's see what fields need to be set
                 add_fields[qname] = [model, cf_cache.getLinkFieldData(ftype)['model_field']]
-                response_data['questions'].append([qname, field['label'], ftype])
+                questions.append([qname, field['label'], ftype])
                 # Include this field only if it isn't a dummy field
             elif generic_fields[ftype]['typeMap'] is not DummyField:
-                response_data['questions'].append([qname, field['label'], ftype])
-
-        users = ESPUser.objects.in_bulk([response['user_id'] for response in responses])
-
-        # Now let's set up the responses
-        for response in responses:
-            link_instances_cache={}
-
-            # Add in user if form is not anonymous
-            if not form.anonymous and response['user_id']:
-                user = users[response['user_id']]
-                response['user_id'] = str(response['user_id'])
-                response['user_display'] = user.name()
-                response['user_email'] = user.email
-                response['username'] = user.username
-
-            # Add in links
-            if only_fkey_model is not None:
-                if only_fkey_model.objects.filter(pk=response["link_%s_id" % only_fkey_model.__name__]).exists():
-                    inst = only_fkey_model.objects.get(pk=response["link_%s_id" % only_fkey_model.__name__])
-                else: inst = None
-                response["link_%s_id" % only_fkey_model.__name__] = str(inst)
-
-            # Now, put in the additional fields in response
-            for qname, data in add_fields.items():
-                if data[0].__name__ not in link_instances_cache:
-                    if data[0].objects.filter(pk=response["link_%s_id" % data[0].__name__]).exists():
-                        link_instances_cache[data[0].__name__] = data[0].objects.get(pk=response["link_%s_id" % data[0].__name__])
-                    else:
-                        link_instances_cache[data[0].__name__] = None
+                questions.append([qname, field['label'], ftype])
 
-                if cf_cache.isCompoundLinkField(data[0], data[1]):
-                    if link_instances_cache[data[0].__name__] is None:
-                        response[qname] = []
-                    else:
-                        response[qname] = [link_instances_cache[data[0].__name__].__dict__[x] for x in cf_cache.getCompoundLinkFields(data[0], data[1])]
-                else:
-                    if link_instances_cache[data[0].__name__] is None:
-                        response[qname]=''
+        return questions, only_fkey_model, add_fields
+
+    def _iterResponses(self, form, only_fkey_model, add_fields, chunk_size=500):
+        """
+        Yields the responses to this form in order, with the values from
+        users and linked models filled in.
+
+        Responses are fetched chunk_size at a time, and the users and link
+        model instances for each chunk are fetched with one query per model,
+        so this takes a constant number of queries per chunk.
+        """
+        dmh = DMH(form=form)
+        dyn = dmh.createDynModel()
+
+        link_models = {data[0].__name__: data[0] for data in add_fields.values()}
+        if only_fkey_model is not None:
+            link_models[only_fkey_model.__name__] = only_fkey_model
+
+        last_id = None
+        while True:
+            responses = dyn.objects.all().order_by('id')
+            if last_id is not None:
+                responses = responses.filter(id__gt=last_id)
+            responses = list(responses.values()[:chunk_size])
+            if not responses:
+                return
+            last_id = responses[-1]['id']
+
+            users = {}
+            if not form.anonymous:
+                users = ESPUser.objects.in_bulk([response['user_id'] for response in responses if response['user_id']])
+            link_instances = {}
+            for name, model in link_models.items():
+                link_instances[name] = model.objects.in_bulk([response["link_%s_id" % name] for response in responses if response["link_%s_id" % name] is not None])
+
+            for response in responses:
+                # Look up the linked instances before we overwrite the link
+                # column with the display value.
+                link_instances_cache = {name: link_instances[name].get(response["link_%s_id" % name]) for name in link_models}
+
+                # Add in user if form is not anonymous
+                if not form.anonymous and response['user_id']:
+                    user = users[response['user_id']]
+                    response['user_id'] = str(response['user_id'])
+                    response['user_display'] = user.name()
+                    response['user_email'] = user.email
+                    response['username'] = user.username
+
+                # Add in links
+                if only_fkey_model is not None:
+                    response["link_%s_id" % only_fkey_model.__name__] = str(link_instances_cache[only_fkey_model.__name__])
+
+                # Now, put in the additional fields in response
+                for qname, data in add_fields.items():
+                    instance = link_instances_cache[data[0].__name__]
+                    if cf_cache.isCompoundLinkField(data[0], data[1]):
+                        if instance is None:
+                            response[qname] = []
+                        else:
+                            response[qname] = [instance.__dict__[x] for x in cf_cache.getCompoundLinkFields(data[0], data[1])]
                     else:
-                        response[qname] = link_instances_cache[data[0].__name__].__dict__[data[1]]
+                        if instance is None:
+                            response[qname] = ''
+                        else:
+                            response[qname] = instance.__dict__[data[1]]
+
+                yield response
+
+    # IMPORTANT -> *NEED* TO REGISTER A CACHE DEPENDENCY ON THE RESPONSE MODEL
+    # @cache_function
+    def getResponseData(self, form):
+        """
+        Returns the response data for this form, along with the questions
+        """
+        questions, only_fkey_model, add_fields = self._getResponseQuestions(form)
+        response_data = {'questions': questions, 'answers': []}
 
         # Add responses to response_data
-        response_data['answers'].extend(responses)
+        response_data['answers'].extend(self._iterResponses(form, only_fkey_model, add_fields))
 
         return response_data
     # getResponseData.depend_on_row('customforms.Field', lambda field: {'form': field.form})
 
+    def getResponseRows(self):
+        """
+        Yields the response data as rows for a spreadsheet: first the question
+        labels, then one row per response.  Responses are fetched as they are
+        needed, so this can be streamed.
+        """
+        questions, only_fkey_model, add_fields = self._getResponseQuestions(self.form)
+        yield [ques[1] for ques in questions]
+        for response in self._iterResponses(self.form, only_fkey_model, add_fields):
+            row = []
+            for ques in questions:
+                ans = response.get(ques[0])
+                # Join together responses from compound fields
+                if isinstance(ans, list):
+                    ans = " ".join(ans)
+                row.append(ans)
+            yield row
+
     def getResponseExcel(self):
         """
         Returns the response data as excel data.
         """
         import xlwt
-        try:
-            from cStringIO import StringIO
-        except:
-            from io import StringIO
+        from io import BytesIO
 
-        response_data = self.getResponseData(self.form)
         wbk = xlwt.Workbook()
         sheet = wbk.add_sheet('sheet 1')
 
@@ -737,32 +786,37 @@ def getResponseExcel(self):
         font.bold = True
         style.font = font
 
-        # write the questions first
-        for i in range(0, len(response_data['questions'])):
-            sheet.write(0, i, response_data['questions'][i][1], style)
+        rows = self.getResponseRows()
 
-        # Build up a simple dict storing question_name and question_index (=column number)
-        ques_cols = {}
-        for qid, ques in enumerate(response_data['questions']):
-            ques_cols.update({ques[0]: qid})
+        # write the questions first
+        for col, label in enumerate(next(rows)):
+            sheet.write(0, col, label, style)
 
         # Now writing the answers
-        for idx, response in enumerate(response_data['answers']):
-            for ques, ans in response.items():
-                try:
-                    col = ques_cols[ques]
-                except KeyError:
-                    continue
-                # Join together responses from compound fields
-                if isinstance(ans, list):
-                    write_ans = " ".join(ans)
-                else: write_ans = ans
-                sheet.write(idx+1, col, write_ans)
-
-        output = StringIO()
+        for idx, row in enumerate(rows):
+            for col, ans in enumerate(row):
+                if ans is not None:
+                    sheet.write(idx+1, col, ans)
+            # Let xlwt write out finished rows as we go.
+            if idx % 1000 == 999:
+                sheet.flush_row_data()
+
+        output = BytesIO()
         wbk.save(output)
         return output
 
+    def getResponseCSV(self):
+        """
+        Returns an iterator over the response data as CSV.
+        """
+        return iter_csv(self.getResponseRows())
+
+    def getResponseXLSX(self):
+        """
+        Returns an iterator over the response data as an Excel (.xlsx) workbook.
+        """
+        return iter_xlsx(self.getResponseRows())
+
     def rebuildData(self):
         """
         Returns the metadata so that a form can be re-built in the form builder
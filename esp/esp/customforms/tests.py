@@ -32,9 +32,16 @@
   Email: web-team@learningu.org
 """
 
+import csv
+import io
 import json
+import zipfile
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from esp.customforms.models import Form, Field
+from esp.customforms.DynamicForm import FormHandler
 from esp.customforms.DynamicModel import DynamicModelHandler
 from esp.users.models import ESPUser
 from esp.tests.util import CacheFlushTestCase as TestCase
@@ -209,3 +216,33 @@ def testForms(self):
             if entry[0] in ['user_id', 'user_display', 'user_email', 'username']:
                 continue
             self.assertTrue(entry[0] in responses_corrected)
+
+        #   - Make sure the responses can be exported
+        response = self.client.get("/customforms/exportdata/%d/csv/" % form.id)
+        self.assertEqual(response.status_code, 200)
+        csv_rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode('UTF-8'))))
+        self.assertEqual(csv_rows[0], [entry[1] for entry in response_data['questions']])
+        self.assertEqual(len(csv_rows), 2)
+        self.assertIn(self.student.username, csv_rows[1])
+        self.assertIn('Smart', csv_rows[1])
+
+        response = self.client.get("/customforms/exportdata/%d/xlsx/" % form.id)
+        self.assertEqual(response.status_code, 200)
+        workbook = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertIsNone(workbook.testzip())
+        self.assertIn('Smart', workbook.read('xl/worksheets/sheet1.xml').decode('UTF-8'))
+
+        response = self.client.get("/customforms/exceldata/%d/" % form.id)
+        self.assertEqual(response.status_code, 200)
+
+        #   - Make sure fetching the responses doesn't take a query per response
+        fh = FormHandler(form=form, request=None)
+        fh.getResponseData(form)
+        with CaptureQueriesContext(connection) as one_response:
+            fh.getResponseData(form)
+        for i in range(5):
+            form_response.pk = None
+            form_response.save()
+        with self.assertNumQueries(len(one_response)):
+            response_data = fh.getResponseData(form)
+        self.assertEqual(len(response_data['answers']), 6)
@@ -17,5 +17,6 @@
     url(r'^/getmodules/$', views.get_modules),
     url(r'^/builddata/$', views.formBuilderData),
     url(r'^/exceldata/(?P<form_id>\d{1,6})/$', views.getExcelData),
+    url(r'^/exportdata/(?P<form_id>\d{1,6})/(?P<format>csv|xlsx)/$', views.exportData),
     url(r'^/bulkdownloadfiles/?', views.bulkDownloadFiles)
 ]
@@ -5,6 +5,7 @@
 from django.shortcuts import redirect, HttpResponse
 from django.http import Http404, HttpResponseRedirect, JsonResponse
 from django.db import connection
+from django.core.exceptions import FieldDoesNotExist
 from django.core.serializers.json import DjangoJSONEncoder
 
 from esp.customforms.models import *
@@ -19,6 +20,7 @@
 from esp.users.models import ESPUser
 from esp.middleware import ESPError
 from esp.utils.web import render_to_response, zip_download
+from esp.utils.streaming import streaming_download
 
 def test_func(user):
     return user.is_authenticated and (user.is_morphed() or user.isTeacher() or user.isAdministrator())
@@ -375,6 +377,20 @@ def getExcelData(request, form_id):
     response['Content-Disposition']='attachment; filename=%s.xls' % form.title
     return response
 
+@user_passes_test(test_func)
+def exportData(request, form_id, format):
+    """
+    Streams the response data as a CSV file or Excel (.xlsx) workbook
+    """
+
+    form = Form.objects.get(pk=form_id)
+    fh = FormHandler(form=form, request=request)
+    if format == 'csv':
+        return streaming_download(fh.getResponseCSV(), '%s.csv' % form.title, 'text/csv')
+    else:
+        return streaming_download(fh.getResponseXLSX(), '%s.xlsx' % form.title,
+                                  'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
 @user_passes_test(test_func)
 def getData(request):
     """
@@ -406,7 +422,13 @@ def bulkDownloadFiles(request):
         form = Form.objects.get(pk=form_id)
         dmh = DMH(form=form)
         dyn = dmh.createDynModel()
-        filenames = [resp[question_name] for resp in dyn.objects.all().values()]
+        # The zip file is streamed, so check the question now rather than
+        # failing partway through the download.
+        try:
+            dyn._meta.get_field(question_name)
+        except FieldDoesNotExist:
+            return HttpResponse(status=400)
+        filenames = dyn.objects.order_by('id').values_list(question_name, flat=True).iterator()
         return zip_download(filenames, 'surveyfiles')
     return HttpResponse(status=400)
 
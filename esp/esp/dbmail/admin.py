@@ -35,7 +35,7 @@
 from django.contrib import admin
 from esp.admin import admin_site
 
-from esp.dbmail.models import MessageVars, EmailList, PlainRedirect, MessageRequest, TextOfEmail
+from esp.dbmail.models import MessageVars, EmailList, PlainRedirect, MessageRequest, TextOfEmail, MailingListChange
 from esp.utils.admin_user_search import default_user_search
 
 class MessageVarsAdmin(admin.ModelAdmin):
@@ -66,3 +66,9 @@ class TextOfEmailAdmin(admin.ModelAdmin):
     date_hierarchy = 'sent'
     list_filter = ('send_from',)
 admin_site.register(TextOfEmail, TextOfEmailAdmin)
+
+class MailingListChangeAdmin(admin.ModelAdmin):
+    list_display = ('id', 'list_name', 'action', 'email', 'created_at')
+    search_fields = ('list_name', 'email')
+    list_filter = ('action',)
+admin_site.register(MailingListChange, MailingListChangeAdmin)
@@ -36,10 +36,16 @@
 logger = logging.getLogger(__name__)
 
 import math
+import queue
+import threading
 import time
 
 from esp.dbmail.models import MessageRequest, send_mail, TextOfEmail
 from datetime import datetime, timedelta
+from django.contrib.sites.models import Site
+from django.core.mail import get_connection
+from django.db import connection as db_connection
+from django.db.models import F
 from django.db.models.query import Q
 from django.template.loader import render_to_string
 
@@ -70,17 +76,157 @@ def process_messages():
     #   Process message requests
     for message in messages:
         # If we raise an error here, transaction management will make sure that
-        # things with the MessageRequest get backed out properly.  We let the
-        # whole script just exit in this case -- this way we get an error
-        # message via cron, and the next run of the script can just try again.
+        # the chunk we were working on gets backed out properly, and
+        # processed_through records how far we got.  We let the whole script
+        # just exit in this case -- this way we get an error message via cron,
+        # and the next run of the script can just pick up where we left off.
         message.process()
     return messages
 
+class TokenBucket(object):
+    """A thread-safe token bucket, allowing up to `rate` operations per second
+    on average with bursts of up to `capacity` operations."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = max(float(capacity), 1.0)
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self):
+        """Take a token, sleeping until one is available."""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def _send_worker(work, results, bucket):
+    """Send the (mailtxt, extra_headers) pairs in the queue `work` until we
+    reach a None, putting a (mailtxt, exception) pair in the queue `results`
+    for each one.
+
+    Each worker keeps its own SMTP connection open across messages, rather
+    than letting send_mail open a new one for each message.  Workers don't
+    touch the database; the caller records the results as they come in.
+    """
+    connection = get_connection(return_path=settings.DEFAULT_EMAIL_ADDRESSES['bounces'])
+    try:
+        while True:
+            item = work.get()
+            if item is None:
+                break
+            mailtxt, extra_headers = item
+            try:
+                bucket.consume()
+                # A no-op if the connection is already open.
+                connection.open()
+            except Exception as e:
+                mailtxt.tries += 1
+                exception = e
+            else:
+                # send_mail adds to extra_headers, so give it a copy.
+                exception = mailtxt.send(connection=connection, extra_headers=dict(extra_headers), save=False)
+            if exception is not None:
+                # The connection may be in a bad state, so start a new one
+                # for the next message.
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+            results.put((mailtxt, exception))
+    finally:
+        try:
+            connection.close()
+        except Exception:
+            pass
+        # In case anything did query the database in this thread.
+        db_connection.close()
+
+
+def _send_batch(mailtxts, headers, num_workers, bucket):
+    """Send a batch of TextOfEmails using num_workers threads, yielding
+    lists of (mailtxt, exception) pairs as they are sent: each list has every
+    result that is ready, after waiting for at least one.
+
+    Workers are only given new messages once the caller has taken the results
+    of earlier ones, so at most num_workers messages are ever sent without
+    the caller having seen their results.  If the caller stops early (e.g.
+    because recording results failed), nothing more is sent.
+    """
+    work = queue.Queue()
+    results = queue.Queue()
+    pending = iter(mailtxts)
+    def feed():
+        # Give the workers another message, or tell one to stop.
+        mailtxt = next(pending, None)
+        if mailtxt is None:
+            work.put(None)
+        else:
+            work.put((mailtxt, headers.get(mailtxt.messagerequest_id, {})))
+
+    workers = []
+    for i in range(num_workers):
+        feed()
+        worker = threading.Thread(target=_send_worker, args=(work, results, bucket))
+        worker.start()
+        workers.append(worker)
+    try:
+        remaining = len(mailtxts)
+        while remaining:
+            done = [results.get()]
+            try:
+                while True:
+                    done.append(results.get_nowait())
+            except queue.Empty:
+                pass
+            remaining -= len(done)
+            yield done
+            for result in done:
+                feed()
+    finally:
+        try:
+            while True:
+                work.get_nowait()
+        except queue.Empty:
+            pass
+        for worker in workers:
+            work.put(None)
+        for worker in workers:
+            worker.join()
+
+
+def _record_results(results):
+    """Record a list of (mailtxt, exception) results from _send_batch with
+    one UPDATE for the messages that were sent and one for those that
+    weren't.  As in TextOfEmail.send(), the msgtext of sent emails is cleared
+    to save DB space."""
+    sent_ids = [mailtxt.id for (mailtxt, exception) in results if exception is None]
+    failed_ids = [mailtxt.id for (mailtxt, exception) in results if exception is not None]
+    if sent_ids:
+        TextOfEmail.objects.filter(id__in=sent_ids).update(sent=datetime.now(), msgtext='')
+    if failed_ids:
+        TextOfEmail.objects.filter(id__in=failed_ids).update(tries=F('tries') + 1)
+
+
 # Deliberately uses transaction autocommitting -- we don't need this to be
 # atomic.
 def send_email_requests():
     """Go through all email requests that aren't sent and send them.
 
+    Messages are sent by settings.EMAIL_SEND_WORKERS threads (default 4), each
+    with its own persistent SMTP connection, at a rate of at most
+    settings.EMAIL_SEND_RATE messages per second.  If EMAIL_SEND_RATE is not
+    set, it defaults to one message every settings.EMAILTIMEOUT seconds if
+    that is set, and 10 per second otherwise.
+
     Callers (e.g. dbmail_cron.py) should ensure that this function is not
     called in more than one thread simultaneously."""
 
@@ -102,11 +248,22 @@ def send_email_requests():
                                           Q(sent_by__isnull=True),
                                           created_at__gte=one_week_ago,
                                           sent__isnull=True,
-                                          tries__lte=retries)
+                                          tries__lte=retries).select_related('user')
+
+    rate = getattr(settings, 'EMAIL_SEND_RATE', None)
+    if rate is None:
+        wait = getattr(settings, 'EMAILTIMEOUT', None)
+        rate = 1.0 / wait if wait else 10
+    num_workers = getattr(settings, 'EMAIL_SEND_WORKERS', None) or 4
+    bucket = TokenBucket(rate, num_workers)
+
+    # Prime the Site cache, which send_mail uses for unsubscribe links, so
+    # that the workers don't need to query for it.
+    Site.objects.get_current()
 
-    wait = getattr(settings, 'EMAILTIMEOUT', None)
-    if wait is None:
-        wait = 1.5
+    # The special headers for each MessageRequest, by ID; we only need to
+    # load them once per request, rather than once per email.
+    headers = {}
 
     num_sent = 0
     errors = [] # if any messages failed to deliver
@@ -122,26 +279,36 @@ def send_email_requests():
     batch_size = 1000
     for i in range(int(math.ceil(float(mailtxts.count()) / batch_size))):
         # .iterator() re-evaulates the QuerySet each time, moving to the remaining unsent texts
-        for mailtxt in mailtxts[:batch_size].iterator():
-            exception = mailtxt.send()
-            if exception is not None:
-                # In the line below, we don't use str(exception) because if the user-defined exception doesn't define
-                # __str__() then str(exception) will return an empty string. Then we won't know what the exception is.
-                # There are many cases in the logs where the errors show exception as empty string, which indicates that
-                # there was an exception but we have no idea what it was. At least str(type(exception)) will show us
-                # the type (class name) of the exception.
-                exception_type_str = str(type(exception))
-
-                errors.append({'email': mailtxt, 'exception': exception_type_str})
-
-                # Do not use str(mailtxt.send_to) in the line below. If the mailtxt.send_to contains a non-ascii
-                # character, then the str() will cause a UnicodeEncodeError, but directly concatenating with +
-                # works fine.
-                logger.warning("Encountered error while sending to " + mailtxt.send_to + ": " + exception_type_str)
-            else:
-                num_sent += 1
+        batch = list(mailtxts[:batch_size].iterator())
+        if not batch:
+            break
 
-            time.sleep(wait)
+        new_request_ids = {mailtxt.messagerequest_id for mailtxt in batch} - set(headers)
+        for request in MessageRequest.objects.filter(id__in=new_request_ids).only('id', 'special_headers'):
+            headers[request.id] = request.special_headers_dict
+
+        for results in _send_batch(batch, headers, num_workers, bucket):
+            # Record each group of results as soon as it comes in, so that if
+            # this process dies partway through a batch, at most the messages
+            # the workers were in the middle of get sent again.
+            _record_results(results)
+            for mailtxt, exception in results:
+                if exception is not None:
+                    # In the line below, we don't use str(exception) because if the user-defined exception doesn't define
+                    # __str__() then str(exception) will return an empty string. Then we won't know what the exception is.
+                    # There are many cases in the logs where the errors show exception as empty string, which indicates that
+                    # there was an exception but we have no idea what it was. At least str(type(exception)) will show us
+                    # the type (class name) of the exception.
+                    exception_type_str = str(type(exception))
+
+                    errors.append({'email': mailtxt, 'exception': exception_type_str})
+
+                    # Do not use str(mailtxt.send_to) in the line below. If the mailtxt.send_to contains a non-ascii
+                    # character, then the str() will cause a UnicodeEncodeError, but directly concatenating with +
+                    # works fine.
+                    logger.warning("Encountered error while sending to " + mailtxt.send_to + ": " + exception_type_str)
+                else:
+                    num_sent += 1
 
     if num_sent > 0:
         logger.info('Sent %d messages', num_sent)
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbmail', '0010_textofemail_messagerequest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailingListChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('list_name', models.CharField(db_index=True, max_length=256)),
+                ('action', models.CharField(choices=[('add', 'add'), ('remove', 'remove')], max_length=16)),
+                ('email', models.CharField(help_text='The bare email address, used to match up changes for the same member', max_length=256)),
+                ('address', models.CharField(help_text='The address to subscribe, possibly including a real name', max_length=512)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbmail', '0011_mailinglistchange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagerequest',
+            name='processed_through',
+            field=models.IntegerField(default=0, help_text='The highest recipient user ID for which emails have already been created. Lets processing resume where it left off if it is interrupted.'),
+        ),
+    ]
@@ -67,7 +67,7 @@
 # https://support.google.com/a/answer/81126?visit_id=638428689824104778-3542874255&rd=1#subscriptions
 def send_mail(subject, message, from_email, recipient_list, fail_silently=False, bcc=None,
               return_path=settings.DEFAULT_EMAIL_ADDRESSES['bounces'], extra_headers={}, user=None,
-              *args, **kwargs):
+              connection=None, *args, **kwargs):
     from_email = from_email.strip()
     # the from_email must match one of our DMARC domains/subdomains
     # or the email may be rejected by email clients
@@ -104,9 +104,11 @@ def send_mail(subject, message, from_email, recipient_list, fail_silently=False,
     from django.core.mail import EmailMessage, EmailMultiAlternatives #send_mail as django_send_mail
     logger.info("Sent mail to %s", recipients)
 
-    #   Get whatever type of email connection Django provides.
+    #   Get whatever type of email connection Django provides, unless the
+    #   caller is reusing an already-open one.
     #   Normally this will be SMTP, but it also has an in-memory backend for testing.
-    connection = get_connection(fail_silently=fail_silently, return_path=return_path)
+    if connection is None:
+        connection = get_connection(fail_silently=fail_silently, return_path=return_path)
 
     #   Detect HTML tags in message and change content-type if they are found
     if '<html>' in message:
@@ -218,6 +220,7 @@ class MessageRequest(models.Model):
 
     processed = models.BooleanField(default=False, db_index=True) # Have we made EmailRequest objects from this MessageRequest yet?
     processed_by = models.DateTimeField(null=True, default=None, db_index=True) # When should this be processed by?
+    processed_through = models.IntegerField(default=0, help_text="The highest recipient user ID for which emails have already been created. Lets processing resume where it left off if it is interrupted.")
     priority_level = models.IntegerField(null=True, blank=True) # Priority of a message; may be used in the future to make a message non-digested, or to prevent a low-priority message from being sent
 
     public = models.BooleanField(default=False) # Should the subject and msgtext of this request be publicly viewable at /email/<id>?
@@ -333,79 +336,110 @@ def assert_is_valid_sendto_fn_or_ESPError(cls, sendto_fn_name):
                 'The error message is: "%s".' % \
                 (sendto_fn_name, settings.DEFAULT_EMAIL_ADDRESSES['support'], e))
 
-    # Processing a MessageRequest needs to be atomic, so that if the DB falls
-    # over halfway through the processing, we don't end up with half of the
-    # TextOfEmail objects created and half of them not without a way to repair.
-    # Unfortunately, this could be a pretty huge transaction -- if it turns out
-    # to be a huge performance hit, we will need to rethink how we do this, but
-    # I think we'll be okay, since nothing should block on it except other
-    # instances of the same function (which should probably be locked out
-    # anyway at a higher level).
-    @transaction.atomic
-    def process(self):
+    def get_send_from(self):
+        """ Returns the address this request's emails should be sent from. """
+        if self.sender is not None and len(self.sender.strip()) > 0:
+            return self.sender
+        if self.creator is not None:
+            return self.creator.get_email_sendto_address()
+        return 'ESP Web Site <esp@mit.edu>'
+
+    # Processing a MessageRequest used to be one big transaction, which for a
+    # program-wide announcement meant holding a transaction open across tens of
+    # thousands of single-row inserts.  Instead, we walk the recipients in
+    # order of user ID and create their emails in chunks, each chunk in its own
+    # transaction along with an update of processed_through.  If the DB falls
+    # over partway through, every recipient is either fully done (and at or
+    # below processed_through) or not started, so the next run of the cron
+    # script picks up exactly where this one stopped.
+    def process(self, chunk_size=None):
         """Process this request, creating TextOfEmail and EmailRequest objects.
 
+        Recipients are handled in chunks of chunk_size users (by default,
+        settings.EMAIL_PROCESS_CHUNK_SIZE), each committed separately.
+
         It is the caller's responsibility to call this only on unprocessed
         MessageRequests.
         """
-        logger.info("Processing MessageRequest %d: %s", self.id, self.subject)
+        if chunk_size is None:
+            chunk_size = getattr(settings, 'EMAIL_PROCESS_CHUNK_SIZE', 500)
 
-        # figure out who we're sending from...
-        if self.sender is not None and len(self.sender.strip()) > 0:
-            send_from = self.sender
+        if self.processed_through:
+            logger.info("Resuming MessageRequest %d after user %d: %s", self.id, self.processed_through, self.subject)
         else:
-            if self.creator is not None:
-                send_from = self.creator.get_email_sendto_address()
-            else:
-                send_from = 'ESP Web Site <esp@mit.edu>'
+            logger.info("Processing MessageRequest %d: %s", self.id, self.subject)
+
+        # figure out who we're sending from...
+        send_from = self.get_send_from()
 
-        users = self.recipients.getList(ESPUser).distinct()
+        users = self.recipients.getList(ESPUser).distinct().filter(id__gt=self.processed_through).order_by('id')
 
         sendto_fn = self.get_sendto_fn_callable(self.sendto_fn_name)
 
-        # go through each user and parse the text...then create the proper
-        # emailrequest and textofemail object
+        # Compile the templates and load the message variables once, rather
+        # than once per recipient.
+        subject_template = Template(str(self.subject))
+        msgtext_template = Template(str(self.msgtext))
+        providers = MessageVars.getProviders(self)
+
+        chunk = []
+        for user in users.iterator(chunk_size=chunk_size):
+            chunk.append(user)
+            if len(chunk) >= chunk_size:
+                self._process_chunk(chunk, send_from, sendto_fn, subject_template, msgtext_template, providers)
+                chunk = []
+        if chunk:
+            self._process_chunk(chunk, send_from, sendto_fn, subject_template, msgtext_template, providers)
+
+        # Mark ourselves processed.  Everything up to this point has already
+        # been committed, chunk by chunk; if we fall over before this write,
+        # the next run will find no recipients past processed_through and
+        # just finish the job.
+        self.processed = True
+        self.save(update_fields=['processed'])
+
+        logger.info('Prepared emails to send for message request %d: %s', self.id, self.subject)
+
+    @transaction.atomic
+    def _process_chunk(self, users, send_from, sendto_fn, subject_template, msgtext_template, providers):
+        """Create the emails for one chunk of recipients, and record that we
+        have processed through the last of them."""
+        texts = []
+        targets = []
         for user in users:
-            subject = self.parseSmartText(self.subject, user)
-            msgtext = self.parseSmartText(self.msgtext, user)
+            context = MessageVars.getContext(self, user, providers=providers)
+            subject = subject_template.render(context)
+            msgtext = msgtext_template.render(context)
 
             # For each user, create an EmailRequest and a TextOfEmail
             # for each address given by the output of the sendto function.
             for address_pair in sendto_fn(user):
-                newemailrequest = {'target': user, 'msgreq': self}
                 send_to = ESPUser.email_sendto_address(*address_pair)
-                newtxt = {
-                    'messagerequest': self,
-                    'user': user,
-                    'send_to': send_to,
-                    'send_from': send_from,
-                    'subject': subject,
-                    'msgtext': msgtext,
-                    'created_at': self.created_at,
-                    'sent': None,
-                }
-
-                # Use get_or_create so that, if this send_to address is
-                # already receiving the exact same email, it doesn't need to
-                # get sent a second time.
-                # This is useful to de-duplicate announcement emails for
-                # people with multiple accounts, or for preventing a user
-                # from receiving a duplicate when a message request needs to
-                # be resent after a bug prevented it from being received by
-                # all recipients the first time.
-                # Disabled in hopes that it will make postgres less sad.
-                # TODO(benkraft): Figure out a more permanent solution.
-                newtxt = TextOfEmail.objects.create(**newtxt)
-                newemailrequest['textofemail'] = newtxt
-                EmailRequest.objects.create(**newemailrequest)
-
-        # Mark ourselves processed.  We don't have to worry about the DB
-        # falling over between the above writes and this one, because the whole
-        # assembly is in a transaction.
-        self.processed = True
-        self.save()
-
-        logger.info('Prepared emails to send for message request %d: %s', self.id, self.subject)
+                # We used to consider using get_or_create here, to
+                # de-duplicate announcement emails for people with multiple
+                # accounts; it made postgres sad, so we don't.
+                texts.append(TextOfEmail(
+                    messagerequest=self,
+                    user=user,
+                    send_to=send_to,
+                    send_from=send_from,
+                    subject=subject,
+                    msgtext=msgtext,
+                    created_at=self.created_at,
+                    sent=None,
+                ))
+                targets.append(user)
+
+        # On postgres, bulk_create sets the primary keys of the objects it
+        # creates, so we can point the EmailRequests at them.
+        texts = TextOfEmail.objects.bulk_create(texts)
+        EmailRequest.objects.bulk_create([
+            EmailRequest(target=target, msgreq=self, textofemail=text)
+            for target, text in zip(targets, texts)
+        ])
+
+        self.processed_through = users[-1].id
+        MessageRequest.objects.filter(id=self.id).update(processed_through=self.processed_through)
 
 @python_2_unicode_compatible
 class TextOfEmail(models.Model):
@@ -432,24 +466,30 @@ class TextOfEmail(models.Model):
     def __str__(self):
         return str(self.subject) + ' <' + (self.send_to) + '>'
 
-    def send(self):
+    def send(self, connection=None, extra_headers=None, save=True):
         """Take the email data in this TextOfEmail and send it.
 
         Returns an exception, if one was raised by `send_mail`, or None if the
         message sent successfully.
 
+        connection may be an open email backend to send through, and
+        extra_headers the parent request's special_headers_dict, if the caller
+        already has them.  If save is False, the caller is responsible for
+        saving the updated sent/tries/msgtext fields.
+
         It is the caller's responsibility to call this only on emails which
         have not already been sent, and which do not have too many retries.
         """
 
-        parent_request = None
-        if self.emailrequest_set.count() > 0:
-            parent_request = self.emailrequest_set.all()[0].msgreq
+        if extra_headers is None:
+            parent_request = None
+            if self.emailrequest_set.count() > 0:
+                parent_request = self.emailrequest_set.all()[0].msgreq
 
-        if parent_request is not None:
-            extra_headers = parent_request.special_headers_dict
-        else:
-            extra_headers = {}
+            if parent_request is not None:
+                extra_headers = parent_request.special_headers_dict
+            else:
+                extra_headers = {}
 
         now = datetime.now()
 
@@ -460,17 +500,20 @@ def send(self):
                       self.send_to,
                       False,
                       extra_headers=extra_headers,
-                      user = self.user)
+                      user = self.user,
+                      connection=connection)
         except Exception as e:
             self.tries += 1
-            self.save()
+            if save:
+                self.save()
             return e
         else:
             self.sent = now
             # clear the msgtext to save DB space
             # we can always repopulate it using self.fill_msgtext()
             self.msgtext = ""
-            self.save()
+            if save:
+                self.save()
 
     def fill_msgtext(self):
         """ Repopulate the msgtext based on the messagerequest """
@@ -536,13 +579,24 @@ def getVar(self, key, user):
             return None
 
     @staticmethod
-    def getContext(msgrequest, user):
-        """ Get a context-like dictionary for template rendering. """
+    def getProviders(msgrequest):
+        """ Load the variable providers for a message, as a list of
+            (provider_name, provider) pairs. """
+        return [(msgvar.provider_name, pickle.loads(msgvar.pickled_provider))
+                for msgvar in msgrequest.messagevars_set.all()]
+
+    @staticmethod
+    def getContext(msgrequest, user, providers=None):
+        """ Get a context-like dictionary for template rendering.
+
+            providers may be the output of getProviders(msgrequest), to avoid
+            reloading them when rendering for many users. """
         from django.template import Context  ## aseering 8-13-2010 -- Yes, this is supposed to be 'Context', not 'RequestContext'.
         context = {}
-        msgvars = msgrequest.messagevars_set.all()
-        for msgvar in msgvars:
-            context.update(msgvar.getDict(user))
+        if providers is None:
+            providers = MessageVars.getProviders(msgrequest)
+        for provider_name, provider in providers:
+            context[provider_name] = ActionHandler(provider, user)
         context['request'] = ActionHandler(msgrequest, user) # add the request so the public url is accessible
         context['EMAIL_HOST_SENDER'] = settings.EMAIL_HOST_SENDER # add the host address
         return Context(context)
@@ -637,6 +691,33 @@ class Meta:
         ordering=('original',)
 
 
+@python_2_unicode_compatible
+class MailingListChange(models.Model):
+    """
+    A pending change to the membership of a Mailman list.
+
+    These are queued by esp.mailman.queue_list_changes() and applied in
+    batches by esp.mailman.process_queued_list_changes(), which dbmail_cron.py
+    runs, so that web requests don't have to wait on Mailman.
+    """
+
+    ADD = 'add'
+    REMOVE = 'remove'
+    ACTION_CHOICES = ((ADD, 'add'), (REMOVE, 'remove'))
+
+    list_name = models.CharField(max_length=256, db_index=True)
+    action = models.CharField(max_length=16, choices=ACTION_CHOICES)
+    email = models.CharField(max_length=256, help_text='The bare email address, used to match up changes for the same member')
+    address = models.CharField(max_length=512, help_text='The address to subscribe, possibly including a real name')
+    created_at = models.DateTimeField(auto_now_add=True, editable=False)
+
+    class Meta:
+        ordering = ('id',)
+
+    def __str__(self):
+        return '%s %s on %s' % (self.action, self.email, self.list_name)
+
+
 # Adapted from http://www.djangosnippets.org/snippets/735/
 class CustomSMTPBackend(SMTPEmailBackend):
     """ Simple override of Django's default backend to allow a Return-Path to be specified """
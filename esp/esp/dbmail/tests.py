@@ -0,0 +1,198 @@
+from esp.dbmail import cronmail
+from esp.dbmail.cronmail import TokenBucket, send_email_requests
+from esp.dbmail.models import EmailRequest, MessageRequest, MessageVars, TextOfEmail
+from esp.tests.util import CacheFlushTestCase as TestCase
+from esp.users.models import ESPUser, PersistentQueryFilter
+
+from django.db.models import Q
+from django.test.utils import override_settings
+
+from datetime import datetime
+from unittest import mock
+import threading
+import time
+
+class TokenBucketTest(TestCase):
+    def test_burst(self):
+        #   A full bucket hands out its capacity without waiting.
+        bucket = TokenBucket(rate=1, capacity=5)
+        start = time.time()
+        for i in range(5):
+            bucket.consume()
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_rate(self):
+        #   After that, tokens come at the given rate.
+        bucket = TokenBucket(rate=20, capacity=1)
+        bucket.consume()
+        start = time.time()
+        for i in range(10):
+            bucket.consume()
+        self.assertGreaterEqual(time.time() - start, 0.45)
+
+    def test_threads(self):
+        #   Several threads share the same rate.
+        bucket = TokenBucket(rate=20, capacity=1)
+        bucket.consume()
+        def consume():
+            for i in range(5):
+                bucket.consume()
+        threads = [threading.Thread(target=consume) for i in range(4)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.time() - start, 0.95)
+
+
+class Crash(Exception):
+    """ Stands in for the cron process dying partway through a batch. """
+
+
+@override_settings(EMAIL_SEND_RATE=1000, EMAIL_SEND_WORKERS=3, EMAILRETRIES=2)
+class SendEmailRequestsTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = ESPUser.objects.create(username='cronmail_test', email='cronmail_test@learningu.org')
+        recipients = PersistentQueryFilter.create_from_Q(ESPUser, Q(id=self.user.id), 'cronmail test')
+        request = MessageRequest.objects.create(subject='Test', msgtext='Test body', recipients=recipients,
+                                                sender='info@learningu.org', creator=self.user,
+                                                created_at=datetime.now(), processed=True)
+        self.texts = [TextOfEmail.objects.create(messagerequest=request, user=self.user,
+                                                 send_to='student%d@learningu.org' % i, send_from='info@learningu.org',
+                                                 subject='Test', msgtext='Test body', created_at=datetime.now())
+                      for i in range(10)]
+        self.failing = self.texts[0]
+        self.delivered = []
+        self.lock = threading.Lock()
+
+    def fake_send_mail(self, subject, message, from_email, recipient_list, *args, **kwargs):
+        if recipient_list == self.failing.send_to:
+            raise IOError('Mailbox unavailable')
+        with self.lock:
+            self.delivered.append(recipient_list)
+
+    def refresh(self, text):
+        return TextOfEmail.objects.get(id=text.id)
+
+    def test_failure_and_retry(self):
+        with mock.patch('esp.dbmail.models.send_mail', self.fake_send_mail), \
+             mock.patch('esp.dbmail.cronmail.send_mail') as report:
+            send_email_requests()
+
+            #   Everything else was sent once, and recorded as such.
+            self.assertEqual(sorted(self.delivered), sorted(text.send_to for text in self.texts[1:]))
+            for text in self.texts[1:]:
+                text = self.refresh(text)
+                self.assertIsNotNone(text.sent)
+                self.assertEqual(text.msgtext, '')
+                self.assertEqual(text.tries, 0)
+
+            #   The failure was counted, and reported.
+            failing = self.refresh(self.failing)
+            self.assertIsNone(failing.sent)
+            self.assertEqual(failing.tries, 1)
+            self.assertEqual(failing.msgtext, 'Test body')
+            self.assertEqual(report.call_count, 1)
+
+            #   Each later run retries only the failure, until it runs out of
+            #   retries.
+            for tries in [2, 3, 3]:
+                self.delivered = []
+                send_email_requests()
+                self.assertEqual(self.delivered, [])
+                self.assertEqual(self.refresh(self.failing).tries, tries)
+
+    def test_interrupted(self):
+        #   If the process dies partway through, what was already sent has
+        #   been recorded, and little else was sent that wasn't.
+        saved = []
+        original_record_results = cronmail._record_results
+        def record_results(results):
+            if len(saved) >= 3:
+                raise Crash()
+            original_record_results(results)
+            saved.extend(mailtxt.id for (mailtxt, exception) in results)
+
+        self.failing = TextOfEmail()
+        with mock.patch('esp.dbmail.models.send_mail', self.fake_send_mail), \
+             mock.patch.object(cronmail, '_record_results', record_results):
+            self.assertRaises(Crash, send_email_requests)
+
+        sent = TextOfEmail.objects.filter(sent__isnull=False)
+        self.assertEqual(set(sent.values_list('id', flat=True)), set(saved))
+        #   At most one message per worker is in flight at any time.
+        self.assertLessEqual(len(self.delivered), len(saved) + 3)
+
+        #   The next run sends the rest, and nothing twice more than that.
+        self.delivered = []
+        with mock.patch('esp.dbmail.models.send_mail', self.fake_send_mail):
+            send_email_requests()
+        self.assertFalse(TextOfEmail.objects.filter(sent__isnull=True).exists())
+        self.assertEqual(len(self.delivered), len(self.texts) - len(saved))
+
+    def test_worker_results_arrive_as_sent(self):
+        #   _send_batch hands back results as soon as they're ready, rather
+        #   than waiting for the whole batch.
+        bucket = TokenBucket(1000, 1)
+        release = threading.Event()
+        def slow_send_mail(subject, message, from_email, recipient_list, *args, **kwargs):
+            if recipient_list != self.texts[0].send_to:
+                release.wait(10)
+        with mock.patch('esp.dbmail.models.send_mail', slow_send_mail):
+            results = cronmail._send_batch(self.texts[:3], {}, 3, bucket)
+            [(mailtxt, exception)] = next(results)
+            self.assertEqual(mailtxt.id, self.texts[0].id)
+            self.assertIsNone(exception)
+            release.set()
+            self.assertEqual(sum(len(done) for done in results), 2)
+
+    def test_results_recorded_in_bulk(self):
+        #   Each group of results is recorded with an UPDATE for the sent
+        #   messages and one for the failures, not a save() per message.
+        with mock.patch('esp.dbmail.models.send_mail', self.fake_send_mail), \
+             mock.patch('esp.dbmail.cronmail.send_mail'), \
+             mock.patch.object(TextOfEmail, 'save') as save:
+            send_email_requests()
+        self.assertFalse(save.called)
+        self.assertEqual(TextOfEmail.objects.filter(sent__isnull=False, msgtext='').count(), len(self.texts) - 1)
+        self.assertEqual(self.refresh(self.failing).tries, 1)
+
+
+class ProcessMessageRequestTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = [ESPUser.objects.create(username='process_test%d' % i, email='process_test%d@learningu.org' % i)
+                      for i in range(7)]
+        recipients = PersistentQueryFilter.create_from_Q(ESPUser, Q(username__startswith='process_test'), 'process test')
+        self.request = MessageRequest.objects.create(subject='Test', msgtext='Test body', recipients=recipients,
+                                                     sender='info@learningu.org', creator=self.users[0],
+                                                     created_at=datetime.now())
+
+    def test_resume(self):
+        #   Fall over partway through the second chunk of three.
+        original_get_context = MessageVars.getContext
+        def get_context(msgrequest, user, providers=None):
+            if user == self.users[4]:
+                raise Crash()
+            return original_get_context(msgrequest, user, providers=providers)
+        with mock.patch.object(MessageVars, 'getContext', staticmethod(get_context)):
+            self.assertRaises(Crash, self.request.process, chunk_size=3)
+
+        #   Only the first chunk was kept.
+        request = MessageRequest.objects.get(id=self.request.id)
+        self.assertFalse(request.processed)
+        self.assertEqual(request.processed_through, self.users[2].id)
+        self.assertEqual(sorted(TextOfEmail.objects.values_list('user', flat=True)), [user.id for user in self.users[:3]])
+
+        #   Processing again picks up where that left off, so everyone gets
+        #   exactly one email.
+        request.process(chunk_size=3)
+        request = MessageRequest.objects.get(id=self.request.id)
+        self.assertTrue(request.processed)
+        self.assertEqual(request.processed_through, self.users[-1].id)
+        self.assertEqual(sorted(TextOfEmail.objects.values_list('user', flat=True)), [user.id for user in self.users])
+        self.assertEqual(sorted(EmailRequest.objects.values_list('target', flat=True)), [user.id for user in self.users])
+        for text in TextOfEmail.objects.all():
+            self.assertIn(text.user.email, text.send_to)
@@ -1,5 +1,9 @@
 
 import os
+import logging
+logger = logging.getLogger(__name__)
+from collections import OrderedDict
+from email.utils import parseaddr
 from subprocess import call, Popen, PIPE
 from django.conf import settings
 from esp.utils.decorators import enable_with_setting
@@ -16,6 +20,22 @@
     MAILMAN_PASSWORD = ''
     MM_PATH = "/usr/sbin/"
 
+class MailmanError(Exception):
+    """ A Mailman script exited with an error status. """
+    def __init__(self, script, returncode, stderr):
+        super().__init__('%s exited with status %d: %s' % (script, returncode, stderr.decode('iso-8859-1', 'replace').strip()))
+        self.returncode = returncode
+        self.stderr = stderr
+
+def _run_script(args, data, check=False):
+    """ Run a Mailman script with data on its stdin, and return its
+    (stdout, stderr).  If check is set, raise MailmanError if it fails. """
+    process = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    (out, err) = process.communicate(data)
+    if check and process.returncode:
+        raise MailmanError(os.path.basename(args[0]), process.returncode, err)
+    return (out, err)
+
 ## Functions for Mailman interop
 
 @enable_with_setting(settings.USE_MAILMAN)
@@ -123,10 +143,11 @@ def add_list_member(list_name, member):
 
 
 @enable_with_setting(settings.USE_MAILMAN)
-def add_list_members(list_name, members):
+def add_list_members(list_name, members, check=False):
     """Add email addresses to the local Mailman mailing list 'list_name'.
 
     'members' is an iterable of email address strings or ESPUser objects.
+    If 'check' is set, raise MailmanError if Mailman reports a failure.
     """
     members = [x.get_email_sendto_address() if isinstance(x, User) else str(x) for x in members]
 
@@ -139,15 +160,16 @@ def add_list_members(list_name, members):
     # for which it doesn't matter much if we lose a few chars
     members = members.encode('iso-8859-1', 'replace')
 
-    return Popen([MM_PATH + "add_members", "--regular-members-file=-", list_name], stdin=PIPE, stdout=PIPE, stderr=PIPE).communicate(members)
+    return _run_script([MM_PATH + "add_members", "--regular-members-file=-", list_name], members, check)
 
 @enable_with_setting(settings.USE_MAILMAN)
-def remove_list_member(list, member):
+def remove_list_member(list, member, check=False):
     """
     Remove the email address 'member' from the local Mailman mailing list 'list'
 
     "member" may be a list (or other iterable) of email address strings,
-    in which case all addresses will be removed.
+    in which case all addresses will be removed.  If 'check' is set, raise
+    MailmanError if Mailman reports a failure.
     """
     if isinstance(member, User):
         member = member.email
@@ -161,7 +183,78 @@ def remove_list_member(list, member):
     if isinstance(member, str):
         member = member.encode('iso-8859-1', 'replace')
 
-    return Popen([MM_PATH + "remove_members", "--nouserack", "--noadminack", "--file=-", list], stdin=PIPE, stdout=PIPE, stderr=PIPE).communicate(member)
+    return _run_script([MM_PATH + "remove_members", "--nouserack", "--noadminack", "--file=-", list], member, check)
+
+def _member_addresses(member):
+    """ Return (bare email, address to subscribe) for a User or address string. """
+    if isinstance(member, User):
+        return (member.email, member.get_email_sendto_address())
+    member = str(member)
+    return (parseaddr(member)[1] or member, member)
+
+@enable_with_setting(settings.USE_MAILMAN)
+def queue_list_changes(adds=(), removes=()):
+    """
+    Queue changes to Mailman list memberships, to be applied later by
+    process_queued_list_changes() (which dbmail_cron.py runs).
+
+    'adds' and 'removes' are iterables of (list name, member) pairs, where
+    each member may be a User object or an email address.  This costs a
+    single INSERT, so unlike add_list_member() and remove_list_member() it is
+    fine to call while handling a request.
+    """
+    from esp.dbmail.models import MailingListChange
+
+    changes = []
+    for action, pairs in ((MailingListChange.ADD, adds), (MailingListChange.REMOVE, removes)):
+        for list_name, member in pairs:
+            email, address = _member_addresses(member)
+            changes.append(MailingListChange(list_name=list_name, action=action, email=email, address=address))
+    MailingListChange.objects.bulk_create(changes)
+    return len(changes)
+
+@enable_with_setting(settings.USE_MAILMAN)
+def process_queued_list_changes():
+    """
+    Apply the list membership changes queued by queue_list_changes().
+
+    Changes are grouped by list so that each list gets at most one
+    add_members and one remove_members run.  Only the latest change for each
+    address counts, so adding and then removing someone just removes them.
+    Changes are deleted once Mailman has been run for their list; if it
+    can't be run, or exits with an error, they stay queued for the next run.
+
+    Callers (e.g. dbmail_cron.py) should ensure that this function is not
+    called in more than one thread simultaneously.
+    """
+    from esp.dbmail.models import MailingListChange
+
+    changes_by_list = OrderedDict()
+    for change in MailingListChange.objects.order_by('id'):
+        changes_by_list.setdefault(change.list_name, []).append(change)
+
+    num_processed = 0
+    for list_name, changes in changes_by_list.items():
+        latest = OrderedDict()
+        for change in changes:
+            latest.pop(change.email.lower(), None)
+            latest[change.email.lower()] = change
+        adds = [c.address for c in latest.values() if c.action == MailingListChange.ADD]
+        removes = [c.email for c in latest.values() if c.action == MailingListChange.REMOVE]
+        try:
+            if adds:
+                add_list_members(list_name, adds, check=True)
+            if removes:
+                remove_list_member(list_name, removes, check=True)
+        except (OSError, MailmanError):
+            logger.exception('Could not update Mailman list %s; will retry', list_name)
+            continue
+        MailingListChange.objects.filter(id__in=[c.id for c in changes]).delete()
+        num_processed += len(changes)
+
+    if num_processed:
+        logger.info('Applied %d queued mailing list changes', num_processed)
+    return num_processed
 
 @enable_with_setting(settings.USE_MAILMAN)
 def list_contents(lst):
@@ -0,0 +1,111 @@
+from esp.dbmail.models import MailingListChange
+from esp.tests.util import CacheFlushTestCase as TestCase
+from esp.users.models import ESPUser
+import esp.mailman
+
+from django.test.utils import override_settings
+
+from importlib import reload
+from unittest import mock
+
+class MailingListChangeTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        #   The Mailman functions are no-ops unless USE_MAILMAN was set when
+        #   esp.mailman was imported, so import it again with it set.
+        with override_settings(USE_MAILMAN=True, MAILMAN_PATH='/mailman/', MAILMAN_PASSWORD=''):
+            self.mailman = reload(esp.mailman)
+        self.addCleanup(reload, esp.mailman)
+
+        #   Stand in for Mailman's scripts, recording how they were run.
+        self.runs = []
+        self.failing_lists = set()
+        self.erroring_lists = set()
+        def fake_popen(args, **kwargs):
+            if args[-1] in self.failing_lists:
+                raise OSError('Mailman is not installed')
+            process = mock.Mock()
+            process.returncode = 1 if args[-1] in self.erroring_lists else 0
+            def communicate(data=b''):
+                self.runs.append((args[0].replace('/mailman/', ''), args[-1], data.decode('iso-8859-1').split('\n')))
+                if process.returncode:
+                    return (b'', b'No such list: ' + args[-1].encode())
+                return (b'', b'')
+            process.communicate.side_effect = communicate
+            return process
+        patcher = mock.patch.object(self.mailman, 'Popen', fake_popen)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.user = ESPUser.objects.create(username='mailman_test', first_name='Mailman', last_name='Test', email='mailman_test@learningu.org')
+
+    def test_queue(self):
+        #   Queueing doesn't run Mailman, and records both the bare address and
+        #   the one to subscribe.
+        self.assertEqual(self.mailman.queue_list_changes(adds=[('a', self.user), ('b', 'other@learningu.org')],
+                                                         removes=[('a', 'Someone <someone@learningu.org>')]), 3)
+        self.assertEqual(self.runs, [])
+        changes = list(MailingListChange.objects.values_list('list_name', 'action', 'email', 'address'))
+        self.assertEqual(changes, [
+            ('a', MailingListChange.ADD, self.user.email, self.user.get_email_sendto_address()),
+            ('b', MailingListChange.ADD, 'other@learningu.org', 'other@learningu.org'),
+            ('a', MailingListChange.REMOVE, 'someone@learningu.org', 'Someone <someone@learningu.org>'),
+        ])
+
+    def test_add_then_remove(self):
+        #   Only the latest change for an address counts, whatever its case,
+        #   so an add that was later undone is never sent to Mailman.
+        self.mailman.queue_list_changes(adds=[('a', self.user)])
+        self.mailman.queue_list_changes(removes=[('a', self.user.email.upper())])
+        self.assertEqual(self.mailman.process_queued_list_changes(), 2)
+        self.assertEqual(self.runs, [('remove_members', 'a', [self.user.email.upper()])])
+        self.assertFalse(MailingListChange.objects.exists())
+
+        #   ... and the other way around.
+        self.runs = []
+        self.mailman.queue_list_changes(removes=[('a', self.user)])
+        self.mailman.queue_list_changes(adds=[('a', self.user)])
+        self.mailman.process_queued_list_changes()
+        self.assertEqual(self.runs, [('add_members', 'a', [self.user.get_email_sendto_address()])])
+
+    def test_ordering(self):
+        #   Each list is updated with one run per action, in the order the
+        #   lists were first queued.
+        self.mailman.queue_list_changes(adds=[('b', 'one@learningu.org'), ('a', 'two@learningu.org')])
+        self.mailman.queue_list_changes(adds=[('b', 'three@learningu.org')], removes=[('a', 'four@learningu.org')])
+        self.assertEqual(self.mailman.process_queued_list_changes(), 4)
+        self.assertEqual(self.runs, [
+            ('add_members', 'b', ['one@learningu.org', 'three@learningu.org']),
+            ('add_members', 'a', ['two@learningu.org']),
+            ('remove_members', 'a', ['four@learningu.org']),
+        ])
+
+    def test_failure(self):
+        #   If Mailman can't be run for a list, its changes stay queued, and
+        #   other lists still get theirs.
+        self.mailman.queue_list_changes(adds=[('a', 'one@learningu.org'), ('b', 'two@learningu.org')])
+        self.failing_lists = {'a'}
+        self.assertEqual(self.mailman.process_queued_list_changes(), 1)
+        self.assertEqual(self.runs, [('add_members', 'b', ['two@learningu.org'])])
+        self.assertEqual(list(MailingListChange.objects.values_list('list_name', 'email')), [('a', 'one@learningu.org')])
+
+        #   The next run picks them up.
+        self.failing_lists = set()
+        self.runs = []
+        self.assertEqual(self.mailman.process_queued_list_changes(), 1)
+        self.assertEqual(self.runs, [('add_members', 'a', ['one@learningu.org'])])
+        self.assertFalse(MailingListChange.objects.exists())
+
+    def test_error_status(self):
+        #   If Mailman runs but exits with an error, the changes stay queued
+        #   too, and what it said is logged.
+        self.mailman.queue_list_changes(adds=[('a', 'one@learningu.org'), ('b', 'two@learningu.org')])
+        self.erroring_lists = {'a'}
+        with self.assertLogs('esp.mailman', 'ERROR') as logs:
+            self.assertEqual(self.mailman.process_queued_list_changes(), 1)
+        self.assertIn('No such list: a', '\n'.join(logs.output))
+        self.assertEqual(list(MailingListChange.objects.values_list('list_name', 'email')), [('a', 'one@learningu.org')])
+
+        #   Callers that don't ask for a check still just get the output.
+        self.assertEqual(self.mailman.add_list_members('a', ['three@learningu.org']), (b'', b'No such list: a'))
+        self.assertRaises(self.mailman.MailmanError, self.mailman.add_list_members, 'a', ['three@learningu.org'], check=True)
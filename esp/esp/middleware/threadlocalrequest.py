@@ -7,6 +7,8 @@
 _threading_local = threading.local()
 
 from django.template import Context, RequestContext
+
+from esp.utils import request_cache
 try:
     from django.utils.deprecation import MiddlewareMixin
 except ImportError:
@@ -40,6 +42,17 @@ class ThreadLocals(MiddlewareMixin):
     """
     Middleware that gets various objects from the
     request object and saves them in thread local storage.
+
+    It also keeps a memo of cache reads for the length of the request;
+    see esp.utils.request_cache.
     """
     def process_request(self, request):
         _threading_local.request = request
+        request_cache.start()
+
+    def process_response(self, request, response):
+        memo = request_cache.end()
+        if memo is not None:
+            logger.debug("Request cache for %s: %d hits, %d misses",
+                         request.path, memo.hits, memo.misses)
+        return response
@@ -0,0 +1,187 @@
+
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of the ESP Web Site
+Copyright (c) 2026 by the individual contributors
+  (see AUTHORS file)
+
+The ESP Web Site is free software; you can redistribute it and/or
+modify it under the terms of the GNU Affero General Public License
+as published by the Free Software Foundation; either version 3
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Contact information:
+MIT Educational Studies Program
+  84 Massachusetts Ave W20-467, Cambridge, MA 02139
+  Phone: 617-253-4882
+  Email: esp-webmasters@mit.edu
+Learning Unlimited, Inc.
+  527 Franklin St, Cambridge, MA 02139
+  Phone: 617-379-0178
+  Email: web-team@learningu.org
+"""
+"""
+Full-text search over the class archive (ArchiveClass).
+
+On PostgreSQL, each archive class stores a weighted tsvector of its title,
+teacher, category, program, year and description in search_vector, which is
+kept up to date when it is saved and covered by a GIN index.  Searches are
+tsquery matches against it, ranked with ts_rank.
+
+Other databases (such as SQLite) can't do that, so there the same searches
+are answered from an inverted index of the archive built in-process.
+"""
+
+import bisect
+import re
+import threading
+from collections import defaultdict
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connection
+from django.db.models import Case, F, FloatField, Value, When
+
+SEARCH_CONFIG = 'english'
+
+#   The fields that are searched, and their weight in the search vector.
+FIELD_WEIGHTS = [
+    ('title', 'A'),
+    ('teacher', 'B'),
+    ('category', 'C'),
+    ('program', 'C'),
+    ('year', 'C'),
+    ('description', 'D'),
+]
+
+#   How much a match in a field of each weight adds to the rank in the
+#   fallback index; these are ts_rank()'s default weights.
+RANK_WEIGHTS = {'A': 1.0, 'B': 0.4, 'C': 0.2, 'D': 0.1}
+
+def use_postgres():
+    return connection.vendor == 'postgresql'
+
+def tokenize(text):
+    """ Split text into lowercase words, for matching against the index. """
+    return re.findall(r'[^\W_]+', str(text).lower())
+
+def search_vector():
+    """ An expression for the search vector of an archive class. """
+    vector = None
+    for field, weight in FIELD_WEIGHTS:
+        part = SearchVector(field, weight=weight, config=SEARCH_CONFIG)
+        vector = part if vector is None else vector + part
+    return vector
+
+def update_search_vectors(queryset):
+    """ Bring the search index up to date with the archive classes in
+    queryset, which have been created or changed. """
+    if use_postgres():
+        queryset.update(search_vector=search_vector())
+    else:
+        InvertedIndex.reset()
+
+def search(queryset, queries):
+    """
+    Filter queryset to the archive classes matching all of queries, and
+    annotate each with its relevance as `rank`.
+
+    queries is a list of (text, fields) pairs; each word of text must be
+    the start of a word in one of fields (or in any searched field, if
+    fields is None).
+    """
+    terms = []
+    for text, fields in queries:
+        terms += [(word, fields) for word in tokenize(text)]
+    if not terms:
+        return queryset.annotate(rank=Value(0.0, output_field=FloatField()))
+
+    if use_postgres():
+        #   Words are reduced to letters and digits by tokenize(), so they
+        #   are safe to put in a raw tsquery.
+        weight_labels = dict(FIELD_WEIGHTS)
+        parts = []
+        for word, fields in terms:
+            weights = ''
+            if fields is not None:
+                weights = ''.join(sorted({weight_labels[field] for field in fields}))
+            parts.append('%s:*%s' % (word, weights))
+        query = SearchQuery(' & '.join(parts), config=SEARCH_CONFIG, search_type='raw')
+        return queryset.filter(search_vector=query).annotate(rank=SearchRank(F('search_vector'), query))
+
+    ranks = InvertedIndex.get().search(terms)
+    if not ranks:
+        return queryset.none().annotate(rank=Value(0.0, output_field=FloatField()))
+    rank = Case(*[When(id=id, then=Value(rank)) for (id, rank) in ranks.items()], default=Value(0.0), output_field=FloatField())
+    return queryset.filter(id__in=list(ranks)).annotate(rank=rank)
+
+class InvertedIndex(object):
+    """
+    An in-process stand-in for the search vectors and their GIN index, for
+    databases other than PostgreSQL: maps each word in the archive to the
+    archive classes it appears in, and the fields it appears in there.
+
+    One index is shared by the whole process, and is rebuilt the next time
+    it's needed after an archive class is saved or deleted.
+    """
+    _lock = threading.Lock()
+    _current = None
+
+    def __init__(self, rows):
+        self.postings = defaultdict(dict)
+        for row in rows:
+            for field, weight in FIELD_WEIGHTS:
+                for word in tokenize(row[field]):
+                    self.postings[word].setdefault(row['id'], set()).add(field)
+        self.words = sorted(self.postings)
+
+    @classmethod
+    def get(cls):
+        from esp.program.models import ArchiveClass
+        with cls._lock:
+            if cls._current is None:
+                fields = [field for (field, weight) in FIELD_WEIGHTS]
+                cls._current = cls(ArchiveClass.objects.values('id', *fields).iterator())
+            return cls._current
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._current = None
+
+    def matches(self, prefix, fields=None):
+        """ Map the id of each archive class with a word starting with
+        prefix in one of fields to the rank that match is worth. """
+        weights = dict(FIELD_WEIGHTS)
+        result = {}
+        i = bisect.bisect_left(self.words, prefix)
+        while i < len(self.words) and self.words[i].startswith(prefix):
+            for id, word_fields in self.postings[self.words[i]].items():
+                rank = sum(RANK_WEIGHTS[weights[field]] for field in word_fields if fields is None or field in fields)
+                if rank > result.get(id, 0):
+                    result[id] = rank
+            i += 1
+        return result
+
+    def search(self, terms):
+        """ Map the id of each archive class matching all of terms, a list
+        of (prefix, fields) pairs, to its rank. """
+        ranks = None
+        for prefix, fields in terms:
+            matches = self.matches(prefix, fields)
+            if ranks is None:
+                ranks = matches
+            else:
+                ranks = {id: ranks[id] + rank for (id, rank) in matches.items() if id in ranks}
+        return ranks or {}
@@ -699,8 +699,13 @@ def save_assignments(self):
             self.changed[student_ind] = True
 
     def unsave_assignments(self):
-        StudentRegistration.objects.filter(end_date__gte=self.now, end_date__lte=datetime(9000, 1, 1)).update(end_date=None)
-        StudentRegistration.objects.filter(start_date__gte=self.now).delete()
+        registrations = StudentRegistration.objects.filter(section__parent_class__parent_program=self.program)
+        expired = registrations.filter(end_date__gte=self.now, end_date__lte=datetime(9000, 1, 1))
+        unexpired = list(expired)
+        expired.update(end_date=None)
+        registrations.filter(start_date__gte=self.now).delete()
+        #   update() doesn't send signals, so expire the program's registration caches in one go.
+        StudentRegistration.invalidate_caches(unexpired)
 
     def send_student_email(self, student_ind, changed = True, for_real = False, f = None):
         student = self.students[student_ind]
@@ -54,12 +54,30 @@
 from django.conf import settings
 from django.db import transaction
 from django.db.models import Min
+import functools
+import json
+import multiprocessing
 import os
 import operator
+import struct
 import zlib
 import base64
 from io import BytesIO
 
+#   Exported assignments in the binary format start with this prefix (after
+#   base64 decoding), followed by a version byte; the original text format is
+#   plain zlib data, which can't start with it.
+EXPORT_MAGIC = b'ESPLOT'
+EXPORT_VERSION = 2
+
+#   The controller whose seeds are being run by a pool of worker processes.  The
+#   workers are forked, so they share its initialized arrays with the parent
+#   process (copy-on-write) instead of receiving pickled copies of them.
+_seed_controller = None
+
+def _run_lottery_seed(seed, check_result=True):
+    return (seed, _seed_controller.run_seed(seed, check_result))
+
 class LotteryException(Exception):
     """ Top level exception class for lottery related problems.  """
     pass
@@ -87,7 +105,15 @@ class LotteryAssignmentController(object):
         'use_student_apps': (False, 'Whether to use student application ranks'),
         'fill_low_priorities': (False, 'Whether to push students who have interested classes marked but no priority, to priority'),
         'max_timeslots': (0, 'The maximum number of timeslots for which a student should be enrolled (0 means no limit)'),
-        'max_sections': (0, 'The maximum number of sections in which a student should be enrolled (0 means no limit)')
+        'max_sections': (0, 'The maximum number of sections in which a student should be enrolled (0 means no limit)'),
+        'sparse': (False, 'Whether to use the sparse lottery engine, which needs much less memory for large programs'),
+        'num_runs': (1, 'Number of lottery runs to try with different random seeds; the best run is kept'),
+        'objective': ('overall_utility', 'Statistic to maximize when choosing the best run (e.g. overall_utility, overall_interest_ratio, num_registrations)'),
+        'seed': (None, 'Random seed for the first run (None to pick one from the clock); run k uses this seed plus k'),
+        #   Forking from a threaded web server process isn't safe, so runs stay
+        #   in this process unless this is set (0 means one per CPU), e.g. by
+        #   the run_lottery management command.
+        'processes': (1, False),
     }
 
     def __init__(self, program, **kwargs):
@@ -132,7 +158,13 @@ def __init__(self, program, **kwargs):
         self.options.update(kwargs)
 
         self.now = datetime.now()
-        numpy.random.seed(self.now.microsecond)
+        self.initial_seed = self.now.microsecond if self.options['seed'] is None else int(self.options['seed'])
+        numpy.random.seed(self.initial_seed)
+        #   The seed used for the current assignments (if known), and the (seed, score) of each run
+        self.seed = None
+        self.seed_scores = []
+        #   The options that produced assignments loaded with import_assignments(), if known
+        self.imported_options = {}
 
         self.initialize()
 
@@ -178,43 +210,54 @@ def clear_assignments(self):
         self.student_weights = numpy.ones((self.num_students,))
         self.student_utilities = numpy.zeros((self.num_students, ), dtype=numpy.float)
 
+    def get_pref_indices(self, prefs):
+        """ Helper function for self.initialize_preferences().
+
+        Given ValuesListQuerySet of preferences (student, section), return a tuple of arrays (student indices, section indices) for them, or None if there are no preferences.  Check that all values in question are valid.
+
+        prefs should be a ValuesListQuerySet of tuples (user, section), such as that generated by StudentRegistration.objects.filter(...).values_list('user__id', 'section__id').distinct()."""
+        if not prefs.exists():
+            return None
+
+        pref_array = numpy.array(prefs, dtype=numpy.uint32)
+        student_ixs = self.student_indices[pref_array[:, 0]]
+        section_ixs = self.section_indices[pref_array[:, 1]]
+
+        #   - Missing student (this should never happen and would indicate an error in the code)
+        assert numpy.min(student_ixs)>=0, "Got a preference for a student who doesn't exist!"
+
+        #   - Missing section (this can happen due to factors outside the code's control)
+        if numpy.min(section_ixs) < 0:
+            #   Try to diagnose what is wrong with the sections we are not tracking
+            bad_section_id = pref_array[numpy.nonzero(section_ixs < 0)[0][0], 1]
+            #   Use .get(), since all class sections should be present in the database.
+            #   (If any does not exist, that is a problem with the code and should cause
+            #   a server error.)
+            bad_section = ClassSection.objects.get(id=bad_section_id)
+            if bad_section.status <= 0:
+                raise LotterySectionException(bad_section, 'is not approved.')
+            elif bad_section.registration_status != 0:
+                raise LotterySectionException(bad_section, 'is not open to registration.')
+            elif not bad_section.meeting_times.exists():
+                raise LotterySectionException(bad_section, 'is not scheduled.')
+            elif bad_section.parent_class.status <= 0:
+                raise LotterySubjectException(bad_section.parent_class, 'is not approved.')
+            elif bad_section.parent_class.parent_program != self.program:
+                raise LotterySubjectException(bad_section.parent_class, 'does not belong to the right program.')
+            else:
+                raise LotterySectionException(bad_section, 'is not associated with the lottery (unknown reason).')
+
+        return (student_ixs, section_ixs)
+
     def put_prefs_in_array(self, prefs, array):
-        """ Helper function for self.initialize().
+        """ Helper function for self.initialize_preferences().
 
-        Given ValuesListQuerySet of preferences (student, section) and a students-by-sections array (likely self.interest or self.priority[i]), set the entries of the array corresponding to the preferences True.  Check that all values in question are valid.
+        Given ValuesListQuerySet of preferences (student, section) and a students-by-sections array (likely self.interest or self.priority[i]), set the entries of the array corresponding to the preferences True.
 
-        prefs should be a ValuesListQuerySet of tuples (user, section), such as that generated by StudentRegistration.objects.filter(...).values_list('user__id', 'section__id').distinct().
         array should be a boolean array of dimension self.num_students by self.num_sections, such as self.interest or self.priority[i]."""
-        if prefs.exists():
-            pref_array = numpy.array(prefs, dtype=numpy.uint32)
-            student_ixs = self.student_indices[pref_array[:, 0]]
-            section_ixs = self.section_indices[pref_array[:, 1]]
-
-            #   - Missing student (this should never happen and would indicate an error in the code)
-            assert numpy.min(student_ixs)>=0, "Got a preference for a student who doesn't exist!"
-
-            #   - Missing section (this can happen due to factors outside the code's control)
-            if numpy.min(section_ixs) < 0:
-                #   Try to diagnose what is wrong with the sections we are not tracking
-                bad_section_id = pref_array[numpy.nonzero(section_ixs < 0)[0][0], 1]
-                #   Use .get(), since all class sections should be present in the database.
-                #   (If any does not exist, that is a problem with the code and should cause
-                #   a server error.)
-                bad_section = ClassSection.objects.get(id=bad_section_id)
-                if bad_section.status <= 0:
-                    raise LotterySectionException(bad_section, 'is not approved.')
-                elif bad_section.registration_status != 0:
-                    raise LotterySectionException(bad_section, 'is not open to registration.')
-                elif not bad_section.meeting_times.exists():
-                    raise LotterySectionException(bad_section, 'is not scheduled.')
-                elif bad_section.parent_class.status <= 0:
-                    raise LotterySubjectException(bad_section.parent_class, 'is not approved.')
-                elif bad_section.parent_class.parent_program != self.program:
-                    raise LotterySubjectException(bad_section.parent_class, 'does not belong to the right program.')
-                else:
-                    raise LotterySectionException(bad_section, 'is not associated with the lottery (unknown reason).')
-
-            array[student_ixs, section_ixs] = True
+        indices = self.get_pref_indices(prefs)
+        if indices is not None:
+            array[indices] = True
 
     def initialize(self):
         """ Gather all of the information needed to run the lottery assignment.
@@ -224,13 +267,9 @@ def initialize(self):
             -   Timeslots (incl. lunch periods for each day)
         """
 
-        self.interest = numpy.zeros((self.num_students, self.num_sections), dtype=numpy.bool)
-        self.priority = [numpy.zeros((self.num_students, self.num_sections), dtype=numpy.bool) for i in range(self.effective_priority_limit+1)]
-        self.ranks = 10*numpy.ones((self.num_students, self.num_sections), dtype=numpy.int32)
         self.section_schedules = numpy.zeros((self.num_sections, self.num_timeslots), dtype=numpy.bool)
         self.section_start_schedules = numpy.zeros((self.num_sections, self.num_timeslots), dtype=numpy.bool)
         self.section_capacities = numpy.zeros((self.num_sections,), dtype=numpy.uint32)
-        self.section_overlap = numpy.zeros((self.num_sections, self.num_sections), dtype=numpy.bool)
 
         # One array to keep track of the utility of each student
         # (defined as hours of interested class + 1.5*hours of priority classes)
@@ -262,28 +301,8 @@ def initialize(self):
             self.lunch_schedule[self.timeslot_indices[ts.id]] = True
         self.lunch_timeslots = numpy.array(lunch_by_day)
 
-        #   Populate interest matrix; this uses both the StudentRegistrations (which apply to a particular section) and StudentSubjectIntegests (which apply to all sections of the class).  If one does not exist, ignore it.  Be careful to only return SRs and SSIs for accepted sections of accepted classes; this might matter for SSIs where only some sections of the class are accepted.
-        interest_regs_sr = StudentRegistration.valid_objects().filter(section__parent_class__parent_program=self.program, section__status__gt=0, section__parent_class__status__gt=0, section__registration_status=0, section__meeting_times__isnull=False, relationship__name='Interested').values_list('user__id', 'section__id').distinct()
-        interest_regs_ssi = StudentSubjectInterest.valid_objects().filter(subject__parent_program=self.program, subject__status__gt=0, subject__sections__status__gt=0, subject__sections__registration_status=0, subject__sections__meeting_times__isnull=False).values_list('user__id', 'subject__sections__id').distinct()
-        self.put_prefs_in_array(interest_regs_sr, self.interest)
-        self.put_prefs_in_array(interest_regs_ssi, self.interest)
-
-        #   Populate priority matrix
-        priority_regs = [StudentRegistration.valid_objects().filter(section__parent_class__parent_program=self.program, relationship__name='Priority/%s'%i).values_list('user__id', 'section__id').distinct() for i in range(self.real_priority_limit+1)]
-        if self.grade_range_exceptions:
-            priority_regs.append(StudentRegistration.valid_objects().filter(section__parent_class__parent_program=self.program, relationship__name='GradeRangeException').values_list('user__id', 'section__id').distinct())
-        for i in range(1, self.effective_priority_limit+1):
-            self.put_prefs_in_array(priority_regs[i], self.priority[i])
-        if self.options['use_student_apps']:
-            for i in range(1, self.effective_priority_limit+1):
-                for (student_id, section_id) in priority_regs[i]:
-                    self.ranks[self.student_indices[student_id], self.section_indices[section_id]] = ESPUser.getRankInClass(student_id, self.parent_classes[self.section_indices[section_id]])
-            for (student_id, section_id) in interest_regs_sr + interest_regs_ssi:
-                self.ranks[self.student_indices[student_id], self.section_indices[section_id]] = ESPUser.getRankInClass(student_id, self.parent_classes[self.section_indices[section_id]])
-
-
-        #   Set student utility weights. Counts number of classes that students selected. Used only for computing the overall_utility stat
-        self.student_utility_weights = numpy.sum(self.interest.astype(float), 1) + sum([numpy.sum(self.priority[i].astype(float), 1) for i in range(1, self.effective_priority_limit+1)])
+        #   Populate interest and priority preferences
+        self.initialize_preferences()
 
         #   Populate section schedule
         section_times = numpy.array(self.sections.values_list('id', 'meeting_times__id'))
@@ -292,9 +311,7 @@ def initialize(self):
         self.section_start_schedules[self.section_indices[start_times[:, 0]], self.timeslot_indices[start_times[:, 1]]] = True
 
         #   Populate section overlap matrix
-        for i in range(self.num_sections):
-            group_ids = numpy.nonzero(self.parent_classes == self.parent_classes[i])[0]
-            self.section_overlap[tuple(numpy.meshgrid(group_ids, group_ids))] = True
+        self.initialize_section_overlap()
 
         #   Populate section grade limits
         self.section_grade_min = numpy.array(self.sections.values_list('parent_class__grade_min', flat=True), dtype=numpy.uint32)
@@ -313,32 +330,161 @@ def initialize(self):
         self.section_lengths = numpy.array([x.nonzero()[0].size for x in self.section_schedules])
 
         if self.options['fill_low_priorities']:
-            #   Compute who has a priority when.  Includes lower priorities, since this is used for places where we check not clobbering priorities.
-            self.has_priority = [numpy.zeros((self.num_students, self.num_timeslots), dtype=numpy.bool) for i in range(self.effective_priority_limit+1)]
-            for i in range(1, self.effective_priority_limit+1):
-                priority_at_least_i = reduce(operator.or_, [self.priority[j] for j in range(i, self.effective_priority_limit+1)])
-                numpy.dot(priority_at_least_i, self.section_schedules, out=self.has_priority[i])
+            self.fill_low_priority_preferences()
 
-            self.sections_at_same_time = numpy.dot(self.section_schedules, numpy.transpose(self.section_schedules))
+    def get_preference_querysets(self):
+        """ Return a tuple (interest_regs, priority_regs) of the preferences
+            that students have marked for the lottery.  interest_regs is a list
+            of querysets; priority_regs[i] is the queryset for priority level i
+            (the last level holds grade range exceptions if they are in use). """
 
-            #   And the same, overlappingly.
-            self.has_overlapping_priority = [numpy.zeros((self.num_students, self.num_timeslots), dtype=numpy.bool) for i in range(self.effective_priority_limit+1)]
-            for i in range(1, self.effective_priority_limit+1):
-                priority_at_least_i = reduce(operator.or_, [self.priority[j] for j in range(i, self.effective_priority_limit+1)])
-                numpy.dot(numpy.dot(priority_at_least_i, self.sections_at_same_time), self.section_schedules, out=self.has_overlapping_priority[i])
+        #   Interest uses both the StudentRegistrations (which apply to a particular section) and StudentSubjectIntegests (which apply to all sections of the class).  If one does not exist, ignore it.  Be careful to only return SRs and SSIs for accepted sections of accepted classes; this might matter for SSIs where only some sections of the class are accepted.
+        interest_regs_sr = StudentRegistration.valid_objects().filter(section__parent_class__parent_program=self.program, section__status__gt=0, section__parent_class__status__gt=0, section__registration_status=0, section__meeting_times__isnull=False, relationship__name='Interested').values_list('user__id', 'section__id').distinct()
+        interest_regs_ssi = StudentSubjectInterest.valid_objects().filter(subject__parent_program=self.program, subject__status__gt=0, subject__sections__status__gt=0, subject__sections__registration_status=0, subject__sections__meeting_times__isnull=False).values_list('user__id', 'subject__sections__id').distinct()
 
-            #   Fill in preferences for students who haven't ranked them.  In particular, if a student has ranked some level of class in a timeblock (i.e. they plan to be at Splash that timeblock), but has not ranked any priority/n or lower-priority classes overlapping it, add a random class from their interesteds.
+        priority_regs = [StudentRegistration.valid_objects().filter(section__parent_class__parent_program=self.program, relationship__name='Priority/%s'%i).values_list('user__id', 'section__id').distinct() for i in range(self.real_priority_limit+1)]
+        if self.grade_range_exceptions:
+            priority_regs.append(StudentRegistration.valid_objects().filter(section__parent_class__parent_program=self.program, relationship__name='GradeRangeException').values_list('user__id', 'section__id').distinct())
+
+        return ([interest_regs_sr, interest_regs_ssi], priority_regs)
+
+    def get_preference_ranks(self, interest_regs, priority_regs):
+        """ Yield (student index, section index, rank) for each preference, in
+            the order in which they should be applied when use_student_apps is on. """
+
+        for i in range(1, self.effective_priority_limit+1):
+            for (student_id, section_id) in priority_regs[i]:
+                yield (self.student_indices[student_id], self.section_indices[section_id], ESPUser.getRankInClass(student_id, self.parent_classes[self.section_indices[section_id]]))
+        for regs in interest_regs:
+            for (student_id, section_id) in regs:
+                yield (self.student_indices[student_id], self.section_indices[section_id], ESPUser.getRankInClass(student_id, self.parent_classes[self.section_indices[section_id]]))
 
-            for i in range(1, self.real_priority_limit+1): #Use self.real_priority_limit since we don't want to give people free grade range exceptions!
-                should_fill = numpy.transpose(numpy.nonzero(self.has_priority[1]&~self.has_overlapping_priority[i]))
-                if len(should_fill):
-                    for student, timeslot in should_fill:
-                        # student is interested, and class starts in this timeslot, and class does not overlap any lower or equal priorities
-                        possible_classes = numpy.nonzero(self.interest[student] & self.section_start_schedules[:, timeslot] & ~numpy.dot(self.section_schedules, numpy.transpose(self.has_priority[i][student])))[0]
-                        if len(possible_classes):
-                            choice = numpy.random.choice(possible_classes)
-                            self.priority[i][student, choice]=True
+    def initialize_preferences(self):
+        """ Populate the students-by-sections interest, priority and rank
+            matrices, and the student utility weights that depend on them. """
 
+        self.interest = numpy.zeros((self.num_students, self.num_sections), dtype=numpy.bool)
+        self.priority = [numpy.zeros((self.num_students, self.num_sections), dtype=numpy.bool) for i in range(self.effective_priority_limit+1)]
+        self.ranks = 10*numpy.ones((self.num_students, self.num_sections), dtype=numpy.int32)
+
+        (interest_regs, priority_regs) = self.get_preference_querysets()
+        for regs in interest_regs:
+            self.put_prefs_in_array(regs, self.interest)
+        for i in range(1, self.effective_priority_limit+1):
+            self.put_prefs_in_array(priority_regs[i], self.priority[i])
+        if self.options['use_student_apps']:
+            for (student_ix, section_ix, rank) in self.get_preference_ranks(interest_regs, priority_regs):
+                self.ranks[student_ix, section_ix] = rank
+
+        #   Set student utility weights. Counts number of classes that students selected. Used only for computing the overall_utility stat
+        self.student_utility_weights = numpy.sum(self.interest.astype(float), 1) + sum([numpy.sum(self.priority[i].astype(float), 1) for i in range(1, self.effective_priority_limit+1)])
+
+    def initialize_section_overlap(self):
+        """ Record which sections belong to the same class, so that students
+            are not assigned to two sections of one class. """
+
+        self.section_overlap = numpy.zeros((self.num_sections, self.num_sections), dtype=numpy.bool)
+        for i in range(self.num_sections):
+            group_ids = numpy.nonzero(self.parent_classes == self.parent_classes[i])[0]
+            self.section_overlap[tuple(numpy.meshgrid(group_ids, group_ids))] = True
+
+    def fill_low_priority_preferences(self):
+        """ Fill in preferences for students who haven't ranked them.  In particular, if a student has ranked some level of class in a timeblock (i.e. they plan to be at Splash that timeblock), but has not ranked any priority/n or lower-priority classes overlapping it, add a random class from their interesteds. """
+
+        #   Compute who has a priority when.  Includes lower priorities, since this is used for places where we check not clobbering priorities.
+        self.has_priority = [numpy.zeros((self.num_students, self.num_timeslots), dtype=numpy.bool) for i in range(self.effective_priority_limit+1)]
+        for i in range(1, self.effective_priority_limit+1):
+            priority_at_least_i = reduce(operator.or_, [self.priority[j] for j in range(i, self.effective_priority_limit+1)])
+            numpy.dot(priority_at_least_i, self.section_schedules, out=self.has_priority[i])
+
+        self.sections_at_same_time = numpy.dot(self.section_schedules, numpy.transpose(self.section_schedules))
+
+        #   And the same, overlappingly.
+        self.has_overlapping_priority = [numpy.zeros((self.num_students, self.num_timeslots), dtype=numpy.bool) for i in range(self.effective_priority_limit+1)]
+        for i in range(1, self.effective_priority_limit+1):
+            priority_at_least_i = reduce(operator.or_, [self.priority[j] for j in range(i, self.effective_priority_limit+1)])
+            numpy.dot(numpy.dot(priority_at_least_i, self.sections_at_same_time), self.section_schedules, out=self.has_overlapping_priority[i])
+
+        for i in range(1, self.real_priority_limit+1): #Use self.real_priority_limit since we don't want to give people free grade range exceptions!
+            should_fill = numpy.transpose(numpy.nonzero(self.has_priority[1]&~self.has_overlapping_priority[i]))
+            if len(should_fill):
+                for student, timeslot in should_fill:
+                    # student is interested, and class starts in this timeslot, and class does not overlap any lower or equal priorities
+                    possible_classes = numpy.nonzero(self.interest[student] & self.section_start_schedules[:, timeslot] & ~numpy.dot(self.section_schedules, numpy.transpose(self.has_priority[i][student])))[0]
+                    if len(possible_classes):
+                        choice = numpy.random.choice(possible_classes)
+                        self.priority[i][student, choice]=True
+
+    def get_signups(self, signup, si):
+        """ Return the sorted indices of the students who marked the section
+            with index si in the given preference matrix. """
+        return numpy.nonzero(signup[:, si])[0]
+
+    def get_student_ranks(self, students, si):
+        """ Return the ranks of the given students in the section with index si. """
+        return self.ranks[students, si]
+
+    def count_enrolled(self, si):
+        """ Return the number of students assigned to the section with index si. """
+        return numpy.sum(self.student_sections[:, si])
+
+    def count_student_sections(self, students):
+        """ Return the number of sections each of the given students is assigned to. """
+        return numpy.sum(self.student_sections[students], axis=1)
+
+    def enrolled_in_class(self, students, si):
+        """ Return a boolean array of which of the given students are assigned
+            to any section of the same class as the section with index si. """
+        return numpy.any(self.student_sections[students][:, self.section_overlap[:, si]], axis=1)
+
+    def enroll_students(self, si, students):
+        """ Assign the given students to the section with index si. """
+        #   Check that none of these students are already assigned to this section
+        assert(numpy.sum(self.student_sections[students, si]) == 0)
+        self.student_sections[students, si] = True
+
+    def get_candidate_students(self, si, timeslots, signup, priority=False, rank=10):
+        """ Return the sorted indices of the students who may be added to the
+            section with index si, which meets during the given timeslot indices. """
+
+        #   Get students who have indicated interest in the section
+        students = self.get_signups(signup, si)
+        possible_students = numpy.ones(students.shape, dtype=numpy.bool)
+
+        #   Filter students by the section's grade limits
+        if self.options['check_grade'] and not (priority == self.effective_priority_limit and self.grade_range_exceptions):
+            possible_students *= (self.student_grades[students] >= self.section_grade_min[si])
+            possible_students *= (self.student_grades[students] <= self.section_grade_max[si])
+
+        if self.options['use_student_apps']:
+            possible_students *= (self.get_student_ranks(students, si) == rank)
+
+        #   Filter students by who has fewer than the max number of timeslot enrollments
+        if self.options['max_sections']:
+            possible_students *= (self.count_student_sections(students) < self.options['max_sections'])
+
+        #   Filter students by who has fewer than the max number of timeslot enrollments
+        if self.options['max_timeslots']:
+            possible_students *= (numpy.sum(self.student_schedules[students], axis=1) < self.options['max_timeslots'])
+
+        #   Filter students by who has all of the section's timeslots available
+        for i in range(timeslots.shape[0]):
+            possible_students *= ~(self.student_schedules[students, timeslots[i]])
+
+        #   Filter students by who is not already registered for a different section of the class
+        possible_students *= ~self.enrolled_in_class(students, si)
+
+        #   Filter students by lunch constraint - if class overlaps with lunch period, student must have 1 additional free spot
+        #   NOTE: Currently only works with 2 lunch periods per day
+        for i in range(timeslots.shape[0]):
+            if numpy.sum(self.lunch_timeslots == self.timeslot_ids[timeslots[i]]) > 0:
+                lunch_day = numpy.nonzero(self.lunch_timeslots == self.timeslot_ids[timeslots[i]])[0][0]
+                for j in range(self.lunch_timeslots.shape[1]):
+                    timeslot_index = self.timeslot_indices[self.lunch_timeslots[lunch_day, j]]
+                    if timeslot_index != timeslots[i]:
+                        possible_students *= ~(self.student_schedules[students, timeslot_index])
+
+        return students[possible_students]
 
     def fill_section(self, si, priority=False, rank=10):
         """ Assigns students to the section with index si.
@@ -349,7 +495,7 @@ def fill_section(self, si, priority=False, rank=10):
         if self.options['stats_display']: logger.info('-- Filling section %d (index %d, capacity %d, timeslots %s), priority=%s', self.section_ids[si], si, self.section_capacities[si], self.timeslot_ids[timeslots], priority)
 
         #   Compute number of spaces - exit if section or program is already full.  Otherwise, set num_spaces to the number of students we can add without overfilling the section or program.
-        num_spaces = self.section_capacities[si] - numpy.sum(self.student_sections[:, si])
+        num_spaces = self.section_capacities[si] - self.count_enrolled(si)
         if self.program_size_max:
             program_spaces_remaining = self.program_size_max - numpy.sum((numpy.sum(self.student_schedules, 1) > 0))
             if program_spaces_remaining == 0:
@@ -382,44 +528,7 @@ def fill_section(self, si, priority=False, rank=10):
                 if self.options['stats_display']: logger.info('   Section covered all lunch timeslots %s on day %d, aborting', self.lunch_timeslots[i,:], i)
                 return False
 
-        #   Get students who have indicated interest in the section
-        possible_students = numpy.copy(signup[:, si])
-
-        #   Filter students by the section's grade limits
-        if self.options['check_grade'] and not (priority == self.effective_priority_limit and self.grade_range_exceptions):
-            possible_students *= (self.student_grades >= self.section_grade_min[si])
-            possible_students *= (self.student_grades <= self.section_grade_max[si])
-
-        if self.options['use_student_apps']:
-            possible_students *= (self.ranks[:, si] == rank)
-
-        #   Filter students by who has fewer than the max number of timeslot enrollments
-        if self.options['max_sections']:
-            possible_students *= (numpy.sum(self.student_sections, axis=1) < self.options['max_sections'])
-
-        #   Filter students by who has fewer than the max number of timeslot enrollments
-        if self.options['max_timeslots']:
-            possible_students *= (numpy.sum(self.student_schedules, axis=1) < self.options['max_timeslots'])
-
-        #   Filter students by who has all of the section's timeslots available
-        for i in range(timeslots.shape[0]):
-            possible_students *= ~(self.student_schedules[:, timeslots[i]])
-
-        #   Filter students by who is not already registered for a different section of the class
-        for sec_index in numpy.nonzero(self.section_overlap[:, si])[0]:
-            possible_students *= ~(self.student_sections[:, sec_index])
-
-        #   Filter students by lunch constraint - if class overlaps with lunch period, student must have 1 additional free spot
-        #   NOTE: Currently only works with 2 lunch periods per day
-        for i in range(timeslots.shape[0]):
-            if numpy.sum(self.lunch_timeslots == self.timeslot_ids[timeslots[i]]) > 0:
-                lunch_day = numpy.nonzero(self.lunch_timeslots == self.timeslot_ids[timeslots[i]])[0][0]
-                for j in range(self.lunch_timeslots.shape[1]):
-                    timeslot_index = self.timeslot_indices[self.lunch_timeslots[lunch_day, j]]
-                    if timeslot_index != timeslots[i]:
-                        possible_students *= ~(self.student_schedules[:, timeslot_index])
-
-        candidate_students = numpy.nonzero(possible_students)[0]
+        candidate_students = self.get_candidate_students(si, timeslots, signup, priority=priority, rank=rank)
         if candidate_students.shape[0] <= num_spaces:
             #   If the section has enough space for all students that applied, let them all in.
             selected_students = candidate_students
@@ -434,9 +543,7 @@ def fill_section(self, si, priority=False, rank=10):
             section_filled = True
 
         #   Update student section assignments
-        #   Check that none of these students are already assigned to this section
-        assert(numpy.sum(self.student_sections[selected_students, si]) == 0)
-        self.student_sections[selected_students, si] = True
+        self.enroll_students(si, selected_students)
 
         #   Update student schedules
         #   Check that none of the students are already occupied in those timeblocks
@@ -484,7 +591,7 @@ def compute_assignments(self, check_result=True):
                         self.fill_section(section_index, priority=i, rank=rank)
             #   Sort sections in increasing order of number of interesting students
             #   TODO: Check with Alex that this is the desired algorithm
-            interested_counts = numpy.sum(self.interest, 0)
+            interested_counts = self.count_section_signups(self.interest)
             sorted_section_indices = numpy.argsort(interested_counts.astype(numpy.float) / self.section_capacities)
             if self.options['stats_display']:
                 logger.info('\n== Assigning interested students%s',
@@ -495,11 +602,62 @@ def compute_assignments(self, check_result=True):
         if check_result:
             self.check_assignments()
 
+    def get_objective(self, stats):
+        """ Return the score of a set of assignments (higher is better) from
+            its stats, according to self.options['objective']. """
+
+        objective = self.options['objective']
+        if objective not in stats or not numpy.isscalar(stats[objective]):
+            raise LotteryException('Cannot rank lottery runs by %s; the objective must be one of the numerical statistics, such as overall_utility.' % objective)
+        score = float(stats[objective])
+        return -numpy.inf if numpy.isnan(score) else score
+
+    def run_seed(self, seed, check_result=True):
+        """ Compute assignments using the given random seed, and return their score. """
+
+        self.seed = seed
+        numpy.random.seed(seed)
+        self.compute_assignments(check_result)
+        return self.get_objective(self.compute_stats(display=False))
+
+    def compute_best_assignments(self, check_result=True):
+        """ Compute assignments with self.options['num_runs'] different random
+            seeds and keep the ones that score best.  If the 'processes'
+            option asks for more than one process, the runs are spread across
+            a pool of forked worker processes; otherwise they run here.
+
+            The (seed, score) of each run is stored in self.seed_scores and the
+            chosen seed in self.seed, so that the chosen assignments can be
+            reproduced later with run_seed(). """
+
+        num_runs = max(1, int(self.options['num_runs']))
+        seeds = [(self.initial_seed + i) % 2**32 for i in range(num_runs)]
+        processes = int(self.options['processes'])
+        processes = min(num_runs, processes or os.cpu_count() or 1)
+
+        if processes > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            global _seed_controller
+            _seed_controller = self
+            try:
+                with multiprocessing.get_context('fork').Pool(processes) as pool:
+                    self.seed_scores = pool.map(functools.partial(_run_lottery_seed, check_result=check_result), seeds)
+            finally:
+                _seed_controller = None
+        else:
+            self.seed_scores = [(seed, self.run_seed(seed, check_result)) for seed in seeds]
+
+        #   Ties go to the earliest seed
+        best_seed = max(self.seed_scores, key=lambda x: x[1])[0]
+        if self.options['stats_display']:
+            logger.info('Lottery runs by seed: %s; keeping seed %d', self.seed_scores, best_seed)
+        if best_seed != self.seed:
+            self.run_seed(best_seed, check_result)
+
     def check_assignments(self):
         """ Check the result for desired properties, before it is saved. """
 
         #   Check that no sections are overfilled
-        assert(numpy.sum(numpy.sum(self.student_sections, 0) > self.section_capacities) == 0)
+        assert(numpy.sum(self.get_section_enrollments() > self.section_capacities) == 0)
 
         #   Check that no student's schedule violates the lunch constraints: 1 or more open lunch periods per day
         for i in range(self.lunch_timeslots.shape[0]):
@@ -508,8 +666,38 @@ def check_assignments(self):
             assert(numpy.sum(numpy.sum(self.student_schedules[:, timeslots] > self.lunch_timeslots.shape[1] - 1)) == 0)
 
         #   Check that each student's schedule is consistent with their assigned sections
-        for i in range(self.num_students):
-            assert(numpy.sum(self.student_schedules[i,:] != numpy.sum(self.section_schedules[numpy.nonzero(self.student_sections[i,:])[0],:], 0)) == 0)
+        assert(numpy.sum(self.student_schedules != self.count_student_timeslots()) == 0)
+
+    def count_section_signups(self, signup):
+        """ Return the number of students who marked each section in the given preference matrix. """
+        return numpy.sum(signup, 0)
+
+    def get_section_enrollments(self):
+        """ Return the number of students assigned to each section. """
+        return numpy.sum(self.student_sections, 0)
+
+    def count_student_timeslots(self):
+        """ Return a students-by-timeslots array of how many assigned sections
+            each student has in each timeslot. """
+        return numpy.dot(self.student_sections.astype(numpy.int32), self.section_schedules.astype(numpy.int32))
+
+    def count_preferences(self, prefs):
+        """ Return a tuple (assigned, requested) of arrays counting, for each
+            student, the sections marked in the given preference matrix that
+            they were assigned to and that they marked at all. """
+        return (numpy.sum(self.student_sections * prefs, 1), numpy.sum(prefs, 1))
+
+    def count_preference_timeslots(self, prefs):
+        """ Return the number of timeslots in which each student has a section
+            marked in the given preference matrix. """
+        return numpy.dot(prefs, self.section_schedules).sum(axis=1)
+
+    def get_rank_stats(self):
+        """ Return the student application rank statistics for compute_stats(). """
+        stats = {'ranks': self.ranks}
+        for rank in (10, 5, 1):
+            stats['rank_%s_assigned'%rank] = numpy.logical_and(self.ranks == rank, self.student_sections == True)
+        return stats
 
     def compute_stats(self, display=True):
         """ Compute statistics to provide feedback to the user about how well the
@@ -517,9 +705,9 @@ def compute_stats(self, display=True):
 
         stats = {}
 
-        priority_matches = [self.student_sections * self.priority[i] for i in range(self.effective_priority_limit+1)]
-        priority_assigned = [numpy.sum(priority_matches[i], 1) for i in range(self.effective_priority_limit+1)]
-        priority_requested = [numpy.sum(self.priority[i], 1) for i in range(self.effective_priority_limit+1)]
+        priority_counts = [self.count_preferences(self.priority[i]) for i in range(self.effective_priority_limit+1)]
+        priority_assigned = [priority_counts[i][0] for i in range(self.effective_priority_limit+1)]
+        priority_requested = [priority_counts[i][1] for i in range(self.effective_priority_limit+1)]
         priority_fractions = [0 for i in range(self.effective_priority_limit+1)]
 
         # We expect that there will occasionally be 0/0 division errors,
@@ -536,9 +724,7 @@ def compute_stats(self, display=True):
             with numpy.errstate(divide=np_errstate, invalid=np_errstate):
                 priority_fractions[i] = numpy.nan_to_num(priority_assigned[i].astype(numpy.float) / priority_requested[i])
 
-        interest_matches = self.student_sections * self.interest
-        interest_assigned = numpy.sum(interest_matches, 1)
-        interest_requested = numpy.sum(self.interest, 1)
+        (interest_assigned, interest_requested) = self.count_preferences(self.interest)
         with numpy.errstate(divide=np_errstate, invalid=np_errstate):
             interest_fractions = numpy.nan_to_num(interest_assigned.astype(numpy.float) / interest_requested)
 
@@ -553,12 +739,9 @@ def compute_stats(self, display=True):
             stats['overall_priority_ratio'] = float(numpy.sum(priority_assigned[1])) / numpy.sum(priority_requested[1])
 
         if self.options['use_student_apps']:
-            stats['ranks'] = self.ranks
-            for rank in (10, 5, 1):
-                stats['rank_%s_assigned'%rank] = numpy.logical_and(self.ranks == rank, self.student_sections == True)
+            stats.update(self.get_rank_stats())
         stats['interest_requested'] = interest_requested
         stats['interest_assigned'] = interest_assigned
-        stats['enrollments'] = self.student_sections
         stats['assignments'] = self.student_enrollments
         stats['student_ids'] = self.student_ids
         stats['student_grades'] = self.student_grades
@@ -566,14 +749,15 @@ def compute_stats(self, display=True):
         stats['num_enrolled_students'] = numpy.sum((numpy.sum(self.student_schedules, 1) > 0))
         stats['num_lottery_students'] = self.num_students
         stats['overall_interest_ratio'] = float(numpy.sum(interest_assigned)) / numpy.sum(interest_requested)
-        stats['num_registrations'] = numpy.sum(self.student_sections)
-        stats['num_full_classes'] = numpy.sum(self.section_capacities == numpy.sum(self.student_sections, 0))
+        section_enrollments = self.get_section_enrollments()
+        stats['num_registrations'] = numpy.sum(section_enrollments)
+        stats['num_full_classes'] = numpy.sum(self.section_capacities == section_enrollments)
         stats['total_spaces'] = numpy.sum(self.section_capacities)
 
         #   Timeslot-based metrics
         stats['timeslots_filled'] = numpy.sum(self.student_schedules, axis=1)
         for j in range(1, self.effective_priority_limit+1):
-            stats['timeslots_priority_%s'%j] = numpy.dot(self.priority[j], self.section_schedules).sum(axis=1)
+            stats['timeslots_priority_%s'%j] = self.count_preference_timeslots(self.priority[j])
         stats['hist_timeslots_filled'] = dict(enumerate(numpy.bincount(stats['timeslots_filled'])))
 
         #   Compute histograms of assigned vs. requested classes
@@ -625,6 +809,8 @@ def compute_stats(self, display=True):
 
         stats['overall_utility'] = overall_utility
         stats['students_by_screwedness'] = screwed_students
+        stats['seed'] = self.seed
+        stats['seed_scores'] = self.seed_scores
 
         if self.options['stats_display'] or display:
             self.display_stats(stats)
@@ -678,6 +864,9 @@ def extract_stats(self, stats):
         ratios.append('%2.2f%% of interested classes were enrolled' % (stats['overall_interest_ratio'] * 100.0))
         sections.append(('ratios', ratios))
 
+        if len(stats['seed_scores']) > 1:
+            sections.append(('runs', ['seed %d scored %f%s' % (seed, score, ' (kept)' if seed == stats['seed'] else '') for (seed, score) in stats['seed_scores']]))
+
         return sections
 
     def get_computed_schedule(self, student_id, mode='assigned'):
@@ -735,7 +924,7 @@ def save_assignments(self, try_mailman=True):
         with transaction.atomic():
             self.clear_saved_assignments()
 
-            assignments = numpy.nonzero(self.student_sections)
+            assignments = self.get_assignment_pairs()
             student_ids = self.student_ids[assignments[0]]
             section_ids = self.section_ids[assignments[1]]
 
@@ -745,8 +934,7 @@ def save_assignments(self, try_mailman=True):
             self.now = datetime.now()   # The time that all the registrations start at, in case all lottery registrations need to be manually reverted later
             srs = StudentRegistration.objects.bulk_create([StudentRegistration(user_id=student_ids[i], section_id=section_ids[i], relationship=relationship, start_date=self.now) for i in range(student_ids.shape[0])])
             # Trigger any relevant caches
-            for sr in srs:
-                sr.save()
+            StudentRegistration.invalidate_caches(srs)
             if self.options['stats_display']:
                 logger.info("StudentRegistration enrollments all created to start at %s", self.now)
                 logger.info('Created %d registrations', student_ids.shape[0])
@@ -762,23 +950,103 @@ def clear_saved_assignments(self, delete=False):
 
         old_registrations = StudentRegistration.objects.filter(section__parent_class__parent_program=self.program, relationship__name='Enrolled')
         if delete:
+            section_ids = set(old_registrations.values_list('section', flat=True))
             old_registrations.delete()
+            ClassSection.bulk_sync_enrolled_students(section_ids)
         else:
-            old_registrations.filter(StudentRegistration.is_valid_qobject()).update(end_date=datetime.now())
+            now = datetime.now()
+            valid_registrations = old_registrations.filter(StudentRegistration.is_valid_qobject(now))
+            expired = list(valid_registrations)
+            valid_registrations.update(end_date=now)
+            # Trigger any relevant caches, since update() doesn't
+            StudentRegistration.invalidate_caches(expired)
+
+    def get_assignment_pairs(self):
+        """ Return a tuple of arrays (student indices, section indices) of the
+            current assignments, ordered by student and then by section. """
+        return numpy.nonzero(self.student_sections)
+
+    def set_assignment_pairs(self, student_ixs, section_ixs, num_students, num_sections):
+        """ Replace the current assignments with the given (student index,
+            section index) pairs. """
+        self.student_sections = numpy.zeros((num_students, num_sections), dtype=numpy.bool)
+        self.student_sections[student_ixs, section_ixs] = True
 
     def export_assignments(self):
-        def export_array(arr):
-            s = BytesIO()
-            numpy.savetxt(s, arr)
-            return s.getvalue()
-
-        student_sections = export_array(self.student_sections)
-        student_ids = export_array(self.student_ids)
-        section_ids = export_array(self.section_ids)
-        return base64.b64encode(zlib.compress(student_sections + b'|' + student_ids + b'|' + section_ids)).decode()
+        """ Serialize the current assignments, along with the student and
+            section IDs they refer to and the seed and options that produced
+            them, as a base64 string for import_assignments().
+
+            The (student index, section index) pairs and the IDs are stored as
+            packed little-endian integers after a JSON header. """
+
+        (student_ixs, section_ixs) = self.get_assignment_pairs()
+        header = json.dumps({
+            'num_students': self.student_ids.shape[0],
+            'num_sections': self.section_ids.shape[0],
+            'num_assignments': student_ixs.shape[0],
+            'seed': self.seed,
+            #   Only the options an admin can set from the lottery page; the
+            #   rest (e.g. directory) are details of this server.
+            'options': {key: value for key, value in self.options.items()
+                        if self.default_options.get(key, (None, False))[1] is not False},
+        }, default=str).encode()
+        payload = b''.join([
+            struct.pack('<I', len(header)), header,
+            self.student_ids.astype('<i8').tobytes(),
+            self.section_ids.astype('<i8').tobytes(),
+            student_ixs.astype('<u4').tobytes(),
+            section_ixs.astype('<u4').tobytes(),
+        ])
+        return base64.b64encode(EXPORT_MAGIC + struct.pack('<B', EXPORT_VERSION) + zlib.compress(payload)).decode()
 
     def import_assignments(self, data):
-        data_parts = zlib.decompress(base64.b64decode(data.encode())).split(b'|')
+        """ Load assignments produced by export_assignments(), in either the
+            binary format or the original text format. """
+
+        raw = base64.b64decode(data.encode())
+        if raw.startswith(EXPORT_MAGIC):
+            self.import_binary_assignments(raw[len(EXPORT_MAGIC):])
+        else:
+            self.import_text_assignments(raw)
+
+    def import_binary_assignments(self, raw):
+        if len(raw) < 1 or struct.unpack('<B', raw[:1])[0] != EXPORT_VERSION:
+            raise ValueError('provided lottery_data has an unsupported format version')
+        try:
+            payload = zlib.decompress(raw[1:])
+            (header_length,) = struct.unpack('<I', payload[:4])
+            header = json.loads(payload[4:4 + header_length].decode())
+            num_students = int(header['num_students'])
+            num_sections = int(header['num_sections'])
+            num_assignments = int(header['num_assignments'])
+        except (zlib.error, struct.error, ValueError, KeyError, TypeError):
+            raise ValueError('provided lottery_data is corrupted (bad header)')
+
+        arrays = payload[4 + header_length:]
+        if len(arrays) != 8 * (num_students + num_sections) + 8 * num_assignments:
+            raise ValueError('provided lottery_data is corrupted (wrong length)')
+        student_ids = numpy.frombuffer(arrays, dtype='<i8', count=num_students)
+        offset = 8 * num_students
+        section_ids = numpy.frombuffer(arrays, dtype='<i8', count=num_sections, offset=offset)
+        offset += 8 * num_sections
+        student_ixs = numpy.frombuffer(arrays, dtype='<u4', count=num_assignments, offset=offset)
+        offset += 4 * num_assignments
+        section_ixs = numpy.frombuffer(arrays, dtype='<u4', count=num_assignments, offset=offset)
+        if num_assignments and (numpy.max(student_ixs) >= num_students or numpy.max(section_ixs) >= num_sections):
+            raise ValueError('provided lottery_data is corrupted (assignment out of range)')
+
+        self.student_ids = student_ids.astype(numpy.int64)
+        self.section_ids = section_ids.astype(numpy.int64)
+        self.set_assignment_pairs(student_ixs.astype(numpy.int64), section_ixs.astype(numpy.int64), num_students, num_sections)
+        self.seed = header.get('seed')
+        self.imported_options = header.get('options', {})
+
+    def import_text_assignments(self, raw):
+        try:
+            data_parts = zlib.decompress(raw).split(b'|')
+        except zlib.error:
+            raise ValueError('provided lottery_data is corrupted (not compressed)')
 
         if len(data_parts) != 3:
             raise ValueError('provided lottery_data is corrupted (doesn\'t contain three parts)')
@@ -786,9 +1054,13 @@ def import_assignments(self, data):
         # ndmin is for corner cases where one of the array dimensions is 1.  If you don't include the ndmin parameter,
         # then "mono-dimensional axes will be squeezed" (see the numpy documentation), and the resulting array
         # would not have the right shape.
-        self.student_sections = numpy.loadtxt(BytesIO(data_parts[0]), ndmin=2)
-        self.student_ids = numpy.loadtxt(BytesIO(data_parts[1]), ndmin=1)
-        self.section_ids = numpy.loadtxt(BytesIO(data_parts[2]), ndmin=1)
+        student_sections = numpy.loadtxt(BytesIO(data_parts[0]), ndmin=2)
+        self.student_ids = numpy.loadtxt(BytesIO(data_parts[1]), ndmin=1).astype(numpy.int64)
+        self.section_ids = numpy.loadtxt(BytesIO(data_parts[2]), ndmin=1).astype(numpy.int64)
+        if student_sections.size and student_sections.shape != (self.student_ids.shape[0], self.section_ids.shape[0]):
+            raise ValueError('provided lottery_data is corrupted (assignments don\'t match the IDs)')
+        (student_ixs, section_ixs) = numpy.nonzero(student_sections)
+        self.set_assignment_pairs(student_ixs, section_ixs, self.student_ids.shape[0], self.section_ids.shape[0])
 
     def clear_mailman_list(self, list_name):
         contents = list_contents(list_name)
@@ -802,11 +1074,226 @@ def update_mailman_lists(self, delete=True):
             # Add all registered students into the program mailing list, even
             # if they didn't get enrolled into any classes.
             add_list_members(program_list, ESPUser.objects.filter(id__in=list(self.student_ids)).distinct())
+            (student_ixs, section_ixs) = self.get_assignment_pairs()
             for i in range(self.num_sections):
                 section = ClassSection.objects.get(id=self.section_ids[i])
                 list_names = ["%s-%s" % (section.emailcode(), "students"), "%s-%s" % (section.parent_class.emailcode(), "students")]
-                student_ids = self.student_ids[numpy.nonzero(self.student_sections[:, i])]
+                student_ids = self.student_ids[student_ixs[section_ixs == i]]
                 students = ESPUser.objects.filter(id__in=student_ids).distinct()
                 for list_name in list_names:
                     self.clear_mailman_list(list_name)
                     add_list_members(list_name, students)
+
+class SparseLotteryAssignmentController(LotteryAssignmentController):
+    """ A lottery assignment controller that stores preferences and assignments
+        as per-section arrays of student indices instead of dense
+        students-by-sections matrices, so that its memory use grows with the
+        number of preferences rather than with the size of the program.
+
+        Given the same random seed, this produces exactly the same assignments
+        as LotteryAssignmentController: candidate students are considered in
+        the same (increasing index) order and random numbers are drawn in the
+        same order, so either one can be used to check the other.
+
+        Here self.interest and self.priority[i] are lists, indexed by section,
+        of sorted arrays of student indices; self.section_overlap[si] is the
+        array of indices of the sections of the same class as section si;
+        self.ranks maps (student index, section index) to a rank (default 10);
+        and self.section_students[si] holds the indices of the students
+        assigned to section si.
+    """
+
+    def flatten(self, arrays):
+        """ Concatenate a list of index arrays, which may be empty. """
+        return numpy.concatenate([numpy.zeros((0,), dtype=numpy.int64)] + list(arrays))
+
+    def group_indices(self, keys, values, size):
+        """ Given parallel arrays of keys and values, return a list whose k-th
+            entry (for k < size) is the sorted array of distinct values whose key is k. """
+
+        keys = numpy.asarray(keys, dtype=numpy.int64)
+        values = numpy.asarray(values, dtype=numpy.int64)
+        order = numpy.lexsort((values, keys))
+        keys = keys[order]
+        values = values[order]
+        if keys.shape[0]:
+            distinct = numpy.ones(keys.shape, dtype=numpy.bool)
+            distinct[1:] = (keys[1:] != keys[:-1]) | (values[1:] != values[:-1])
+            keys = keys[distinct]
+            values = values[distinct]
+        bounds = numpy.searchsorted(keys, numpy.arange(size + 1))
+        return [values[bounds[k]:bounds[k+1]] for k in range(size)]
+
+    def get_pref_pairs(self, regs_list):
+        """ Return a tuple of arrays (student indices, section indices) for all
+            of the preferences in the given list of querysets. """
+
+        student_ixs = []
+        section_ixs = []
+        for regs in regs_list:
+            indices = self.get_pref_indices(regs)
+            if indices is not None:
+                student_ixs.append(indices[0])
+                section_ixs.append(indices[1])
+        return (self.flatten(student_ixs), self.flatten(section_ixs))
+
+    def count_by_student(self, prefs):
+        """ Return the number of sections in prefs that each student appears in. """
+        return numpy.bincount(self.flatten(prefs), minlength=self.num_students)
+
+    def students_by_timeslot(self, prefs, schedules):
+        """ Return a students-by-timeslots boolean array of which students
+            have a section in prefs covering each timeslot, where schedules
+            gives the timeslots covered by each section. """
+
+        result = numpy.zeros((self.num_students, self.num_timeslots), dtype=numpy.bool)
+        for si in range(self.num_sections):
+            result[prefs[si]] |= schedules[si]
+        return result
+
+    def initialize_preferences(self):
+        (interest_regs, priority_regs) = self.get_preference_querysets()
+
+        (students, sections) = self.get_pref_pairs(interest_regs)
+        self.interest = self.group_indices(sections, students, self.num_sections)
+        #   Interest by student is only needed to fill in low priorities
+        self.interest_sections = self.group_indices(students, sections, self.num_students)
+
+        self.priority = [self.group_indices([], [], self.num_sections)]
+        for i in range(1, self.effective_priority_limit+1):
+            (students, sections) = self.get_pref_pairs([priority_regs[i]])
+            self.priority.append(self.group_indices(sections, students, self.num_sections))
+
+        self.ranks = {}
+        if self.options['use_student_apps']:
+            for (student_ix, section_ix, rank) in self.get_preference_ranks(interest_regs, priority_regs):
+                self.ranks[(int(student_ix), int(section_ix))] = rank
+
+        #   Set student utility weights. Counts number of classes that students selected. Used only for computing the overall_utility stat
+        self.student_utility_weights = self.count_by_student(self.interest).astype(float) + sum([self.count_by_student(self.priority[i]).astype(float) for i in range(1, self.effective_priority_limit+1)])
+
+    def initialize_section_overlap(self):
+        (classes, class_indices) = numpy.unique(self.parent_classes, return_inverse=True)
+        class_sections = self.group_indices(class_indices, numpy.arange(self.num_sections), classes.shape[0])
+        self.section_overlap = [class_sections[class_indices[si]] for si in range(self.num_sections)]
+
+    def fill_low_priority_preferences(self):
+        #   Compute who has a priority when.  Includes lower priorities, since this is used for places where we check not clobbering priorities.
+        #   Section i reaches timeslot t if it shares a timeslot with a section that meets during t; this is
+        #   the dense engine's sections_at_same_time times section_schedules, computed via timeslots-by-timeslots.
+        section_reach = numpy.dot(self.section_schedules, numpy.dot(numpy.transpose(self.section_schedules), self.section_schedules))
+        self.has_priority = [numpy.zeros((self.num_students, self.num_timeslots), dtype=numpy.bool) for i in range(self.effective_priority_limit+1)]
+        self.has_overlapping_priority = [numpy.zeros((self.num_students, self.num_timeslots), dtype=numpy.bool) for i in range(self.effective_priority_limit+1)]
+        for i in range(self.effective_priority_limit, 0, -1):
+            self.has_priority[i] = self.students_by_timeslot(self.priority[i], self.section_schedules)
+            self.has_overlapping_priority[i] = self.students_by_timeslot(self.priority[i], section_reach)
+            if i < self.effective_priority_limit:
+                self.has_priority[i] |= self.has_priority[i+1]
+                self.has_overlapping_priority[i] |= self.has_overlapping_priority[i+1]
+
+        for i in range(1, self.real_priority_limit+1): #Use self.real_priority_limit since we don't want to give people free grade range exceptions!
+            should_fill = numpy.transpose(numpy.nonzero(self.has_priority[1]&~self.has_overlapping_priority[i]))
+            for student, timeslot in should_fill:
+                # student is interested, and class starts in this timeslot, and class does not overlap any lower or equal priorities
+                sections = self.interest_sections[student]
+                possible_classes = sections[self.section_start_schedules[sections, timeslot] & ~numpy.dot(self.section_schedules[sections], self.has_priority[i][student])]
+                if len(possible_classes):
+                    choice = numpy.random.choice(possible_classes)
+                    self.priority[i][choice] = numpy.union1d(self.priority[i][choice], [student])
+
+    def clear_assignments(self):
+        self.student_schedules = numpy.zeros((self.num_students, self.num_timeslots), dtype=numpy.bool)
+        self.student_enrollments = numpy.zeros((self.num_students, self.num_timeslots), dtype=numpy.int32)
+        self.section_students = [numpy.zeros((0,), dtype=numpy.int64) for si in range(self.num_sections)]
+        self.section_enrollments = numpy.zeros((self.num_sections,), dtype=numpy.int64)
+        self.student_section_counts = numpy.zeros((self.num_students,), dtype=numpy.int64)
+        self.student_weights = numpy.ones((self.num_students,))
+        self.student_utilities = numpy.zeros((self.num_students, ), dtype=numpy.float)
+
+    @property
+    def student_sections(self):
+        """ The students-by-sections boolean assignment matrix used by the
+            dense engine, built on demand.  This takes as much memory as the
+            dense engine, so nothing here uses it; it is only for comparing
+            the two engines' results. """
+
+        result = numpy.zeros((self.student_ids.shape[0], len(self.section_students)), dtype=numpy.bool)
+        for si, students in enumerate(self.section_students):
+            result[students, si] = True
+        return result
+
+    def get_assignment_pairs(self):
+        student_ixs = self.flatten(self.section_students)
+        section_ixs = numpy.repeat(numpy.arange(len(self.section_students)), [students.shape[0] for students in self.section_students]).astype(numpy.int64)
+        order = numpy.lexsort((section_ixs, student_ixs))
+        return (student_ixs[order], section_ixs[order])
+
+    def set_assignment_pairs(self, student_ixs, section_ixs, num_students, num_sections):
+        self.section_students = self.group_indices(section_ixs, student_ixs, num_sections)
+        self.section_enrollments = numpy.array([students.shape[0] for students in self.section_students], dtype=numpy.int64)
+        self.student_section_counts = numpy.bincount(self.flatten([student_ixs]), minlength=num_students)
+
+    def get_signups(self, signup, si):
+        return signup[si]
+
+    def get_student_ranks(self, students, si):
+        return numpy.array([self.ranks.get((int(student), int(si)), 10) for student in students], dtype=numpy.int32)
+
+    def count_enrolled(self, si):
+        return self.section_enrollments[si]
+
+    def count_student_sections(self, students):
+        return self.student_section_counts[students]
+
+    def enrolled_in_class(self, students, si):
+        return numpy.isin(students, self.flatten([self.section_students[sj] for sj in self.section_overlap[si]]))
+
+    def enroll_students(self, si, students):
+        #   Check that none of these students are already assigned to this section
+        assert(not numpy.any(numpy.isin(students, self.section_students[si])))
+        self.section_students[si] = numpy.concatenate((self.section_students[si], students))
+        self.section_enrollments[si] += students.shape[0]
+        self.student_section_counts[students] += 1
+
+    def count_section_signups(self, signup):
+        return numpy.array([students.shape[0] for students in signup], dtype=numpy.int64)
+
+    def get_section_enrollments(self):
+        return self.section_enrollments
+
+    def count_student_timeslots(self):
+        counts = numpy.zeros((self.num_students, self.num_timeslots), dtype=numpy.int32)
+        for si in range(self.num_sections):
+            counts[self.section_students[si]] += self.section_schedules[si]
+        return counts
+
+    def count_preferences(self, prefs):
+        assigned = [numpy.intersect1d(prefs[si], self.section_students[si]) for si in range(self.num_sections)]
+        return (self.count_by_student(assigned), self.count_by_student(prefs))
+
+    def count_preference_timeslots(self, prefs):
+        return self.students_by_timeslot(prefs, self.section_schedules).sum(axis=1)
+
+    def get_rank_stats(self):
+        """ Like the dense engine's rank statistics, except that the
+            rank_N_assigned entries are lists of (student index, section index)
+            pairs instead of boolean matrices. """
+
+        stats = {'ranks': self.ranks}
+        for rank in (10, 5, 1):
+            stats['rank_%s_assigned'%rank] = [(student, si) for si in range(self.num_sections) for student in sorted(self.section_students[si]) if self.ranks.get((int(student), si), 10) == rank]
+        return stats
+
+    def get_computed_schedule(self, student_id, mode='assigned'):
+        #   mode can be 'assigned', 'interested', or 'priority'
+        student = self.student_indices[student_id]
+        if mode == 'assigned':
+            prefs = self.section_students
+        elif mode == 'interested':
+            prefs = self.interest
+        elif mode == 'priority':
+            prefs = self.priority[1]
+        else:
+            import re
+            prefs = self.priority[int(re.search(r'(?<=priority_)\d*', mode).group(0))]
+        return [ClassSection.objects.get(id=self.section_ids[si]) for si in range(len(prefs)) if student in prefs[si]]
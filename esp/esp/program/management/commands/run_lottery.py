@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from esp.program.controllers.lottery import LotteryAssignmentController, SparseLotteryAssignmentController, LotteryException
+from esp.program.models import Program
+
+class Command(BaseCommand):
+    """
+    Run the class lottery for a program with many random seeds, spread across
+    worker processes, and keep the best run.
+
+    The lottery frontend runs its seeds inside the web request, one after
+    another, so it only allows a few; this is for when more are wanted.
+    """
+    help = 'Run the class lottery for a program, trying several seeds in parallel.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('program', help='the program URL, e.g. Splash/2026_Fall')
+        parser.add_argument('--runs', type=int, default=1, help='number of seeds to try')
+        parser.add_argument('--seed', type=int, default=None, help='seed for the first run; run k uses this seed plus k')
+        parser.add_argument('--processes', type=int, default=0, help='worker processes to use (0 means one per CPU)')
+        parser.add_argument('--objective', default=LotteryAssignmentController.default_options['objective'][0], help='statistic to maximize when choosing the best run')
+        parser.add_argument('--sparse', action='store_true', help='use the sparse lottery engine')
+        parser.add_argument('--output', help='file to write the assignments to, in the format the lottery frontend imports')
+        parser.add_argument('--save', action='store_true', help='save the assignments, replacing any existing enrollments')
+
+    def handle(self, *args, **options):
+        try:
+            program = Program.objects.get(url=options['program'])
+        except Program.DoesNotExist:
+            raise CommandError('No program with URL %s' % options['program'])
+
+        controller_class = SparseLotteryAssignmentController if options['sparse'] else LotteryAssignmentController
+        try:
+            controller = controller_class(program, num_runs=options['runs'], seed=options['seed'], processes=options['processes'], objective=options['objective'], sparse=options['sparse'])
+            controller.compute_best_assignments()
+        except LotteryException as e:
+            raise CommandError(str(e))
+
+        for label, lines in controller.extract_stats(controller.compute_stats(display=False)):
+            self.stdout.write('%s:' % label.title())
+            for line in lines:
+                self.stdout.write(line)
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(controller.export_assignments())
+        if options['save']:
+            controller.save_assignments()
+            self.stdout.write('Saved the assignments for seed %d.' % controller.seed)
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-17 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('program', '0030_auto_20260106_2204'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClassCatalogEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('teacher_ids', models.TextField(blank=True, default='')),
+                ('teacher_names', models.TextField(blank=True, default='')),
+                ('media_count', models.IntegerField(default=0)),
+                ('has_index_qsd', models.BooleanField(default=False)),
+                ('app_question_count', models.IntegerField(default=0)),
+                ('last_modified', models.DateTimeField(auto_now=True)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='catalog_entries', to='program.ClassCategories')),
+                ('program', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='catalog_entries', to='program.Program')),
+                ('section', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='catalog_entries', to='program.ClassSection')),
+                ('subject', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='catalog_entries', to='program.ClassSubject')),
+            ],
+            options={
+                'verbose_name_plural': 'class catalog entries',
+                'db_table': 'program_classcatalogentry',
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-17 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('program', '0031_classcatalogentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegistrationCacheEpoch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('epoch', models.IntegerField(default=0)),
+                ('program', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='registration_cache_epoch', to='program.Program')),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.28 on 2026-10-17 12:00
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+from esp.program.archive_search import search_vector
+
+def create_search_index(apps, schema_editor):
+    # Full-text search is only indexed on PostgreSQL; elsewhere
+    # esp.program.archive_search builds an index in-process.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    ArchiveClass = apps.get_model('program', 'ArchiveClass')
+    ArchiveClass.objects.update(search_vector=search_vector())
+    schema_editor.execute('CREATE INDEX program_archiveclass_search_vector_gin ON program_archiveclass USING gin (search_vector)')
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS program_archiveclass_search_vector_gin')
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('program', '0032_registrationcacheepoch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archiveclass',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 2.2.28 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+def backfill_catalog_entries(apps, schema_editor):
+    # This mirrors ClassCatalogEntry.build_entries(), with historical models.
+    ClassCatalogEntry = apps.get_model('program', 'ClassCatalogEntry')
+    ClassSubject = apps.get_model('program', 'ClassSubject')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Media = apps.get_model('qsdmedia', 'Media')
+    QuasiStaticData = apps.get_model('qsd', 'QuasiStaticData')
+
+    # Drop any duplicates left by concurrent refreshes; the class gets rebuilt
+    # below.
+    seen = set()
+    duplicated = set()
+    for entry_id, subject_id, section_id in ClassCatalogEntry.objects.order_by('id').values_list('id', 'subject_id', 'section_id'):
+        if (subject_id, section_id) in seen:
+            duplicated.add(subject_id)
+        seen.add((subject_id, section_id))
+    ClassCatalogEntry.objects.filter(subject__in=duplicated).delete()
+
+    content_type = ContentType.objects.filter(app_label='program', model='classsubject').first()
+    subjects = ClassSubject.objects.filter(catalog_entries__isnull=True).select_related('parent_program', 'category')
+    for subject in subjects.iterator():
+        teachers = list(subject.teachers.all().order_by('last_name', 'first_name', 'id'))
+        url = '%s/Classes/%s%s' % (subject.parent_program.url, subject.category.symbol, subject.id)
+        fields = {
+            'program_id': subject.parent_program_id,
+            'category_id': subject.category_id,
+            'teacher_ids': '|' + '|'.join(str(t.id) for t in teachers) + '|' if teachers else '',
+            'teacher_names': ', '.join('%s %s' % (t.first_name, t.last_name) for t in teachers),
+            'media_count': Media.objects.filter(owner_type=content_type, owner_id=subject.id).count() if content_type else 0,
+            'has_index_qsd': QuasiStaticData.objects.filter(name='learn:index', url__startswith='learn/' + url + '/index').exists(),
+            'app_question_count': subject.studentappquestion_set.count(),
+        }
+        section_ids = list(subject.sections.order_by('id').values_list('id', flat=True)) or [None]
+        ClassCatalogEntry.objects.bulk_create([ClassCatalogEntry(subject=subject, section_id=section_id, **fields)
+                                               for section_id in section_ids])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('qsd', '0004_clean_class_qsds'),
+        ('qsdmedia', '0003_auto_20260106_2204'),
+        ('program', '0033_archiveclass_search_vector'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_catalog_entries, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='classcatalogentry',
+            constraint=models.UniqueConstraint(fields=('subject', 'section'), name='classcatalogentry_subject_section'),
+        ),
+        migrations.AddConstraint(
+            model_name='classcatalogentry',
+            constraint=models.UniqueConstraint(condition=models.Q(section__isnull=True), fields=('subject',), name='classcatalogentry_subject_no_section'),
+        ),
+    ]
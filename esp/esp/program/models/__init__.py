@@ -1,5 +1,5 @@
 from django.utils.encoding import python_2_unicode_compatible
-from functools import reduce
+from functools import lru_cache, partial, reduce
 __author__    = "Individual contributors (see AUTHORS file)"
 __date__      = "$DATE$"
 __rev__       = "$REV$"
@@ -37,7 +37,7 @@
 import copy
 import re
 from collections import defaultdict, OrderedDict
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta
 from decimal import Decimal
 import random
 import json
@@ -46,14 +46,18 @@
 
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericRelation
+from django.contrib.postgres.search import SearchVectorField
 from phonenumber_field.modelfields import PhoneNumberField
 from django.core import validators
 from django.core.cache import cache
-from django.db import models
+from django.db import connection, models, transaction
 from django.db.models import Count
+from django.db.models import F
+from django.db.models import Max, Min
+from django.db.models.functions import TruncDate
 from django.db.models import Q
 from django.db.models.query import QuerySet
-from django.db.models.signals import m2m_changed
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 from django.template.loader import render_to_string
 from django.utils import timezone
@@ -66,10 +70,13 @@
 from esp.dbmail.models import send_mail
 from esp.middleware import ESPError, AjaxError
 from esp.tagdict.models import Tag
-from esp.users.models import ContactInfo, StudentInfo, TeacherInfo, EducatorInfo, GuardianInfo, ESPUser, Record
+from esp.users.models import ContactInfo, StudentInfo, TeacherInfo, EducatorInfo, GuardianInfo, ESPUser, Record, UserAvailability
+from esp.program import archive_search
+from esp.program.class_status import ClassStatus
 from esp.utils.expirable_model import ExpirableModel
 from esp.utils.formats import format_lazy
 from esp.qsdmedia.models import Media
+from esp.utils import request_cache
 
 # Create your models here.
 @python_2_unicode_compatible
@@ -153,6 +160,9 @@ class ArchiveClass(models.Model):
 
     num_old_students = models.IntegerField(default=0)
 
+    #   Maintained by esp.program.archive_search; only used on PostgreSQL.
+    search_vector = SearchVectorField(null=True, editable=False)
+
     class Meta:
         app_label = 'program'
         db_table = 'program_archiveclass'
@@ -240,6 +250,15 @@ def getForUser(user):
         Q_Class = Q_ClassTeacher #  | Q_ClassStudent
         return ArchiveClass.objects.filter(Q_Class).order_by('-year', '-date', 'title')
 
+@receiver(post_save, sender=ArchiveClass, dispatch_uid='archive_class_search_save')
+def _update_archive_search(sender, instance, raw=False, **kwargs):
+    if not raw:
+        archive_search.update_search_vectors(ArchiveClass.objects.filter(id=instance.id))
+
+@receiver(post_delete, sender=ArchiveClass, dispatch_uid='archive_class_search_delete')
+def _reset_archive_search(sender, **kwargs):
+    archive_search.InvertedIndex.reset()
+
 def _get_type_url(type):
     def _really_get_type_url(self):
         if hasattr(self, '_type_url'):
@@ -618,6 +637,7 @@ def _student_is_in_program(self, user):
     _student_is_in_program.depend_on_row('program.ClassSubject', lambda cls: {'self': cls.parent_program})
     _student_is_in_program.depend_on_row('program.ClassSection', lambda cls: {'self': cls.parent_class.parent_program})
     _student_is_in_program.depend_on_row('program.StudentRegistration', lambda sr: {'user': sr.user})
+    _student_is_in_program.depend_on_row('program.RegistrationCacheEpoch', lambda epoch: {'self': epoch.program})
     _student_is_in_program.depend_on_row('program.StudentSubjectInterest', lambda ssi: {'user': ssi.user})
     _student_is_in_program.get_or_create_token(('self',))
     _student_is_in_program.get_or_create_token(('user',))
@@ -727,6 +747,28 @@ def getScheduleConstraints(self):
     getScheduleConstraints.depend_on_model('program.ScheduleTestCategory')
     getScheduleConstraints.depend_on_model('program.ScheduleTestSectionList')
 
+    @cache_function
+    def getCompiledScheduleConstraints(self):
+        return CompiledScheduleConstraints(self, self.getScheduleConstraints().order_by('id'))
+    getCompiledScheduleConstraints.depend_on_cache(getScheduleConstraints, lambda self=wildcard, **kwargs: {'self': self})
+    getCompiledScheduleConstraints.depend_on_model('program.BooleanExpression')
+    # Category tests are compiled into lists of the program's sections in
+    # each category, so we also need to know when those change.
+    getCompiledScheduleConstraints.depend_on_row('program.ClassSubject', lambda cls: {'self': cls.parent_program})
+    getCompiledScheduleConstraints.depend_on_row('program.ClassSection', lambda sec: {'self': sec.parent_class.parent_program})
+
+    @cache_function
+    def getTeacherAvailabilityMatrix(self):
+        return TeacherAvailabilityMatrix(self)
+    getTeacherAvailabilityMatrix.depend_on_row('users.UserAvailability', lambda ua: {'self': ua.event.program})
+    getTeacherAvailabilityMatrix.depend_on_row('program.ClassSubject', lambda cls: {'self': cls.parent_program})
+    getTeacherAvailabilityMatrix.depend_on_row('program.ClassSection', lambda sec: {'self': sec.parent_class.parent_program})
+    getTeacherAvailabilityMatrix.depend_on_m2m('program.ClassSubject', 'teachers', lambda cls, teacher: {'self': cls.parent_program})
+    getTeacherAvailabilityMatrix.depend_on_m2m('program.ClassSection', 'moderators', lambda sec, moderator: {'self': sec.parent_class.parent_program})
+    getTeacherAvailabilityMatrix.depend_on_m2m('program.ClassSection', 'meeting_times', lambda sec, event: {'self': sec.parent_class.parent_program})
+    getTeacherAvailabilityMatrix.depend_on_m2m('program.Program', 'program_modules', lambda prog, pm: {'self': prog})
+    getTeacherAvailabilityMatrix.depend_on_row(Event, lambda event: {'self': event.program})
+
     def lock_schedule(self, lock_level=1):
         """ Locks all schedule assignments for the program, for convenience
             (e.g. between scheduling some sections manually and running
@@ -889,7 +931,18 @@ def getTimeSlotList(self, include_all=False):
             return list(self.getTimeSlots(exclude_types=[]))
         else:
             return list(self.getTimeSlots())
-    getTimeSlotList.depend_on_model('cal.Event')
+    getTimeSlotList.depend_on_row(Event, lambda event: {'self': event.program})
+
+    @cache_function
+    def schedule_bitmask_version(self):
+        """ A random token naming the current version of the students'
+            ScheduleBitmasks for this program.  It changes, so that they are
+            all rebuilt, when the program's timeslots or the times its sections
+            meet at change, or its RegistrationCacheEpoch is bumped. """
+        return '%016x' % random.getrandbits(64)
+    schedule_bitmask_version.depend_on_row(Event, lambda event: {'self': event.program})
+    schedule_bitmask_version.depend_on_m2m('program.ClassSection', 'meeting_times', lambda sec, event: {'self': sec.parent_class.parent_program})
+    schedule_bitmask_version.depend_on_row('program.RegistrationCacheEpoch', lambda epoch: {'self': epoch.program})
 
     def total_duration(self):
         """ Returns the total length of the events in this program, as a timedelta object. """
@@ -899,20 +952,42 @@ def total_duration(self):
             time_sum = time_sum + t.duration()
         return time_sum
 
+    @cache_function
+    def timeline(self):
+        """ A tuple (start, end, dates): the start of the program's first
+            class timeslot, the end of its last, and the sorted list of dates
+            it has timeslots on; or None if it has no timeslots.
+
+            This is cached per program, so that code which looks at the dates
+            of many programs only needs a query for those whose timeslots
+            have changed.
+        """
+        days = list(Event.objects.filter(program=self, event_type__description='Class Time Block').annotate(day=TruncDate('start')).values('day').annotate(first=Min('start'), last=Max('end')).order_by('day'))
+        if not days:
+            return None
+        return (days[0]['first'], max(row['last'] for row in days), [row['day'] for row in days])
+    timeline.depend_on_row(Event, lambda event: {'self': event.program})
+
     def dates(self):
-        result = []
-        for ts in self.getTimeSlotList():
-            ts_day = date(ts.start.year, ts.start.month, ts.start.day)
-            if ts_day not in result:
-                result.append(ts_day)
-        return result
+        timeline = self.timeline()
+        if timeline:
+            return list(timeline[2])
+        return []
 
     def datetime_range(self):
-        slots = self.getTimeSlots()
-        if slots:
-            return (min(slots).start, max(slots).end)
+        timeline = self.timeline()
+        if timeline:
+            return timeline[:2]
         return None
 
+    def past_program_ids(self):
+        """ The ids of the programs whose first timeslot is on an earlier
+            date than the first timeslot of this program. """
+        dates = self.dates()
+        if not dates:
+            return []
+        return [program.id for program in Program.objects.exclude(id=self.id) if program.dates() and program.dates()[0] < dates[0]]
+
     # @staticmethod --- applied below after the depend_on_model call
     @cache_function_for(60*60*24)
     def current_programs():
@@ -976,7 +1051,7 @@ def currentness_penalty(program):
             else:
                 return [tagged_programs[0][1]]
         return []
-    current_programs.depend_on_model('cal.Event')
+    current_programs.depend_on_cache(timeline, lambda self=wildcard, **kwargs: {})
     current_programs.depend_on_model('program.Program')
     current_programs = staticmethod(current_programs)
 
@@ -1914,6 +1989,242 @@ def __marinade__(self):
     def __str__(self):
         return '%s' % self.map
 
+class ScheduleBitmask(object):
+    """ A compact summary of a student's registrations in a program, for
+        quickly checking whether they can add a section.
+
+        Each of the program's timeslots is assigned a bit; we keep a mask of
+        the timeslots the student is enrolled in, the IDs of the subjects they
+        are enrolled in, and for each priority level, a mask of the timeslots
+        where they have already used that priority.  These are cached per user
+        and program (see get()), so checking a section against them doesn't
+        need any queries.
+
+        When one of the student's registrations is saved or deleted, the
+        cached copy is updated with just that registration (see
+        registration_changed()) rather than being rebuilt.  Changes to the
+        program's timeslots, or to when its sections meet, rebuild every
+        student's copy (see Program.schedule_bitmask_version()).
+    """
+
+    #   How long cached bitmasks live, and how long to keep one that was
+    #   updated for a registration whose transaction hasn't committed yet.
+    timeout = timedelta(hours=12).total_seconds()
+    uncommitted_timeout = 60
+
+    def __init__(self, user, program):
+        self.slot_bits = {}
+        for timeslot in program.getTimeSlotList(include_all=True):
+            self.slot_bits[timeslot.id] = 1 << len(self.slot_bits)
+
+        #   Registration ID -> (subject ID, relationship name, timeslot IDs)
+        self.registrations = {}
+        registrations = StudentRegistration.valid_objects().filter(
+            user=user, section__parent_class__parent_program=program,
+        ).values_list('id', 'section__parent_class', 'relationship__name', 'section__meeting_times')
+        for (registration_id, subject_id, verb, timeslot_id) in registrations:
+            (subject_id, verb, timeslot_ids) = self.registrations.setdefault(registration_id, (subject_id, verb, []))
+            if timeslot_id is not None:
+                timeslot_ids.append(timeslot_id)
+        self.update_masks()
+
+    def update_masks(self):
+        self.enrolled = 0
+        self.enrolled_subjects = set()
+        self.priorities = {}
+        for (subject_id, verb, timeslot_ids) in self.registrations.values():
+            bits = self.mask(timeslot_ids)
+            if verb == 'Enrolled':
+                self.enrolled |= bits
+                self.enrolled_subjects.add(subject_id)
+            elif verb.startswith('Priority'):
+                try:
+                    level = int(verb[9:])
+                except ValueError: # 'Priority' is set, rather than 'Priority/1'
+                    level = 1
+                self.priorities[level] = self.priorities.get(level, 0) | bits
+
+    def apply(self, registration_id, entry):
+        """ Record a change to one registration: entry is its (subject ID,
+            relationship name, timeslot IDs), or None if it is no longer
+            valid. """
+        if entry is None:
+            self.registrations.pop(registration_id, None)
+        else:
+            self.registrations[registration_id] = entry
+        self.update_masks()
+
+    @staticmethod
+    def cache_key(user_id, program):
+        return 'schedule_bitmask:%d:%d:%s' % (user_id, program.id, program.schedule_bitmask_version())
+
+    @classmethod
+    def get(cls, user, program):
+        key = cls.cache_key(user.id, program)
+        bitmask = cache.get(key)
+        if bitmask is None:
+            bitmask = cls(user, program)
+            #   Don't overwrite a copy that was updated while we built this.
+            cache.add(key, bitmask, cls.timeout)
+        return bitmask
+
+    @classmethod
+    def update_cached(cls, key, registration_id, entry, timeout):
+        #   Start from the cache's copy, not one this request read earlier, so
+        #   that we don't undo another process's update.
+        with request_cache.suspended():
+            bitmask = cache.get(key)
+            if bitmask is not None:
+                bitmask.apply(registration_id, entry)
+                cache.set(key, bitmask, timeout)
+
+    @classmethod
+    def registration_changed(cls, registration, deleted=False):
+        """ Update the student's cached bitmask, if there is one, for a
+            registration that was saved or deleted. """
+        try:
+            section = registration.section
+        except ClassSection.DoesNotExist:
+            return
+        key = cls.cache_key(registration.user_id, section.parent_program)
+        if deleted or not registration.is_valid():
+            entry = None
+        else:
+            entry = (section.parent_class_id, registration.relationship.name, list(section.timeslot_ids()))
+        if connection.in_atomic_block:
+            #   The rest of the transaction should see the change right away,
+            #   but if it is rolled back, the updated copy must not outlive it
+            #   for long; once it commits, keep it for as long as usual.
+            cls.update_cached(key, registration.id, entry, cls.uncommitted_timeout)
+            transaction.on_commit(partial(cls.update_cached, key, registration.id, entry, cls.timeout))
+        else:
+            cls.update_cached(key, registration.id, entry, cls.timeout)
+
+    def mask(self, timeslot_ids):
+        result = 0
+        for timeslot_id in timeslot_ids:
+            result |= self.slot_bits.get(timeslot_id, 0)
+        return result
+
+    def is_enrolled_in_subject(self, subject_id):
+        return subject_id in self.enrolled_subjects
+
+    def conflicts(self, timeslot_ids):
+        """ Is the student enrolled in anything at any of these timeslots? """
+        return bool(self.enrolled & self.mask(timeslot_ids))
+
+    def priority(self, timeslot_ids):
+        """ Finds the highest available priority level across the supplied
+            timeslots, as in ESPUser.getRegistrationPriority. """
+        mask = self.mask(timeslot_ids)
+        if not timeslot_ids or self.enrolled & mask:
+            return 0
+        priority = 1
+        while self.priorities.get(priority, 0) & mask:
+            priority += 1
+        return priority
+
+class TeacherAvailabilityMatrix(object):
+    """ The availability of all of a program's teachers and moderators, as
+        bitmasks over the program's timeslots, built in a few bulk queries.
+
+        For each user we keep a mask of the timeslots they said they are
+        available for, a mask of the timeslots they are moderating in, and for
+        each section they teach, a mask of the timeslots it meets in.  This
+        lets us answer the same questions as ESPUser.getAvailableTimes() for
+        any number of users and sections without further queries.  It is
+        cached per program (see Program.getTeacherAvailabilityMatrix).
+    """
+    def __init__(self, program):
+        from esp.program.models.class_ import ClassSection
+
+        #   Index every event in the program, so that meeting times which
+        #   aren't class time blocks can still conflict.
+        self.timeslots = list(program.getTimeSlots(exclude_types=[]))
+        self.slot_bits = {}
+        self.class_mask = 0
+        for timeslot in self.timeslots:
+            bit = 1 << len(self.slot_bits)
+            self.slot_bits[timeslot.id] = bit
+            if timeslot.event_type.description == 'Class Time Block':
+                self.class_mask |= bit
+
+        #   Without the availability module, everyone is always available.
+        self.use_availability = program.hasModule('AvailabilityModule')
+        self.available = {}
+        if self.use_availability:
+            for (user_id, event_id) in UserAvailability.objects.filter(
+                    event__program=program,
+                    event__event_type__description='Class Time Block',
+                    ).values_list('user_id', 'event_id'):
+                self.available[user_id] = self.available.get(user_id, 0) | self.slot_bits.get(event_id, 0)
+
+        #   Sections taught, as in ESPUser.getTaughtSections(); we also note
+        #   which are cancelled, since those don't count as conflicts.
+        self.teaching = {}
+        self.cancelled_sections = set()
+        for (section_id, status, class_status, user_id, event_id) in ClassSection.objects.filter(
+                parent_class__parent_program=program,
+                parent_class__teachers__isnull=False,
+                ).exclude(status=ClassStatus.REJECTED).exclude(parent_class__status=ClassStatus.REJECTED).values_list(
+                'id', 'status', 'parent_class__status', 'parent_class__teachers', 'meeting_times'):
+            sections = self.teaching.setdefault(user_id, {})
+            sections[section_id] = sections.get(section_id, 0) | self.slot_bits.get(event_id, 0)
+            if status == ClassStatus.CANCELLED or class_status == ClassStatus.CANCELLED:
+                self.cancelled_sections.add(section_id)
+
+        self.moderating = {}
+        for (user_id, event_id) in ClassSection.objects.filter(
+                parent_class__parent_program=program,
+                moderators__isnull=False,
+                ).values_list('moderators', 'meeting_times'):
+            self.moderating[user_id] = self.moderating.get(user_id, 0) | self.slot_bits.get(event_id, 0)
+
+    def mask(self, event_ids):
+        result = 0
+        for event_id in event_ids:
+            result |= self.slot_bits.get(event_id, 0)
+        return result
+
+    def events(self, mask):
+        """ The Events in the mask, in order of start time. """
+        return [timeslot for timeslot in self.timeslots if self.slot_bits[timeslot.id] & mask]
+
+    def available_mask(self, user_id, ignore_classes=False, ignore_moderation=False, ignore_sections=()):
+        """ The timeslots a user can teach in, as ESPUser.getAvailableTimes()
+            would return them.  ignore_sections is a list of section IDs. """
+        if self.use_availability:
+            mask = self.available.get(user_id, 0)
+        else:
+            mask = self.class_mask
+        if not ignore_classes:
+            for (section_id, section_mask) in self.teaching.get(user_id, {}).items():
+                if section_id not in ignore_sections:
+                    mask &= ~section_mask
+        if not ignore_moderation:
+            mask &= ~self.moderating.get(user_id, 0)
+        return mask
+
+    def common_mask(self, user_ids, **kwargs):
+        """ The timeslots all of the given users can teach in. """
+        if not user_ids:
+            return 0
+        mask = -1
+        for user_id in user_ids:
+            mask &= self.available_mask(user_id, **kwargs)
+        return mask
+
+    def teaching_conflict(self, user_id, mask, exclude_section_id=None):
+        """ Find a non-cancelled section the user teaches that meets during
+            the mask, returning (section ID, Event) or None. """
+        for (section_id, section_mask) in sorted(self.teaching.get(user_id, {}).items()):
+            if section_id == exclude_section_id or section_id in self.cancelled_sections:
+                continue
+            overlap = section_mask & mask
+            if overlap:
+                return (section_id, self.events(overlap)[0])
+        return None
+
 @python_2_unicode_compatible
 class ScheduleConstraint(models.Model):
     """ A scheduling constraint that can be tested:
@@ -1963,12 +2274,27 @@ def evaluate(self, smap, recursive=True):
             return True
 
     def handle_failure(self):
+        return ScheduleConstraint.run_failure_handler(self.on_failure, self.schedule_map)
+
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _compile_failure_handler(on_failure):
+        """ Compile the on_failure code of a constraint into a function of the
+            schedule map.  The most recently used ones are kept, by source
+            text, so that each is usually compiled once per process. """
+        func_str = """def _f(schedule_map):
+%s""" % ('\n'.join('    %s' % l.rstrip() for l in on_failure.strip().split('\n')))
+        namespace = dict(globals())
+        exec(func_str, namespace)
+        return namespace['_f']
+
+    @staticmethod
+    def run_failure_handler(on_failure, schedule_map):
+        """ Run the on_failure code of a constraint on schedule_map, returning
+            a tuple whose first element may be an updated ScheduleMap. """
         #   Try the on_failure callback but be very lenient about it (fail silently)
         try:
-            func_str = """def _f(schedule_map):
-%s""" % ('\n'.join('    %s' % l.rstrip() for l in self.on_failure.strip().split('\n')))
-            exec(func_str)
-            result = _f(self.schedule_map)
+            result = ScheduleConstraint._compile_failure_handler(on_failure)(schedule_map)
             return result
         except Exception as inst:
             #   raise ESPError('Schedule constraint handler error: %s' % inst, log=False)
@@ -2051,6 +2377,132 @@ def filter_by_sections(cls, sections):
 
         return cls.objects.filter( reduce(operator.or_, q_list) )
 
+class CompiledScheduleConstraints(object):
+    """ A program's schedule constraints, compiled into a form that can be
+        checked against a student's schedule without touching the database.
+
+        Each BooleanExpression is compiled from its token stack into a tree of
+        tuples, which is evaluated against bitmasks over the timeblocks the
+        constraints refer to: one for the timeblocks the student is occupied
+        in, and one per section for the timeblocks it takes up.  Category
+        tests are compiled into tests for the program's sections in that
+        category.  The whole thing can be pickled, so the program caches it
+        (see Program.getCompiledScheduleConstraints).
+    """
+    def __init__(self, program, constraints):
+        self.program_id = program.id
+        self.slot_bits = {}
+        self.category_sections = {}
+        self.constraints = []
+        for constraint in constraints:
+            self.constraints.append((
+                self._compile(constraint.condition.get_stack()),
+                self._compile(constraint.requirement.get_stack()),
+                constraint.requirement.label,
+                constraint.on_failure.strip(),
+            ))
+
+    def __len__(self):
+        return len(self.constraints)
+
+    def _bit(self, timeblock_id):
+        if timeblock_id not in self.slot_bits:
+            self.slot_bits[timeblock_id] = 1 << len(self.slot_bits)
+        return self.slot_bits[timeblock_id]
+
+    def _sections_in_category(self, category_id):
+        if category_id not in self.category_sections:
+            from esp.program.models.class_ import ClassSection
+            self.category_sections[category_id] = frozenset(ClassSection.objects.filter(parent_class__parent_program=self.program_id, parent_class__category_id=category_id).values_list('id', flat=True))
+        return self.category_sections[category_id]
+
+    def _compile(self, stack):
+        """ Compile a token stack, as in BooleanToken.evaluate(). """
+        stack = list(stack)
+        def pop():
+            if not stack:
+                return ('const', None)
+            token = stack.pop()
+            if (token.text == '||') or (token.text.lower() == 'or'):
+                return ('or', pop(), pop())
+            elif (token.text == '&&') or (token.text.lower() == 'and'):
+                return ('and', pop(), pop())
+            elif (token.text == '!') or (token.text == '~') or (token.text.lower() == 'not'):
+                return ('not', pop())
+            elif isinstance(token, ScheduleTestOccupied):
+                return ('occupied', self._bit(token.timeblock_id))
+            elif isinstance(token, ScheduleTestCategory):
+                return ('sections', self._bit(token.timeblock_id), self._sections_in_category(token.category_id))
+            elif isinstance(token, ScheduleTestSectionList):
+                return ('sections', self._bit(token.timeblock_id), frozenset(int(a) for a in token.section_ids.split(',')))
+            else:
+                return ('const', BooleanToken.boolean_value(token))
+        return pop()
+
+    def _evaluate(self, tree, occupied, section_masks):
+        op = tree[0]
+        if op == 'const':
+            return tree[1]
+        elif op == 'occupied':
+            return bool(occupied & tree[1])
+        elif op == 'sections':
+            bit = tree[1]
+            return any(section_masks.get(sec_id, 0) & bit for sec_id in tree[2])
+        elif op == 'not':
+            return not self._evaluate(tree[1], occupied, section_masks)
+        elif op == 'and':
+            return self._evaluate(tree[1], occupied, section_masks) and self._evaluate(tree[2], occupied, section_masks)
+        else:
+            return self._evaluate(tree[1], occupied, section_masks) or self._evaluate(tree[2], occupied, section_masks)
+
+    def masks(self, sections):
+        """ Compute the (occupied, section_masks) bitmasks for a schedule
+            consisting of the given sections. """
+        occupied = 0
+        section_masks = {}
+        for sec in sections:
+            if hasattr(sec, '_timeslot_ids'):
+                timeslot_ids = sec._timeslot_ids
+            else:
+                timeslot_ids = sec.timeslot_ids()
+            mask = 0
+            for timeslot_id in timeslot_ids:
+                mask |= self.slot_bits.get(timeslot_id, 0)
+            occupied |= mask
+            section_masks[sec.id] = section_masks.get(sec.id, 0) | mask
+        return (occupied, section_masks)
+
+    def _satisfied(self, constraint, masks):
+        (condition, requirement, label, on_failure) = constraint
+        return not self._evaluate(condition, *masks) or self._evaluate(requirement, *masks)
+
+    def violation(self, sections, get_schedule_map=None):
+        """ Check a schedule consisting of the given sections against the
+            constraints, as ScheduleConstraint.evaluate() would.  Returns the
+            requirement label of the first violated constraint, or None.
+
+            If get_schedule_map is given, constraints with an on_failure
+            handler get a chance to fix the schedule: get_schedule_map() should
+            return the ScheduleMap to pass to the handler.
+        """
+        masks = self.masks(sections)
+        schedule_map = None
+        for constraint in self.constraints:
+            if self._satisfied(constraint, masks):
+                continue
+            on_failure = constraint[3]
+            if get_schedule_map is None or not on_failure:
+                return constraint[2]
+            if schedule_map is None:
+                schedule_map = get_schedule_map()
+            (fail_result, data) = ScheduleConstraint.run_failure_handler(on_failure, schedule_map)
+            if isinstance(fail_result, ScheduleMap):
+                schedule_map = fail_result
+            masks = self.masks(sec for secs in schedule_map.map.values() for sec in secs)
+            if not self._satisfied(constraint, masks):
+                return constraint[2]
+        return None
+
 @python_2_unicode_compatible
 class VolunteerRequest(models.Model):
     program = models.ForeignKey(Program, on_delete=models.CASCADE)
@@ -2186,6 +2638,34 @@ def __str__(self):
     class Meta:
         app_label = 'program'
 
+@python_2_unicode_compatible
+class RegistrationCacheEpoch(models.Model):
+    """
+    A counter which is bumped to expire every cache that depends on a
+    program's student registrations at once.
+
+    Each of those caches depends on this row as well as on
+    StudentRegistration, so code that changes many registrations without
+    save() (e.g. with QuerySet.update()) can call bump() once instead of
+    sending post_save for every registration.
+    """
+    program = models.OneToOneField(Program, related_name='registration_cache_epoch', on_delete=models.CASCADE)
+    epoch = models.IntegerField(default=0)
+
+    class Meta:
+        app_label = 'program'
+
+    def __str__(self):
+        return 'Registration cache epoch %d for %s' % (self.epoch, self.program)
+
+    @classmethod
+    def bump(cls, program):
+        """ Expire all of the registration-derived caches for a program. """
+        epoch, created = cls.objects.get_or_create(program=program)
+        #   save() rather than update(), so that post_save expires the caches.
+        epoch.epoch = F('epoch') + 1
+        epoch.save(update_fields=['epoch'])
+
 @python_2_unicode_compatible
 class StudentRegistration(ExpirableModel):
     """
@@ -2202,6 +2682,38 @@ class Meta:
     def __str__(self):
         return '%s %s in %s' % (self.user, self.relationship, self.section)
 
+    @staticmethod
+    def invalidate_caches(registrations):
+        """ Expire the caches that depend on a batch of registrations that were
+        created or changed without save(), e.g. by bulk_create() or update(),
+        and recompute enrolled_students for their sections.
+
+        Rather than sending post_save for each registration, this bumps the
+        RegistrationCacheEpoch of each program involved, which expires all
+        of that program's registration-derived caches in one go.  The onsite
+        change feed does want every registration, so it is told about them
+        directly. """
+        registrations = list(registrations)
+        section_ids = {reg.section_id for reg in registrations}
+        if not section_ids:
+            return
+
+        program_ids = ClassSection.objects.filter(id__in=section_ids).values_list('parent_class__parent_program', flat=True).distinct()
+        for program in Program.objects.filter(id__in=list(program_ids)):
+            RegistrationCacheEpoch.bump(program)
+
+        ClassSection.bulk_sync_enrolled_students(section_ids)
+        ProgramChangeFeed.registrations_changed(registrations)
+
+@receiver(post_save, sender=StudentRegistration, dispatch_uid='schedule_bitmask_registration_save')
+def _schedule_bitmask_registration_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        ScheduleBitmask.registration_changed(instance)
+
+@receiver(post_delete, sender=StudentRegistration, dispatch_uid='schedule_bitmask_registration_delete')
+def _schedule_bitmask_registration_deleted(sender, instance, **kwargs):
+    ScheduleBitmask.registration_changed(instance, deleted=True)
+
 @python_2_unicode_compatible
 class StudentSubjectInterest(ExpirableModel):
     """
@@ -2255,6 +2767,7 @@ def signal_handler(sender, **kwargs):
 from esp.program.models.class_ import *
 from esp.program.models.app_ import *
 from esp.program.models.flags import *
+from esp.program.models.change_feed import ProgramChangeFeed
 
 def install():
     from esp.program.models.class_ import install as install_class
@@ -37,6 +37,8 @@
 from esp.users.models import ESPUser
 
 from django.db import models
+from django.db.models import signals
+from django.dispatch import receiver
 from django import forms
 from django.utils.deconstruct import deconstructible
 
@@ -142,6 +144,14 @@ class Meta:
         app_label = 'program'
         db_table = 'program_studentappquestion'
 
+@receiver(signals.post_save, sender=StudentAppQuestion, dispatch_uid='catalog_entry_appquestion_save')
+@receiver(signals.post_delete, sender=StudentAppQuestion, dispatch_uid='catalog_entry_appquestion_delete')
+def _catalog_app_question_changed(sender, instance, signal, raw=False, **kwargs):
+    #   The catalog shows how many application questions each class has.
+    from esp.program.models.class_ import ClassCatalogEntry
+    if not raw and instance.subject_id is not None:
+        ClassCatalogEntry.refresh_subject(instance.subject_id, create=(signal is not signals.post_delete))
+
 @python_2_unicode_compatible
 class StudentAppResponse(BaseAppElement, models.Model):
     """ A response to an application question. """
@@ -0,0 +1,243 @@
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of the ESP Web Site
+Copyright (c) 2008 by the individual contributors
+  (see AUTHORS file)
+
+The ESP Web Site is free software; you can redistribute it and/or
+modify it under the terms of the GNU Affero General Public License
+as published by the Free Software Foundation; either version 3
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Contact information:
+MIT Educational Studies Program
+  84 Massachusetts Ave W20-467, Cambridge, MA 02139
+  Phone: 617-253-4882
+  Email: esp-webmasters@mit.edu
+Learning Unlimited, Inc.
+  527 Franklin St, Cambridge, MA 02139
+  Phone: 617-379-0178
+  Email: web-team@learningu.org
+"""
+
+from collections import defaultdict
+from datetime import timedelta
+import functools
+import time
+
+from django.apps import apps
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import signals
+from django.dispatch import receiver
+
+from esp.program.models import Program, StudentRegistration
+from esp.program.models.class_ import ClassSection
+from esp.tagdict.models import Tag
+from esp.utils import request_cache
+
+class ProgramChangeFeed(object):
+    """ Lets clients wait for a program's schedule or enrollment to change.
+
+    For each program we keep two cursors in the cache: the latest
+    AJAXChangeLog index, and a sequence number that advances whenever one of
+    its StudentRegistrations is created, changed or deleted (each step also
+    records the (section, user) pair involved).  Waiting on the feed only
+    reads the cache, so the AJAX scheduler and the onsite grid can hold a
+    request open until there is something new, instead of re-running their
+    status queries every few seconds; and the onsite grid can ask for just
+    the enrollments that changed since it last looked.
+    """
+
+    #   How long cached cursors live (the same as AJAXChangeLog.max_log_age,
+    #   how long the scheduler's change log keeps entries), and how many
+    #   registration changes we will replay before just sending everything.
+    timeout = timedelta(hours=12).total_seconds()
+    max_replay = 500
+
+    #   How often a waiting request checks the cache, in seconds.
+    poll_interval = 0.5
+
+    def __init__(self, program):
+        if isinstance(program, Program):
+            program = program.id
+        self.program_id = program
+
+    def cache_key(self, *parts):
+        return 'program_change_feed:%d:%s' % (self.program_id, ':'.join(str(part) for part in parts))
+
+    @staticmethod
+    def request_timeout(request, program):
+        """ How long a request for the feed may wait: the 'timeout' GET
+        parameter, capped by the change_feed_timeout tag. """
+        max_timeout = float(Tag.getProgramTag('change_feed_timeout', program))
+        try:
+            timeout = float(request.GET.get('timeout', max_timeout))
+        except ValueError:
+            timeout = max_timeout
+        return max(0.0, min(timeout, max_timeout))
+
+    @staticmethod
+    def request_cursor(request):
+        """ The 'since' GET parameter, or None if it's missing or invalid. """
+        try:
+            return int(request.GET['since'])
+        except (KeyError, ValueError):
+            return None
+
+    @classmethod
+    def registrations_changed(cls, registrations):
+        """ Record that these StudentRegistrations were created, changed or
+        deleted, once the current transaction commits (so that anyone we tell
+        will be able to see the change). """
+        registrations = list(registrations)
+        pairs = {(reg.section_id, reg.user_id) for reg in registrations}
+        #   Registrations usually come with their section and class already
+        #   loaded (e.g. from preregister_student()), so only look up the rest.
+        programs = {}
+        for reg in registrations:
+            if StudentRegistration.section.is_cached(reg) and ClassSection.parent_class.is_cached(reg.section):
+                programs[reg.section_id] = reg.section.parent_class.parent_program_id
+        missing = {section_id for (section_id, user_id) in pairs} - set(programs)
+        if missing:
+            programs.update(ClassSection.objects.filter(id__in=missing).values_list('id', 'parent_class__parent_program'))
+        program_pairs = defaultdict(list)
+        for (section_id, user_id) in sorted(pairs):
+            if section_id in programs:
+                program_pairs[programs[section_id]].append((section_id, user_id))
+        for (program_id, changes) in program_pairs.items():
+            transaction.on_commit(functools.partial(cls(program_id).record_registrations, changes))
+
+    def log_changed(self, index):
+        cache.set(self.cache_key('log'), index, self.timeout)
+
+    def initial_seq(self):
+        #   Start from the current time rather than 0, so that the sequence
+        #   keeps going up even if the counter is evicted from the cache, and
+        #   old cursors can't be mistaken for new ones.
+        return int(time.time() * 1000)
+
+    def record_registrations(self, changes):
+        key = self.cache_key('registrations')
+        cache.add(key, self.initial_seq(), self.timeout)
+        try:
+            seq = cache.incr(key, len(changes))
+        except ValueError:
+            seq = self.initial_seq() + len(changes)
+            cache.set(key, seq, self.timeout)
+        first = seq - len(changes) + 1
+        cache.set_many({self.cache_key('registrations', first + i): change for (i, change) in enumerate(changes)}, self.timeout)
+
+    def get_log_index(self):
+        index = cache.get(self.cache_key('log'))
+        if index is None:
+            #   The scheduler's change log lives in esp.program.modules.
+            change_log = apps.get_model('modules', 'AJAXChangeLog').objects.filter(program=self.program_id).first()
+            index = change_log.get_latest_index() if change_log else 0
+            cache.add(self.cache_key('log'), index, self.timeout)
+        return index
+
+    def get_registration_seq(self):
+        key = self.cache_key('registrations')
+        cache.add(key, self.initial_seq(), self.timeout)
+        #   Without a working cache, every cursor is out of date, so clients
+        #   will just get everything each time, like they used to.
+        return cache.get(key) or self.initial_seq()
+
+    def wait(self, log_index=None, registration_seq=None, timeout=0):
+        """ Wait up to timeout seconds for the change log to move past
+        log_index, or the registrations past registration_seq; a cursor of
+        None is not waited on.  Returns True if something changed.
+
+        Waiting ties up a web server thread for up to timeout seconds, so
+        views that call this should be exempt from ATOMIC_REQUESTS (see
+        ProgramModuleObj.findModule()); outside of a transaction, we let go
+        of the database connection while we wait. """
+        if timeout > 0 and not connection.in_atomic_block:
+            connection.close()
+        keys = [self.cache_key('log'), self.cache_key('registrations')]
+        deadline = time.time() + timeout
+        while True:
+            #   We're waiting for other processes to change these, so don't
+            #   let the request cache answer from what we saw last time.
+            with request_cache.suspended():
+                values = cache.get_many(keys)
+            if log_index is not None and values.get(keys[0]) != log_index:
+                return True
+            if registration_seq is not None and values.get(keys[1]) != registration_seq:
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(min(self.poll_interval, max(deadline - time.time(), 0)))
+
+    def get_registration_changes(self, since=None):
+        """ Return (seq, changes): the current sequence number, and the set of
+        (section_id, user_id) pairs whose registrations changed after
+        sequence number since.  changes is None if we can't tell. """
+        seq = self.get_registration_seq()
+        if since is None or since > seq or seq - since > self.max_replay:
+            return (seq, None)
+        keys = [self.cache_key('registrations', i) for i in range(since + 1, seq + 1)]
+        changes = cache.get_many(keys)
+        if len(changes) < len(keys):
+            return (seq, None)
+        return (seq, {tuple(change) for change in changes.values()})
+
+    def get_count_changes(self, since=None):
+        """ Return (seq, counts, reset), where counts lists the
+        [id, enrolled_students, attending_students] of every section that
+        changed after sequence number since.  If we can't tell which sections
+        those are, all of the program's sections are listed and reset is True.
+        """
+        (seq, changes) = self.get_registration_changes(since)
+        sections = ClassSection.objects.filter(status__gt=0, parent_class__status__gt=0, parent_class__parent_program=self.program_id)
+        if changes is not None:
+            if not changes:
+                return (seq, [], False)
+            sections = sections.filter(id__in={section_id for (section_id, user_id) in changes})
+        counts = [list(row) for row in sections.order_by('id').values_list('id', 'enrolled_students', 'attending_students')]
+        return (seq, counts, changes is None)
+
+    def enrollments(self):
+        """ The valid (user_id, section_id) enrollments in open sections of
+        the program, as used by the onsite grid. """
+        return StudentRegistration.valid_objects().filter(section__status__gt=0, section__parent_class__status__gt=0, section__parent_class__parent_program=self.program_id, relationship__name='Enrolled').values_list('user__id', 'section__id')
+
+    def get_enrollment_changes(self, changes):
+        """ Given the changes from get_registration_changes(), return
+        (added, removed): the (user_id, section_id) enrollments that were
+        added and removed.  If changes is None, added lists every enrollment.
+        """
+        if changes is None:
+            return (sorted(set(self.enrollments())), [])
+        if not changes:
+            return ([], [])
+        section_ids = {section_id for (section_id, user_id) in changes}
+        user_ids = {user_id for (section_id, user_id) in changes}
+        enrolled = set(self.enrollments().filter(section__in=section_ids, user__in=user_ids))
+        added = []
+        removed = []
+        for (section_id, user_id) in sorted(changes):
+            if (user_id, section_id) in enrolled:
+                added.append((user_id, section_id))
+            else:
+                removed.append((user_id, section_id))
+        return (added, removed)
+
+@receiver(signals.post_save, sender=StudentRegistration, dispatch_uid='change_feed_registration_save')
+@receiver(signals.post_delete, sender=StudentRegistration, dispatch_uid='change_feed_registration_delete')
+def _change_feed_registration_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        ProgramChangeFeed.registrations_changed([instance])
@@ -47,8 +47,10 @@
 from django.conf import settings
 from django.db import models, transaction
 from django.db.models.query import Q
-from django.db.models import signals, Sum
+from django.db.models import signals, Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
 from django.db.models.manager import Manager
+from django.dispatch import receiver
 from collections import OrderedDict
 from django.template.loader import render_to_string
 from django.template import Template, Context
@@ -66,7 +68,7 @@
 from esp.utils.query_utils import nest_Q
 from esp.utils import cmp
 from esp.tagdict.models import Tag
-from esp.mailman import add_list_member, remove_list_member
+from esp.mailman import queue_list_changes, remove_list_member
 
 # ESP models
 from esp.cal.models import Event
@@ -76,7 +78,7 @@
 from esp.users.models import ESPUser, Permission, PersistentQueryFilter
 from esp.program.models import Program
 from esp.program.models import StudentRegistration, StudentSubjectInterest, RegistrationType, RegistrationProfile
-from esp.program.models import ScheduleMap, ScheduleConstraint
+from esp.program.models import ScheduleMap
 from esp.program.models import ArchiveClass
 from esp.resources.models         import Resource, ResourceRequest, ResourceAssignment, ResourceType
 from argcache                     import cache_function, wildcard
@@ -87,7 +89,7 @@
 
 from esp.customforms.linkfields import CustomFormsLinkModel
 
-__all__ = ['ClassSection', 'ClassSubject', 'ClassManager', 'ClassCategories', 'ClassSizeRange']
+__all__ = ['ClassSection', 'ClassSubject', 'ClassManager', 'ClassCategories', 'ClassSizeRange', 'ClassCatalogEntry']
 
 STATUS_CHOICES = (
         (ClassStatus.CANCELLED, "cancelled"),
@@ -165,16 +167,14 @@ def catalog(self, program, ts=None, force_all=False, initial_queryset=None, use_
 
     @cache_function
     def catalog_cached(self, program, ts=None, force_all=False, initial_queryset=None, order_args_override=None):
-        """ Return a queryset of classes for view in the catalog.
+        """ Return a list of classes for view in the catalog.
 
-        In addition to just giving you the classes, it also
-        queries for the category's title (cls.category_txt)
-        and the total # of media.
+        In addition to just giving you the classes, it also fills in the
+        teachers, sections, total # of media (cls.media_count), whether the
+        class has an index QSD and its # of application questions.  Those come
+        from the ClassCatalogEntry snapshot, which is kept up to date one class
+        at a time, rather than from subqueries over the whole program.
         """
-        now = datetime.datetime.now()
-
-        enrolled_type = RegistrationType.get_map(include=['Enrolled'], category='student')['Enrolled']
-
         if initial_queryset:
             classes = initial_queryset
         else:
@@ -183,8 +183,6 @@ def catalog_cached(self, program, ts=None, force_all=False, initial_queryset=Non
         if not force_all:
             classes = classes.filter(self.approved(return_q_obj=True))
 
-        classes = classes.select_related('category')
-
         if program is not None:
             classes = classes.filter(parent_program = program)
 
@@ -192,21 +190,6 @@ def catalog_cached(self, program, ts=None, force_all=False, initial_queryset=Non
             classes = classes.filter(sections__meeting_times=ts)
 
         classes = classes.annotate(_num_students=Sum('sections__enrolled_students'))
-        classes = classes.prefetch_related('teachers')
-
-        #   Retrieve the content type for finding class documents (generic relation)
-        content_type_id = ContentType.objects.get_for_model(ClassSubject).id
-
-        select = OrderedDict([('media_count', 'SELECT COUNT(*) FROM "qsdmedia_media" WHERE ("qsdmedia_media"."owner_id" = "program_class"."id") AND ("qsdmedia_media"."owner_type_id" = %s)'),
-                             ('_index_qsd', 'SELECT COUNT(*) FROM "qsd_quasistaticdata" WHERE ("qsd_quasistaticdata"."name" = \'learn:index\' AND "qsd_quasistaticdata"."url" LIKE %s AND "qsd_quasistaticdata"."url" SIMILAR TO %s || "program_class"."id" || %s)'),
-                             ('_studentapps_count', 'SELECT COUNT(*) FROM "program_studentappquestion" WHERE ("program_studentappquestion"."subject_id" = "program_class"."id")')])
-
-        select_params = [ content_type_id,
-                          '%/Classes/%',
-                          '%[A-Z]',
-                          '/%',
-                         ]
-        classes = classes.extra(select=select, select_params=select_params)
 
         #   Allow customized orderings for the catalog.
         #   These are the default ordering fields in descending order of priority.
@@ -223,57 +206,55 @@ def catalog_cached(self, program, ts=None, force_all=False, initial_queryset=Non
         #   Order the QuerySet using the specified list.
         classes = classes.order_by(*order_args)
 
-        classes = classes.distinct()
-        classes = list(classes)
-
-        #   Filter out duplicates by ID.  This is necessary because Django's ORM
-        #   adds the related fields (e.g. sections__meeting_times) to the SQL
-        #   SELECT statement and doesn't include them in the result.
+        #   Filter out duplicates by ID, keeping the first occurrence.  This is
+        #   necessary because Django's ORM adds the related fields (e.g.
+        #   sections__meeting_times) to the SQL SELECT statement and doesn't
+        #   include them in the result.
         #   See http://docs.djangoproject.com/en/dev/ref/models/querysets/#s-distinct
-        counter = 0
-        index = 0
-        max_count = len(classes)
-        id_list = []
-        while counter < max_count:
-            cls = classes[index]
-            cls._temp_index = counter
-            if cls.id not in id_list:
-                id_list.append(cls.id)
-                index += 1
-            else:
-                classes.remove(cls)
-            counter += 1
-
-        # All class ID's; used by later query ugliness:
-        class_ids = [x.id for x in classes]
-
-        # Now to get the sections corresponding to these classes...
-        sections = ClassSection.objects.filter(parent_class__in=class_ids)
-
-        sections_by_parent_id = defaultdict(list)
-        for s in sections:
-            sections_by_parent_id[s.parent_class_id].append(s)
+        num_students = OrderedDict()
+        for class_id, count in classes.values_list('id', '_num_students'):
+            num_students.setdefault(class_id, count)
+        class_ids = list(num_students.keys())
+
+        #   Fetch the snapshot rows (one per section) for these classes.
+        entries_by_subject = ClassCatalogEntry.entries_by_subject(class_ids, select_related=['subject', 'subject__category', 'section'])
+        teacher_ids = set()
+        for class_entries in entries_by_subject.values():
+            teacher_ids.update(class_entries[0].get_teacher_ids())
+        teachers = ESPUser.objects.in_bulk(list(teacher_ids))
 
         # Now, to combine all of the above
 
-        if len(classes) >= 1:
-            p = Program.objects.get(id=classes[0].parent_program_id)
-
-        for c in classes:
-            c._teachers = list(c.teachers.all())
-            c._teachers.sort(key=lambda t: t.last_name)
-            c._sections = sections_by_parent_id[c.id]
+        p = program
+        result = []
+        for class_id in class_ids:
+            class_entries = entries_by_subject[class_id]
+            if not class_entries:
+                continue
+            entry = class_entries[0]
+            c = entry.subject
+            if p is None:
+                p = Program.objects.get(id=c.parent_program_id)
+            c._num_students = num_students[class_id]
+            c.media_count = entry.media_count
+            c._index_qsd = int(entry.has_index_qsd)
+            c._studentapps_count = entry.app_question_count
+            c._teachers = [teachers[t] for t in entry.get_teacher_ids() if t in teachers]
+            c._sections = [e.section for e in class_entries if e.section is not None]
             for s in c._sections:
                 s.parent_class = c
-            c._sections.sort(key=lambda s:s.id)
             c.parent_program = p # So that if we set attributes on one instance of the program,
                                  # they show up for all instances.
+            result.append(c)
 
-        return classes
-    catalog_cached.depend_on_model('program.ClassSubject')
-    catalog_cached.depend_on_model('program.ClassSection')
-    catalog_cached.depend_on_model('qsdmedia.Media')
-    catalog_cached.depend_on_model('tagdict.Tag')
+        return result
+    catalog_cached.depend_on_row('program.ClassSubject', lambda cls: {'program': cls.parent_program})
+    catalog_cached.depend_on_row('program.ClassSection', lambda sec: {'program': sec.parent_program})
+    catalog_cached.depend_on_m2m('program.ClassSubject', 'teachers', lambda cls, teacher: {'program': cls.parent_program})
+    catalog_cached.depend_on_row('program.StudentAppQuestion', lambda q: {'program': q.subject.parent_program}, lambda q: q.subject_id is not None)
+    catalog_cached.depend_on_row('qsdmedia.Media', lambda media: {'program': media.owner.parent_program},
+                                 lambda media: media.owner_type_id is not None and media.owner_type.model == 'classsubject' and media.owner is not None)
+    catalog_cached.depend_on_row('tagdict.Tag', lambda tag: {}, lambda tag: tag.key == 'catalog_sort_fields')
 
     #perhaps make it program-specific?
     @staticmethod
@@ -292,6 +273,12 @@ def random_class(self, q=None):
         count = classes.count()
         return classes[random.randint(0, count - 1)]
 
+def _epoch_sections(epoch):
+    """ Key sets for the section caches that a program's registration cache
+    epoch expires: one per section of that program, so that bumping it leaves
+    other programs' caches alone. """
+    return [{'self': section} for section in ClassSection.objects.filter(parent_class__parent_program=epoch.program_id)]
+
 @python_2_unicode_compatible
 class ClassSection(models.Model):
     """ An instance of class.  There should be one of these for each weekend of HSSP, for example; or multiple
@@ -742,25 +729,10 @@ def assign_room(self, base_room, clear_others=False, allow_partial=False, lock=0
     def viable_times(self, ignore_classes=False):
         """ Return a list of Events for which all of the teachers are available. """
 
-        def intersect_lists(list_of_lists):
-            if len(list_of_lists) == 0:
-                return []
-
-            base_list = list_of_lists[0]
-            for other_list in list_of_lists[1:]:
-                i = 0
-                for elt in base_list:
-                    if elt not in other_list:
-                        base_list.remove(elt)
-            return base_list
-
         teachers = self.parent_class.get_teachers()
 
-        timeslot_list = []
-        for t in teachers:
-            timeslot_list.append(list(t.getAvailableTimes(self.parent_program, ignore_classes)))
-
-        available_times = intersect_lists(timeslot_list)
+        matrix = self.parent_program.getTeacherAvailabilityMatrix()
+        available_times = matrix.events(matrix.common_mask([t.id for t in teachers], ignore_classes=ignore_classes))
 
         #   If the class is already scheduled, put its time in.
         if self.isScheduled():
@@ -846,13 +818,12 @@ def timeslot_ids(self):
     timeslot_ids.depend_on_m2m('program.ClassSection', 'meeting_times', lambda instance, object: {'self': instance})
 
     def cannotRemove(self, user):
-        relevantConstraints = self.parent_program.getScheduleConstraints()
-        if relevantConstraints:
-            sm = ScheduleMap(user, self.parent_program)
-            sm.remove_section(self)
-            for exp in relevantConstraints:
-                if not exp.evaluate(sm, recursive=False):
-                    return "You can't remove this class from your schedule because it would violate the requirement that you %s.  You can go back and correct this." % exp.requirement.label
+        constraints = self.parent_program.getCompiledScheduleConstraints()
+        if constraints:
+            sections = [sec for sec in user.getEnrolledSectionsFromProgram(self.parent_program) if sec.id != self.id]
+            label = constraints.violation(sections)
+            if label is not None:
+                return "You can't remove this class from your schedule because it would violate the requirement that you %s.  You can go back and correct this." % label
         return False
 
     def cannotAdd(self, user, checkFull=True, autocorrect_constraints=True, ignore_constraints=False, webapp=False):
@@ -865,37 +836,37 @@ def cannotAdd(self, user, checkFull=True, autocorrect_constraints=True, ignore_c
 
         # Test any scheduling constraints
         if ignore_constraints:
-            relevantConstraints = ScheduleConstraint.objects.none()
+            constraints = None
         else:
-            relevantConstraints = self.parent_program.getScheduleConstraints()
-
-        if relevantConstraints:
-            # Set up a ScheduleMap; fake-insert this class into it
-            sm = ScheduleMap(user, self.parent_program)
-            sm.add_section(self)
-
-            for exp in relevantConstraints:
-                if not exp.evaluate(sm, recursive=autocorrect_constraints):
-                    return "Adding <i>%s</i> to your schedule requires that you %s.  You can go back and correct this." % (self.title(), exp.requirement.label)
+            constraints = self.parent_program.getCompiledScheduleConstraints()
+
+        if constraints:
+            # Check the student's schedule with this class fake-inserted into
+            # it.  Only if a constraint fails and has a handler that might fix
+            # it do we need a real ScheduleMap.
+            sections = list(user.getEnrolledSectionsFromProgram(self.parent_program)) + [self]
+            get_schedule_map = None
+            if autocorrect_constraints:
+                def get_schedule_map():
+                    sm = ScheduleMap(user, self.parent_program)
+                    sm.add_section(self)
+                    return sm
+            label = constraints.violation(sections, get_schedule_map)
+            if label is not None:
+                return "Adding <i>%s</i> to your schedule requires that you %s.  You can go back and correct this." % (self.title(), label)
 
         scrmi = self.parent_program.studentclassregmoduleinfo
-        section_list = user.getEnrolledSectionsFromProgram(self.parent_program)
+        schedule = user.getScheduleBitmask(self.parent_program)
 
         # check to see if there's a conflict:
         my_timeslots = self.timeslot_ids()
-        for sec in section_list:
-            if sec.parent_class == self.parent_class:
-                return 'You are already signed up for a section of this class!'
-            if hasattr(sec, '_timeslot_ids'):
-                timeslot_ids = sec._timeslot_ids
+        if schedule.is_enrolled_in_subject(self.parent_class_id):
+            return 'You are already signed up for a section of this class!'
+        if schedule.conflicts(my_timeslots):
+            if self.parent_class.sections.filter(resourceassignment__isnull=False, meeting_times__isnull=False, status=ClassStatus.ACCEPTED).exclude(id=self.id):
+                return 'This section conflicts with your schedule--check out the other sections!'
             else:
-                timeslot_ids = sec.timeslot_ids()
-            for tid in timeslot_ids:
-                if tid in my_timeslots:
-                    if self.parent_class.sections.filter(resourceassignment__isnull=False, meeting_times__isnull=False, status=ClassStatus.ACCEPTED).exclude(id=self.id):
-                        return 'This section conflicts with your schedule--check out the other sections!'
-                    else:
-                        return 'This class conflicts with your schedule!'
+                return 'This class conflicts with your schedule!'
 
         # check to see if registration has been closed for this section
         if not self.isRegOpen():
@@ -907,7 +878,7 @@ def cannotAdd(self, user, checkFull=True, autocorrect_constraints=True, ignore_c
 
         # check to make sure they haven't already registered for too many classes in this section
         if scrmi.use_priority:
-            priority = user.getRegistrationPriority(self.parent_class.parent_program, self.meeting_times.all())
+            priority = schedule.priority(my_timeslots)
             if priority > scrmi.priority_limit:
                 return 'You are only allowed to select up to %s top classes' % (scrmi.priority_limit)
 
@@ -934,18 +905,20 @@ def cannotSchedule(self, meeting_times, ignore_classes=True):
 
         """
         # check if proposed times are the same as the current meeting_times
-        current_times = self.meeting_times.all()
-        if all(time in current_times for time in meeting_times):
+        current_times = set(self.timeslot_ids())
+        if all(time.id in current_times for time in meeting_times):
             return False
         # otherwise, check if all teachers are available
+        matrix = self.parent_program.getTeacherAvailabilityMatrix()
+        wanted = matrix.mask(e.id for e in meeting_times)
         for t in self.teachers:
-            available = t.getAvailableTimes(self.parent_program, ignore_classes=ignore_classes, ignore_sections=[self])
+            available = matrix.available_mask(t.id, ignore_classes=ignore_classes, ignore_sections=[self.id])
             for e in meeting_times:
-                if e not in available:
+                if not available & matrix.slot_bits.get(e.id, 0):
                     return "The teacher %s has not indicated availability during %s." % (t.name(), e.pretty_time())
-            conflicts = self.conflicts(t, meeting_times)
-            if conflicts:
-                return "The teacher %s is teaching %s during %s." % (t.name(), conflicts[0].emailcode(), conflicts[1].pretty_time())
+            conflict = matrix.teaching_conflict(t.id, wanted, exclude_section_id=self.id)
+            if conflict:
+                return "The teacher %s is teaching %s during %s." % (t.name(), ClassSection.objects.get(id=conflict[0]).emailcode(), conflict[1].pretty_time())
             # Fallback in case we couldn't come up with details
         return False
 
@@ -971,6 +944,7 @@ def students_dict(self):
                 del result[result_key]
         return result
     students_dict.depend_on_row('program.StudentRegistration', lambda reg: {'self': reg.section})
+    students_dict.depend_on_row('program.RegistrationCacheEpoch', _epoch_sections)
 
     def students_prereg(self):
         return self.registrations.filter(nest_Q(StudentRegistration.is_valid_qobject(), 'studentregistration')).distinct()
@@ -994,6 +968,7 @@ def count_ever_checked_in_students(self):
     def num_students_prereg(self):
         return self.students_prereg().count()
     num_students_prereg.depend_on_row('program.StudentRegistration', lambda reg: {'self': reg.section})
+    num_students_prereg.depend_on_row('program.RegistrationCacheEpoch', _epoch_sections)
 
     @cache_function
     def num_students(self, verbs=['Enrolled']):
@@ -1003,11 +978,13 @@ def num_students(self, verbs=['Enrolled']):
             return self._count_students
         return self.students(verbs).count()
     num_students.depend_on_row('program.StudentRegistration', lambda reg: {'self': reg.section})
+    num_students.depend_on_row('program.RegistrationCacheEpoch', _epoch_sections)
 
     @cache_function
     def count_enrolled_students(self):
         return self.num_students(use_cache=False)
     count_enrolled_students.depend_on_row('program.StudentRegistration', lambda reg: {'self': reg.section})
+    count_enrolled_students.depend_on_row('program.RegistrationCacheEpoch', _epoch_sections)
 
     enrolled_students = DerivedField(models.IntegerField, count_enrolled_students)(null=False, default=0)
 
@@ -1015,6 +992,7 @@ def count_enrolled_students(self):
     def count_attending_students(self):
         return self.num_students(verbs=['Attended'], use_cache=False)
     count_attending_students.depend_on_row('program.StudentRegistration', lambda reg: {'self': reg.section})
+    count_attending_students.depend_on_row('program.RegistrationCacheEpoch', _epoch_sections)
 
     attending_students = DerivedField(models.IntegerField, count_attending_students)(null=False, default=0)
 
@@ -1111,12 +1089,10 @@ def cancel(self, email_students=True, include_lottery_students=False, text_stude
     def clearStudents(self):
         now = datetime.datetime.now()
         qs = StudentRegistration.valid_objects(now).filter(section=self)
-        for reg in qs:
-            signals.pre_save.send(sender=StudentRegistration, instance=reg)
+        registrations = list(qs)
         qs.update(end_date=now)
         #   Compensate for the lack of a signal on update().
-        for reg in qs:
-            signals.post_save.send(sender=StudentRegistration, instance=reg)
+        StudentRegistration.invalidate_caches(registrations)
         if all([sec.isCancelled() for sec in self.parent_class.get_sections() if sec!=self]):
             qs_ssi = StudentSubjectInterest.valid_objects(now).filter(subject=self.parent_class)
             for ssi in qs_ssi:
@@ -1215,6 +1191,84 @@ def isFull(self, ignore_changes=False, webapp=False):
         else:
             return (num_students >= self._get_capacity(ignore_changes))
 
+    def _uses_attendance_capacity(self, webapp=False):
+        """ Whether isFull(webapp=webapp) may currently be based on attendance
+        rather than enrollment numbers (modes 1 and 2 in isFull). """
+        if not webapp:
+            return False
+        now = datetime.datetime.now()
+        switch_lag = Tag.getProgramTag('switch_lag_class_attendance', program=self.parent_program)
+        switch_time = Tag.getProgramTag('switch_time_program_attendance', program=self.parent_program)
+        if switch_lag:
+            try:
+                if now >= self.start_time_prefetchable() + timedelta(minutes=int(switch_lag)) and self.count_attending_students() >= 1:
+                    return True
+            except (ValueError, TypeError):
+                pass
+        if switch_time:
+            try:
+                if now >= datetime.datetime.strptime(now.strftime("%Y/%m/%d ") + switch_time, "%Y/%m/%d %H:%M"):
+                    return True
+            except ValueError:
+                pass
+        return False
+
+    def reserve_seat(self, ignore_changes=False, webapp=False):
+        """ Claim a seat in this section for a new registration.
+
+        Unlike checking isFull() and then registering, this can't overfill the
+        section when many students register at once: the seat is taken with
+        a conditional UPDATE of enrolled_students, which also locks the
+        section's row until the surrounding transaction ends.  Callers should
+        call sync_enrolled_students() once they have created (or decided not
+        to create) the registration.  Returns True if a seat was claimed.
+        """
+        if len(self.get_meeting_times()) == 0:
+            return False
+
+        sections = ClassSection.objects.filter(id=self.id)
+        if self._uses_attendance_capacity(webapp):
+            #   Attendance numbers aren't a counter we can reserve against, so
+            #   just serialize on the section's row and use the usual check.
+            list(sections.select_for_update())
+            return not self.isFull(ignore_changes=ignore_changes, webapp=webapp)
+
+        #   A section with zero capacity still takes its first student; see isFull().
+        capacity = self._get_capacity(ignore_changes)
+        limit = capacity if capacity > 0 else 1
+        return sections.filter(enrolled_students__lt=limit).update(enrolled_students=F('enrolled_students') + 1) == 1
+
+    @transaction.atomic
+    def sync_enrolled_students(self):
+        """ Set enrolled_students to the actual number of enrolled students,
+        releasing any seats claimed by reserve_seat() that weren't used.
+
+        The section's row is locked before counting, so that a seat claimed
+        by another transaction that hasn't committed its registration yet
+        isn't overwritten with a count that misses it. """
+        list(ClassSection.objects.filter(id=self.id).select_for_update().values_list('id', flat=True))
+        count = StudentRegistration.valid_objects().filter(section=self, relationship__name='Enrolled').values('user').distinct().count()
+        ClassSection.objects.filter(id=self.id).update(enrolled_students=count)
+        self.enrolled_students = count
+        if hasattr(self, '_count_students'):
+            del self._count_students
+        return count
+
+    @staticmethod
+    @transaction.atomic
+    def bulk_sync_enrolled_students(section_ids):
+        """ Like sync_enrolled_students(), but for many sections at once,
+        with a single UPDATE.  Also recomputes attending_students, since the
+        registrations may not all be enrollments. """
+        def count(relationship):
+            counts = StudentRegistration.valid_objects().filter(section=OuterRef('pk'), relationship__name=relationship).order_by().values('section').annotate(count=Count('user', distinct=True)).values('count')
+            return Coalesce(Subquery(counts, output_field=models.IntegerField()), 0)
+        sections = ClassSection.objects.filter(id__in=list(section_ids))
+        #   Lock the rows (in a fixed order, to avoid deadlocks) before
+        #   counting; see sync_enrolled_students().
+        list(sections.order_by('id').select_for_update().values_list('id', flat=True))
+        return sections.update(enrolled_students=count('Enrolled'), attending_students=count('Attended'))
+
     def isFullWebapp(self, ignore_changes=False):
         return self.isFull(ignore_changes = ignore_changes, webapp = True)
 
@@ -1293,26 +1347,35 @@ def getRegVerbs(self, user, allowed_verbs=False):
         else:
             return [v.relationship for v in qs.filter(relationship__name__in=allowed_verbs).distinct()]
 
+    @transaction.atomic
     def unpreregister_student(self, user, prereg_verbs = []):
         #   New behavior: prereg_verbs should be a list of strings matching the names of
         #   RegistrationTypes to match (if you want to use it)
 
         from esp.program.models.app_ import StudentAppQuestion
 
+        #   Lock the section's row first, as reserve_seat() does, so that the
+        #   seat count below can't miss a concurrent registration.
+        list(ClassSection.objects.filter(id=self.id).select_for_update().values_list('id', flat=True))
+
         now = datetime.datetime.now()
 
         #   Stop all active or pending registrations
+        qs = StudentRegistration.valid_objects(now).filter(section=self, user=user)
         if prereg_verbs:
-            qs = StudentRegistration.valid_objects(now).filter(relationship__name__in=prereg_verbs, section=self, user=user)
-            qs.update(end_date=now)
-        else:
-            qs = StudentRegistration.valid_objects(now).filter(section=self, user=user)
-            qs.update(end_date=now)
+            qs = qs.filter(relationship__name__in=prereg_verbs)
+        registrations = list(qs.select_related('relationship'))
+        qs.update(end_date=now)
 
-        #   Explicitly fire the signals for saving a StudentRegistration in order to update caches
-        #   since it doesn't get sent by update() above
-        if qs.exists():
-            signals.post_save.send(sender=StudentRegistration, instance=qs[0])
+        #   Explicitly fire the signals for saving each StudentRegistration in order to update caches
+        #   since they don't get sent by update() above
+        for registration in registrations:
+            registration.end_date = now
+            registration.section = self
+            signals.post_save.send(sender=StudentRegistration, instance=registration)
+
+        #   Release the student's seat
+        self.sync_enrolled_students()
 
         #   If the student had blank application question responses for this class, remove them.
         app = user.getApplication(self.parent_program, create=False)
@@ -1325,8 +1388,7 @@ def unpreregister_student(self, user, prereg_verbs = []):
 
         # Remove the student from any existing class mailing lists
         list_names = ["%s-%s" % (self.emailcode(), "students"), "%s-%s" % (self.parent_class.emailcode(), "students")]
-        for list_name in list_names:
-            remove_list_member(list_name, user.email)
+        queue_list_changes(removes=[(list_name, user.email) for list_name in list_names])
 
     @transaction.atomic
     def preregister_student(self, user, overridefull=False, priority=1, prereg_verb = None, fast_force_create=False, webapp=False):
@@ -1337,7 +1399,9 @@ def preregister_student(self, user, overridefull=False, priority=1, prereg_verb
             else:
                 prereg_verb = 'Enrolled'
 
-        if overridefull or fast_force_create or not self.isFull(webapp=webapp):
+        #   Claim a seat first (see reserve_seat()), so that concurrent
+        #   registrations can't all see a free seat and overfill the section.
+        if overridefull or fast_force_create or self.reserve_seat(webapp=webapp):
             #    Then, create the registration for this class.
             rt = RegistrationType.get_cached(name=prereg_verb, category='student')
             qs = self.registrations.filter(nest_Q(StudentRegistration.is_valid_qobject(), 'studentregistration'), id=user.id, studentregistration__relationship=rt)
@@ -1365,6 +1429,10 @@ def preregister_student(self, user, overridefull=False, priority=1, prereg_verb
             else:
                 pass
 
+            #   Replace the claimed seat with the real count, which also frees
+            #   it again if it turned out not to be needed.
+            self.sync_enrolled_students()
+
             if self.parent_program.isUsingStudentApps():
                 #   Clear completion bit on the student's application if the class has app questions.
                 app = user.getApplication(self.parent_program, create=False)
@@ -1376,9 +1444,8 @@ def preregister_student(self, user, overridefull=False, priority=1, prereg_verb
 
             #   Add the student to the class mailing lists, if they exist
             list_names = ["%s-%s" % (self.emailcode(), "students"), "%s-%s" % (self.parent_class.emailcode(), "students")]
-            for list_name in list_names:
-                add_list_member(list_name, user)
-            add_list_member("%s_%s-students" % (self.parent_program.program_type, self.parent_program.program_instance), user)
+            list_names.append("%s_%s-students" % (self.parent_program.program_type, self.parent_program.program_instance))
+            queue_list_changes(adds=[(list_name, user) for list_name in list_names])
 
             return True
         else:
@@ -1808,9 +1875,8 @@ def cannotAdd(self, user, checkFull=True, which_section=None, webapp=False):
             if not Permission.user_has_perm(user, "GradeOverride", self.parent_program):
                 return 'You are not in the requested grade range for this class.'
 
-        for section in self.get_sections():
-            if user.isEnrolledInClass(section):
-                return 'You are already signed up for a section of this class!'
+        if user.getScheduleBitmask(self.parent_program).is_enrolled_in_subject(self.id):
+            return 'You are already signed up for a section of this class!'
 
         if which_section:
             sections = [which_section]
@@ -2150,6 +2216,195 @@ def __str__(self):
         return '%s (%s)' % (self.category, self.symbol)
 
 
+@python_2_unicode_compatible
+class ClassCatalogEntry(models.Model):
+    """ A denormalized row of a program's class catalog.
+
+    There is one entry per section (or a single entry with no section, for a
+    class that doesn't have any), carrying the per-class data that the catalog
+    would otherwise compute with correlated subqueries on every rebuild.  The
+    entries for a class are recomputed by refresh_subject() whenever the class,
+    its sections, teachers, documents, index QSD or application questions
+    change; see the signal receivers below.
+    """
+    program = models.ForeignKey(Program, related_name='catalog_entries', on_delete=models.CASCADE)
+    subject = models.ForeignKey(ClassSubject, related_name='catalog_entries', on_delete=models.CASCADE)
+    section = models.ForeignKey(ClassSection, related_name='catalog_entries', blank=True, null=True, on_delete=models.CASCADE)
+    category = models.ForeignKey(ClassCategories, related_name='catalog_entries', on_delete=models.CASCADE)
+    #   Teachers are stored in catalog order (by last name), like ArchiveClass.teacher_ids
+    teacher_ids = models.TextField(blank=True, default='')
+    teacher_names = models.TextField(blank=True, default='')
+    media_count = models.IntegerField(default=0)
+    has_index_qsd = models.BooleanField(default=False)
+    app_question_count = models.IntegerField(default=0)
+    last_modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = 'program'
+        db_table = 'program_classcatalogentry'
+        verbose_name_plural = 'class catalog entries'
+        constraints = [
+            models.UniqueConstraint(fields=['subject', 'section'], name='classcatalogentry_subject_section'),
+            #   NULLs are never equal, so sectionless entries need their own.
+            models.UniqueConstraint(fields=['subject'], condition=Q(section__isnull=True), name='classcatalogentry_subject_no_section'),
+        ]
+
+    def __str__(self):
+        return 'Catalog entry for %s' % (self.section or self.subject)
+
+    def get_teacher_ids(self):
+        return [int(x) for x in self.teacher_ids.split('|') if x]
+
+    @staticmethod
+    def subject_fields(subject):
+        """ Compute the per-class fields shared by all of a class's entries. """
+        teachers = list(subject.teachers.all().order_by('last_name', 'first_name', 'id'))
+        content_type = ContentType.objects.get_for_model(ClassSubject)
+        return {
+            'program_id': subject.parent_program_id,
+            'category_id': subject.category_id,
+            'teacher_ids': '|' + '|'.join(str(t.id) for t in teachers) + '|' if teachers else '',
+            'teacher_names': ', '.join('%s %s' % (t.first_name, t.last_name) for t in teachers),
+            'media_count': Media.objects.filter(owner_type=content_type, owner_id=subject.id).count(),
+            'has_index_qsd': QuasiStaticData.objects.filter(name='learn:index', url__startswith='learn/' + subject.url() + '/index').exists(),
+            'app_question_count': subject.studentappquestion_set.count(),
+        }
+
+    @classmethod
+    def build_entries(cls, subject):
+        """ Compute (but do not save) the catalog entries for a ClassSubject. """
+        fields = cls.subject_fields(subject)
+        section_ids = list(subject.sections.order_by('id').values_list('id', flat=True))
+        if not section_ids:
+            return [cls(subject=subject, section=None, **fields)]
+        return [cls(subject=subject, section_id=section_id, **fields) for section_id in section_ids]
+
+    @classmethod
+    @transaction.atomic
+    def refresh_subject(cls, subject, create=True):
+        """ Recompute the catalog entries for one ClassSubject.
+
+        With create=False the existing entries are updated in place, but
+        none are added or removed.  The post_delete receivers use this, since
+        they may be running in the middle of deleting the class itself.
+
+        Otherwise the class's row is locked first, so that concurrent
+        refreshes of the same class take turns instead of both inserting.
+        """
+        if not isinstance(subject, ClassSubject):
+            subject = ClassSubject.objects.filter(id=subject).select_related('parent_program', 'category').first()
+            if subject is None:
+                return
+        if create:
+            if not list(ClassSubject.objects.filter(id=subject.id).select_for_update().values_list('id', flat=True)):
+                return
+            cls.objects.filter(subject=subject).delete()
+            cls.objects.bulk_create(cls.build_entries(subject), ignore_conflicts=True)
+        else:
+            cls.objects.filter(subject=subject).update(**cls.subject_fields(subject))
+
+    @classmethod
+    def entries_by_subject(cls, subject_ids, select_related=()):
+        """ Return a dict of ClassSubject IDs to lists of their entries.
+
+        The lists are ordered by section ID.  Classes that don't have entries
+        yet (because they predate the snapshot, or their last section was just
+        deleted) get them built here.
+        """
+        subject_ids = list(subject_ids)
+        def get_entries():
+            return cls.objects.filter(subject__in=subject_ids).select_related(*select_related).order_by('subject', 'section')
+        result = defaultdict(list)
+        for entry in get_entries():
+            result[entry.subject_id].append(entry)
+        missing_ids = set(subject_ids) - set(result.keys())
+        if missing_ids:
+            for subject_id in missing_ids:
+                cls.refresh_subject(subject_id)
+            result = defaultdict(list)
+            for entry in get_entries():
+                result[entry.subject_id].append(entry)
+        return result
+
+    @classmethod
+    def refresh_program(cls, program, missing_only=False):
+        """ Rebuild the catalog entries for every class in a program.
+
+        With missing_only=True, only classes that have no entries yet (for
+        instance classes created before the catalog snapshot existed, or whose
+        last section was deleted) are rebuilt.
+        """
+        subjects = ClassSubject.objects.filter(parent_program=program).select_related('parent_program', 'category')
+        if missing_only:
+            subjects = subjects.filter(catalog_entries__isnull=True)
+        for subject in subjects:
+            cls.refresh_subject(subject)
+
+
+#   Keep ClassCatalogEntry up to date.  Each of these only touches the entries
+#   of the one class affected by the change.
+
+def _refresh_catalog_entry(subject_id, signal=signals.post_save):
+    if subject_id is not None:
+        ClassCatalogEntry.refresh_subject(subject_id, create=(signal is not signals.post_delete))
+
+@receiver(signals.post_save, sender=ClassSubject, dispatch_uid='catalog_entry_subject_save')
+def _catalog_subject_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _refresh_catalog_entry(instance.id)
+
+@receiver(signals.post_save, sender=ClassSection, dispatch_uid='catalog_entry_section_save')
+def _catalog_section_saved(sender, instance, raw=False, **kwargs):
+    #   Deleted sections take their entries with them (on_delete=CASCADE).
+    if not raw:
+        _refresh_catalog_entry(instance.parent_class_id)
+
+@receiver(signals.m2m_changed, sender=ClassSubject.teachers.through, dispatch_uid='catalog_entry_teachers')
+def _catalog_teachers_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        _refresh_catalog_entry(instance.id)
+    else:
+        #   Reverse clears (user.classsubject_set.clear()) don't say which
+        #   classes were affected, so there is nothing we can refresh.
+        for subject_id in (pk_set or []):
+            _refresh_catalog_entry(subject_id)
+
+@receiver(signals.post_save, sender=Media, dispatch_uid='catalog_entry_media_save')
+@receiver(signals.post_delete, sender=Media, dispatch_uid='catalog_entry_media_delete')
+def _catalog_media_changed(sender, instance, signal, raw=False, **kwargs):
+    if not raw and instance.owner_type_id == ContentType.objects.get_for_model(ClassSubject).id:
+        _refresh_catalog_entry(instance.owner_id, signal)
+
+@receiver(signals.post_save, sender=QuasiStaticData, dispatch_uid='catalog_entry_qsd_save')
+@receiver(signals.post_delete, sender=QuasiStaticData, dispatch_uid='catalog_entry_qsd_delete')
+def _catalog_qsd_changed(sender, instance, signal, raw=False, **kwargs):
+    if raw or not ClassManager.is_class_index_qsd(instance):
+        return
+    emailcode = instance.url.split('/')[-2]
+    if emailcode[1:].isdigit():
+        _refresh_catalog_entry(int(emailcode[1:]), signal)
+
+@receiver(signals.post_save, sender=ESPUser, dispatch_uid='catalog_entry_teacher_save')
+def _catalog_teacher_saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    #   Teacher names are denormalized, so a rename has to reach their classes.
+    #   Only entries that don't already have the teacher's current name are
+    #   touched; those in current programs are rebuilt now, and the rest are
+    #   dropped, to be rebuilt by entries_by_subject() if they're ever needed.
+    if raw or (update_fields is not None and not {'first_name', 'last_name'} & set(update_fields)):
+        return
+    #   Compare whole names, so that e.g. "Ann Lee" isn't found in "Joann Lee".
+    name = '%s %s' % (instance.first_name, instance.last_name)
+    entries = ClassCatalogEntry.objects.filter(subject__teachers=instance).values_list('subject_id', 'teacher_names')
+    subject_ids = {subject_id for (subject_id, teacher_names) in entries if name not in teacher_names.split(', ')}
+    if not subject_ids:
+        return
+    current_ids = set(ClassSubject.objects.filter(id__in=subject_ids, parent_program__in=Program.current_programs()).values_list('id', flat=True))
+    ClassCatalogEntry.objects.filter(subject__in=subject_ids - current_ids).delete()
+    for subject_id in current_ids:
+        _refresh_catalog_entry(subject_id)
+
 @cache_function
 def sections_in_program_by_id(prog):
     return [int(x) for x in ClassSection.objects.filter(parent_class__parent_program=prog).distinct().values_list('id', flat=True)]
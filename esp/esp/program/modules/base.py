@@ -40,7 +40,7 @@
 import logging
 logger = logging.getLogger(__name__)
 
-from django.db import models
+from django.db import connections, models, transaction
 from django.utils.decorators import available_attrs
 from django.utils.safestring import mark_safe
 
@@ -182,8 +182,24 @@ def findRequiredModules(self):
 
     @staticmethod
     def findModule(request, tl, one, two, call_txt, extra, prog):
-        from esp.program.modules.handlers.regprofilemodule import RegProfileModule
+        """ Find and call the view for this request.
+
+        The program() view that calls this is exempt from ATOMIC_REQUESTS,
+        since it can't tell which module view it will end up calling.  So,
+        as Django would, we call the view in a transaction here, unless it
+        is decorated with transaction.non_atomic_requests (e.g. the change
+        feeds, which wait for a long time without touching the database). """
         moduleobj = ProgramModuleObj.findModuleObject(tl, call_txt, prog)
+        view = ProgramModuleObj._findModule
+        non_atomic_requests = getattr(getattr(moduleobj, call_txt, None), '_non_atomic_requests', set())
+        for conn in connections.all():
+            if conn.settings_dict['ATOMIC_REQUESTS'] and conn.alias not in non_atomic_requests:
+                view = transaction.atomic(using=conn.alias)(view)
+        return view(moduleobj, request, tl, one, two, call_txt, extra, prog)
+
+    @staticmethod
+    def _findModule(moduleobj, request, tl, one, two, call_txt, extra, prog):
+        from esp.program.modules.handlers.regprofilemodule import RegProfileModule
 
         #   If a "core" module has been found:
         #   Put the user through a sequence of all required modules in the same category.
@@ -34,8 +34,9 @@
 """
 from esp.program.modules.base    import ProgramModuleObj, needs_admin, main_call, aux_call
 from esp.program.modules         import module_ext
-from esp.program.models          import ClassSection
+from esp.program.models          import ClassSection, ProgramChangeFeed
 from esp.utils.web               import render_to_response
+from django.db                   import transaction
 from django.http                 import HttpResponse
 from esp.cal.models              import Event
 from esp.users.models            import ESPUser
@@ -181,8 +182,25 @@ def ajax_schedule_swap(self, prog, assignments, user=None, override=False):
     @needs_admin
     @json_response()
     def ajax_change_log(self, request, tl, one, two, module, extra, prog):
-        cl = self.get_change_log(prog)
+        return self.get_change_log_data(prog, int(request.GET['last_fetched_index']))
+
+    @transaction.non_atomic_requests
+    @aux_call
+    @needs_admin
+    @json_response()
+    def ajax_change_feed(self, request, tl, one, two, module, extra, prog):
+        """ Like ajax_change_log, but if there is nothing new, waits (for up
+        to the change_feed_timeout tag) until there is before answering.
+        Clients that can't hold a request open can keep polling
+        ajax_change_log; the two return the same thing. """
         last_fetched_index = int(request.GET['last_fetched_index'])
+        feed = ProgramChangeFeed(prog)
+        if feed.get_log_index() == last_fetched_index:
+            feed.wait(log_index=last_fetched_index, timeout=feed.request_timeout(request, prog))
+        return self.get_change_log_data(prog, last_fetched_index)
+
+    def get_change_log_data(self, prog, last_fetched_index):
+        cl = self.get_change_log(prog)
 
         #check whether we have a log entry at least as old as the last fetched time
         #if not, we return a command to reload instead of the log
@@ -200,6 +218,7 @@ def ajax_clear_change_log(self, request, tl, one, two, module, extra, prog):
         Clears the change log for this program. """
 
         self.get_change_log(prog).entries.all().delete()
+        ProgramChangeFeed(prog).log_changed(0)
         context = {}
         return render_to_response(self.baseDir()+'clear_cache_confirmation.html', request, context)
 
@@ -285,9 +304,10 @@ def ajax_assign_moderator(self, request, tl, one, two, module, extra, prog):
             override = request.POST['override'] == "true"
             if not override:
                 # check availability
-                avail_times = [time.id for time in mod.getAvailableTimes(prog)]
+                matrix = prog.getTeacherAvailabilityMatrix()
+                available = matrix.available_mask(mod.id)
                 for time in sec.meeting_times.all():
-                    if time.id not in avail_times:
+                    if not available & matrix.slot_bits.get(time.id, 0):
                         return self.makeret(prog, ret=False, msg="Moderator '%s' is not available to moderate Class Section '%s'" % (mod.name(), sec.emailcode()))
             sec.moderators.add(mod)
             self.get_change_log(prog).appendModerator(mod_id, sec_id, True, request.user)
@@ -338,14 +358,19 @@ def ajax_schedule_get_uuid(self, prog):
     # This function should be called iff the data returned by any of the other ajax_ JSON functions changes.
     # So, cache it; and have the cache expire whenever any of the relevant models changes.
     # Yeah, the cache will get expired quite often...; but, eh, it's a cheap function.
+    # Each dependency only expires the UUID of the program that owns the row,
+    # so editing one program doesn't force every other open scheduler to reload.
     ajax_schedule_get_uuid.get_or_create_token(('prog',))
-    ajax_schedule_get_uuid.depend_on_model('resources.ResourceAssignment')
-    ajax_schedule_get_uuid.depend_on_model('resources.Resource')
-    ajax_schedule_get_uuid.depend_on_model('resources.ResourceRequest')
-    ajax_schedule_get_uuid.depend_on_model('cal.Event')
-    ajax_schedule_get_uuid.depend_on_model('program.ClassSection')
-    ajax_schedule_get_uuid.depend_on_model('program.ClassSubject')
-    ajax_schedule_get_uuid.depend_on_model('users.UserAvailability')
+    ajax_schedule_get_uuid.depend_on_row('resources.ResourceAssignment', lambda ra: {'prog': ra.target.parent_class.parent_program}, lambda ra: ra.target_id is not None)
+    ajax_schedule_get_uuid.depend_on_row('resources.ResourceAssignment', lambda ra: {'prog': ra.target_subj.parent_program}, lambda ra: ra.target_subj_id is not None)
+    ajax_schedule_get_uuid.depend_on_row('resources.Resource', lambda res: {'prog': res.event.parent_program()})
+    ajax_schedule_get_uuid.depend_on_row('resources.ResourceRequest', lambda rr: {'prog': rr.target.parent_class.parent_program}, lambda rr: rr.target_id is not None)
+    ajax_schedule_get_uuid.depend_on_row('resources.ResourceRequest', lambda rr: {'prog': rr.target_subj.parent_program}, lambda rr: rr.target_subj_id is not None)
+    ajax_schedule_get_uuid.depend_on_row('cal.Event', lambda event: {'prog': event.parent_program()})
+    ajax_schedule_get_uuid.depend_on_row('program.ClassSection', lambda sec: {'prog': sec.parent_class.parent_program})
+    ajax_schedule_get_uuid.depend_on_m2m('program.ClassSection', 'meeting_times', lambda sec, event: {'prog': sec.parent_class.parent_program})
+    ajax_schedule_get_uuid.depend_on_row('program.ClassSubject', lambda subj: {'prog': subj.parent_program})
+    ajax_schedule_get_uuid.depend_on_row('users.UserAvailability', lambda ua: {'prog': ua.event.parent_program()})
 
     @cache_function
     def ajax_lunch_timeslots_cached(self, prog):
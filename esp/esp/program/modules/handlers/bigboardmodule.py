@@ -253,6 +253,7 @@ def popular_classes(self, prog):
         return popular_classes
     popular_classes.depend_on_row(StudentRegistration, lambda sr: {'prog': sr.section.parent_class.parent_program},
                                                        filter = lambda sr: (sr.relationship.name in ["Priority/1", "Enrolled"]))
+    popular_classes.depend_on_row('program.RegistrationCacheEpoch', lambda epoch: {'prog': epoch.program})
     popular_classes.depend_on_row(StudentSubjectInterest, lambda ssi: {'prog': ssi.subject.parent_program})
 
     @cache_function_for(105)
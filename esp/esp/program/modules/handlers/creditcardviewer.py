@@ -34,8 +34,10 @@
 """
 from esp.program.modules.base import ProgramModuleObj, needs_admin, main_call
 from esp.utils.web       import render_to_response
-from esp.accounting.controllers import ProgramAccountingController, IndividualAccountingController
-from argcache            import cache_function
+from esp.accounting.controllers import ProgramAccountingController
+from esp.accounting.models import Transfer
+
+import collections
 
 class CreditCardViewer(ProgramModuleObj):
     doc = """Lists the credit card payments for the program."""
@@ -58,8 +60,13 @@ def viewpay(self, request, tl, one, two, module, extra, prog):
         payment_table = []
 
         #   Fetch detailed information for every student associated with the program
+        summaries = pac.summarize(student_list)
+        transfers_by_student = collections.defaultdict(list)
+        for transfer in Transfer.objects.filter(user__in=student_list, line_item__in=pac.get_lineitemtypes()).order_by('id'):
+            transfers_by_student[transfer.user_id].append(transfer)
         for student in student_list:
-            payment_table.append(self._payment_table_row_cached(prog, student))
+            summary = summaries[student.id]
+            payment_table.append((student, transfers_by_student[student.id], summary.amount_requested(), summary.amount_due()))
 
         #   Also fetch summary information about the payments
         (num_payments, total_payment) = pac.payments_summary()
@@ -74,17 +81,6 @@ def viewpay(self, request, tl, one, two, module, extra, prog):
 
         return render_to_response(self.baseDir() + 'viewpay.html', request, context)
 
-    @staticmethod
-    @cache_function
-    def _payment_table_row_cached(prog, student):
-        iac = IndividualAccountingController(prog, student)
-        return (student, iac.get_transfers(), iac.amount_requested(), iac.amount_due())
-    _payment_table_row_cached.__func__.depend_on_model('accounting.LineItemType')
-    _payment_table_row_cached.__func__.depend_on_model('accounting.LineItemOptions')
-    _payment_table_row_cached.__func__.depend_on_model('accounting.FinancialAidGrant')
-    _payment_table_row_cached.__func__.depend_on_model('accounting.Account')
-    _payment_table_row_cached.__func__.depend_on_model('accounting.Transfer')
-
     def isStep(self):
         return self.program.hasModule('CreditCardModule_Stripe')
 
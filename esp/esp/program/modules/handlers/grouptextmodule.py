@@ -34,18 +34,56 @@
 """
 from esp.program.modules.base import ProgramModuleObj, needs_admin, main_call, aux_call
 from esp.program.modules.handlers.listgenmodule import ListGenModule
+from esp.program.modules.module_ext import GroupTextMessage, GroupTextRecipient
+from esp.dbmail.cronmail import TokenBucket
 from esp.utils.web import render_to_response
 from esp.users.models   import ESPUser, PersistentQueryFilter, ContactInfo
 from esp.users.controllers.usersearch import UserSearchController
 from esp.middleware import ESPError
 
 from django.conf import settings
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
 
 from twilio.rest import Client
 from twilio.base.exceptions import TwilioRestException
 
 from phonenumbers import format_number, PhoneNumberFormat
 
+import queue
+import threading
+
+def _send_worker(client, work, buckets):
+    """ Send the (recipient, body) pairs in the queue `work` until we reach a
+        None, recording the outcome on each GroupTextRecipient.
+
+        Each sending number has its own rate limit, given by its entry in
+        `buckets`.  Workers don't touch the database; the caller saves the
+        results. """
+    while True:
+        item = work.get()
+        if item is None:
+            break
+        recipient, body = item
+        buckets[recipient.sent_from].consume()
+        try:
+            sms = client.messages.create(body=body,
+                                         to=recipient.phone_number,
+                                         from_=recipient.sent_from)
+        except TwilioRestException as error:
+            recipient.status = GroupTextRecipient.FAILED
+            recipient.error = error.msg
+        except Exception as error:
+            # e.g. the connection to Twilio failed; record it so the text can
+            # be retried rather than losing the rest of the batch.
+            recipient.status = GroupTextRecipient.FAILED
+            recipient.error = str(error)
+        else:
+            recipient.status = GroupTextRecipient.SENT
+            recipient.sid = sms.sid or ''
+            recipient.error = ''
+            recipient.sent_at = timezone.now()
+
 class GroupTextModule(ProgramModuleObj):
     doc = """Text users that match specific search criteria."""
     """ Want to tell all enrolled students about a last-minute lunch location
@@ -77,6 +115,12 @@ def is_configured():
 
         return True
 
+    @staticmethod
+    def send_rate():
+        """ The number of texts per second we may send from each of our
+            numbers (settings.TWILIO_SEND_RATE, by default 1). """
+        return float(getattr(settings, 'TWILIO_SEND_RATE', 1))
+
     @aux_call
     @needs_admin
     def grouptextfinal(self, request, tl, one, two, module, extra, prog):
@@ -93,9 +137,33 @@ def grouptextfinal(self, request, tl, one, two, module, extra, prog):
         if 'text-override' in request.POST:
             override = request.POST['text-override']
 
-        log = self.sendMessages(filterObj, message, override = override)
+        text, log = self.textUsers(filterObj, message, override = override)
+
+        return render_to_response(self.baseDir()+'finished.html', request, self.finished_context(text, log))
 
-        return render_to_response(self.baseDir()+'finished.html', request, {'log': log, 'override': override})
+    @aux_call
+    @needs_admin
+    def grouptextretry(self, request, tl, one, two, module, extra, prog):
+        """ Resend a group text to the recipients it failed to reach. """
+        if request.method != 'POST' or 'message' not in request.POST:
+            raise ESPError()('No message has been selected to retry')
+
+        if not self.is_configured():
+            return render_to_response(self.baseDir() + 'not_configured.html', request, {})
+
+        text = get_object_or_404(GroupTextMessage, id=request.POST['message'])
+        log = self.retryMessage(text)
+
+        return render_to_response(self.baseDir()+'finished.html', request, self.finished_context(text, log))
+
+    def finished_context(self, text, log):
+        return {
+            'program': self.program,
+            'log': log,
+            'override': text.override,
+            'text': text,
+            'num_failed': text.recipients.filter(status=GroupTextRecipient.FAILED).count(),
+        }
 
     @main_call
     @needs_admin
@@ -113,7 +181,7 @@ def grouptextpanel(self, request, tl, one, two, module, extra, prog):
 
             context['filterid'] = filterObj.id
             context['num_users'] = ESPUser.objects.filter(filterObj.get_Q()).distinct().count()
-            context['est_time'] = float(context['num_users']) * 1.0 / len(settings.TWILIO_ACCOUNT_NUMBERS)
+            context['est_time'] = float(context['num_users']) / (len(settings.TWILIO_ACCOUNT_NUMBERS) * self.send_rate())
             return render_to_response(self.baseDir()+'options.html', request, context)
 
         context.update(usc.prepare_context(prog, target_path='/manage/%s/grouptextpanel' % prog.url))
@@ -123,39 +191,44 @@ def grouptextpanel(self, request, tl, one, two, module, extra, prog):
     def sendMessages(filterobj, body, override = False):
         """ Attempts to send a text message with body to users matching filterobj
             Returns a log of actions which can be displayed to user. """
+        return GroupTextModule.textUsers(filterobj, body, override)[1]
+
+    @staticmethod
+    def textUsers(filterobj, body, override = False):
+        """ Attempts to send a text message with body to users matching filterobj.
+            Returns the GroupTextMessage, which records the outcome for each
+            user, and a log of actions which can be displayed to user. """
 
         users = filterobj.getList(ESPUser)
         try:
             users = users.distinct()
         except:
             pass
+        users = list(users)
 
         if not users:
             raise ESPError()("Your query did not match any users")
 
-        account_sid = settings.TWILIO_ACCOUNT_SID
-        auth_token = settings.TWILIO_AUTH_TOKEN
-        ourNumbers = settings.TWILIO_ACCOUNT_NUMBERS
-
-        if not account_sid or not auth_token or not ourNumbers:
-          raise ESPError()("You must configure the Twilio account settings before attempting to send texts using this module")
-
-        # cycle through our phone numbers to reduce sending time
-        numberIndex = 0
+        GroupTextModule.check_settings()
 
         send_log = []
-        send_log.append('Sending message to ' + str(users.count()) + ' users')
+        send_log.append('Sending message to ' + str(len(users)) + ' users')
+
+        #   Only get contact info for the actual user (not guardians or emergency contacts)
+        contact_infos = ContactInfo.objects.filter(user__in=users, as_user__isnull=False).order_by('user', '-id').distinct('user')
+        contact_info_by_user = {contactInfo.user_id: contactInfo for contactInfo in contact_infos}
 
+        text = GroupTextMessage.objects.create(body=body, override=bool(override))
+        recipients = []
         for user in users:
+            recipient = GroupTextRecipient(message=text, user=user)
+            recipients.append(recipient)
 
-            contactInfo = None
-            try:
-                #   Only get contact info for the actual user (not guardians or emergency contacts)
-                contactInfo = ContactInfo.objects.filter(user=user, as_user__isnull=False).distinct('user')[0]
-            except ContactInfo.DoesNotExist:
-                pass
+            contactInfo = contact_info_by_user.get(user.id)
             if not contactInfo:
                 send_log.append("Could not find contact info for "+str(user))
+                recipient.status = GroupTextRecipient.SKIPPED
+                recipient.error = "No contact info"
                 continue
             send_log.append("Found contact info for "+str(user))
 
@@ -163,24 +236,93 @@ def sendMessages(filterobj, body, override = False):
             # unless override is true
             if not contactInfo.receive_txt_message and not override:
                 send_log.append(str(user)+" does not want text messages, fine")
+                recipient.status = GroupTextRecipient.SKIPPED
+                recipient.error = "Does not want text messages"
                 continue
-            client = Client(account_sid, auth_token)
 
             # format the number for Twilio
-            formattedNumber = format_number(contactInfo.phone_cell, PhoneNumberFormat.E164)
-
-            if formattedNumber:
-                send_log.append("Sending text message to "+formattedNumber)
-                try:
-                    client.messages.create(body=body,
-                                           to=formattedNumber,
-                                           from_=ourNumbers[numberIndex])
-                except TwilioRestException as error:
-                    send_log.append(error.msg)
-                numberIndex = (numberIndex + 1) % len(ourNumbers)
+            if contactInfo.phone_cell:
+                recipient.phone_number = format_number(contactInfo.phone_cell, PhoneNumberFormat.E164)
+            if not recipient.phone_number:
+                recipient.status = GroupTextRecipient.SKIPPED
+                recipient.error = "No cell phone number"
+
+        GroupTextRecipient.objects.bulk_create(recipients)
+        send_log.extend(GroupTextModule.deliver(text, text.recipients.filter(status=GroupTextRecipient.PENDING)))
+
+        return text, "\n".join(send_log)
 
+    @staticmethod
+    def retryMessage(text):
+        """ Resend a GroupTextMessage to the recipients it failed to reach,
+            returning a log of actions which can be displayed to user. """
+        GroupTextModule.check_settings()
+        failed = text.recipients.filter(status=GroupTextRecipient.FAILED)
+        send_log = ['Retrying message to ' + str(failed.count()) + ' users']
+        send_log.extend(GroupTextModule.deliver(text, failed))
         return "\n".join(send_log)
 
+    @staticmethod
+    def check_settings():
+        if not settings.TWILIO_ACCOUNT_SID or not settings.TWILIO_AUTH_TOKEN or not settings.TWILIO_ACCOUNT_NUMBERS:
+            raise ESPError()("You must configure the Twilio account settings before attempting to send texts using this module")
+
+    @staticmethod
+    def get_client():
+        """ Get a Twilio client for our account.  settings.TWILIO_API_URL may
+            be set to send requests somewhere other than Twilio's API, e.g. a
+            test server. """
+        client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+        api_url = getattr(settings, 'TWILIO_API_URL', None)
+        if api_url:
+            client.api.base_url = api_url
+        return client
+
+    @staticmethod
+    def deliver(text, recipients):
+        """ Send text to the given GroupTextRecipients and save the results,
+            returning a log of actions which can be displayed to user.
+
+            Recipients are spread across our numbers (settings.TWILIO_ACCOUNT_NUMBERS)
+            and sent by settings.TWILIO_SEND_WORKERS threads (by default one
+            per number), sharing a single client.  Each number sends at most
+            GroupTextModule.send_rate() texts per second. """
+
+        recipients = list(recipients.select_related('user'))
+        if not recipients:
+            return []
+
+        ourNumbers = settings.TWILIO_ACCOUNT_NUMBERS
+        rate = GroupTextModule.send_rate()
+        buckets = {number: TokenBucket(rate) for number in ourNumbers}
+
+        send_log = []
+        work = queue.Queue()
+        # cycle through our phone numbers to reduce sending time
+        for (i, recipient) in enumerate(recipients):
+            recipient.sent_from = ourNumbers[i % len(ourNumbers)]
+            send_log.append("Sending text message to "+recipient.phone_number)
+            work.put((recipient, text.body))
+
+        client = GroupTextModule.get_client()
+        num_workers = min(getattr(settings, 'TWILIO_SEND_WORKERS', len(ourNumbers)), len(recipients))
+        workers = []
+        for i in range(num_workers):
+            work.put(None)
+            worker = threading.Thread(target=_send_worker, args=(client, work, buckets))
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+
+        GroupTextRecipient.objects.bulk_update(recipients, ['sent_from', 'status', 'sid', 'error', 'sent_at'])
+
+        for recipient in recipients:
+            if recipient.status == GroupTextRecipient.FAILED:
+                send_log.append("Could not send text message to %s (%s): %s" % (recipient.phone_number, recipient.user, recipient.error))
+
+        return send_log
+
     def isStep(self):
         return False
 
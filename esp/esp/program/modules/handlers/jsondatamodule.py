@@ -45,11 +45,11 @@
 
 from argcache import cache_function
 
-from esp.cal.models import Event, EventType
+from esp.cal.models import Event
 from esp.dbmail.models import MessageRequest
 from esp.middleware import ESPError
 from esp.program.class_status import ClassStatus
-from esp.program.models import Program, ClassSection, ClassSubject, StudentRegistration, ClassCategories, StudentSubjectInterest, ClassFlagType, ClassFlag, ModeratorRecord, RegistrationProfile, TeacherBio, PhaseZeroRecord, FinancialAidRequest, VolunteerOffer
+from esp.program.models import Program, ClassSection, ClassSubject, ClassCatalogEntry, StudentRegistration, ClassCategories, StudentSubjectInterest, ClassFlagType, ClassFlag, ModeratorRecord, RegistrationProfile, TeacherBio, PhaseZeroRecord, FinancialAidRequest, VolunteerOffer
 from esp.program.modules.base import ProgramModuleObj, CoreModule, needs_student_in_grade, needs_admin, no_auth, aux_call
 from esp.resources.models import ResourceAssignment, ResourceRequest, ResourceType
 from esp.tagdict.models import Tag
@@ -79,40 +79,16 @@ def module_properties(cls):
 
     @staticmethod
     def _bulk_availability(prog, user_ids, subtract_moderation=False):
-        """Bulk-fetch availability for multiple users in one query.
+        """Look up availability for multiple users from the program's cached
+        teacher availability matrix.
 
         Returns {user_id: [event_id, ...]} lookup.
         When subtract_moderation=True, subtracts moderating section times.
         """
-        avail_by_user = defaultdict(set)
-        if prog.hasModule('AvailabilityModule'):
-            et = EventType.get_from_desc('Class Time Block')
-            for uid, eid in UserAvailability.objects.filter(
-                event__program=prog,
-                event__event_type=et,
-                user_id__in=user_ids,
-            ).values_list('user_id', 'event_id'):
-                avail_by_user[uid].add(eid)
-        else:
-            all_ts = set(prog.getTimeSlots().values_list('id', flat=True))
-            for uid in user_ids:
-                avail_by_user[uid] = set(all_ts)
-
-        if subtract_moderation:
-            #   Bulk-subtract moderating section times
-            mod_times = (
-                ClassSection.objects
-                .filter(
-                    parent_class__parent_program=prog,
-                    moderators__id__in=user_ids,
-                )
-                .values_list('moderators__id', 'meeting_times__id')
-            )
-            for uid, tid in mod_times:
-                if tid is not None:
-                    avail_by_user.get(uid, set()).discard(tid)
-
-        return {uid: list(events) for uid, events in avail_by_user.items()}
+        matrix = prog.getTeacherAvailabilityMatrix()
+        return {uid: [e.id for e in matrix.events(matrix.available_mask(
+                    uid, ignore_classes=True, ignore_moderation=not subtract_moderation))]
+                for uid in user_ids}
 
 
     @aux_call
@@ -123,6 +99,7 @@ def counts(prog):
         return {'sections': list(ClassSection.objects.filter(status__gt=0, parent_class__status__gt=0, parent_class__parent_program=prog).values('id', 'enrolled_students'))}
     counts.method.cached_function.depend_on_row(ClassSection, lambda sec: {'prog': sec.parent_class.parent_program})
     counts.method.cached_function.depend_on_row(StudentRegistration, lambda sr: {'prog': sr.section.parent_class.parent_program})
+    counts.method.cached_function.depend_on_row('program.RegistrationCacheEpoch', lambda epoch: {'prog': epoch.program})
 
     @aux_call
     @json_response()
@@ -150,7 +127,7 @@ def rooms(prog):
             } for room_id in classrooms_grouped.keys() ]
 
         return {'rooms': classrooms_dicts}
-    rooms.method.cached_function.depend_on_model('resources.Resource')
+    rooms.method.cached_function.depend_on_row('resources.Resource', lambda res: {'prog': res.event.parent_program()})
 
     @aux_call
     @json_response()
@@ -358,7 +335,7 @@ def sections(extra, prog):
     sections.cached_function.depend_on_row(ClassSection, lambda sec: {'prog': sec.parent_class.parent_program})
     sections.cached_function.depend_on_m2m(ClassSection, 'moderators', lambda sec, moderator: {'prog': sec.parent_class.parent_program})
     sections.cached_function.depend_on_row(ClassSubject, lambda subj: {'prog': subj.parent_program})
-    sections.cached_function.depend_on_model(UserAvailability)
+    sections.cached_function.depend_on_row(UserAvailability, lambda ua: {'prog': ua.event.parent_program()})
     # Put this import here rather than at the toplevel, because wildcard messes things up
     from argcache.key_set import wildcard
     sections.cached_function.depend_on_cache(ClassSubject.get_teachers, lambda self=wildcard, **kwargs: {'prog': self.parent_program})
@@ -491,12 +468,28 @@ def class_subjects(extra, prog):
         teachers = []
         moderators = []
         classes = []
-        qs = prog.classes().prefetch_related(
-            'category', 'sections', 'teachers')
+        qs = list(prog.classes().select_related('category'))
+
+        #   Sections and teachers come from the catalog snapshot; moderators
+        #   are looked up for the whole program at once.
+        entries_by_subject = ClassCatalogEntry.entries_by_subject([c.id for c in qs])
+        teacher_lookup = ESPUser.objects.in_bulk(list(set(
+            t for class_entries in entries_by_subject.values()
+            for t in class_entries[0].get_teacher_ids())))
+        section_moderators = defaultdict(list)
+        for section_id, user_id in ClassSection.moderators.through.objects.filter(
+                classsection__parent_class__parent_program=prog).values_list(
+                'classsection_id', 'espuser_id'):
+            section_moderators[section_id].append(user_id)
+        moderator_lookup = ESPUser.objects.in_bulk(list(set(
+            m for ids in section_moderators.values() for m in ids)))
 
         for c in qs:
-            class_teachers = c.get_teachers()
-            class_moderators = c.moderators()
+            class_entries = entries_by_subject[c.id]
+            class_teachers = [teacher_lookup[t] for t in class_entries[0].get_teacher_ids() if t in teacher_lookup] if class_entries else []
+            section_ids = [e.section_id for e in class_entries if e.section_id is not None]
+            class_moderators = [moderator_lookup[m] for m in sorted(set(
+                m for section_id in section_ids for m in section_moderators[section_id]))]
             cls = {
                 'id': c.id,
                 'status': c.status,
@@ -516,7 +509,7 @@ def class_subjects(extra, prog):
             cls['emailcode'] = c.emailcode()
             if c.duration:
                 cls['length'] = float(c.duration)
-            cls['sections'] = [s.id for s in c.sections.all()]
+            cls['sections'] = section_ids
             cls['teachers'] = [t.id for t in class_teachers]
             for t in class_teachers:
                 if t.id in teacher_dict:
@@ -555,6 +548,8 @@ def class_subjects(extra, prog):
         return {'classes': classes, 'teachers': teachers, 'moderators': moderators}
     class_subjects.cached_function.depend_on_row(ClassSubject, lambda cls: {'prog': cls.parent_program})
     class_subjects.cached_function.depend_on_cache(ClassSubject.get_teachers, lambda cls=wildcard, **kwargs: {'prog': cls.parent_program})
+    class_subjects.cached_function.depend_on_row(ClassSection, lambda sec: {'prog': sec.parent_class.parent_program})
+    class_subjects.cached_function.depend_on_m2m(ClassSection, 'moderators', lambda sec, moderator: {'prog': sec.parent_class.parent_program})
 
     @aux_call
     @json_response({
@@ -675,8 +670,8 @@ def class_info(self, request, tl, one, two, module, extra, prog):
         }
 
         return {return_key: [return_dict]}
-    class_info.cached_function.depend_on_model(ClassSubject)
-    class_info.cached_function.depend_on_model(ClassSection)
+    class_info.cached_function.depend_on_row(ClassSubject, lambda cls: {'prog': cls.parent_program})
+    class_info.cached_function.depend_on_row(ClassSection, lambda sec: {'prog': sec.parent_class.parent_program})
 
     @aux_call
     @cache_control(public=True, max_age=300)
@@ -966,6 +961,7 @@ def student_nums(prog):
         return student_num_list
     student_nums.depend_on_row(StudentSubjectInterest, lambda ssi: {'prog': ssi.subject.parent_program})
     student_nums.depend_on_row(StudentRegistration, lambda sr: {'prog': sr.section.parent_class.parent_program})
+    student_nums.depend_on_row('program.RegistrationCacheEpoch', lambda epoch: {'prog': epoch.program})
     student_nums.depend_on_row(RegistrationProfile, lambda prof: {'prog': prof.program})
     student_nums.depend_on_row(Record, lambda rec: {'prog': rec.program})
     student_nums.depend_on_row(PhaseZeroRecord, lambda rec: {'prog': rec.program})
@@ -1049,6 +1045,7 @@ def hour_nums(prog):
     hour_nums.depend_on_row(ClassSection, lambda sec: {'prog': sec.parent_class.parent_program})
     hour_nums.depend_on_m2m(ClassSection, 'meeting_times', lambda sec, event: {'prog': sec.parent_class.parent_program})
     hour_nums.depend_on_row(StudentRegistration, lambda sr: {'prog': sr.section.parent_class.parent_program})
+    hour_nums.depend_on_row('program.RegistrationCacheEpoch', lambda epoch: {'prog': epoch.program})
     hour_nums.depend_on_row(Record, lambda rec: {'prog': rec.program}, lambda rec: rec.event and rec.event.name == 'attended')
     hour_nums = staticmethod(hour_nums)
 
@@ -1095,6 +1092,7 @@ def student_max_count(clslist):
     timeslots_nums.depend_on_row(ClassSection, lambda sec: {'prog': sec.parent_class.parent_program})
     timeslots_nums.depend_on_m2m(ClassSection, 'meeting_times', lambda sec, event: {'prog': sec.parent_class.parent_program})
     timeslots_nums.depend_on_row(StudentRegistration, lambda sr: {'prog': sr.section.parent_class.parent_program})
+    timeslots_nums.depend_on_row('program.RegistrationCacheEpoch', lambda epoch: {'prog': epoch.program})
     timeslots_nums = staticmethod(timeslots_nums)
 
     @aux_call
@@ -2,13 +2,17 @@
 
 from esp.program.models import StudentRegistration
 from esp.program.modules.base import ProgramModuleObj, needs_admin, main_call, aux_call
-from esp.program.controllers.lottery import LotteryAssignmentController, LotteryException
+from esp.program.controllers.lottery import LotteryAssignmentController, SparseLotteryAssignmentController, LotteryException
 from esp.utils.web import render_to_response
 from esp.utils.decorators import json_response
 
 class LotteryFrontendModule(ProgramModuleObj):
     doc = """Run the class lottery and assign students to classes."""
 
+    #   Each run happens inside the request, one after another, so only allow
+    #   a few; the run_lottery management command can try more in parallel.
+    max_runs = 5
+
     @classmethod
     def module_properties(cls):
         return {
@@ -63,16 +67,24 @@ def lottery_execute(self, request, tl, one, two, module, extra, prog):
 
                 options[key.split('_', 1)[1]] = value
 
+        #   Never fork worker processes from the web server.
+        options.pop('processes', None)
+        if options.get('num_runs', 1) > self.max_runs:
+            return {'response': [{'error_msg': 'At most %d runs can be tried from this page; use the run_lottery management command to try more.' % self.max_runs}]}
+
         try:
-            lotteryObj = LotteryAssignmentController(prog, **options)
-            lotteryObj.compute_assignments(True)
+            if options.get('sparse'):
+                lotteryObj = SparseLotteryAssignmentController(prog, **options)
+            else:
+                lotteryObj = LotteryAssignmentController(prog, **options)
+            lotteryObj.compute_best_assignments(True)
         except LotteryException as e:
             logging.exception(e)
             return {'response': [{'error_msg': str(e)}]}
 
         stats = lotteryObj.extract_stats(lotteryObj.compute_stats())
         lottery_data = lotteryObj.export_assignments()
-        return {'response': [{'stats': stats, 'lottery_data': lottery_data}]}
+        return {'response': [{'stats': stats, 'lottery_data': lottery_data, 'seed': lotteryObj.seed}]}
 
     @aux_call
     @json_response()
@@ -82,7 +94,10 @@ def lottery_save(self, request, tl, one, two, module, extra, prog):
             return {'response': [{'success': 'no', 'error': 'missing lottery_data POST field'}]};
 
         lotteryObj = LotteryAssignmentController(prog)
-        lotteryObj.import_assignments(request.POST['lottery_data'])
+        try:
+            lotteryObj.import_assignments(request.POST['lottery_data'])
+        except ValueError as e:
+            return {'response': [{'success': 'no', 'error': str(e)}]}
         lotteryObj.save_assignments()
         return {'response': [{'success': 'yes'}]};
 
@@ -33,14 +33,19 @@
   Email: web-team@learningu.org
 """
 
+import hashlib
 import json
+from collections import defaultdict
 from datetime import datetime, timedelta
 
 from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
 from django.db.models import Min
 from django.db.models.query import Q
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified
 from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
 from django.utils.safestring import mark_safe
 
 from esp.users.models    import ESPUser, Record
@@ -48,7 +53,7 @@
 from esp.program.class_status import ClassStatus
 
 from esp.program.modules.base import ProgramModuleObj, needs_onsite, needs_student_in_grade, main_call, aux_call
-from esp.program.models import ClassSubject, ClassSection, StudentRegistration, ScheduleMap, Program
+from esp.program.models import ClassSubject, ClassSection, StudentRegistration, ScheduleMap, Program, ProgramChangeFeed
 from esp.utils.web import render_to_response
 from esp.cal.models import Event
 from argcache import cache_function
@@ -93,13 +98,21 @@ def section_data(sec):
     def catalog_status(self, request, tl, one, two, module, extra, prog):
         resp = HttpResponse(content_type='application/json')
         #   Fetch a reduced version of the catalog to save time
-        sections = list(ClassSection.objects.filter(parent_class__parent_program=prog, status__gt=0).extra({'event_ids':  """ARRAY(SELECT "cal_event"."id" FROM "cal_event", "program_classsection_meeting_times" WHERE ("program_classsection_meeting_times"."event_id" = "cal_event"."id" AND "program_classsection_meeting_times"."classsection_id" = "program_classsection"."id"))"""}).values('id', 'parent_class__id', 'enrolled_students', 'event_ids', 'registration_status'))
-        for i in range(0, len(sections)):
-            sections[i]['capacity'] = ClassSection.objects.get(id=sections[i]['id']).capacity
+        sections = ClassSection.objects.filter(parent_class__parent_program=prog, status__gt=0)
+        event_ids = defaultdict(list)
+        for (section_id, event_id) in ClassSection.meeting_times.through.objects.filter(classsection__in=sections).order_by('event__start').values_list('classsection_id', 'event_id'):
+            event_ids[section_id].append(event_id)
         data = {
             #   Todo: section current capacity ? (see ClassSection.get_capacity())
             'classes': list(ClassSubject.objects.filter(parent_program=prog, status__gt=0).extra({'teacher_names': """array_to_string(ARRAY(SELECT auth_user.first_name || ' ' || auth_user.last_name FROM auth_user,program_class_teachers WHERE program_class_teachers.classsubject_id=program_class.id AND auth_user.id=program_class_teachers.espuser_id), ', ')""", 'class_size_max_optimal': """SELECT program_classsizerange.range_max FROM program_classsizerange WHERE program_classsizerange.id = optimal_class_size_range_id"""}).values('id', 'class_size_max', 'class_size_max_optimal', 'class_info', 'prereqs', 'hardness_rating', 'grade_min', 'grade_max', 'title', 'teacher_names', 'category__symbol', 'category__id')),
-            'sections': sections,
+            'sections': [{
+                'id': section.id,
+                'parent_class__id': section.parent_class_id,
+                'enrolled_students': section.enrolled_students,
+                'event_ids': event_ids[section.id],
+                'registration_status': section.registration_status,
+                'capacity': section.capacity,
+            } for section in sections.select_related('parent_class')],
             'timeslots': list(prog.getTimeSlots().extra({'start_millis':"""EXTRACT(EPOCH FROM start) * 1000""",'label': """to_char("start", 'Dy HH:MI -- ') || to_char("end", 'HH:MI AM')"""}).values_list('id', 'label', 'start_millis').order_by("start")),
             'categories': list(prog.class_categories.all().order_by('-symbol').values('id', 'symbol', 'category')),
         }
@@ -110,9 +123,38 @@ def catalog_status(self, request, tl, one, two, module, extra, prog):
     @aux_call
     @needs_onsite
     def enrollment_status(self, request, tl, one, two, module, extra, prog):
+        """ The (user, section) pairs of every enrollment in the program.
+
+        With a 'since' cursor, returns a dict with the cursor to use next
+        time, and only the pairs that were 'added' or 'removed' since the
+        given cursor; if that cursor is too old to tell, 'reset' is set and
+        'added' lists every enrollment.  Full snapshots carry an ETag, so that
+        clients re-fetching one that hasn't changed get a 304 instead. """
+        feed = ProgramChangeFeed(prog)
+        delta = 'since' in request.GET
+        (seq, changes) = feed.get_registration_changes(feed.request_cursor(request))
+        etag = None
+        if changes is None:
+            #   The registration cursor covers changes to enrollments, and
+            #   which sections are open is the only other thing a snapshot
+            #   depends on, so we can tell if it has changed cheaply.
+            statuses = ClassSection.objects.filter(parent_class__parent_program=prog).order_by('id').values_list('id', 'status', 'parent_class__status')
+            etag = quote_etag(hashlib.md5(json.dumps([delta, seq, list(statuses)]).encode('utf-8')).hexdigest())
+            if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+                resp = HttpResponseNotModified()
+                resp['ETag'] = etag
+                return resp
+
         resp = HttpResponse(content_type='application/json')
-        data = StudentRegistration.valid_objects().filter(section__status__gt=0, section__parent_class__status__gt=0, section__parent_class__parent_program=prog, relationship__name='Enrolled').values_list('user__id', 'section__id')
-        json.dump(list(data), resp)
+        (added, removed) = feed.get_enrollment_changes(changes)
+        if delta:
+            data = {'cursor': seq, 'added': added, 'removed': removed, 'reset': changes is None}
+        else:
+            data = added
+        json.dump(data, resp)
+        if etag:
+            resp['ETag'] = etag
+            patch_cache_control(resp, private=True, no_cache=True)
         return resp
 
     @aux_call
@@ -202,6 +244,23 @@ def counts_status(self, request, tl, one, two, module, extra, prog):
         json.dump(list(data), resp)
         return resp
 
+    @transaction.non_atomic_requests
+    @aux_call
+    @needs_onsite
+    def counts_feed(self, request, tl, one, two, module, extra, prog):
+        """ Enrollment counts for the sections that changed since the 'since'
+        cursor, in the same format as counts_status.  If nothing has changed
+        yet, waits (for up to the change_feed_timeout tag) before answering.
+        Without a usable cursor, 'reset' is set and every section is listed. """
+        resp = HttpResponse(content_type='application/json')
+        feed = ProgramChangeFeed(prog)
+        since = feed.request_cursor(request)
+        if since is not None and since == feed.get_registration_seq():
+            feed.wait(registration_seq=since, timeout=feed.request_timeout(request, prog))
+        (seq, counts, reset) = feed.get_count_changes(since)
+        json.dump({'cursor': seq, 'counts': counts, 'reset': reset}, resp)
+        return resp
+
     @aux_call
     @needs_onsite
     def full_status(self, request, tl, one, two, module, extra, prog):
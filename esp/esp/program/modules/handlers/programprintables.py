@@ -104,17 +104,18 @@ def paid_list(self, request, tl, one, two, module, extra, prog):
                 single_select = False
 
             if ids is None:
-                transfers = pac.all_transfers().exclude(line_item__text__in=exclude_line_items).order_by('line_item', 'user').select_related()
+                lineitems = pac.all_transfers().exclude(line_item__text__in=exclude_line_items).order_by('line_item', 'user').select_related()
             else:
                 lineitems = pac.all_transfers().filter(line_item__id__in=ids).order_by('line_item', 'user').select_related()
         else:
             single_select = False
             lineitems = pac.all_transfers().exclude(line_item__text__in=exclude_line_items).order_by('line_item', 'user').select_related()
 
-        for lineitem in lineitems:
-            lineitem.has_financial_aid = lineitem.user.hasFinancialAid(prog)
-
         lineitems_list = list(lineitems)
+        summaries = pac.summarize({lineitem.user for lineitem in lineitems_list})
+        for lineitem in lineitems_list:
+            lineitem.has_financial_aid = summaries[lineitem.user_id].amount_finaid() > 0
+
         lineitems_list.sort(key=lambda li: li.user.last_name.lower())
 
         context = { 'lineitems': lineitems_list,
@@ -1152,9 +1153,11 @@ def student_financial_spreadsheet(self, request, tl, one, two, module, extra, pr
         response = HttpResponse(content_type='text/csv')
         writer = csv.writer(response)
         writer.writerow(('Control ID', 'Student ID', 'Last name', 'First name', 'Total cost', 'Finaid grant', 'Amount paid', 'Amount owed'))
+        summaries = ProgramAccountingController(self.program).summarize(students)
         for student in students:
             iac = IndividualAccountingController(self.program, student)
-            writer.writerow((iac.get_id(), student.id, student.last_name.encode('ascii', 'replace'), student.first_name.encode('ascii', 'replace'), '%.2f' % iac.amount_requested(), '%.2f' % iac.amount_finaid(), '%.2f' % iac.amount_paid(), '%.2f' % iac.amount_due()))
+            summary = summaries[student.id]
+            writer.writerow((iac.get_id(), student.id, student.last_name.encode('ascii', 'replace'), student.first_name.encode('ascii', 'replace'), '%.2f' % summary.amount_requested(), '%.2f' % summary.amount_finaid(), '%.2f' % summary.amount_paid(), '%.2f' % summary.amount_due()))
 
         return response
 
@@ -1262,6 +1265,7 @@ def get_student_schedules(request, students, prog, extra='', onsite=False):
 
         show_empty_blocks = Tag.getBooleanTag('studentschedule_show_empty_blocks', prog)
         timeslots = list(prog.getTimeSlots())
+        summaries = ProgramAccountingController(prog).summarize(students)
         for student in students:
             student.updateOnsite(request)
             # get list of valid classes
@@ -1313,6 +1317,7 @@ def get_student_schedules(request, students, prog, extra='', onsite=False):
 
             # get payment information
             iac = IndividualAccountingController(prog, student)
+            summary = summaries[student.id]
 
             # attach payment information to student
             student.invoice_id = iac.get_id()
@@ -1320,10 +1325,10 @@ def get_student_schedules(request, students, prog, extra='', onsite=False):
             student.meals = iac.get_transfers(optional_only=True)  # catch everything that's not admission to the program.
             student.required = iac.get_transfers(required_only=True).exclude(line_item=iac.default_admission_lineitemtype())
             student.admission = iac.get_transfers(line_items = [iac.default_admission_lineitemtype()])  # Program admission
-            student.paid_online = iac.has_paid()
-            student.amount_finaid = iac.amount_finaid()
-            student.amount_siblingdiscount = iac.amount_siblingdiscount()
-            student.itemizedcosttotal = iac.amount_due()
+            student.paid_online = summary.has_paid()
+            student.amount_finaid = summary.amount_finaid()
+            student.amount_siblingdiscount = summary.amount_siblingdiscount()
+            student.itemizedcosttotal = summary.amount_due()
 
             student.has_paid = ( student.itemizedcosttotal == 0 )
             student.payment_info = True
@@ -1347,7 +1352,8 @@ def get_student_schedules(request, students, prog, extra='', onsite=False):
             return render_to_response(basedir+'studentschedule.html', request, context)
         elif file_type == 'pdf':
             if len(students) > 1:
-                response = render_to_latex(basedir+'studentschedule.tex', context, 'pdf')
+                # Large batches are compiled in parallel chunks and merged.
+                response = render_to_latex(basedir+'studentschedule.tex', context, 'pdf', split='students')
                 response['Content-Disposition'] = 'attachment; filename="studentschedules.pdf"'
                 return response
             else:
@@ -1588,6 +1594,7 @@ def studentchecklist(self, request, tl, one, two, module, extra, prog):
         if tag_data:
             records = [event for event in [x.strip().lower() for x in tag_data.split(',') if RecordType.objects.filter(name = x.strip().lower()).exists()] if event not in ['attended', 'med', 'liab']]
         studentList = []
+        summaries = ProgramAccountingController(self.program).summarize(students)
         for student in students:
             finaid_status = 'None'
             if student.appliedFinancialAid(prog):
@@ -1596,13 +1603,13 @@ def studentchecklist(self, request, tl, one, two, module, extra, prog):
                 else:
                     finaid_status = 'Req. (No RL)'
 
-            iac = IndividualAccountingController(self.program, student)
-            if student.hasFinancialAid(self.program):
+            summary = summaries[student.id]
+            if summary.amount_finaid() > 0:
                 finaid_status = 'Approved'
 
             studentList.append({'user': student,
-                                'paid': iac.has_paid(in_full=True),
-                                'amount_due': iac.amount_due(),
+                                'paid': summary.has_paid(in_full=True),
+                                'amount_due': summary.amount_due(),
                                 'finaid': finaid_status,
                                 'checked_in': Record.user_completed(student, "attended", self.program),
                                 'med': Record.user_completed(student, "med", self.program),
@@ -1625,6 +1632,7 @@ def classchecklists(self, request, tl, one, two, module, extra, prog):
         students= sorted([ user for user in self.program.students()['confirmed']])
 
         class_list = []
+        summaries = ProgramAccountingController(self.program).summarize(students)
 
         for c in self.program.classes():
             class_dict = {'cls': c}
@@ -1632,8 +1640,7 @@ def classchecklists(self, request, tl, one, two, module, extra, prog):
 
             for student in students:
                 if c in student.getEnrolledClasses(self.program):
-                    iac = IndividualAccountingController(self.program, student)
-                    if iac.amount_due() <= 0:
+                    if summaries[student.id].amount_due() <= 0:
                         paid_symbol = 'X'
                     else:
                         paid_symbol = ''
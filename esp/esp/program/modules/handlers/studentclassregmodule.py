@@ -49,7 +49,7 @@
 from esp.program.modules.base import ProgramModuleObj, needs_student_in_grade, meets_deadline, meets_any_deadline, aux_call, meets_cap, no_auth
 
 from esp.program.controllers.studentclassregmodule import RegistrationTypeController as RTC
-from esp.program.models  import ClassSubject, ClassSection, ClassCategories, RegistrationProfile, Program, StudentRegistration, StudentSubjectInterest
+from esp.program.models  import ClassSubject, ClassSection, ClassCategories, RegistrationProfile, StudentRegistration, StudentSubjectInterest
 from esp.utils.web import render_to_response
 from esp.middleware      import ESPError, AjaxError, ESPError_NoLog
 from esp.users.models    import ESPUser, Permission
@@ -147,11 +147,7 @@ def students(self, QObject = False):
         Enrolled = Q(studentregistration__relationship__name='Enrolled')
         Par = Q(studentregistration__section__parent_class__parent_program=self.program)
         Unexpired = nest_Q(StudentRegistration.is_valid_qobject(), 'studentregistration')
-        if len(self.program.dates()) == 0: # If current program doesn't have dates set yet, there are no past programs
-            past_programs = []
-        else:
-            past_programs = [x for x in Program.objects.all()
-                             if len(x.dates()) > 0 and x.dates()[0] < self.program.dates()[0]]
+        past_programs = self.program.past_program_ids()
         Past = Q(studentregistration__section__parent_class__parent_program__in=past_programs)
 
         # Force Django to generate two subqueries without joining SRs to SSIs,
@@ -386,7 +382,9 @@ def addclass_logic(request, tl, one, two, module, extra, prog, webapp=False):
             error = cobj.cannotAdd(request.user, scrmi.enforce_max, webapp=webapp) or section.cannotAdd(request.user, scrmi.enforce_max, webapp=webapp)
 
         if scrmi.use_priority:
-            priority = request.user.getRegistrationPriority(prog, section.meeting_times.all())
+            #   This is 0 if the student is already enrolled at that time, but
+            #   there is no 'Priority/0', so they go in at the first level.
+            priority = max(request.user.getRegistrationPriority(prog, section.meeting_times.all()), 1)
         else:
             priority = 1
 
@@ -36,6 +36,7 @@
 from esp.program.modules.forms.onsite import TeacherCheckinForm
 from esp.program.modules.base import ProgramModuleObj, needs_onsite, main_call, aux_call
 from esp.program.modules.handlers.grouptextmodule import GroupTextModule
+from esp.program.modules.module_ext import GroupTextRecipient
 from esp.program.models import RegistrationProfile
 from esp.program.models.class_ import ClassSubject, ClassSection
 from esp.program.class_status import ClassStatus
@@ -181,8 +182,8 @@ def ajaxteachertext(self, request, tl, one, two, module, extra, prog):
                 template = get_template(self.baseDir() + 'teachertext.txt')
                 context = {'prog': prog, 'one': one, 'two': two, 'sec': sec, 'teacher': teacher}
                 message = template.render(context)
-                log = GroupTextModule.sendMessages(teacher, message, True)
-                if "error" in log:
+                text, log = GroupTextModule.textUsers(teacher, message, True)
+                if text.recipients.filter(status=GroupTextRecipient.FAILED).exists():
                     return {'message': "Error texting teacher"}
                 else:
                     return {'message': "Texted teacher"}
@@ -34,7 +34,6 @@
 """
 import datetime
 import logging
-from django.db.models import signals
 from esp.users.models import Record
 from esp.program.modules.base import ProgramModuleObj, needs_admin, main_call, aux_call
 from esp.program.models import StudentRegistration, RegistrationType
@@ -85,14 +84,8 @@ def unenroll_students(self, request, tl, one, two, module, extra, prog):
                 registrations = StudentRegistration.objects.filter(id__in=ids)
                 registrations.update(end_date=datetime.datetime.now())
                 logger.info("Expired student registrations: %s", ids)
-            # send signal to expire caches
-            # XXX: sending all of them is actually kind of
-            # expensive and mostly redundant; it would be
-            # preferable to have a way to say "just invalidate the
-            # whole table".
-            for reg in registrations:
-                signals.post_save.send(
-                    sender=StudentRegistration, instance=reg)
+            # expire caches, since update() doesn't send signals
+            StudentRegistration.invalidate_caches(registrations)
             context['ids'] = ids
             return render_to_response(
                 self.baseDir()+'result.html', request, context)
@@ -171,6 +164,8 @@ def unenroll_status(prog):
     cache = unenroll_status.method.cached_function
     cache.depend_on_row(StudentRegistration,
         lambda sr: {'prog': sr.section.parent_class.parent_program})
+    cache.depend_on_row('program.RegistrationCacheEpoch',
+        lambda epoch: {'prog': epoch.program})
     cache.depend_on_row('users.Record',
         lambda record: {'prog': record.program},
         lambda record: record.event and record.event.name == 'attended')
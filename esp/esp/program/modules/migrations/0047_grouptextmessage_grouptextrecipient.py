@@ -0,0 +1,42 @@
+# Generated by Django 2.2.28 on 2026-10-17 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import esp.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modules', '0046_auto_20260106_2204'),
+        ('users', '0040_auto_20260106_2204'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupTextMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('body', models.TextField()),
+                ('override', models.BooleanField(default=False, help_text="Whether the recipients' texting preferences were overridden")),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GroupTextRecipient',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('phone_number', models.CharField(blank=True, max_length=32)),
+                ('sent_from', models.CharField(blank=True, max_length=32)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed'), ('skipped', 'Skipped')], db_index=True, default='pending', max_length=16)),
+                ('sid', models.CharField(blank=True, help_text="The SMS provider's ID for the sent message", max_length=64)),
+                ('error', models.TextField(blank=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipients', to='modules.GroupTextMessage')),
+                ('user', esp.db.fields.AjaxForeignKey(on_delete=django.db.models.deletion.CASCADE, to='users.ESPUser')),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+    ]
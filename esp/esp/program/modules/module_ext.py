@@ -38,10 +38,10 @@
 import time
 
 from django.core.validators import RegexValidator, validate_comma_separated_integer_list
-from django.db import models
+from django.db import models, transaction
 
 from esp.db.fields import AjaxForeignKey
-from esp.program.models import Program, RegistrationType, ClassSection
+from esp.program.models import Program, ProgramChangeFeed, RegistrationType, ClassSection
 from esp.users.models import ESPUser
 
 # If this module is a little confusingly named, or has some cruft in it, it's
@@ -379,6 +379,9 @@ def append(self, entry, user=None):
         self.entries.add(entry)
         self.save()
 
+        index = entry.index
+        transaction.on_commit(lambda: ProgramChangeFeed(self.program_id).log_changed(index))
+
     def appendScheduling(self, timeslots, room_name, cls_id, user=None):
         entry = AJAXChangeLogEntry()
         entry.setScheduling(timeslots, room_name, cls_id)
@@ -434,4 +437,44 @@ def update(self, comment, locked):
         self.locked = locked
         self.save()
 
+@python_2_unicode_compatible
+class GroupTextMessage(models.Model):
+    """ A text message sent to a group of users by the group text module. """
+    body = models.TextField()
+    override = models.BooleanField(default=False, help_text='Whether the recipients\' texting preferences were overridden')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return 'Group text sent %s: %s' % (self.created_at, self.body[:40])
+
+@python_2_unicode_compatible
+class GroupTextRecipient(models.Model):
+    """ The result of sending a GroupTextMessage to one user, so that failed
+    texts can be found and retried. """
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+        (SKIPPED, 'Skipped'),
+    )
+
+    message = models.ForeignKey(GroupTextMessage, related_name='recipients', on_delete=models.CASCADE)
+    user = AjaxForeignKey(ESPUser, on_delete=models.CASCADE)
+    phone_number = models.CharField(max_length=32, blank=True)
+    sent_from = models.CharField(max_length=32, blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    sid = models.CharField(max_length=64, blank=True, help_text='The SMS provider\'s ID for the sent message')
+    error = models.TextField(blank=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ('id',)
+
+    def __str__(self):
+        return '%s to %s: %s' % (self.message_id, self.user, self.status)
+
 from esp.application.models import FormstackAppSettings
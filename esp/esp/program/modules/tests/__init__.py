@@ -33,7 +33,7 @@
   Email: web-team@learningu.org
 """
 
-from esp.program.modules.tests.ajaxschedulingmodule import AJAXSchedulingModuleTest
+from esp.program.modules.tests.ajaxschedulingmodule import AJAXSchedulingModuleTest, ProgramChangeFeedTest
 from esp.program.modules.tests.availabilitymodule import AvailabilityModuleTest
 from esp.program.modules.tests.regprofilemodule import RegProfileModuleTest
 from esp.program.modules.tests.studentreg import StudentRegTest
@@ -50,4 +50,6 @@
 from esp.program.modules.tests.classsearchmodule import ClassSearchModuleTest
 from esp.program.modules.tests.auth import ProgramModuleAuthTest
 from esp.program.modules.tests.unenrollmodule import UnenrollModuleTest
+from esp.program.modules.tests.onsiteclasslist import OnSiteClassListTest
+from esp.program.modules.tests.grouptextmodule import GroupTextModuleTest
 from esp.program.modules.tests.testallviews import AllViewsTest
@@ -34,7 +34,14 @@
 
 from esp.program.tests import ProgramFrameworkTest
 from esp.program.modules.tests.support import TestProgramManager
+from esp.program.models import ClassSection, ProgramChangeFeed, StudentRegistration
 from esp.program.modules.module_ext import AJAXChangeLog
+from esp.program.modules.handlers.ajaxschedulingmodule import AJAXSchedulingModule
+from esp.tests.util import CacheFlushTransactionTestCase
+
+from django.db import connection
+
+from unittest import mock
 import json
 import time
 
@@ -119,6 +126,42 @@ def testModelAPI(self):
         self.assertTrue(not s2.classrooms().exists(), "Second class should not have any classrooms assigned.")
 
 
+    def testUUIDScopedToProgram(self):
+        """Changes to one program shouldn't expire the schedule UUID of another."""
+        from esp.program.modules.base import ProgramModule, ProgramModuleObj
+        self.create_past_program()
+        other_prog = self.new_prog
+        module = ProgramModuleObj.getFromProgModule(self.program, ProgramModule.objects.get(handler='AJAXSchedulingModule'))
+
+        uuid = module.ajax_schedule_get_uuid(self.program)
+        other_uuid = module.ajax_schedule_get_uuid(other_prog)
+        self.assertEqual(module.ajax_schedule_get_uuid(self.program), uuid, "Schedule UUID was not cached.")
+
+        # Each kind of schedule edit in this program should change only its own UUID
+        section = self.program.sections()[0]
+        edits = [
+            lambda: section.save(),
+            lambda: section.parent_class.save(),
+            lambda: section.assign_meeting_times([self.timeslots[0]]),
+            lambda: section.assign_room(self.rooms[0]),
+            lambda: self.rooms[0].save(),
+            lambda: self.timeslots[0].save(),
+            lambda: self.teachers[0].addAvailableTime(self.program, self.timeslots[1]),
+        ]
+        self.emptySchedule()
+        uuid = module.ajax_schedule_get_uuid(self.program)
+        for edit in edits:
+            edit()
+            new_uuid = module.ajax_schedule_get_uuid(self.program)
+            self.assertNotEqual(new_uuid, uuid, "Schedule UUID was not updated by an edit to its program.")
+            self.assertEqual(module.ajax_schedule_get_uuid(other_prog), other_uuid, "Schedule UUID was updated by an edit to another program.")
+            uuid = new_uuid
+
+        # ...and edits to the other program leave this one alone
+        other_prog.getTimeSlots()[0].save()
+        self.assertNotEqual(module.ajax_schedule_get_uuid(other_prog), other_uuid)
+        self.assertEqual(module.ajax_schedule_get_uuid(self.program), uuid)
+
     def testWebAPI(self):
         """Schedule classes using the ajax_schedule_class view."""
         self.clearScheduleAvailability()
@@ -212,3 +255,95 @@ def testChangeLogFailedScheduling(self):
         changelog_response = self.client.get(self.changelog_url, {'last_fetched_index': 1 })
         changelog = json.loads(changelog_response.content)["changelog"]
         self.assertTrue(len(changelog) == 0, "Change log shows unsuccessfully scheduled class: " + str(changelog))
+
+class ProgramChangeFeedTest(CacheFlushTransactionTestCase):
+    """ The change feed only moves once changes are committed, so this needs
+    real transactions. """
+    setUp = ProgramFrameworkTest.setUp
+
+    def testChangeFeed(self):
+        self.assertTrue(self.client.login(username=self.admins[0].username, password='password'), "Failed to log in admin user.")
+        feed_url = '/manage/%s/ajax_change_feed' % self.program.getUrlBase()
+        feed = ProgramChangeFeed(self.program)
+        changelog = AJAXChangeLog.objects.create(program=self.program)
+        self.assertEqual(feed.get_log_index(), 0)
+
+        # With nothing new, the feed gives up after the timeout
+        response = self.client.get(feed_url, {'last_fetched_index': 0, 'timeout': 0})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['changelog'], [])
+        self.assertFalse(feed.wait(log_index=0, timeout=0))
+
+        # A new entry moves the feed, and is sent right away
+        section = self.program.sections()[0]
+        changelog.appendComment('Needs a projector', False, section.id)
+        self.assertEqual(feed.get_log_index(), 1)
+        self.assertTrue(feed.wait(log_index=0, timeout=0))
+        start = time.time()
+        response = self.client.get(feed_url, {'last_fetched_index': 0, 'timeout': 10})
+        self.assertLess(time.time() - start, 10)
+        entries = json.loads(response.content)['changelog']
+        self.assertEqual([(e['index'], e['id'], e['comment']) for e in entries], [(1, section.id, 'Needs a projector')])
+
+    def testFeedsDontHoldTransactions(self):
+        """ With ATOMIC_REQUESTS, the change feeds should still wait outside
+        of a transaction, while other module views run in one as usual. """
+        self.assertTrue(self.client.login(username=self.admins[0].username, password='password'), "Failed to log in admin user.")
+        seen = {}
+        def wait(feed, *args, **kwargs):
+            seen['wait'] = connection.in_atomic_block
+            return False
+        def get_change_log_data(module, prog, last_fetched_index):
+            seen['log'] = connection.in_atomic_block
+            return {}
+        with mock.patch.dict(connection.settings_dict, {'ATOMIC_REQUESTS': True}), \
+             mock.patch.object(ProgramChangeFeed, 'wait', wait), \
+             mock.patch.object(AJAXSchedulingModule, 'get_change_log_data', get_change_log_data):
+            self.client.get('/manage/%s/ajax_change_feed' % self.program.getUrlBase(), {'last_fetched_index': 0})
+            self.assertFalse(seen['wait'])
+            self.client.get('/manage/%s/ajax_change_log' % self.program.getUrlBase(), {'last_fetched_index': 0})
+            self.assertTrue(seen['log'])
+
+    def testCountsFeed(self):
+        feed = ProgramChangeFeed(self.program)
+        sections = self.program.sections().filter(status__gt=0)
+
+        # Without a cursor we get every section
+        (cursor, counts, reset) = feed.get_count_changes()
+        self.assertTrue(reset)
+        self.assertEqual(sorted(c[0] for c in counts), sorted(sections.values_list('id', flat=True)))
+        self.assertEqual(feed.get_count_changes(cursor), (cursor, [], False))
+
+        # Registering a student sends just that section
+        section = sections[0]
+        section.meeting_times.add(self.timeslots[0])
+        section.preregister_student(self.students[0], prereg_verb='Enrolled')
+        self.assertTrue(feed.wait(registration_seq=cursor, timeout=0))
+        (new_cursor, counts, reset) = feed.get_count_changes(cursor)
+        self.assertFalse(reset)
+        section.refresh_from_db()
+        self.assertEqual(counts, [[section.id, section.enrolled_students, section.attending_students]])
+        self.assertEqual(section.enrolled_students, 1)
+
+        # A cursor from the future (e.g. after the cache was cleared) resets
+        (_, counts, reset) = feed.get_count_changes(new_cursor + 1)
+        self.assertTrue(reset)
+        self.assertEqual(len(counts), sections.count())
+
+    def testRegistrationsChangedQueries(self):
+        """ Registrations whose section and class are already loaded are
+        recorded without looking up their program. """
+        feed = ProgramChangeFeed(self.program)
+        section = self.program.sections()[0]
+        section.meeting_times.add(self.timeslots[0])
+        section.preregister_student(self.students[0], prereg_verb='Enrolled')
+        registration = StudentRegistration.objects.get(section=section, user=self.students[0])
+        seq = feed.get_registration_seq()
+
+        registration.section = ClassSection.objects.select_related('parent_class').get(id=section.id)
+        with self.assertNumQueries(0):
+            ProgramChangeFeed.registrations_changed([registration])
+        registration = StudentRegistration.objects.get(id=registration.id)
+        with self.assertNumQueries(1):
+            ProgramChangeFeed.registrations_changed([registration])
+        self.assertEqual(feed.get_registration_changes(seq), (seq + 2, {(section.id, self.students[0].id)}))
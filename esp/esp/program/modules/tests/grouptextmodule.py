@@ -0,0 +1,166 @@
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of the ESP Web Site
+Copyright (c) 2026 by the individual contributors
+  (see AUTHORS file)
+
+The ESP Web Site is free software; you can redistribute it and/or
+modify it under the terms of the GNU Affero General Public License
+as published by the Free Software Foundation; either version 3
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Contact information:
+MIT Educational Studies Program
+  84 Massachusetts Ave W20-467, Cambridge, MA 02139
+  Phone: 617-253-4882
+  Email: esp-webmasters@mit.edu
+Learning Unlimited, Inc.
+  527 Franklin St, Cambridge, MA 02139
+  Phone: 617-379-0178
+  Email: web-team@learningu.org
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import threading
+from urllib.parse import parse_qs
+
+from django.db.models import Q
+from django.test.utils import override_settings
+
+from esp.program.models import RegistrationProfile
+from esp.program.modules.handlers.grouptextmodule import GroupTextModule
+from esp.program.modules.module_ext import GroupTextRecipient
+from esp.program.tests import ProgramFrameworkTest
+from esp.users.models import ContactInfo, ESPUser, PersistentQueryFilter
+
+INVALID_NUMBER = '+16175550199'
+
+class FakeTwilioHandler(BaseHTTPRequestHandler):
+    """ Stands in for Twilio's message API, accepting every text except those
+    to INVALID_NUMBER. """
+
+    def do_POST(self):
+        data = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        to, from_ = data['To'][0], data['From'][0]
+        with self.server.lock:
+            self.server.sent.append((to, from_, data['Body'][0]))
+            sid = 'SM%032d' % len(self.server.sent)
+        if to == INVALID_NUMBER:
+            self.respond(400, {'code': 21211, 'message': "The 'To' number %s is not a valid phone number." % to,
+                               'more_info': 'https://www.twilio.com/docs/errors/21211', 'status': 400})
+        else:
+            self.respond(201, {'sid': sid, 'to': to, 'from': from_, 'body': data['Body'][0], 'status': 'queued',
+                               'date_created': 'Thu, 30 Jul 2015 20:12:31 +0000',
+                               'date_updated': 'Thu, 30 Jul 2015 20:12:31 +0000'})
+
+    def respond(self, status, payload):
+        content = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+class GroupTextModuleTest(ProgramFrameworkTest):
+    our_numbers = ['+16175550100', '+16175550101']
+
+    def setUp(self, *args, **kwargs):
+        super(GroupTextModuleTest, self).setUp(*args, **kwargs)
+
+        self.server = HTTPServer(('127.0.0.1', 0), FakeTwilioHandler)
+        self.server.sent = []
+        self.server.lock = threading.Lock()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+
+        settings_override = override_settings(
+            TWILIO_ACCOUNT_SID='AC' + '0' * 32,
+            TWILIO_AUTH_TOKEN='token',
+            TWILIO_ACCOUNT_NUMBERS=self.our_numbers,
+            TWILIO_API_URL='http://127.0.0.1:%d' % self.server.server_port,
+            TWILIO_SEND_RATE=100,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        #   Students 0-2 want texts, student 3 doesn't, and student 4 has no
+        #   contact info at all.
+        self.phone_numbers = {}
+        for (i, student) in enumerate(self.students[:4]):
+            phone_number = INVALID_NUMBER if i == 2 else '+1617555%04d' % (i + 1)
+            contact_info = ContactInfo.objects.create(user=student, first_name=student.first_name,
+                                                      last_name=student.last_name, e_mail=student.email,
+                                                      phone_cell=phone_number, receive_txt_message=(i != 3))
+            profile = RegistrationProfile.getLastForProgram(student, self.program)
+            profile.contact_user = contact_info
+            profile.save()
+            self.phone_numbers[student.id] = phone_number
+        self.filter = PersistentQueryFilter.create_from_Q(ESPUser, Q(id__in=[student.id for student in self.students[:5]]))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        super(GroupTextModuleTest, self).tearDown()
+
+    def testSendMessages(self):
+        text, log = GroupTextModule.textUsers(self.filter, 'Lunch has moved')
+
+        recipients = {recipient.user_id: recipient for recipient in text.recipients.all()}
+        self.assertEqual(set(recipients), {student.id for student in self.students[:5]})
+        for student in self.students[:2]:
+            self.assertEqual(recipients[student.id].status, GroupTextRecipient.SENT)
+            self.assertEqual(recipients[student.id].phone_number, self.phone_numbers[student.id])
+            self.assertTrue(recipients[student.id].sid.startswith('SM'))
+            self.assertIsNotNone(recipients[student.id].sent_at)
+        self.assertEqual(recipients[self.students[2].id].status, GroupTextRecipient.FAILED)
+        self.assertIn('not a valid phone number', recipients[self.students[2].id].error)
+        self.assertEqual(recipients[self.students[3].id].status, GroupTextRecipient.SKIPPED)
+        self.assertEqual(recipients[self.students[4].id].status, GroupTextRecipient.SKIPPED)
+        self.assertIn('does not want text messages', log)
+        self.assertIn('Could not send text message to %s' % INVALID_NUMBER, log)
+
+        #   One request per text, spread across both of our numbers.
+        sent = self.server.sent
+        self.assertEqual(sorted(to for (to, from_, body) in sent),
+                         sorted(self.phone_numbers[student.id] for student in self.students[:3]))
+        self.assertEqual({from_ for (to, from_, body) in sent}, set(self.our_numbers))
+        self.assertTrue(all(body == 'Lunch has moved' for (to, from_, body) in sent))
+        self.assertEqual({recipient.sent_from for recipient in recipients.values() if recipient.phone_number},
+                         set(self.our_numbers))
+
+    def testOverride(self):
+        text, log = GroupTextModule.textUsers(self.filter, 'Class is cancelled', override=True)
+        self.assertEqual(text.recipients.get(user=self.students[3]).status, GroupTextRecipient.SENT)
+        self.assertEqual(len(self.server.sent), 4)
+
+    def testRetry(self):
+        text, log = GroupTextModule.textUsers(self.filter, 'Lunch has moved')
+        self.assertEqual(len(self.server.sent), 3)
+
+        #   Only the failed text is retried; this time it goes through.
+        failed = text.recipients.get(status=GroupTextRecipient.FAILED)
+        ContactInfo.objects.filter(user=failed.user).update(phone_cell='+16175550009')
+        failed.phone_number = '+16175550009'
+        failed.save()
+        GroupTextModule.retryMessage(text)
+        self.assertEqual(len(self.server.sent), 4)
+        self.assertEqual(self.server.sent[-1][0], '+16175550009')
+        self.assertFalse(text.recipients.filter(status=GroupTextRecipient.FAILED).exists())
+        self.assertEqual(text.recipients.filter(status=GroupTextRecipient.SENT).count(), 3)
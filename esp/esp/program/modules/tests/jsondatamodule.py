@@ -34,11 +34,14 @@
 
 import json
 
+from django.test.client import RequestFactory
 from django.utils.html import escape
 
 from esp.program.tests import ProgramFrameworkTest
 from esp.program.modules.base import ProgramModule, ProgramModuleObj
+from esp.program.modules.handlers.jsondatamodule import JSONDataModule
 from esp.program.models import ClassSubject
+from esp.resources.models import Resource, ResourceType
 
 class JSONDataModuleTest(ProgramFrameworkTest):
     ## This test is very incomplete.
@@ -131,3 +134,52 @@ def testClasses(self):
             self.assertTrue(cls.id in json_classes_dict)
             self.assertEquals(json_classes_dict[cls.id]['emailcode'], cls.emailcode())
 
+    def cachedViews(self, prog, cls):
+        """Report which of the program-scoped JSON views are cached for prog."""
+        (one, two) = prog.url.split('/')
+        request = self.class_info_requests[cls.id]
+        return {
+            'rooms': JSONDataModule.rooms.method.cached_function(prog, cache_only=True) is not None,
+            'sections': JSONDataModule.sections.cached_function(None, prog, cache_only=True) is not None,
+            'class_info': JSONDataModule.class_info.cached_function(self.json_module, request, 'json', one, two, 'class_info', None, prog, cache_only=True) is not None,
+        }
+
+    def fillViews(self, prog, cls):
+        (one, two) = prog.url.split('/')
+        JSONDataModule.rooms.method.cached_function(prog)
+        JSONDataModule.sections.cached_function(None, prog)
+        JSONDataModule.class_info.cached_function(self.json_module, self.class_info_requests[cls.id], 'json', one, two, 'class_info', None, prog)
+
+    def testCachesScopedToProgram(self):
+        ## Edits to one program's rows should only expire that program's views
+        self.create_past_program()
+        other_prog = self.new_prog
+        Resource.objects.create(name='Elsewhere', num_students=10, res_type=ResourceType.get_or_create('Classroom'), event=other_prog.getTimeSlots()[0])
+        other_cls = ClassSubject.objects.create(title='Other class', category=self.categories[0], grade_min=7, grade_max=12, parent_program=other_prog, class_size_max=10, class_info='Elsewhere!')
+        other_cls.add_section(duration=1.0)
+        cls = ClassSubject.objects.filter(parent_program=self.program)[0]
+
+        self.json_module = ProgramModuleObj.getFromProgModule(self.program, ProgramModule.objects.get(handler='JSONDataModule'))
+        factory = RequestFactory()
+        self.class_info_requests = {c.id: factory.get('/', {'class_id': c.id}) for c in [cls, other_cls]}
+
+        all_cached = {'rooms': True, 'sections': True, 'class_info': True}
+        self.fillViews(self.program, cls)
+        self.fillViews(other_prog, other_cls)
+        self.assertEqual(self.cachedViews(self.program, cls), all_cached)
+        self.assertEqual(self.cachedViews(other_prog, other_cls), all_cached)
+
+        # Touch one row of each kind in the first program
+        self.rooms[0].save()
+        self.teachers[0].addAvailableTime(self.program, self.timeslots[0])
+        cls.save()
+        self.assertEqual(self.cachedViews(self.program, cls), {'rooms': False, 'sections': False, 'class_info': False})
+        self.assertEqual(self.cachedViews(other_prog, other_cls), all_cached)
+
+        # ...and the other way around
+        self.fillViews(self.program, cls)
+        other_prog.getResources()[0].save()
+        self.teachers[0].addAvailableTime(other_prog, other_prog.getTimeSlots()[0])
+        other_cls.save()
+        self.assertEqual(self.cachedViews(self.program, cls), all_cached)
+        self.assertEqual(self.cachedViews(other_prog, other_cls), {'rooms': False, 'sections': False, 'class_info': False})
@@ -0,0 +1,114 @@
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of the ESP Web Site
+Copyright (c) 2026 by the individual contributors
+  (see AUTHORS file)
+
+The ESP Web Site is free software; you can redistribute it and/or
+modify it under the terms of the GNU Affero General Public License
+as published by the Free Software Foundation; either version 3
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Contact information:
+MIT Educational Studies Program
+  84 Massachusetts Ave W20-467, Cambridge, MA 02139
+  Phone: 617-253-4882
+  Email: esp-webmasters@mit.edu
+Learning Unlimited, Inc.
+  527 Franklin St, Cambridge, MA 02139
+  Phone: 617-379-0178
+  Email: web-team@learningu.org
+"""
+
+import json
+
+from esp.program.tests import ProgramFrameworkTest
+from esp.tests.util import CacheFlushTransactionTestCase
+
+class OnSiteClassListTest(CacheFlushTransactionTestCase):
+    """ Tests for the JSON views behind the onsite class changes grid.  The
+    enrollment feed only moves once registrations are committed, so this
+    needs real transactions. """
+    setUp_program = ProgramFrameworkTest.setUp
+
+    def setUp(self):
+        self.setUp_program()
+        self.assertTrue(self.client.login(username=self.admins[0].username, password='password'), "Failed to log in admin user.")
+        self.url_base = '/onsite/%s/' % self.program.url
+        self.sections = list(self.program.sections().order_by('id')[:2])
+        for (section, timeslot) in zip(self.sections, self.timeslots):
+            section.meeting_times.add(timeslot)
+        for student in self.students[:3]:
+            self.sections[0].preregister_student(student, prereg_verb='Enrolled')
+
+    def get_enrollments(self, **params):
+        response = self.client.get(self.url_base + 'enrollment_status', params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def testEnrollmentDeltas(self):
+        expected = [[student.id, self.sections[0].id] for student in self.students[:3]]
+        self.assertEqual(sorted(self.get_enrollments()), sorted(expected))
+
+        # With an empty cursor we get everything, and a cursor to use next time
+        data = self.get_enrollments(since='')
+        self.assertTrue(data['reset'])
+        self.assertEqual(sorted(data['added']), sorted(expected))
+        self.assertEqual(data['removed'], [])
+        cursor = data['cursor']
+        self.assertEqual(self.get_enrollments(since=cursor), {'cursor': cursor, 'added': [], 'removed': [], 'reset': False})
+
+        # Then only what changed
+        self.sections[1].preregister_student(self.students[3], prereg_verb='Enrolled')
+        self.sections[0].unpreregister_student(self.students[0])
+        data = self.get_enrollments(since=cursor)
+        self.assertFalse(data['reset'])
+        self.assertGreater(data['cursor'], cursor)
+        self.assertEqual(data['added'], [[self.students[3].id, self.sections[1].id]])
+        self.assertEqual(data['removed'], [[self.students[0].id, self.sections[0].id]])
+
+        # A cursor we can't account for gets everything again
+        data = self.get_enrollments(since=data['cursor'] + 1)
+        self.assertTrue(data['reset'])
+        self.assertEqual(len(data['added']), 3)
+
+    def testSnapshotETag(self):
+        url = self.url_base + 'enrollment_status'
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # A new enrollment changes the snapshot
+        self.sections[1].preregister_student(self.students[3], prereg_verb='Enrolled')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        etag = response['ETag']
+
+        # So does closing a section, which hides its enrollments
+        self.sections[0].status = 0
+        self.sections[0].save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), [[self.students[3].id, self.sections[1].id]])
+
+    def testCatalogStatus(self):
+        response = self.client.get(self.url_base + 'catalog_status')
+        sections = {section['id']: section for section in json.loads(response.content)['sections']}
+        for section in self.program.sections().filter(status__gt=0):
+            self.assertEqual(sections[section.id]['parent_class__id'], section.parent_class_id)
+            self.assertEqual(sections[section.id]['event_ids'], list(section.meeting_times.order_by('start').values_list('id', flat=True)))
+            self.assertEqual(sections[section.id]['capacity'], section.capacity)
+            self.assertEqual(sections[section.id]['enrolled_students'], section.enrolled_students)
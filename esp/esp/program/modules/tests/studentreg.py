@@ -39,6 +39,9 @@
 from esp.program.tests import ProgramFrameworkTest
 from esp.accounting.controllers import ProgramAccountingController, IndividualAccountingController
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
 from decimal import Decimal
 import random
 import re
@@ -317,3 +320,48 @@ def test_extracosts(self):
         spi = SplashInfo.getForUser(student, self.program)
         self.assertEqual(spi.siblingname, 'Test Name')
 
+
+    def test_summarize(self):
+        """ Verify that the bulk accounting summary agrees with the
+            per-student accounting controller. """
+
+        program_cost = 25.0
+
+        pac = ProgramAccountingController(self.program)
+        pac.clear_all_data()
+        pac.setup_accounts()
+        pac.setup_lineitemtypes(program_cost, [('Item1', 10, 1)], [])
+
+        #   Give a few students some extra costs, financial aid, payments and sibling discounts
+        students = self.students[:4]
+        IndividualAccountingController(self.program, students[0]).set_preference('Item1', 1)
+        IndividualAccountingController(self.program, students[1]).set_finaid_params(10, 50)
+        IndividualAccountingController(self.program, students[2]).submit_payment(program_cost)
+        spi = SplashInfo.getForUser(students[3], self.program)
+        spi.siblingdiscount = True
+        spi.save()
+
+        #   The summary should create the required transfers, and then take
+        #   the same number of queries no matter how many students there are
+        summaries = pac.summarize(students)
+        self.assertEqual(set(summaries.keys()), {student.id for student in students})
+        with CaptureQueriesContext(connection) as one_student:
+            pac.summarize(students[:1])
+        with CaptureQueriesContext(connection) as all_students:
+            pac.summarize(students)
+        self.assertEqual(len(one_student), len(all_students))
+
+        for student in students:
+            iac = IndividualAccountingController(self.program, student)
+            summary = summaries[student.id]
+            self.assertEqual(summary.amount_requested(), iac.amount_requested())
+            self.assertEqual(summary.amount_requested(for_finaid_only=True), iac.amount_requested(for_finaid_only=True))
+            self.assertEqual(summary.amount_finaid(), iac.amount_finaid())
+            self.assertEqual(summary.amount_siblingdiscount(), iac.amount_siblingdiscount())
+            self.assertEqual(summary.amount_paid(), iac.amount_paid())
+            self.assertEqual(summary.amount_due(), iac.amount_due())
+            self.assertEqual(summary.has_paid(in_full=True), iac.has_paid(in_full=True))
+
+        self.assertEqual(summaries[students[0].id].amount_due(), program_cost + 10)
+        self.assertEqual(summaries[students[2].id].amount_due(), 0)
+        self.assertEqual(summaries[students[3].id].amount_due(), program_cost - 20)
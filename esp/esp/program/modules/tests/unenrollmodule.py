@@ -1,7 +1,7 @@
 import json
 import random
 
-from esp.program.models import ClassSection, StudentRegistration
+from esp.program.models import ClassSection, RegistrationCacheEpoch, StudentRegistration
 from esp.program.modules.base import ProgramModule, ProgramModuleObj
 from esp.program.tests import ProgramFrameworkTest
 from esp.users.models import ESPUser, Record, RecordType
@@ -85,3 +85,26 @@ def test_submit(self):
         self.assertFalse(enrollments.filter(StudentRegistration.is_valid_qobject()).exists())
 
         enrollments.update(end_date=None)
+
+    def test_submit_expires_caches(self):
+        self.client.login(username='admin', password='password')
+        response = self.client.get('/onsite/' + self.program.url + '/unenroll_status')
+        data = json.loads(str(response.content, encoding='UTF-8'))
+        enrollment_ids = list(data['enrollments'].keys())
+        enrollments = StudentRegistration.objects.filter(id__in=enrollment_ids)
+        section = enrollments[0].section
+        student = enrollments[0].user
+
+        #   Fill the caches before expiring the registrations.
+        self.assertGreater(section.num_students(), 0)
+        self.assertIn(section, student.getEnrolledSectionsFromProgram(self.program))
+
+        self.client.post('/onsite/' + self.program.url + '/unenroll_students', {'selected_enrollments': ','.join(enrollment_ids)})
+        self.assertEqual(RegistrationCacheEpoch.objects.get(program=self.program).epoch, 1)
+
+        section = ClassSection.objects.get(id=section.id)
+        self.assertEqual(section.num_students(), section.students().count())
+        self.assertNotIn(section, student.getEnrolledSectionsFromProgram(self.program))
+        response = self.client.get('/onsite/' + self.program.url + '/unenroll_status')
+        data = json.loads(str(response.content, encoding='UTF-8'))
+        self.assertFalse(set(data['enrollments']) & set(enrollment_ids))
@@ -56,6 +56,7 @@ def render_class(cls, user=None, filter=False, timeslot=None):
 # affect whether you can add a class in this one.  So we depend on all SRs for
 # this user.  This only applies to tags that can depend on a user.
 render_class.cached_function.depend_on_row('program.StudentRegistration', lambda reg: {'user': reg.user})
+render_class.cached_function.depend_on_row('program.RegistrationCacheEpoch', lambda epoch: [{'cls': cls} for cls in ClassSubject.objects.filter(parent_program=epoch.program_id)])
 render_class.cached_function.get_or_create_token(('user',))
 
 @cache_inclusion_tag(register, 'inclusion/program/class_catalog_webapp.html')
@@ -75,6 +76,7 @@ def render_class_webapp(cls, prog, user=None, filter=False, timeslot=None, check
 # affect whether you can add a class in this one.  So we depend on all SRs for
 # this user.  This only applies to tags that can depend on a user.
 render_class_webapp.cached_function.depend_on_row('program.StudentRegistration', lambda reg: {'user': reg.user})
+render_class_webapp.cached_function.depend_on_row('program.RegistrationCacheEpoch', lambda epoch: {'prog': epoch.program})
 render_class_webapp.cached_function.get_or_create_token(('user',))
 render_class_webapp.cached_function.depend_on_row('users.Record', lambda record: {'prog': record.program}, lambda record: record.event and record.event.name == 'attended')
 
@@ -38,7 +38,7 @@
 
 from esp.accounting.models import LineItemType
 from esp.cal.models import EventType, Event
-from esp.program.models import Program, ClassSection, RegistrationProfile, ScheduleMap, ProgramModule, StudentRegistration, RegistrationType, ClassCategories, ClassSubject, BooleanExpression, ScheduleConstraint, ScheduleTestOccupied, ScheduleTestCategory, ScheduleTestSectionList
+from esp.program.models import Program, ClassSection, ClassCatalogEntry, StudentAppQuestion, RegistrationProfile, ScheduleMap, ScheduleBitmask, ProgramModule, StudentRegistration, RegistrationCacheEpoch, RegistrationType, ClassCategories, ClassSubject, BooleanExpression, ScheduleConstraint, ScheduleTestOccupied, ScheduleTestCategory, ScheduleTestSectionList
 from esp.qsd.models import QuasiStaticData
 from esp.resources.models import Resource, ResourceType
 from esp.users.models import ESPUser, ContactInfo, StudentInfo, TeacherInfo, Permission
@@ -46,26 +46,34 @@
 from esp.tagdict.models import Tag
 
 from django.contrib.auth.models import Group
+from django.core.management import call_command
+from django.db import connection, transaction
 from django.test import LiveServerTestCase
 from django.test.client import Client
 from django import forms
 
 from esp.program.controllers.classreg import get_custom_fields
-from esp.program.controllers.lottery import LotteryAssignmentController
+from esp.program.controllers.lottery import LotteryAssignmentController, LotteryException, SparseLotteryAssignmentController
 from esp.program.controllers.lunch_constraints import LunchConstraintGenerator
 from esp.program.forms import ProgramCreationForm
 from esp.program.modules.base import ProgramModuleObj
 from esp.program.setup import prepare_program, commit_program
-from esp.tests.util import CacheFlushTestCase as TestCase, user_role_setup
+from esp.tests.util import CacheFlushTestCase as TestCase, CacheFlushTransactionTestCase, user_role_setup
 
 from datetime import datetime, timedelta
 from decimal import Decimal
+from io import BytesIO, StringIO
 from random import sample
+from time import sleep
+from unittest import mock
+import base64
 import hashlib
 import numpy
 import random
 import re
+import threading
 import unicodedata
+import zlib
 
 class ViewUserInfoTest(TestCase):
     def setUp(self):
@@ -975,6 +983,97 @@ def occupied_slots(smap):
         sm = ScheduleMap(student, program)
         self.assertTrue(len(occupied_slots(sm.map)) == 0, 'Schedule map did not clear properly.')
 
+class ScheduleBitmaskTest(ProgramFrameworkTest):
+    """ Check that a student's cached schedule bitmask follows their
+        registrations, and that cannotAdd uses it to find conflicts.
+    """
+    def runTest(self):
+        student = self.students[0]
+        program = self.program
+        (section_list, timeslot_list) = randomized_attrs(program)
+        section1 = section_list[0]
+        section2 = [sec for sec in section_list if sec.parent_class_id != section1.parent_class_id][0]
+        ts1 = timeslot_list[0]
+        ts2 = timeslot_list[1]
+        section1.assign_start_time(ts1)
+        section2.assign_start_time(ts1)
+
+        schedule = student.getScheduleBitmask(program)
+        self.assertIsInstance(schedule, ScheduleBitmask)
+        self.assertFalse(schedule.conflicts([ts1.id, ts2.id]))
+        self.assertEqual(schedule.priority([ts1.id]), 1)
+
+        #   Enrolling updates the cached bitmask in place, rather than
+        #   expiring it
+        section1.preregister_student(student)
+        with self.assertNumQueries(0):
+            schedule = student.getScheduleBitmask(program)
+        self.assertTrue(schedule.is_enrolled_in_subject(section1.parent_class_id))
+        self.assertFalse(schedule.is_enrolled_in_subject(section2.parent_class_id))
+        self.assertTrue(schedule.conflicts([ts1.id]))
+        self.assertFalse(schedule.conflicts([ts2.id]))
+        self.assertEqual(schedule.priority([ts1.id]), 0)
+        self.assertEqual(section1.cannotAdd(student, checkFull=False), 'You are already signed up for a section of this class!')
+        self.assertIn('conflicts with your schedule', section2.cannotAdd(student, checkFull=False))
+
+        #   So does rescheduling the other section out of the way
+        section2.assign_start_time(ts2)
+        self.assertFalse(student.getScheduleBitmask(program).conflicts(section2.timeslot_ids()))
+
+        #   And dropping the class
+        student.getScheduleBitmask(program)
+        section1.unpreregister_student(student)
+        with self.assertNumQueries(0):
+            schedule = student.getScheduleBitmask(program)
+        self.assertFalse(schedule.is_enrolled_in_subject(section1.parent_class_id))
+        self.assertFalse(schedule.conflicts([ts1.id, ts2.id]))
+
+        #   Priority registrations use up priority levels in their timeslots
+        section1.preregister_student(student, prereg_verb='Priority/1')
+        schedule = student.getScheduleBitmask(program)
+        self.assertFalse(schedule.conflicts([ts1.id]))
+        self.assertEqual(schedule.priority([ts1.id]), 2)
+        self.assertEqual(schedule.priority([ts2.id]), 1)
+
+class TeacherAvailabilityMatrixTest(ProgramFrameworkTest):
+    """ Check that the program's teacher availability matrix agrees with
+        ESPUser.getAvailableTimes, before and after scheduling classes.
+    """
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        #   cannotSchedule() only checks teachers' availability if the program
+        #   has the module.
+        self.program.program_modules.add(ProgramModule.objects.get(handler='AvailabilityModule', module_type='teach'))
+
+    def check_matrix(self):
+        matrix = self.program.getTeacherAvailabilityMatrix()
+        for teacher in self.teachers:
+            for ignore_classes in (True, False):
+                expected = [e.id for e in teacher.getAvailableTimes(self.program, ignore_classes=ignore_classes)]
+                actual = [e.id for e in matrix.events(matrix.available_mask(teacher.id, ignore_classes=ignore_classes))]
+                self.assertEqual(actual, expected)
+        for section in self.program.sections():
+            available = None
+            for teacher in section.parent_class.get_teachers():
+                times = set(teacher.getAvailableTimes(self.program))
+                available = times if available is None else available & times
+            for time in section.viable_times():
+                self.assertIn(time, available | set(section.meeting_times.all()))
+
+    def runTest(self):
+        self.check_matrix()
+        self.schedule_randomly()
+        self.check_matrix()
+
+        #   A teacher can't be scheduled into a time they've said they can't do.
+        section = self.program.sections()[0]
+        teacher = section.parent_class.get_teachers()[0]
+        timeslot = [ts for ts in self.timeslots if ts.id not in section.timeslot_ids()][0]
+        teacher.useravailability_set.filter(event=timeslot).delete()
+        self.check_matrix()
+        self.assertTrue(self.program.hasModule('AvailabilityModule'))
+        self.assertIn('has not indicated availability', section.cannotSchedule([timeslot]))
+
 class BooleanLogicTest(TestCase):
     """ Verify that the Boolean logic models underlying schedule constraints are
         working correctly.
@@ -1010,6 +1109,19 @@ class ScheduleConstraintTest(ProgramFrameworkTest):
         2. Test whether ScheduleConstraints can track relationships
            between the results of these tests.
     """
+    def assertCompiledMatches(self, program, sm, constraints):
+        """ Check that the program's compiled constraints give the same answer
+            as evaluating the constraints on the ScheduleMap. """
+        expected = None
+        for constraint in constraints:
+            if not constraint.evaluate(sm, recursive=False):
+                expected = constraint.requirement.label
+                break
+        sections = [sec for secs in sm.map.values() for sec in secs]
+        compiled = program.getCompiledScheduleConstraints()
+        self.assertEqual(len(compiled), len(constraints))
+        self.assertEqual(compiled.violation(sections), expected, 'Compiled schedule constraints broken')
+
     def runTest(self):
         #   Initialize
         student = self.students[0]
@@ -1052,6 +1164,7 @@ def runTest(self):
         self.assertFalse(token3.boolean_value(map=sm.map), 'ScheduleTestSectionList broken')
         self.assertTrue(sc1.evaluate(sm), 'ScheduleConstraint broken')
         self.assertTrue(sc2.evaluate(sm), 'ScheduleConstraint broken')
+        self.assertCompiledMatches(program, sm, [sc1, sc2])
 
         #   Register for a class that meets all conditions
         section1.preregister_student(student)
@@ -1061,6 +1174,7 @@ def runTest(self):
         self.assertTrue(token3.boolean_value(map=sm.map), 'ScheduleTestSectionList broken')
         self.assertTrue(sc1.evaluate(sm), 'ScheduleConstraint broken')
         self.assertTrue(sc2.evaluate(sm), 'ScheduleConstraint broken')
+        self.assertCompiledMatches(program, sm, [sc1, sc2])
 
         #   Change the category and check the category constraint
         section1.parent_class.category = self.categories[1]
@@ -1071,6 +1185,7 @@ def runTest(self):
         self.assertTrue(token3.boolean_value(map=sm.map), 'ScheduleTestSectionList broken')
         self.assertFalse(sc1.evaluate(sm), 'ScheduleConstraint broken')
         self.assertTrue(sc2.evaluate(sm), 'ScheduleConstraint broken')
+        self.assertCompiledMatches(program, sm, [sc1, sc2])
 
         #   Change the section and check the section list constraint
         section1.unpreregister_student(student)
@@ -1081,6 +1196,7 @@ def runTest(self):
         self.assertFalse(token3.boolean_value(map=sm.map), 'ScheduleTestSectionList broken')
         self.assertTrue(sc1.evaluate(sm), 'ScheduleConstraint broken')
         self.assertFalse(sc2.evaluate(sm), 'ScheduleConstraint broken')
+        self.assertCompiledMatches(program, sm, [sc1, sc2])
 
         #   Change timeslot and check that occupied is false
         section2.assign_start_time(timeslot_list[1])
@@ -1090,6 +1206,28 @@ def runTest(self):
         self.assertFalse(token3.boolean_value(map=sm.map), 'ScheduleTestSectionList broken')
         self.assertTrue(sc1.evaluate(sm), 'ScheduleConstraint broken')
         self.assertTrue(sc2.evaluate(sm), 'ScheduleConstraint broken')
+        self.assertCompiledMatches(program, sm, [sc1, sc2])
+
+        #   A failure handler's changes to the schedule are seen by the
+        #   constraints after it.  Here, being in section 2 requires section 1,
+        #   which the handler adds; that breaks the category requirement, which
+        #   sc1 didn't see because it was checked before the handler ran.
+        exp4, created = BooleanExpression.objects.get_or_create(label='exp4')
+        ScheduleTestOccupied.objects.create(exp=exp4, timeblock=timeslot_list[1])
+        on_failure = """from esp.program.models import ClassSection
+schedule_map.add_section(ClassSection.objects.get(id=%d))
+return (schedule_map, None)""" % section1.id
+        sc3 = ScheduleConstraint.objects.create(program=program, condition=exp4, requirement=exp3, on_failure=on_failure)
+        sections = [sec for secs in sm.map.values() for sec in secs]
+        compiled = program.getCompiledScheduleConstraints()
+        self.assertEqual(compiled.violation(sections, get_schedule_map=lambda: ScheduleMap(student, program)), None)
+        sc4 = ScheduleConstraint.objects.create(program=program, condition=exp1, requirement=exp2)
+        compiled = program.getCompiledScheduleConstraints()
+        self.assertEqual(len(compiled), 4)
+        self.assertEqual(compiled.violation(sections), 'exp3')
+        self.assertEqual(compiled.violation(sections, get_schedule_map=lambda: ScheduleMap(student, program)), 'exp2')
+        self.assertFalse(sc3.evaluate(ScheduleMap(student, program), recursive=False))
+        self.assertTrue(sc4.evaluate(ScheduleMap(student, program)))
 
 class DynamicCapacityTest(ProgramFrameworkTest):
     def runTest(self):
@@ -1193,6 +1331,245 @@ def runTest(self):
         section.meeting_times.remove(ts2)
         self.assertSetEquals(section.get_meeting_times(), [])
 
+class ClassCatalogEntryTest(ProgramFrameworkTest):
+    def get_catalog_class(self, cls):
+        for c in ClassSubject.objects.catalog(self.program, force_all=True):
+            if c.id == cls.id:
+                return c
+        self.fail('Class %s is missing from the catalog' % cls.emailcode())
+
+    def runTest(self):
+        cls = self.program.classes()[0]
+
+        #   Every section has its own entry.
+        entries = ClassCatalogEntry.objects.filter(subject=cls)
+        self.assertEqual(set(entries.values_list('section', flat=True)),
+                         set(cls.get_sections().values_list('id', flat=True)))
+
+        #   Adding a section only refreshes this class's entries.
+        other_entries = list(ClassCatalogEntry.objects.exclude(subject=cls).values_list('id', 'last_modified'))
+        new_section = cls.add_section(duration=1.0)
+        self.assertTrue(ClassCatalogEntry.objects.filter(subject=cls, section=new_section).exists())
+        self.assertEqual(list(ClassCatalogEntry.objects.exclude(subject=cls).values_list('id', 'last_modified')), other_entries)
+
+        #   Teachers, index QSDs and application questions are reflected.
+        teacher = [t for t in self.teachers if t not in cls.get_teachers()][0]
+        cls.teachers.add(teacher)
+        QuasiStaticData.objects.create(url='learn/%s/index' % cls.url(), name='learn:index', title='Index', content='')
+        StudentAppQuestion.objects.create(subject=cls, question='Why?')
+        entry = ClassCatalogEntry.objects.filter(subject=cls)[0]
+        self.assertIn(teacher.id, entry.get_teacher_ids())
+        self.assertIn('%s %s' % (teacher.first_name, teacher.last_name), entry.teacher_names)
+        self.assertTrue(entry.has_index_qsd)
+        self.assertEqual(entry.app_question_count, 1)
+
+        #   ... and show up in the catalog.
+        catalog_cls = self.get_catalog_class(cls)
+        self.assertIn(teacher.id, [t.id for t in catalog_cls.get_teachers()])
+        self.assertIn(new_section.id, [s.id for s in catalog_cls.get_sections()])
+        self.assertTrue(catalog_cls.got_index_qsd())
+        self.assertEqual(catalog_cls.numStudentAppQuestions(), 1)
+        self.assertEqual(catalog_cls.media_count, 0)
+
+        #   Classes without entries (e.g. from before the snapshot) get them
+        #   built when the catalog is loaded.
+        ClassCatalogEntry.objects.filter(subject=cls).delete()
+        self.get_catalog_class(cls)
+        self.assertTrue(ClassCatalogEntry.objects.filter(subject=cls, section=new_section).exists())
+
+        #   Refreshing again replaces the entries, rather than adding more.
+        ClassCatalogEntry.refresh_subject(cls)
+        ClassCatalogEntry.refresh_subject(cls.id)
+        self.assertEqual(ClassCatalogEntry.objects.filter(subject=cls).count(), cls.get_sections().count())
+
+        #   Saving a teacher only refreshes their classes if their name changed.
+        entries = list(ClassCatalogEntry.objects.filter(subject=cls).values_list('id', 'last_modified'))
+        teacher.save()
+        self.assertEqual(list(ClassCatalogEntry.objects.filter(subject=cls).values_list('id', 'last_modified')), entries)
+        teacher.first_name = 'Renamed'
+        with mock.patch.object(Program, 'current_programs', return_value=[self.program]):
+            teacher.save()
+        self.assertIn('Renamed %s' % teacher.last_name, ClassCatalogEntry.objects.filter(subject=cls)[0].teacher_names)
+
+        #   ... and in past programs, their entries are dropped, to be rebuilt
+        #   when needed.
+        teacher.first_name = 'Again'
+        with mock.patch.object(Program, 'current_programs', return_value=[]):
+            teacher.save()
+        self.assertFalse(ClassCatalogEntry.objects.filter(subject=cls).exists())
+        entry = ClassCatalogEntry.entries_by_subject([cls.id])[cls.id][0]
+        self.assertIn('Again %s' % teacher.last_name, entry.teacher_names)
+
+        #   A new name that is part of the old one is still a change.
+        teacher.first_name = 'gain'
+        with mock.patch.object(Program, 'current_programs', return_value=[self.program]):
+            teacher.save()
+        entry = ClassCatalogEntry.objects.filter(subject=cls)[0]
+        self.assertIn('gain %s' % teacher.last_name, entry.teacher_names.split(', '))
+
+class RegistrationCacheEpochTest(ProgramFrameworkTest):
+    def runTest(self):
+        enrolled, _ = RegistrationType.objects.get_or_create(name='Enrolled', category='student')
+        section = self.program.sections()[0]
+        def counts():
+            section_ = ClassSection.objects.get(id=section.id)
+            return (section_.num_students(), section_.count_enrolled_students(), len(section_.students_dict().get(enrolled, [])))
+        before = counts()
+
+        #   bulk_create() doesn't send post_save, so the counts are stale...
+        StudentRegistration.objects.bulk_create([StudentRegistration(user=student, section=section, relationship=enrolled)
+                                                 for student in self.students[:2]])
+        self.assertEqual(counts(), before)
+
+        #   ... until this program's epoch is bumped; another's won't do.
+        other = Program.objects.create(url='OtherProgram/2000_Spring', name='Other Program Spring 2000', grade_min=7, grade_max=12)
+        RegistrationCacheEpoch.bump(other)
+        self.assertEqual(counts(), before)
+        RegistrationCacheEpoch.bump(self.program)
+        self.assertEqual(counts(), tuple(count + 2 for count in before))
+
+class ProgramTimelineTest(ProgramFrameworkTest):
+    def runTest(self):
+        timeslots = list(self.program.getTimeSlots())
+        start = self.settings['start_time']
+        self.assertEqual(self.program.dates(), [start.date()])
+        self.assertEqual(self.program.datetime_range(), (timeslots[0].start, timeslots[-1].end))
+
+        #   Each program's timeline is built with one query, and then
+        #   looking up its dates again doesn't need another.
+        other = Program.objects.create(url='OtherProgram/2000_Spring', name='Other Program Spring 2000', grade_min=7, grade_max=12)
+        Program.timeline.delete_all()
+        with self.assertNumQueries(1):
+            self.program.dates()
+        with self.assertNumQueries(0):
+            self.program.dates()
+            self.program.datetime_range()
+        self.assertEqual(other.dates(), [])
+        self.assertIsNone(other.datetime_range())
+        self.assertEqual(self.program.past_program_ids(), [])
+
+        #   Adding a timeslot to one program updates its timeline, and leaves
+        #   the other program's cached.
+        other_start = datetime(2000, 3, 4, 10)
+        other_slot = Event.objects.create(program=other, event_type=timeslots[0].event_type, start=other_start, end=other_start + timedelta(hours=1), short_description='Other slot', description='Other slot')
+        with self.assertNumQueries(0):
+            self.program.dates()
+        self.assertEqual(other.dates(), [other_start.date()])
+        self.assertEqual(self.program.past_program_ids(), [other.id])
+        self.assertEqual(other.past_program_ids(), [])
+
+        #   So does taking the timeslot away from its program.
+        other_slot.program = None
+        other_slot.save()
+        self.assertEqual(other.dates(), [])
+        self.assertEqual(self.program.past_program_ids(), [])
+        self.assertEqual(self.program.dates(), [start.date()])
+
+class ConcurrentEnrollmentTest(CacheFlushTransactionTestCase):
+    """ Many students registering for the same section at once shouldn't
+    overfill it.  This needs real transactions, since each thread commits on
+    its own database connection. """
+    setUp = ProgramFrameworkTest.setUp
+
+    def runTest(self):
+        capacity = 3
+        sec = self.program.sections()[0]
+        sec.meeting_times.add(self.timeslots[0])
+        sec.max_class_capacity = capacity
+        sec.save()
+        self.assertEqual(sec._get_capacity(), capacity)
+
+        errors = []
+        barrier = threading.Barrier(len(self.students))
+        def register(student):
+            try:
+                section = ClassSection.objects.get(id=sec.id)
+                barrier.wait()
+                section.preregister_student(student, prereg_verb='Enrolled')
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=register, args=(student,)) for student in self.students]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        enrolled = StudentRegistration.valid_objects().filter(section=sec, relationship__name='Enrolled')
+        self.assertEqual(enrolled.values('user').distinct().count(), capacity)
+        self.assertEqual(ClassSection.objects.get(id=sec.id).enrolled_students, capacity)
+
+        #   Dropping the class gives the seat back.
+        sec = ClassSection.objects.get(id=sec.id)
+        dropped = enrolled[0].user
+        sec.unpreregister_student(dropped)
+        self.assertEqual(ClassSection.objects.get(id=sec.id).enrolled_students, capacity - 1)
+        self.assertTrue(sec.preregister_student(dropped, prereg_verb='Enrolled'))
+        self.assertEqual(ClassSection.objects.get(id=sec.id).enrolled_students, capacity)
+
+class ConcurrentUnenrollmentTest(CacheFlushTransactionTestCase):
+    """ Dropping a class while another transaction has claimed a seat but
+    not yet committed its registration shouldn't give that seat away. """
+    setUp = ProgramFrameworkTest.setUp
+
+    def runTest(self):
+        capacity = 3
+        sec = self.program.sections()[0]
+        sec.meeting_times.add(self.timeslots[0])
+        sec.max_class_capacity = capacity
+        sec.save()
+        dropper, stayer, joiner = self.students[:3]
+        for student in [dropper, stayer]:
+            self.assertTrue(sec.preregister_student(student, prereg_verb='Enrolled'))
+        self.assertEqual(ClassSection.objects.get(id=sec.id).enrolled_students, 2)
+
+        errors = []
+        reserved = threading.Event()
+        proceed = threading.Event()
+        enrolled_rt = RegistrationType.objects.get(name='Enrolled', category='student')
+
+        def join():
+            #   Claim the last seat, and hold the transaction open until the
+            #   other thread is waiting to drop its class.
+            try:
+                with transaction.atomic():
+                    section = ClassSection.objects.get(id=sec.id)
+                    self.assertTrue(section.reserve_seat())
+                    reserved.set()
+                    proceed.wait(10)
+                    StudentRegistration.objects.create(user=joiner, section=section, relationship=enrolled_rt)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                reserved.set()
+                connection.close()
+
+        def drop():
+            try:
+                reserved.wait(10)
+                ClassSection.objects.get(id=sec.id).unpreregister_student(dropper)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=join), threading.Thread(target=drop)]
+        for thread in threads:
+            thread.start()
+        #   Give the dropping thread time to block on the section's row.
+        sleep(1)
+        proceed.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        enrolled = StudentRegistration.valid_objects().filter(section=sec, relationship__name='Enrolled')
+        self.assertEqual(set(enrolled.values_list('user', flat=True)), {stayer.id, joiner.id})
+        self.assertEqual(ClassSection.objects.get(id=sec.id).enrolled_students, 2)
+
 class LSRAssignmentTest(ProgramFrameworkTest):
     def setUp(self):
         random.seed()
@@ -1378,6 +1755,138 @@ def testLotteryMultiplePriorities(self):
 
         self.testLottery()
 
+    def testSaveInvalidatesCaches(self):
+        """ Verify that saving and clearing lottery assignments, which don't
+            save() each registration, still expire the registration caches. """
+
+        sections = list(self.program.sections())
+        #   Prime the caches
+        for sec in sections:
+            self.assertEqual(sec.num_students(), 0)
+        for student in self.students:
+            self.assertEqual(len(student.getEnrolledSections(self.program)), 0)
+
+        lotteryController = LotteryAssignmentController(self.program)
+        lotteryController.compute_assignments()
+        lotteryController.save_assignments(try_mailman=False)
+
+        def check_counts():
+            for sec in sections:
+                count = StudentRegistration.valid_objects().filter(section=sec, relationship=self.enrolled_rt).count()
+                self.assertEqual(ClassSection.objects.get(id=sec.id).num_students(), count)
+                self.assertEqual(ClassSection.objects.get(id=sec.id).enrolled_students, count)
+            for student in self.students:
+                enrolled = StudentRegistration.valid_objects().filter(user=student, section__parent_class__parent_program=self.program, relationship=self.enrolled_rt)
+                self.assertEqual({sec.id for sec in student.getEnrolledSections(self.program)}, set(enrolled.values_list('section', flat=True)))
+
+        self.assertTrue(StudentRegistration.valid_objects().filter(section__parent_class__parent_program=self.program, relationship=self.enrolled_rt).exists())
+        check_counts()
+
+        lotteryController.clear_saved_assignments()
+        self.assertFalse(StudentRegistration.valid_objects().filter(section__parent_class__parent_program=self.program, relationship=self.enrolled_rt).exists())
+        check_counts()
+
+    def testExportImport(self):
+        """ Verify that exported assignments import correctly, in both the
+            binary format and the original text format. """
+
+        lotteryController = LotteryAssignmentController(self.program, seed=7)
+        lotteryController.compute_best_assignments()
+        data = lotteryController.export_assignments()
+
+        def export_array(arr):
+            s = BytesIO()
+            numpy.savetxt(s, arr)
+            return s.getvalue()
+        text_data = base64.b64encode(zlib.compress(export_array(lotteryController.student_sections) + b'|' + export_array(lotteryController.student_ids) + b'|' + export_array(lotteryController.section_ids))).decode()
+
+        for blob in (data, text_data):
+            imported = LotteryAssignmentController(self.program)
+            imported.import_assignments(blob)
+            self.assertTrue(numpy.array_equal(imported.student_sections, lotteryController.student_sections))
+            self.assertTrue(numpy.array_equal(imported.student_ids, lotteryController.student_ids))
+            self.assertTrue(numpy.array_equal(imported.section_ids, lotteryController.section_ids))
+        imported = LotteryAssignmentController(self.program)
+        imported.import_assignments(data)
+        self.assertEqual(imported.seed, 7)
+        self.assertEqual(imported.imported_options['seed'], 7)
+        #   Server-side options aren't exported.
+        self.assertNotIn('directory', imported.imported_options)
+        self.assertNotIn('stats_display', imported.imported_options)
+
+        #   Truncated data is rejected
+        raw = base64.b64decode(data.encode())
+        self.assertRaises(ValueError, imported.import_assignments, base64.b64encode(raw[:-4]).decode())
+        self.assertRaises(ValueError, imported.import_assignments, base64.b64encode(b'not lottery data').decode())
+
+    def testSparseLottery(self):
+        """ Verify that the sparse lottery engine makes exactly the same
+            assignments as the dense one under the same random seed. """
+
+        for options in ({}, {'fill_low_priorities': True, 'max_sections': 2}):
+            controllers = [LotteryAssignmentController(self.program, **options), SparseLotteryAssignmentController(self.program, **options)]
+            results = []
+            for controller in controllers:
+                #   Re-run initialization so that filling low priorities uses the same seed
+                numpy.random.seed(1)
+                controller.initialize()
+                numpy.random.seed(2)
+                controller.compute_assignments()
+                results.append((controller.student_sections, controller.compute_stats(display=False)))
+
+            (dense_sections, dense_stats) = results[0]
+            (sparse_sections, sparse_stats) = results[1]
+            self.assertTrue(numpy.array_equal(dense_sections, sparse_sections))
+            for key in ('num_registrations', 'num_enrolled_students', 'num_full_classes', 'overall_interest_ratio', 'overall_utility', 'students_by_screwedness', 'hist_interest', 'hist_priority'):
+                self.assertEqual(dense_stats[key], sparse_stats[key])
+            for key in ('assignments', 'interest_assigned', 'interest_requested', 'priority_assigned', 'priority_requested', 'timeslots_filled'):
+                self.assertTrue(numpy.array_equal(dense_stats[key], sparse_stats[key]))
+
+        #   Sparse stats and exports don't build the dense matrix
+        sparse = controllers[1]
+        with mock.patch.object(SparseLotteryAssignmentController, 'student_sections', new_callable=mock.PropertyMock) as dense_matrix:
+            sparse.compute_stats(display=False)
+            data = sparse.export_assignments()
+        self.assertFalse(dense_matrix.called)
+
+        #   Sparse assignments survive a round trip through export and import
+        imported = SparseLotteryAssignmentController(self.program)
+        imported.import_assignments(data)
+        self.assertTrue(numpy.array_equal(imported.student_sections, sparse_sections))
+
+    def testBestOfSeeds(self):
+        """ Verify that running the lottery with several seeds keeps the best
+            run, and that the chosen run can be reproduced from its seed. """
+
+        lotteryController = LotteryAssignmentController(self.program, num_runs=3, seed=42, processes=2)
+        lotteryController.compute_best_assignments()
+        self.assertEqual([seed for (seed, score) in lotteryController.seed_scores], [42, 43, 44])
+        best_score = max(score for (seed, score) in lotteryController.seed_scores)
+        self.assertEqual(lotteryController.get_objective(lotteryController.compute_stats(display=False)), best_score)
+        self.assertEqual(dict(lotteryController.seed_scores)[lotteryController.seed], best_score)
+
+        #   Running the seeds in this process (the default) gives the same
+        #   results
+        sequentialController = LotteryAssignmentController(self.program, num_runs=3, seed=42)
+        sequentialController.compute_best_assignments()
+        self.assertEqual(sequentialController.seed_scores, lotteryController.seed_scores)
+        self.assertEqual(sequentialController.seed, lotteryController.seed)
+
+        #   The chosen seed reproduces the chosen assignments
+        sequentialController.run_seed(43 if lotteryController.seed == 42 else 42)
+        sequentialController.run_seed(lotteryController.seed)
+        self.assertTrue(numpy.array_equal(sequentialController.student_sections, lotteryController.student_sections))
+
+        lotteryController = LotteryAssignmentController(self.program, num_runs=2, objective='students_by_screwedness')
+        self.assertRaises(LotteryException, lotteryController.compute_best_assignments)
+
+        #   The management command runs the seeds in worker processes and
+        #   keeps the same run
+        output = StringIO()
+        call_command('run_lottery', self.program.url, runs=3, seed=42, processes=2, stdout=output)
+        best_seed = sequentialController.seed
+        self.assertIn('seed %d scored %f (kept)' % (best_seed, dict(sequentialController.seed_scores)[best_seed]), output.getvalue())
+
 class BulkCreateAccountTest(ProgramFrameworkTest):
     def setUp(self):
         super().setUp()
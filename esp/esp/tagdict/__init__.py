@@ -1261,6 +1261,14 @@ class JSONValidatedCharField(forms.CharField):
         'is_setting': True,
         'field': forms.IntegerField(min_value=0),
     },
+    'change_feed_timeout': {
+        'is_boolean': False,
+        'help_text': 'The longest time, in seconds, that the AJAX scheduler and the onsite class changes grid will wait for new changes before asking again.  Each open page holds a web server thread for this long, so keep it short, and allow for one thread per open page when sizing the server.  Set to 0 to make them poll instead.',
+        'default': '5',
+        'category': 'manage',
+        'is_setting': True,
+        'field': forms.IntegerField(min_value=0),
+    },
     'moderator_title': {
         'is_boolean': False,
         'help_text': 'The name used to refer to a section moderator throughout the website.',
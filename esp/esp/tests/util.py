@@ -1,7 +1,7 @@
 from argcache.registry import dump_all_caches
 
 from django.core.cache import cache
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 import string
 import random
 
@@ -28,6 +28,19 @@ def _fixture_teardown(self):
         self._flush_cache()
         super()._fixture_teardown()
 
+class CacheFlushTransactionTestCase(TransactionTestCase):
+    """ Like CacheFlushTestCase, but without wrapping each test in a
+    transaction, for tests that need to see commits from other threads. """
+    _flush_cache = CacheFlushTestCase._flush_cache
+
+    def _fixture_setup(self):
+        self._flush_cache()
+        super()._fixture_setup()
+
+    def _fixture_teardown(self):
+        self._flush_cache()
+        super()._fixture_teardown()
+
 def user_role_setup(names=['Student', 'Teacher', 'Educator', 'Guardian', 'Volunteer', 'Administrator']):
     from django.contrib.auth.models import Group
     for x in names:
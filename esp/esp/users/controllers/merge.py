@@ -1,9 +1,11 @@
 from django.db import transaction
-from django.db.utils import IntegrityError
+from django.db.models import UniqueConstraint
+from django.db.models.signals import m2m_changed, post_save
+from django.utils.encoding import python_2_unicode_compatible
 
 from esp.users.models import UserForwarder
 
-__all__ = ['get_related', 'merge', 'merge_users']
+__all__ = ['get_related', 'merge', 'merge_users', 'merge_many', 'MergeReport']
 
 #####################
 # Internal use only #
@@ -32,6 +34,154 @@ def _get_m2m_related(target):
     objects = [f for f in target._meta.get_fields(include_hidden=True) if f.many_to_many and f.auto_created]
     return _populate_related(target, objects, True)
 
+def _get_foreign_keys(target):
+    """
+    Gets the foreign keys (and one-to-ones) pointing at target's model.
+
+    This includes the hidden ones on the through tables of many-to-manys,
+    in either direction, so those are handled like any other table.
+
+    """
+    opts = target._meta.concrete_model._meta
+    return [f.field for f in opts.get_fields(include_hidden=True)
+            if (f.one_to_many or f.one_to_one) and f.auto_created and not f.concrete and not f.parent_link]
+
+def _get_through_m2m(field):
+    """If field is on the auto-created through table of a many-to-many,
+    returns that many-to-many; otherwise returns None."""
+    owner = field.model._meta.auto_created
+    if not owner:
+        return None
+    for m2m in owner._meta.local_many_to_many:
+        if m2m.remote_field.through is field.model:
+            return m2m
+    return None
+
+def _get_unique_sets(field):
+    """Gets the unique constraints on field's model that involve field, as
+    a list of (names of the other fields, condition or None)."""
+    opts = field.model._meta
+    ans = []
+    if field.unique:
+        ans.append(([], None))
+    for fields in opts.unique_together:
+        if field.name in fields:
+            ans.append(([f for f in fields if f != field.name], None))
+    for constraint in opts.constraints:
+        if isinstance(constraint, UniqueConstraint) and field.name in constraint.fields:
+            ans.append(([f for f in constraint.fields if f != field.name], constraint.condition))
+    return ans
+
+def _get_conflicts(field, absorber, absorbee):
+    """Gets the pks of the rows pointing at absorbee through field which
+    would break a unique constraint if they pointed at absorber instead."""
+    manager = field.model._base_manager
+    conflicts = set()
+    for others, condition in _get_unique_sets(field):
+        theirs = manager.filter(**{field.name: absorbee})
+        ours = manager.filter(**{field.name: absorber})
+        if condition is not None:
+            theirs = theirs.filter(condition)
+            ours = ours.filter(condition)
+        if not others:
+            if ours.exists():
+                conflicts.update(theirs.values_list('pk', flat=True))
+            continue
+        taken = set(ours.values_list(*others))
+        for row in theirs.values_list('pk', *others):
+            # NULLs are never equal to each other, so they never collide.
+            if None not in row[1:] and row[1:] in taken:
+                conflicts.add(row[0])
+    return conflicts
+
+def _expire_caches(model, pks):
+    """
+    Does what saving the rows with the given pks would have done for caches.
+
+    update() doesn't send post_save, so send it for each row instead,
+    unless the model has a bulk invalidate_caches() hook (e.g.
+    StudentRegistration), in which case use that.
+
+    """
+    if not pks:
+        return
+    instances = model._base_manager.filter(pk__in=pks)
+    if hasattr(model, 'invalidate_caches'):
+        model.invalidate_caches(instances)
+    elif post_save.has_listeners(model):
+        for instance in instances:
+            post_save.send(sender=model, instance=instance, created=False,
+                           update_fields=None, raw=False, using=instances.db)
+
+def _send_m2m_changed(m2m, field, absorber, absorbee, moved, dropped):
+    """
+    Sends the m2m_changed signals that calling remove(absorbee) and then
+    add(absorber) on each of the moved and dropped links would have sent.
+
+    moved and dropped map the pk of each link row to the pk on its other
+    side.
+
+    """
+    through = field.model
+    if not m2m_changed.has_listeners(through):
+        return
+    using = through._base_manager.db
+    if field.name == m2m.m2m_field_name():
+        # The many-to-many is on the user, so the other side is the target.
+        changes = [(absorbee, 'post_remove', set(moved.values()) | set(dropped.values())),
+                   (absorber, 'post_add', set(moved.values()))]
+        for user, action, pk_set in changes:
+            if pk_set:
+                m2m_changed.send(sender=through, instance=user, action=action, reverse=False,
+                                 model=m2m.remote_field.model, pk_set=pk_set, using=using)
+    else:
+        # The many-to-many points at the user from the other side.
+        moved_owners = set(moved.values())
+        for owner in m2m.model._base_manager.filter(pk__in=moved_owners | set(dropped.values())):
+            m2m_changed.send(sender=through, instance=owner, action='post_remove', reverse=False,
+                             model=m2m.remote_field.model, pk_set={absorbee.pk}, using=using)
+            if owner.pk in moved_owners:
+                m2m_changed.send(sender=through, instance=owner, action='post_add', reverse=False,
+                                 model=m2m.remote_field.model, pk_set={absorber.pk}, using=using)
+
+def _merge_field(field, absorber, absorbee, report, dry_run):
+    """Repoints every row that points at absorbee through field, except
+    those that would break a unique constraint, with a single UPDATE."""
+    manager = field.model._base_manager
+    m2m = _get_through_m2m(field)
+    conflicts = _get_conflicts(field, absorber, absorbee)
+    rows = manager.filter(**{field.name: absorbee})
+    if m2m is None:
+        moved = list(rows.exclude(pk__in=conflicts).values_list('pk', flat=True))
+    else:
+        # Remember the other side of each link for m2m_changed.
+        if field.name == m2m.m2m_field_name():
+            other = field.model._meta.get_field(m2m.m2m_reverse_field_name())
+        else:
+            other = field.model._meta.get_field(m2m.m2m_field_name())
+        links = dict(rows.values_list('pk', other.attname))
+        moved = {pk: other_pk for pk, other_pk in links.items() if pk not in conflicts}
+        dropped = {pk: other_pk for pk, other_pk in links.items() if pk in conflicts}
+    if not moved and not conflicts:
+        return
+
+    label = '%s.%s' % (field.model._meta.label, field.name)
+    report.moved[label] = len(moved)
+    if conflicts and m2m is None:
+        # The absorber already has its own copy; leave this one be.
+        report.conflicts[label] = sorted(conflicts)
+    elif conflicts:
+        # The absorber already has this link, so it's redundant.
+        report.dropped[label] = len(conflicts)
+        manager.filter(pk__in=conflicts).delete()
+    manager.filter(pk__in=list(moved)).update(**{field.name: absorber})
+
+    if not dry_run:
+        if m2m is None:
+            _expire_caches(field.model, moved)
+        else:
+            _send_m2m_changed(m2m, field, absorber, absorbee, moved, dropped)
+
 
 ################################
 # Potentially useful elsewhere #
@@ -47,47 +197,99 @@ def get_related(target):
     """
     return _get_simply_related(target) + _get_m2m_related(target)
 
-def merge(absorber, absorbee):
-    """Transfers everything from absorbee to absorber."""
-    for obj, name, m2m in get_related(absorbee):
-        # I could probably be smarter about transaction handling.
-        # Ideally, I'd check for uniqueness constraints *before* saving.
-        # Then I wouldn't have to do any transaction stuff here.
-        with transaction.atomic():
-            if m2m:
-                # TODO: handle symmetric relations.
-                rel = getattr(obj, name)
-                # If it's not auto_created then it's handled by a "through".
-                if rel.through._meta.auto_created:
-                    rel.remove(absorbee)
-                    rel.add(absorber)
-                    # No need to save(); remove and add implicitly do it.
-            else:
-                setattr(obj, name, absorber)
-                obj.save()
-    # Also check local m2m fields.
-    for field in absorber._meta.local_many_to_many:
-        getattr(absorber, field.attname).add(getattr(absorbee, field.attname).all())
+@python_2_unicode_compatible
+class MergeReport(object):
+    """
+    What merge() did, or would have done if it was a dry run.
+
+    Each of these is keyed by the label of a field pointing at users, e.g.
+    'program.StudentRegistration.user':
+        moved: How many rows now point at the absorber.
+        dropped: How many many-to-many links were deleted from the absorbee
+                 because the absorber already had them.
+        conflicts: pks of the rows left on the absorbee because the
+                   absorber already had a row that they must be unique with.
+
+    """
+    def __init__(self, absorber, absorbee, dry_run=False):
+        self.absorber = absorber
+        self.absorbee = absorbee
+        self.dry_run = dry_run
+        self.moved = {}
+        self.dropped = {}
+        self.conflicts = {}
+
+    def __str__(self):
+        lines = ['%s %s into %s' % ('Would merge' if self.dry_run else 'Merged', self.absorbee, self.absorber)]
+        for label in sorted(set(self.moved) | set(self.dropped) | set(self.conflicts)):
+            lines.append('    %s: %d moved, %d dropped, %d left on absorbee' % (
+                label, self.moved.get(label, 0), self.dropped.get(label, 0), len(self.conflicts.get(label, []))))
+        return '\n'.join(lines)
+
+def merge(absorber, absorbee, dry_run=False):
+    """
+    Transfers everything from absorbee to absorber.
+
+    Each table pointing at users is updated with one UPDATE, after finding
+    the rows that would collide with the absorber's under a unique
+    constraint.  Colliding many-to-many links are deleted; other colliding
+    rows are left on the absorbee.  It all happens in one transaction.
+
+    If dry_run is set, the transaction is rolled back afterwards.
+
+    Returns a MergeReport.
+
+    """
+    if absorber.pk == absorbee.pk:
+        raise ValueError('Cannot merge user %s into itself' % absorber)
+    report = MergeReport(absorber, absorbee, dry_run)
+    with transaction.atomic():
+        for field in _get_foreign_keys(absorbee):
+            _merge_field(field, absorber, absorbee, report, dry_run)
+        if dry_run:
+            transaction.set_rollback(True)
+    return report
 
 
 #########################
 # Usable from the shell #
 #########################
 
-def merge_users(absorber, absorbee, forward=True, deactivate=False):
+def merge_users(absorber, absorbee, forward=True, deactivate=False, dry_run=False):
     """
     Merge two accounts, transferring everything from absorbee to abosorber.
 
     Options:
         forward: Set up login forwarding from absorbee to absorber
         deactivate: Deactivate the absorbee
+        dry_run: Report what would be transferred, but don't change anything
+
+    Returns a MergeReport.
+
+    """
+    with transaction.atomic():
+        report = merge(absorber, absorbee, dry_run=dry_run)
+        if dry_run:
+            return report
+        # Set up forwarding
+        if forward:
+            UserForwarder.forward(absorbee, absorber)
+        # Deactivate the absorbed account.
+        if deactivate:
+            absorbee.is_active = False
+            absorbee.save()
+    return report
+
+def merge_many(pairs, forward=True, deactivate=False, dry_run=False):
+    """
+    Merge each of a list of (absorber, absorbee) pairs with merge_users().
+
+    Each pair is merged in its own transaction, so if one fails, the pairs
+    before it stay merged.  Since a dry run doesn't change anything, each
+    pair's report doesn't take the earlier pairs into account.
+
+    Returns a list of MergeReports, one per pair.
 
     """
-    merge(absorber, absorbee)
-    # Set up forwarding
-    if forward:
-        UserForwarder.forward(absorbee, absorber)
-    # Deactivate the absorbed account.
-    if deactivate:
-        absorbee.is_active = False
-        absorbee.save()
+    return [merge_users(absorber, absorbee, forward=forward, deactivate=deactivate, dry_run=dry_run)
+            for absorber, absorbee in pairs]
@@ -747,6 +747,7 @@ def getEnrolledSectionsFromProgram(self, program):
             sec._timeslot_ids = sec.timeslot_ids()
         return result
     getEnrolledSectionsFromProgram.depend_on_row('program.StudentRegistration', lambda reg: {'self': reg.user})
+    getEnrolledSectionsFromProgram.depend_on_row('program.RegistrationCacheEpoch', lambda epoch: {'program': epoch.program})
     getEnrolledSectionsFromProgram.depend_on_cache('program.ClassSection.timeslot_ids', lambda self=wildcard, **kwargs: {})
 
     def getEnrolledSectionsAll(self):
@@ -767,6 +768,7 @@ def getFirstClassTime(self, program):
             else:
                 return sections[0].meeting_times.order_by('start')[0]
     getFirstClassTime.depend_on_row('program.StudentRegistration', lambda reg: {'self': reg.user})
+    getFirstClassTime.depend_on_row('program.RegistrationCacheEpoch', lambda epoch: {'program': epoch.program})
 
     def can_skip_phase_zero(self, program):
         return Permission.user_has_perm(self, 'OverridePhaseZero', program)
@@ -774,40 +776,13 @@ def can_skip_phase_zero(self, program):
     def getRegistrationPriority(self, prog, timeslots):
         """ Finds the highest available priority level for this user across the supplied timeslots.
             Returns 0 if the student is already enrolled in one or more of the timeslots. """
-        if len(timeslots) < 1:
-            return 0
+        return self.getScheduleBitmask(prog).priority([t.id for t in timeslots])
 
-        prereg_sections = self.getSectionsFromProgram(prog)
-
-        priority_dict = {}
-        for t in timeslots:
-            priority_dict[t.id] = []
-
-        for sec in prereg_sections:
-            cv = sec.getRegVerbs(self)
-            smt = sec.meeting_times.all()
-            for t in smt:
-                if t.id in priority_dict:
-                    for v in cv:
-                        if v.name.startswith('Priority'):
-                            try:
-                                priority_dict[t.id].append(int(v[9:]))
-                            except Exception: # fails if 'Priority' is set, rather than 'Priority/1'
-                                priority_dict[t.id].append(1)
-                        elif v == 'Enrolled':
-                            return 0
-        #   Now priority_dict is a dictionary where the keys are timeslot IDs and the values
-        #   are lists of taken priority levels.  Merge those and find the lowest positive
-        #   integer not in that list.
-        all_priorities = []
-        for key in priority_dict:
-            all_priorities += priority_dict[key]
-
-        priority = 1
-        while priority in all_priorities:
-            priority += 1
-
-        return priority
+    def getScheduleBitmask(self, program):
+        #   Cached per user and program, and kept up to date by
+        #   ScheduleBitmask itself rather than by argcache.
+        from esp.program.models import ScheduleBitmask
+        return ScheduleBitmask.get(self, program)
 
     def isEnrolledInClass(self, clsObj, request=None):
         return clsObj.students().filter(id=self.id).exists()
@@ -10,7 +10,7 @@
 from django.utils.functional import SimpleLazyObject
 
 from esp.middleware import ESPError
-from esp.program.models import RegistrationProfile, Program
+from esp.program.models import FinancialAidRequest, RegistrationProfile, Program
 from esp.program.tests import ProgramFrameworkTest
 from esp.tagdict.models import Tag
 from esp.tests.util import CacheFlushTestCase as TestCase, user_role_setup
@@ -305,6 +305,71 @@ def fwd_info(user):
         self.assertTrue(UserForwarder.follow(self.ub) == (self.ub, False), fwd_info(self.ub))
         self.assertTrue(UserForwarder.follow(self.uc) == (self.ub, True), fwd_info(self.uc))
 
+class MergeTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.absorber = ESPUser.objects.create(username='merge_absorber')
+        self.absorbee = ESPUser.objects.create(username='merge_absorbee')
+        self.program1 = Program.objects.create(grade_min=7, grade_max=12, url='Splash/MergeProgram1')
+        self.program2 = Program.objects.create(grade_min=7, grade_max=12, url='Splash/MergeProgram2')
+        self.event = RecordType.objects.get(name='student_survey')
+        self.group_both = Group.objects.create(name='MergeBoth')
+        self.group_absorbee = Group.objects.create(name='MergeAbsorbee')
+
+        #   The absorbee has two records, two financial aid requests (one of
+        #   which collides with the absorber's) and two groups (one of which
+        #   the absorber is also in).
+        for program in [self.program1, self.program2]:
+            Record.objects.create(user=self.absorbee, event=self.event, program=program)
+            FinancialAidRequest.objects.create(user=self.absorbee, program=program)
+        FinancialAidRequest.objects.create(user=self.absorber, program=self.program1)
+        self.absorbee.groups.add(self.group_both, self.group_absorbee)
+        self.absorber.groups.add(self.group_both)
+
+    def test_merge(self):
+        from esp.users.controllers.merge import merge_users
+
+        report = merge_users(self.absorber, self.absorbee, forward=True, deactivate=True)
+        self.assertEqual(report.moved['users.Record.user'], 2)
+        self.assertEqual(Record.objects.filter(user=self.absorber).count(), 2)
+        self.assertFalse(Record.objects.filter(user=self.absorbee).exists())
+
+        #   The colliding financial aid request should be left on the absorbee
+        conflict = FinancialAidRequest.objects.get(user=self.absorbee)
+        self.assertEqual(conflict.program, self.program1)
+        self.assertEqual(report.conflicts['program.FinancialAidRequest.user'], [conflict.id])
+        self.assertEqual(set(FinancialAidRequest.objects.filter(user=self.absorber).values_list('program', flat=True)), {self.program1.id, self.program2.id})
+
+        #   Groups should be combined, without duplicates
+        self.assertEqual(set(self.absorber.groups.all()), {self.group_both, self.group_absorbee})
+        self.assertFalse(self.absorbee.groups.exists())
+        self.assertEqual(sum(report.dropped.values()), 1)
+
+        self.assertEqual(UserForwarder.follow(self.absorbee), (self.absorber, True))
+        self.assertFalse(ESPUser.objects.get(id=self.absorbee.id).is_active)
+
+    def test_dry_run(self):
+        from esp.users.controllers.merge import merge_many
+
+        reports = merge_many([(self.absorber, self.absorbee)], dry_run=True)
+        self.assertEqual(len(reports), 1)
+        self.assertTrue(reports[0].dry_run)
+        self.assertEqual(reports[0].moved['users.Record.user'], 2)
+        self.assertEqual(len(reports[0].conflicts['program.FinancialAidRequest.user']), 1)
+
+        #   Nothing should have changed
+        self.assertEqual(Record.objects.filter(user=self.absorbee).count(), 2)
+        self.assertEqual(FinancialAidRequest.objects.filter(user=self.absorbee).count(), 2)
+        self.assertEqual(self.absorbee.groups.count(), 2)
+        self.assertEqual(self.absorber.groups.count(), 1)
+        self.assertEqual(UserForwarder.follow(self.absorbee), (self.absorbee, False))
+
+        #   A real merge of the same pair should do what the dry run said
+        reports_again = merge_many([(self.absorber, self.absorbee)])
+        self.assertEqual(reports_again[0].moved, reports[0].moved)
+        self.assertEqual(reports_again[0].conflicts, reports[0].conflicts)
+        self.assertEqual(reports_again[0].dropped, reports[0].dropped)
+
 class MakeAdminTest(TestCase):
     def setUp(self):
         self.user, created = ESPUser.objects.get_or_create(username='admin_test')
@@ -35,13 +35,17 @@
 """
 """ This module will render latex code and return a rendered display. """
 
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
+import logging
 import os.path
 import os
 from functools import partial
 from random import random
+import re
 import subprocess
 import tempfile
+import time
 
 from django.conf import settings
 from django.http import HttpResponse
@@ -49,6 +53,8 @@
 
 from esp.middleware import ESPError
 
+logger = logging.getLogger(__name__)
+
 TEX_TEMP = tempfile.gettempdir()
 TEX_EXT  = '.tex'
 _devnull_sentinel = object()
@@ -64,11 +70,16 @@
 }
 
 
-def render_to_latex(filepath, context_dict=None, file_type='pdf'):
+def render_to_latex(filepath, context_dict=None, file_type='pdf', split=None):
     """Render some tex source to latex.
 
     This will run the latex interpreter and generate the necessary file type,
     which must be one of those from FILE_MIME_TYPES.
+
+    If split is the name of a list in context_dict (e.g. 'students') and we
+    are generating a PDF, the template is rendered separately for chunks of
+    settings.LATEX_BATCH_SIZE items of that list (default 100), which are
+    compiled in parallel and merged; see gen_latex_batch.
     """
     if file_type not in FILE_MIME_TYPES:
         raise ESPError('Invalid type received for latex generation: %s should '
@@ -82,20 +93,41 @@ def render_to_latex(filepath, context_dict=None, file_type='pdf'):
         t = loader.select_template(filepath)
     else:
         t = loader.get_template(filepath)
+    doc_type = _template_name(t)
 
     context_dict['MEDIA_ROOT'] = settings.MEDIA_ROOT
     context_dict['file_type'] = file_type
     context_dict['settings'] = settings
 
-    rendered_source = t.render(context_dict)
-
-    contents = gen_latex(rendered_source, file_type)
+    batch_size = getattr(settings, 'LATEX_BATCH_SIZE', 100)
+    if split and file_type == 'pdf' and len(context_dict[split]) > batch_size:
+        items = list(context_dict[split])
+        sources = []
+        for i in range(0, len(items), batch_size):
+            context_dict[split] = items[i:i + batch_size]
+            sources.append(t.render(context_dict))
+        context_dict[split] = items
+        contents = gen_latex_batch(sources, file_type, doc_type=doc_type)
+    else:
+        rendered_source = t.render(context_dict)
+        contents = gen_latex(rendered_source, file_type, doc_type=doc_type)
     return HttpResponse(contents, content_type=FILE_MIME_TYPES[file_type])
 
 
-def gen_latex(texcode, file_type='pdf', stdout=_devnull_sentinel, stderr=subprocess.STDOUT):
+def _template_name(t):
+    """Get a name for the document type of a template, for logging."""
+    # Backend templates wrap the engine's template, which has the name.
+    name = getattr(getattr(t, 'template', t), 'name', None)
+    return os.path.basename(name) if name else 'latex'
+
+
+def gen_latex(texcode, file_type='pdf', stdout=_devnull_sentinel, stderr=subprocess.STDOUT, doc_type='latex', use_cache=True):
     """Generate the latex code.
 
+    Outputs are cached on disk, keyed by a hash of texcode and file_type, so
+    compiling the same source again just returns the saved output; see
+    _cache_path.  The time taken by each compile is logged by doc_type.
+
     :param texcode:
         The latex source code to use to generate the output.
     :type texcode:
@@ -119,6 +151,15 @@ def gen_latex(texcode, file_type='pdf', stdout=_devnull_sentinel, stderr=subproc
         specified by the stdout param.
     :type stderr:
         `int` or `file` or `None`
+    :param doc_type:
+        A name for the kind of document, such as the template name, used
+        when logging compile times.
+    :type doc_type:
+        `str`
+    :param use_cache:
+        Whether to use the cache of rendered outputs.
+    :type use_cache:
+        `bool`
     :return:
         The generated file contents.
     :rtype:
@@ -132,7 +173,152 @@ def gen_latex(texcode, file_type='pdf', stdout=_devnull_sentinel, stderr=subproc
         # parameter for `stderr`.
         stdout, stderr = [devnull_file if f is _devnull_sentinel else f for f in [stdout, stderr]]
 
-        return _gen_latex(texcode, stdout=stdout, stderr=stderr, file_type=file_type)
+        if file_type in ('tex', 'log'):
+            # Nothing to compile, or nothing worth keeping.
+            return _gen_latex(texcode, stdout=stdout, stderr=stderr, file_type=file_type)
+
+        cache_path = _cache_path(texcode, file_type) if use_cache else None
+        if cache_path:
+            contents = _get_cached(cache_path)
+            if contents is not None:
+                logger.info('LaTeX %s (%s): cached', doc_type, file_type)
+                return contents
+
+        start = time.time()
+        contents = _gen_latex(texcode, stdout=stdout, stderr=stderr, file_type=file_type)
+        logger.info('LaTeX %s (%s): compiled in %.2fs', doc_type, file_type, time.time() - start)
+
+        if cache_path:
+            _set_cached(cache_path, contents)
+        return contents
+
+
+def gen_latex_batch(texcodes, file_type='pdf', doc_type='latex'):
+    """Generate a PDF from several pieces of latex code, and merge them.
+
+    Each piece is compiled by gen_latex (and so cached separately), using
+    up to settings.LATEX_WORKERS (default 4) pdflatex processes at once.  The
+    resulting PDFs are then combined in order into one document using
+    pdfpages.  The merged output is cached too, keyed by all of the pieces.
+    """
+    if file_type != 'pdf':
+        raise ESPError('Only PDFs can be generated in batches, not %s' % file_type)
+    if len(texcodes) == 1:
+        return gen_latex(texcodes[0], file_type, doc_type=doc_type)
+
+    cache_path = _cache_path('\0'.join(texcodes), 'batch.' + file_type)
+    if cache_path:
+        contents = _get_cached(cache_path)
+        if contents is not None:
+            logger.info('LaTeX %s (%s, %d parts): cached', doc_type, file_type, len(texcodes))
+            return contents
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=getattr(settings, 'LATEX_WORKERS', 4)) as executor:
+        parts = list(executor.map(partial(gen_latex, file_type=file_type, doc_type=doc_type), texcodes))
+
+    part_files = []
+    try:
+        for part in parts:
+            part_file = os.path.join(TEX_TEMP, get_rand_file_base() + '.pdf')
+            with open(part_file, 'wb') as f:
+                f.write(part)
+            part_files.append(part_file)
+        merge_source = '\n'.join(
+            ['\\documentclass{article}', '\\usepackage{pdfpages}', '\\begin{document}'] +
+            ['\\includepdf[pages=-,fitpaper]{%s}' % part_file for part_file in part_files] +
+            ['\\end{document}'])
+        contents = gen_latex(merge_source, file_type, doc_type=doc_type, use_cache=False)
+    finally:
+        for part_file in part_files:
+            os.remove(part_file)
+    logger.info('LaTeX %s (%s, %d parts): compiled in %.2fs', doc_type, file_type, len(texcodes), time.time() - start)
+
+    if cache_path:
+        _set_cached(cache_path, contents)
+    return contents
+
+
+# When we last removed old files from the cache, in this process.
+_last_prune = 0
+
+
+def _cache_path(texcode, file_type):
+    """Get the path at which to cache the output of texcode as file_type.
+
+    The cache lives in settings.LATEX_CACHE_DIR (by default, a directory in
+    the system temporary directory); set that to None to turn it off.  Files
+    which haven't been used in settings.LATEX_CACHE_MAX_AGE seconds (default
+    one week) are removed.
+
+    Files under MEDIA_ROOT that the source refers to (such as letterhead
+    images) are part of the key too, by modification time and size, so that
+    replacing one doesn't leave stale output in the cache.  Files that are
+    only reached indirectly, e.g. \\input from another file, are not.
+    """
+    cache_dir = getattr(settings, 'LATEX_CACHE_DIR', os.path.join(TEX_TEMP, 'esp_latex_cache'))
+    if not cache_dir:
+        return None
+    key_parts = [file_type, texcode]
+    for path in sorted(set(_media_paths(texcode))):
+        try:
+            stat = os.stat(path)
+            key_parts.append('%s %s %s' % (path, stat.st_mtime, stat.st_size))
+        except OSError:
+            key_parts.append('%s missing' % path)
+    key = hashlib.sha256('\n'.join(key_parts).encode('UTF-8')).hexdigest()
+    return os.path.join(cache_dir, key[:2], '%s.%s' % (key, file_type))
+
+
+def _media_paths(texcode):
+    """Find the paths of files under MEDIA_ROOT mentioned in texcode."""
+    media_root = settings.MEDIA_ROOT
+    if not media_root:
+        return []
+    return re.findall(re.escape(media_root) + r'[^\s{}\[\]%\\]+', texcode)
+
+
+def _get_cached(cache_path):
+    try:
+        with open(cache_path, 'rb') as f:
+            contents = f.read()
+        # Mark it as recently used, so it isn't pruned.
+        os.utime(cache_path)
+        return contents
+    except OSError:
+        return None
+
+
+def _set_cached(cache_path, contents):
+    global _last_prune
+    cache_subdir = os.path.dirname(cache_path)
+    try:
+        os.makedirs(cache_subdir, exist_ok=True)
+        # Write to a temporary file and move it into place, so that nobody
+        # reads a partly-written file.
+        fd, temp_path = tempfile.mkstemp(dir=cache_subdir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(contents)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        logger.warning('Could not cache LaTeX output: %s', e)
+        return
+
+    if time.time() - _last_prune > 3600:
+        _last_prune = time.time()
+        _prune_cache(os.path.dirname(cache_subdir))
+
+
+def _prune_cache(cache_dir):
+    cutoff = time.time() - getattr(settings, 'LATEX_CACHE_MAX_AGE', 7 * 24 * 3600)
+    for dirpath, dirnames, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
 
 
 def _gen_latex(texcode, stdout, stderr, file_type='pdf'):
@@ -8,7 +8,7 @@
 from django.core.cache.backends.memcached import PyLibMCCache as PylibmcCacheClass
 from django.conf import settings
 from esp.utils.try_multi import try_multi
-from esp.utils import ascii
+from esp.utils import ascii, request_cache
 import hashlib
 
 try:
@@ -50,26 +50,84 @@ def _failfast_test(self, key, value):
             except TypeError as e:
                 logger.warning("Got a TypeError (likely because value `{}` is not picklable):\n\n{}".format(value, e))
 
-    @try_multi(8)
+    #   Reads are answered from the request-local memo where possible, and
+    #   everything this process writes updates it; see esp.utils.request_cache.
+
     def add(self, key, value, timeout=None, version=None):
+        added = self._add(key, value, timeout=timeout, version=version)
+        if added:
+            request_cache.remember((key, version), value)
+        else:
+            request_cache.forget((key, version))
+        return added
+
+    @try_multi(8)
+    def _add(self, key, value, timeout=None, version=None):
         self._failfast_test(key, value)
         return self._wrapped_cache.add(self.make_key(key, version), value, timeout=timeout, version=version)
 
-    @try_multi(8)
     def get(self, key, default=None, version=None):
-        return self._wrapped_cache.get(self.make_key(key, version), default=default, version=version)
+        memo = request_cache.get_request_cache()
+        if memo is None:
+            # If the memo is suspended, anything it has for this key may now
+            # be out of date.
+            request_cache.forget((key, version))
+            return self._get(key, default=default, version=version)
+        if (key, version) in memo:
+            return memo.get((key, version), default)
+        memo.misses += 1
+        value = self._get(key, default=request_cache.MISSING, version=version)
+        memo.store((key, version), value)
+        return default if value is request_cache.MISSING else value
 
     @try_multi(8)
+    def _get(self, key, default=None, version=None):
+        return self._wrapped_cache.get(self.make_key(key, version), default=default, version=version)
+
     def set(self, key, value, timeout=None, version=None):
+        request_cache.forget((key, version))
+        self._set(key, value, timeout=timeout, version=version)
+        request_cache.remember((key, version), value)
+
+    @try_multi(8)
+    def _set(self, key, value, timeout=None, version=None):
         self._failfast_test(key, value)
         return self._wrapped_cache.set(self.make_key(key, version), value, timeout=timeout, version=version)
 
-    @try_multi(8)
     def delete(self, key, version=None):
-        return self._wrapped_cache.delete(self.make_key(key, version), version=version)
+        request_cache.forget((key, version))
+        self._delete(key, version=version)
+        request_cache.remember((key, version), request_cache.MISSING)
 
     @try_multi(8)
+    def _delete(self, key, version=None):
+        return self._wrapped_cache.delete(self.make_key(key, version), version=version)
+
     def get_many(self, keys, version=None):
+        memo = request_cache.get_request_cache()
+        if memo is None:
+            for key in keys:
+                request_cache.forget((key, version))
+            return self._get_many(keys, version=version)
+        ans = {}
+        missed = []
+        for key in keys:
+            if (key, version) in memo:
+                value = memo.get((key, version), request_cache.MISSING)
+                if value is not request_cache.MISSING:
+                    ans[key] = value
+            else:
+                missed.append(key)
+        if missed:
+            memo.misses += len(missed)
+            fetched = self._get_many(missed, version=version)
+            for key in missed:
+                memo.store((key, version), fetched.get(key, request_cache.MISSING))
+            ans.update(fetched)
+        return ans
+
+    @try_multi(8)
+    def _get_many(self, keys, version=None):
         keys_dict = dict((self.make_key(key, version), key) for key in keys)
         wrapped_ans = self._wrapped_cache.get_many(list(keys_dict.keys()), version=version)
         ans = {}
@@ -80,12 +138,18 @@ def get_many(self, keys, version=None):
     # Django 1.1 feature
     # Don't try_multi, that could be all kinds of bad...
     def incr(self, key, delta=1, version=None):
-        return self._wrapped_cache.incr(self.make_key(key, version), delta, version=version)
+        request_cache.forget((key, version))
+        value = self._wrapped_cache.incr(self.make_key(key, version), delta, version=version)
+        request_cache.remember((key, version), value)
+        return value
 
     # Django 1.1 feature
     # Don't try_multi, that could be all kinds of bad...
     def decr(self, key, delta=1, version=None):
-        return self._wrapped_cache.decr(self.make_key(key, version), delta, version=version)
+        request_cache.forget((key, version))
+        value = self._wrapped_cache.decr(self.make_key(key, version), delta, version=version)
+        request_cache.remember((key, version), value)
+        return value
 
     def close(self, **kwargs):
         self._wrapped_cache.close()
@@ -3,6 +3,8 @@
 from django.db.models.constants import LOOKUP_SEP
 
 from copy import deepcopy
+from functools import reduce
+import operator
 
 def shallow_copy_Q(q_object):
     obj = Node(connector=q_object.connector, negated=q_object.negated)
@@ -34,3 +36,29 @@ def _append_to_child(child, root):
     else:
         return deepcopy(child)
 
+
+def keyset_Q(ordering, values, before=False):
+    """
+    Takes an ordering (a list of field names, each prefixed with '-' if it
+    is descending) and the values of those fields for one row, and returns
+    a Q object selecting the rows which come after that row in the ordering
+    (or before it, if before is True).  This is for keyset pagination: the
+    next page is the first few rows after the last row of this one.
+
+    The ordering should end with a unique field, so that no two rows tie.
+    For example,
+    keyset_Q(['-year', 'id'], ['2010', 42])
+    returns
+    Q(year__lt='2010') | Q(year='2010', id__gt=42)
+    """
+    conditions = []
+    for i, field in enumerate(ordering):
+        equal = {prev.lstrip('-'): value for (prev, value) in zip(ordering[:i], values[:i])}
+        lookup = 'lt' if field.startswith('-') != before else 'gt'
+        equal[field.lstrip('-') + LOOKUP_SEP + lookup] = values[i]
+        conditions.append(Q(**equal))
+    return reduce(operator.or_, conditions)
+
+def reverse_ordering(ordering):
+    """ The reverse of an ordering, as taken by keyset_Q(). """
+    return [field[1:] if field.startswith('-') else '-' + field for field in ordering]
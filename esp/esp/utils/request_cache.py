@@ -0,0 +1,125 @@
+"""
+Request-local memoization of cache reads.
+
+Within one request, the same cached values (tags, program modules, section
+capacities and enrollment counts, ...) are looked up many times, and each
+lookup is a memcached round trip plus an unpickle.  While a request is being
+handled, the cache backend (esp.utils.memcached_multikey) remembers what it
+has read and written in a RequestCache, and answers repeated reads from it.
+
+Writes, deletes and increments made by this process go through the same
+backend and update the memo, so invalidations made while handling the
+request are seen immediately, exactly as before.  Changes made by other
+processes during the request may not be seen until the next request.  Code
+which waits on the cache for another process to change something should
+read inside `with suspended():`.
+
+The memo is started and cleared by esp.middleware.threadlocalrequest.ThreadLocals.
+"""
+
+from contextlib import contextmanager
+import pickle
+import threading
+
+_threading_local = threading.local()
+
+#   Values of these types are stored as-is; anything else is stored pickled,
+#   so that callers which modify what they get back can't change what the
+#   next caller sees (just like when each read came from memcached).
+_IMMUTABLE_TYPES = (type(None), bool, int, float, str, bytes)
+
+#   Marks a key which we know isn't in the cache.
+MISSING = object()
+
+class RequestCache(object):
+    """ The values read from and written to the cache during one request,
+    with counts of how many reads it answered (hits) or passed on to the
+    cache (misses). """
+
+    def __init__(self):
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+        self.suspended = 0
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def get(self, key, default=None):
+        """ Return the remembered value for key, or default if it isn't in
+        the cache.  Counts a hit. """
+        self.hits += 1
+        pickled, value = self.values[key]
+        if value is MISSING:
+            return default
+        if pickled:
+            return pickle.loads(value)
+        return value
+
+    def store(self, key, value):
+        """ Remember that key has value (or isn't in the cache, if value is
+        MISSING). """
+        if value is MISSING or isinstance(value, _IMMUTABLE_TYPES):
+            self.values[key] = (False, value)
+        else:
+            try:
+                self.values[key] = (True, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            except Exception:
+                #   The cache couldn't have stored it either.
+                self.values.pop(key, None)
+
+    def forget(self, key):
+        """ Forget key, so the next read goes to the cache. """
+        self.values.pop(key, None)
+
+def start():
+    """ Start a new, empty memo for the current thread. """
+    _threading_local.request_cache = RequestCache()
+
+def end():
+    """ Stop memoizing in the current thread, returning the finished memo
+    (or None if there wasn't one). """
+    request_cache = _current()
+    _threading_local.request_cache = None
+    return request_cache
+
+def _current():
+    return getattr(_threading_local, 'request_cache', None)
+
+def remember(key, value):
+    """ Record that this thread wrote value to key. """
+    request_cache = _current()
+    if request_cache is None:
+        return
+    if request_cache.suspended:
+        request_cache.forget(key)
+    else:
+        request_cache.store(key, value)
+
+def forget(key):
+    """ Record that this thread changed key in a way we can't predict. """
+    request_cache = _current()
+    if request_cache is not None:
+        request_cache.forget(key)
+
+def get_request_cache():
+    """ The current thread's memo, or None if reads shouldn't be memoized. """
+    request_cache = _current()
+    if request_cache is None or request_cache.suspended:
+        return None
+    return request_cache
+
+@contextmanager
+def suspended():
+    """ Read from and write to the cache directly inside this block.  Keys
+    read or written inside it are forgotten by the memo, so later reads see
+    the new values too. """
+    request_cache = _current()
+    if request_cache is None:
+        yield
+        return
+    request_cache.suspended += 1
+    try:
+        yield
+    finally:
+        request_cache.suspended -= 1
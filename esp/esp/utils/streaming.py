@@ -0,0 +1,245 @@
+
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of the ESP Web Site
+Copyright (c) 2026 by the individual contributors
+  (see AUTHORS file)
+
+The ESP Web Site is free software; you can redistribute it and/or
+modify it under the terms of the GNU Affero General Public License
+as published by the Free Software Foundation; either version 3
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Contact information:
+MIT Educational Studies Program
+  84 Massachusetts Ave W20-467, Cambridge, MA 02139
+  Phone: 617-253-4882
+  Email: esp-webmasters@mit.edu
+Learning Unlimited, Inc.
+  527 Franklin St, Cambridge, MA 02139
+  Phone: 617-379-0178
+  Email: web-team@learningu.org
+"""
+import csv
+import os
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+from django.http import StreamingHttpResponse
+
+class StreamBuffer(object):
+    """
+    A write-only file-like object which holds on to what is written to it
+    until it is taken with pop().  Writers such as csv and zipfile write into
+    it, and we yield the pieces to a StreamingHttpResponse as we go, so the
+    whole file is never held in memory.
+
+    It supports tell() but not seek(), so zipfile writes data descriptors
+    rather than going back to fill in the local headers.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def iter_csv(rows):
+    """
+    Yields the given rows as UTF-8 encoded CSV, one row at a time.
+    """
+    buf = StreamBuffer()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(row)
+        yield buf.pop()
+
+def iter_zip(members, compression=zipfile.ZIP_DEFLATED):
+    """
+    Yields a zip file, given an iterable of (name, contents) pairs, where
+    contents is an iterable of byte strings.  Contents are compressed and
+    yielded as they are produced.  name may also be a ZipInfo, to set the
+    date or compression type of that member.
+    """
+    buf = StreamBuffer()
+    with zipfile.ZipFile(buf, 'w', compression) as zf:
+        for name, contents in members:
+            with zf.open(name, 'w') as dest:
+                for chunk in contents:
+                    dest.write(chunk)
+                    data = buf.pop()
+                    if data:
+                        yield data
+            yield buf.pop()
+    yield buf.pop()
+
+#   Extensions of formats which are already compressed, so there's no point
+#   in deflating them again.
+COMPRESSED_EXTENSIONS = {
+    '.7z', '.avi', '.bz2', '.docx', '.gif', '.gz', '.heic', '.jpeg', '.jpg',
+    '.m4a', '.mov', '.mp3', '.mp4', '.odp', '.ods', '.odt', '.pdf', '.png',
+    '.pptx', '.rar', '.webm', '.webp', '.xlsx', '.xz', '.zip',
+}
+
+def iter_file(path, chunk_size=64 * 1024):
+    """
+    Yields the contents of the file at path, chunk_size bytes at a time.
+    """
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+def _iter_file_members(files):
+    names = set()
+    for path in files:
+        if not path or not os.path.isfile(path):
+            continue
+        # Name each file by its basename, numbering any repeats.
+        base, ext = os.path.splitext(os.path.basename(os.path.normpath(path)))
+        name = base + ext
+        i = 1
+        while name in names:
+            i += 1
+            name = '%s (%d)%s' % (base, i, ext)
+        names.add(name)
+        info = zipfile.ZipInfo.from_file(path, name)
+        if ext.lower() in COMPRESSED_EXTENSIONS:
+            info.compress_type = zipfile.ZIP_STORED
+        else:
+            info.compress_type = zipfile.ZIP_DEFLATED
+        yield info, iter_file(path)
+
+def iter_zip_files(files):
+    """
+    Yields a zip file containing the files at the given paths, reading each
+    file in chunks.  Files are stored without compression if they are in a
+    format which is already compressed.  Missing files are left out, since
+    by the time we get to them we can't return an error.
+    """
+    return iter_zip(_iter_file_members(files))
+
+_XLSX_PARTS = {
+    '[Content_Types].xml': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>',
+    '_rels/.rels': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>',
+    'xl/_rels/workbook.xml.rels': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+        '</Relationships>',
+    #   Style 1 is bold, for the header row.
+    'xl/styles.xml': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>'
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        '</styleSheet>',
+}
+
+_XLSX_WORKBOOK = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="%s" sheetId="1" r:id="rId1"/></sheets></workbook>')
+
+#   Characters which can't appear in XML at all
+_XML_ILLEGAL_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+def _xlsx_column(index):
+    """ Returns the spreadsheet column name (A, B, ..., Z, AA, ...) for a 0-based index. """
+    name = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        name = chr(ord('A') + remainder) + name
+    return name
+
+def _xlsx_cell(ref, value, style):
+    if value is None or value == '':
+        return ''
+    style_attr = ' s="%d"' % style if style else ''
+    if isinstance(value, bool):
+        return '<c r="%s"%s t="b"><v>%d</v></c>' % (ref, style_attr, value)
+    if isinstance(value, (int, float)):
+        return '<c r="%s"%s><v>%r</v></c>' % (ref, style_attr, value)
+    text = escape(_XML_ILLEGAL_CHARS.sub('', str(value)))
+    return '<c r="%s"%s t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (ref, style_attr, text)
+
+def _iter_xlsx_sheet(rows, header):
+    yield ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+           '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>').encode('utf-8')
+    columns = []
+    for row_index, row in enumerate(rows):
+        style = 1 if header and row_index == 0 else 0
+        while len(columns) < len(row):
+            columns.append(_xlsx_column(len(columns)))
+        cells = ''.join(_xlsx_cell('%s%d' % (columns[i], row_index + 1), value, style) for i, value in enumerate(row))
+        yield ('<row r="%d">%s</row>' % (row_index + 1, cells)).encode('utf-8')
+    yield '</sheetData></worksheet>'.encode('utf-8')
+
+def iter_xlsx(rows, sheet_name='Sheet1', header=True):
+    """
+    Yields an Excel (.xlsx) workbook with a single sheet containing the given
+    rows, writing each row as it is produced.  If header is true, the first
+    row is bolded.
+
+    Values are written as numbers or booleans where they are ones, and
+    otherwise as strings; None is written as an empty cell.
+    """
+    members = [(name, [content.encode('utf-8')]) for name, content in _XLSX_PARTS.items()]
+    members.append(('xl/workbook.xml', [(_XLSX_WORKBOOK % escape(sheet_name[:31], {'"': '&quot;'})).encode('utf-8')]))
+    members.append(('xl/worksheets/sheet1.xml', _iter_xlsx_sheet(rows, header)))
+    return iter_zip(members)
+
+def streaming_download(chunks, filename, content_type):
+    """
+    Returns a StreamingHttpResponse which downloads the given chunks as
+    an attachment called filename.
+    """
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
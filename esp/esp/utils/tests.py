@@ -5,6 +5,7 @@
 
 import datetime
 import doctest
+import io
 try:
     import pylibmc as memcache
 except:
@@ -12,21 +13,28 @@
 import logging
 logger = logging.getLogger(__name__)
 import os
+import shutil
 import subprocess
 import sys
+import tempfile
 from reversion import revisions as reversion
 from reversion.models import Version
 import unittest
+import zipfile
 
+from django.core.cache import cache
 from django.db.models.query import Q
 from django.template import loader, Template, Context, TemplateDoesNotExist
 from django.test import TestCase as DjangoTestCase
+from django.test.utils import override_settings
 
 from esp.middleware import ESPError_Log
+from esp.tagdict.models import Tag
 from esp.users.models import ESPUser
 from esp import utils
-from esp.utils import query_builder
+from esp.utils import latex, query_builder, request_cache
 from esp.utils.models import TemplateOverride, Printer, PrintRequest
+from esp.utils.web import zip_download
 
 
 # Code from <http://snippets.dzone.com/posts/show/6313>
@@ -190,6 +198,153 @@ def test_overrides(self):
         self.expect_template_error('BLAARG.TEMPLATEOVERRIDE')
 
 
+class ZipDownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def make_file(self, name, contents):
+        path = os.path.join(self.tempdir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(contents)
+        return path
+
+    def test_zip_download(self):
+        text = self.make_file('notes.txt', b'notes ' * 100000)
+        other_text = self.make_file('other/notes.txt', b'more notes')
+        image = self.make_file('scan.png', os.urandom(200000))
+        files = [text, None, os.path.join(self.tempdir, 'missing.txt'), other_text, image]
+
+        response = zip_download(files, 'uploads')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=uploads.zip')
+        chunks = list(response.streaming_content)
+        #   The archive comes out a piece at a time, not all at once.
+        self.assertTrue(len(chunks) > 3)
+        self.assertTrue(max(len(chunk) for chunk in chunks) < 200000)
+
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.namelist(), ['notes.txt', 'notes (2).txt', 'scan.png'])
+        self.assertEqual(archive.read('notes.txt'), b'notes ' * 100000)
+        self.assertEqual(archive.read('notes (2).txt'), b'more notes')
+        self.assertEqual(archive.getinfo('notes.txt').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(archive.getinfo('scan.png').compress_type, zipfile.ZIP_STORED)
+
+
+@unittest.skipUnless(find_executable('pdflatex'), 'pdflatex is not installed')
+class LatexCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        settings_override = override_settings(LATEX_CACHE_DIR=self.cache_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def document(self, text):
+        return '\\documentclass{article}\n\\begin{document}\n%s\n\\end{document}\n' % text
+
+    def cached_files(self):
+        return [os.path.join(dirpath, filename) for dirpath, dirnames, filenames in os.walk(self.cache_dir) for filename in filenames]
+
+    def test_cache(self):
+        pdf = latex.gen_latex(self.document('Hello'))
+        self.assertTrue(pdf.startswith(b'%PDF'))
+        self.assertEqual(len(self.cached_files()), 1)
+
+        #   The same source gets the cached output back, without recompiling.
+        with open(self.cached_files()[0], 'wb') as f:
+            f.write(b'cached')
+        self.assertEqual(latex.gen_latex(self.document('Hello')), b'cached')
+        self.assertTrue(latex.gen_latex(self.document('Hello'), use_cache=False).startswith(b'%PDF'))
+        self.assertTrue(latex.gen_latex(self.document('Goodbye')).startswith(b'%PDF'))
+        self.assertEqual(len(self.cached_files()), 2)
+
+    def test_batch(self):
+        pdf = latex.gen_latex_batch([self.document('Page %d' % i) for i in range(3)])
+        self.assertTrue(pdf.startswith(b'%PDF'))
+        #   Each part is cached, as well as the merged document.
+        self.assertEqual(len(self.cached_files()), 4)
+        self.assertEqual(len([path for path in self.cached_files() if path.endswith('.batch.pdf')]), 1)
+        self.assertEqual(latex.gen_latex_batch([self.document('Page %d' % i) for i in range(3)]), pdf)
+
+
+class LatexCacheKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp() + '/'
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, LATEX_CACHE_DIR=tempfile.gettempdir())
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_media(self):
+        #   Replacing an image the source includes changes the key.
+        image = os.path.join(self.media_root, 'latex_media', 'letterhead.pdf')
+        os.makedirs(os.path.dirname(image))
+        with open(image, 'wb') as f:
+            f.write(b'old')
+        texcode = '\\includegraphics[width=2in]{%s}' % image
+        self.assertEqual(latex._media_paths(texcode), [image])
+        key = latex._cache_path(texcode, 'pdf')
+        self.assertEqual(latex._cache_path(texcode, 'pdf'), key)
+        with open(image, 'wb') as f:
+            f.write(b'newer')
+        self.assertNotEqual(latex._cache_path(texcode, 'pdf'), key)
+
+        #   Sources without media are keyed as before.
+        self.assertEqual(latex._media_paths('Hello'), [])
+
+
+class RequestCacheTest(DjangoTestCase):
+    def setUp(self):
+        request_cache.start()
+        self.addCleanup(request_cache.end)
+        self.memo = request_cache.get_request_cache()
+
+    def test_memo(self):
+        cache.set('request_cache_test', [1, 2])
+        value = cache.get('request_cache_test')
+        self.assertEqual(value, [1, 2])
+        self.assertEqual((self.memo.hits, self.memo.misses), (1, 0))
+
+        #   Callers get their own copy of the value.
+        value.append(3)
+        self.assertEqual(cache.get('request_cache_test'), [1, 2])
+
+        #   A change from another process isn't seen during the request...
+        cache._wrapped_cache.set(cache.make_key('request_cache_test'), [4])
+        self.assertEqual(cache.get('request_cache_test'), [1, 2])
+        #   ...unless we read with the memo suspended.
+        with request_cache.suspended():
+            self.assertEqual(cache.get('request_cache_test'), [4])
+        self.assertEqual(cache.get('request_cache_test'), [4])
+
+        #   Our own writes are always seen.
+        cache.delete('request_cache_test')
+        self.assertIsNone(cache.get('request_cache_test'))
+        self.assertEqual(cache.get_many(['request_cache_test', 'request_cache_test_2']), {})
+        cache.set('request_cache_test_2', 1)
+        cache.incr('request_cache_test_2', 2)
+        self.assertEqual(cache.get_many(['request_cache_test', 'request_cache_test_2']), {'request_cache_test_2': 3})
+
+    def test_tags(self):
+        Tag.setTag('request_cache_test_tag', value='1')
+        self.assertEqual(Tag.getTag('request_cache_test_tag'), '1')
+        hits = self.memo.hits
+        with self.assertNumQueries(0):
+            self.assertEqual(Tag.getTag('request_cache_test_tag'), '1')
+        self.assertTrue(self.memo.hits > hits)
+
+        #   Invalidation works just as it does without the memo.
+        Tag.setTag('request_cache_test_tag', value='2')
+        self.assertEqual(Tag.getTag('request_cache_test_tag'), '2')
+
+    def test_middleware(self):
+        self.client.get('/')
+        self.assertIsNone(request_cache.get_request_cache())
+
+
 class QueryBuilderTest(DjangoTestCase):
     maxDiff = None
     def test_query_builder(self):
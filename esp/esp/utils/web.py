@@ -32,15 +32,13 @@
   Phone: 617-379-0178
   Email: web-team@learningu.org
 """
-import os
 import re
-import zipfile
-from io import BytesIO as StringIO
 from django.template import Template, loader, RequestContext
 from django.conf import settings
 from django import http
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponseRedirect
 from esp.middleware import ESPError
+from esp.utils.streaming import iter_zip_files, streaming_download
 from esp.themes.controllers import ThemeController
 from esp.program.models import Program
 from esp.web.views.navBar import makeNavBar
@@ -152,14 +150,7 @@ def _wrapped_view(request, *args, **kwargs):
 
 def zip_download(files = [], zipname = 'files'):
     """
-    Zips a list of files together and returns it as a download
+    Zips a list of files together and returns it as a download.  The zip
+    file is streamed as it is written, so it is never held in memory.
     """
-    file_like = StringIO()
-    zf = zipfile.ZipFile(file_like, 'w')
-    for file in files:
-        if file:
-            zf.write(file, os.path.basename(os.path.normpath(file)))
-    zf.close()
-    response = HttpResponse(file_like.getvalue(), content_type='application/zip')
-    response['Content-Disposition']='attachment; filename=%s.zip' % zipname
-    return response
+    return streaming_download(iter_zip_files(files), '%s.zip' % zipname, 'application/zip')
@@ -34,9 +34,13 @@
 """
 
 from esp.web.models import NavBarEntry, NavBarCategory, default_navbarcategory
+from esp.program import archive_search
+from esp.program.models import ArchiveClass
 from esp.program.tests import ProgramFrameworkTest  ## Really should find somewhere else to put this...
 from django.test.client import Client
 from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from esp.tests.util import CacheFlushTestCase as TestCase
 from esp.utils.models import TemplateOverride
 
@@ -252,3 +256,54 @@ def runTest(self, display=False):
             self.assertEqual(num_errors, 0, 'Closure compiler detected Javascript syntax errors')
 
 
+class ArchiveSearchTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        def archive(title, teacher, description, year='2010'):
+            return ArchiveClass.objects.create(program='Splash', year=year, date='', category='S', teacher=teacher, title=title, description=description, student_ids='')
+        self.rockets = archive('Rocket Science', 'Ada Lovelace', 'Build and launch model rockets.')
+        self.history = archive('History of Flight', 'Orville Wright', 'From kites to rockets and beyond.')
+        self.poetry = archive('Poetry', 'Emily Dickinson', 'Reading and writing poems.')
+        self.origami = [archive('Origami %d' % i, 'Paper Folder', 'Fold paper cranes.', year=str(2011 - i)) for i in range(12)]
+
+    def search_ids(self, queries):
+        return list(archive_search.search(ArchiveClass.objects.all(), queries).order_by('-rank', 'id').values_list('id', flat=True))
+
+    def test_search(self):
+        #   Title matches rank above description matches.
+        self.assertEqual(self.search_ids([('rocket', None)]), [self.rockets.id, self.history.id])
+        #   Every word has to match.
+        self.assertEqual(self.search_ids([('rocket launch', None)]), [self.rockets.id])
+        #   Searches can be limited to some fields.
+        self.assertEqual(self.search_ids([('wright', ['teacher'])]), [self.history.id])
+        self.assertEqual(self.search_ids([('rocket', ['teacher'])]), [])
+        #   Changes are picked up when an archive class is saved.
+        self.poetry.description = 'Poems about rockets.'
+        self.poetry.save()
+        self.assertIn(self.poetry.id, self.search_ids([('rocket', ['description'])]))
+
+    def test_view(self):
+        url = '/archives/classes'
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, {'filter_search': 'origami', 'max_num_results': '10'})
+        self.assertEqual(len([q for q in queries.captured_queries if 'COUNT(' in q['sql'].upper()]), 1)
+        self.assertTrue(response.context['ranked'])
+        self.assertEqual(response.context['num_results'], 12)
+        first_page = [entry.id for entry in response.context['results']]
+        self.assertEqual(len(first_page), 10)
+
+        #   The next page picks up where this one left off.
+        response = self.client.post(url, {'filter_search': 'origami', 'max_num_results': '10', 'newparam': 'relevance', 'results_start': '10', 'results_after': response.context['results_after']})
+        second_page = [entry.id for entry in response.context['results']]
+        self.assertEqual(len(second_page), 2)
+        self.assertEqual(set(first_page + second_page), {cls.id for cls in self.origami})
+        self.assertEqual(response.context['results_range'], {'start': 11, 'end': 12})
+
+        #   ... and the previous page goes back to it.
+        response = self.client.post(url, {'filter_search': 'origami', 'max_num_results': '10', 'newparam': 'relevance', 'results_start': '0', 'results_before': response.context['results_before']})
+        self.assertEqual([entry.id for entry in response.context['results']], first_page)
+
+        #   Searches can also be sorted by a field.
+        response = self.client.post(url, {'filter_teacher': 'folder', 'newparam': 'year', 'max_num_results': 'Show all'})
+        self.assertFalse(response.context['ranked'])
+        self.assertEqual([entry.id for entry in response.context['results']], [cls.id for cls in reversed(self.origami)])
@@ -34,12 +34,15 @@
   Email: web-team@learningu.org
 """
 from esp.users.models import ContactInfo, ESPUser
+from esp.program import archive_search
 from esp.program.models import ArchiveClass, ClassSubject, ClassCategories
+from esp.utils.query_utils import keyset_Q, reverse_ordering
 from esp.utils.web import render_to_response
 from django.db.models.query import QuerySet
 from django.http import HttpResponse, Http404, HttpResponseNotAllowed, HttpResponseRedirect
 from django.contrib.auth.decorators import login_required
 from datetime import datetime
+import json
 
 #    Two inputs to each function:
 #    -    category: what you sort or view by
@@ -58,23 +61,29 @@ def __init__(self, category = "", options = ""):
     def __str__(self):
         return '%s, %s' % (self.category, self.options)
 
-def compute_range(postvars, num_records):
+#    The fields results can be sorted by, and the filters which are
+#    full-text searches (with the fields they search, or None for all).
+SORT_FIELDS = ['year', 'category', 'program', 'title', 'teacher', 'description']
+SEARCH_FILTERS = {'search': None, 'teacher': ['teacher'], 'description': ['description']}
+
+def compute_page_size(postvars):
     default_num_records = 10
-    results_start = 0
-    results_end = None
-    if 'results_start' in postvars:
-        results_start = int(postvars['results_start'])
-    if 'results_end' in postvars:
-        results_end = int(postvars['results_end'])
-    if (num_records > default_num_records) and results_end is None:
-        if postvars.get('max_num_results') == "Show all":
-            results_end = num_records
-        elif postvars.get('max_num_results'):
-            results_end = results_start + int(postvars['max_num_results'])
-        else:
-            results_end = results_start + default_num_records
-
-    return {'start': results_start, 'end': results_end}
+    if postvars.get('max_num_results') == "Show all":
+        return None
+    elif postvars.get('max_num_results'):
+        return int(postvars['max_num_results'])
+    return default_num_records
+
+def parse_cursor(value, ordering):
+    """ Decode a keyset pagination cursor: the values of the ordering
+    fields for the row to start after or end before. """
+    try:
+        cursor = json.loads(value)
+    except ValueError:
+        return None
+    if isinstance(cursor, list) and len(cursor) == len(ordering):
+        return cursor
+    return None
 
 def extract_criteria(postvars):
     #    Use filters
@@ -95,10 +104,11 @@ def filter_archive(records, criteria):
             result = result.filter(title__istartswith = c.options)
         elif c.category == 'category':
             result = result.filter(category__istartswith = c.options)
-        elif c.category == 'teacher':
-            result = result.filter(teacher__icontains = c.options)
-        elif c.category == 'description':
-            result = result.filter(description__icontains = c.options)
+
+    #    Teacher, description and free-text filters all use the search index.
+    searches = [(c.options, SEARCH_FILTERS[c.category]) for c in criteria if c.category in SEARCH_FILTERS]
+    if searches:
+        result = archive_search.search(result, searches)
 
     return result
 
@@ -134,78 +144,107 @@ def archive_classes(request, category, options, sortorder = None):
     for category in classcatList:
         category_dict[category.category[0].upper()] = category.category
 
-    filter_keys = {'category': [{'name': c, 'value': c, 'selected': False} for c in category_list],
+    filter_keys = {'search': [{}],
+            'category': [{'name': c, 'value': c, 'selected': False} for c in category_list],
             'year': [{'name': str(y), 'value': str(y), 'selected': False} for y in range(1998, datetime.now().year + 1)],
             'title': [{'name': 'Starts with ' + letter, 'value': letter, 'selected': False} for letter in map(chr, list(range(65, 91)))],
              'program': [{'name': p, 'value': p, 'selected': False} for p in program_list],
             'teacher': [{}],
             'description': [{}]
             }
-    if 'filter_teacher' in request.POST: filter_keys['teacher'][0]['default_value'] = request.POST['filter_teacher']
-    if 'filter_description' in request.POST: filter_keys['description'][0]['default_value'] = request.POST['filter_description']
 
     results = filter_archive(ArchiveClass.objects.all(), criteria_list)
-
-    #    Sort the results by the specified order
-    if (not isinstance(sortorder, list)) or len(sortorder) < 1:
-        sortorder = ['year', 'category', 'program', 'title', 'teacher', 'description']
-
-    sortorder.reverse()
-    for parameter in sortorder:
-        results = results.order_by(parameter)
-    sortorder.reverse()
+    searching = any(c.category in SEARCH_FILTERS for c in criteria_list)
+
+    #    Sort the results by relevance, if searching and not asked for
+    #    anything else, or else by the first field of the specified order.
+    #    Either way the id comes last, so that no two results tie and we can
+    #    paginate by keyset.
+    if not isinstance(sortorder, list):
+        sortorder = []
+    ranked = searching and (len(sortorder) == 0 or sortorder[0] == 'relevance')
+    sortorder = [s for s in sortorder if s in SORT_FIELDS]
+    if len(sortorder) < 1:
+        sortorder = list(SORT_FIELDS)
+    if ranked:
+        ordering = ['-rank', 'id']
+    else:
+        ordering = [sortorder[0], 'id']
 
     context['sortorder'] = sortorder
+    context['searching'] = searching
+    context['ranked'] = ranked
 
     for c in criteria_list:
         for k in filter_keys[c.category]:
             if 'name' in k and 'value' in k:
                 if c.options == k['value']:
                     k['selected'] = True
+            elif c.category in SEARCH_FILTERS:
+                k['default_value'] = c.options
 
     context['sortparams'] = [{'name': k, 'options': filter_keys[k]} for k in filter_keys.keys()]
 
-    #    Display the appropriate range of results
+    #    Display the appropriate page of results
     postvars = request.POST.copy()
-    relevant_keys = ['max_num_results', 'results_start', 'results_end']
+    relevant_keys = ['max_num_results', 'results_start', 'results_after', 'results_before']
     for k in relevant_keys:
         if k in request.GET:
             postvars[k] = request.GET[k]
 
-    res_range = compute_range(postvars, results.count())
-    context['results_range'] = res_range
+    num_results = results.count()
+    page_size = compute_page_size(postvars)
+    results_start = max(int(postvars.get('results_start') or 0), 0)
+    after = parse_cursor(postvars.get('results_after', ''), ordering)
+    before = parse_cursor(postvars.get('results_before', ''), ordering)
 
-    #    Deal with the Django bug preventing you from using no "end"
-    if res_range['end'] is None:
-        res_range['end'] = results.count()
+    if after is not None:
+        page = results.filter(keyset_Q(ordering, after)).order_by(*ordering)
+    elif before is not None:
+        page = results.filter(keyset_Q(ordering, before, before=True)).order_by(*reverse_ordering(ordering))
+    else:
+        #    Without a cursor, start from the requested position.
+        page = results.order_by(*ordering)[results_start:]
+    if page_size is not None:
+        page = page[:page_size]
+    page = list(page)
+    if before is not None:
+        page.reverse()
+
+    #    The cursors for the previous and next pages, taken before the
+    #    entries are changed for display below.
+    if page:
+        context['results_before'] = json.dumps([getattr(page[0], field.lstrip('-')) for field in ordering])
+        context['results_after'] = json.dumps([getattr(page[-1], field.lstrip('-')) for field in ordering])
+    context['previous_start'] = max(results_start - (page_size or 0), 0)
 
     #    Rename all of the class categories and uppercase the programs
-    for entry in results[res_range['start']:res_range['end']]:
+    for entry in page:
         entry.category = category_dict[entry.category[:1].upper()]
         entry.program = entry.program.upper()
         #    entry.title = entry.title.capitalize()
 
     #    Compute the headings for the 'jump to category' part
-    if sortorder[0] == 'title':
-        headings = [title_heading(item.__dict__['title']) for item in results[res_range['start']:res_range['end']]]
+    if ranked:
+        headings = []
+    elif sortorder[0] == 'title':
+        headings = [title_heading(item.title) for item in page]
     else:
-        headings = [item.__dict__[sortorder[0]] for item in results[res_range['start']:res_range['end']]]
+        headings = [getattr(item, sortorder[0]) for item in page]
 
     context['headings'] = list({str(h) for h in headings})
     context['headings'].sort()
 
     #    Fill in context some more
-    context['num_results'] = results.count()
-    context['results'] = list(results[res_range['start']:res_range['end']])
-    context['results_range']['start'] = context['results_range']['start'] + 1
-    if res_range['end'] > context['num_results']:
-        context['results_range']['end'] = context['num_results']
+    context['num_results'] = num_results
+    context['results'] = page
+    context['results_range'] = {'start': results_start + 1, 'end': results_start + len(page)}
     if 'max_num_results' in request.POST:
         context['max_num_results'] = request.POST['max_num_results']
     else:
         context['max_num_results'] = '25'
     context['num_results_list'] = ['10', '25', '50', '100', '250', 'Show all']
-    context['num_results_shown'] = len(context['results'])
+    context['num_results_shown'] = len(page)
 
     return render_to_response('program/archives.html', request, context)
 
@@ -35,6 +35,7 @@
 from django.contrib.sites.models import Site
 from esp.users.models import ESPUser, Permission
 from django.http import Http404, HttpResponseRedirect, HttpResponse
+from django.db import transaction
 from django.utils.datastructures import MultiValueDict
 from django.template import loader
 from django.views.generic.base import TemplateView
@@ -64,14 +65,16 @@ def home(request):
     context = {'navbar_list': makeNavBar('', nav_category)}
     return render_to_response('index.html', request, context)
 
+@transaction.non_atomic_requests
 def program(request, tl, one, two, module, extra = None):
-    """ Return program-specific pages """
+    """ Return program-specific pages.  The module view is run in a
+    transaction by ProgramModuleObj.findModule(), if it wants one. """
     from esp.program.models import Program
 
     if two == "current":
         try:
-            programs = Program.objects.all()
-            progs = [(program, program.dates()[-1]) for program in programs if program.program_type == one and len(program.dates()) > 0]
+            programs = Program.objects.filter(url__startswith=one + '/')
+            progs = [(program, program.dates()[-1]) for program in programs if program.dates()]
             two = sorted(progs, key=lambda x: x[1], reverse = True)[0][0].program_instance
         except:
             raise Http404("No current program of the type '" + one + "'.")
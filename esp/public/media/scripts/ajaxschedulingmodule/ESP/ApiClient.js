@@ -20,6 +20,29 @@ function ApiClient() {
             });
     }
 
+    /**
+     * Wait for new entries in the change log from the server.  The server
+     * holds the request open until there is something new (or it gives up),
+     * and returns the same data as get_change_log.
+     *
+     * @param last_fetched_index: The previous index we retrieved from the server
+     * @param callback: If successful, this function will be called. Takes one param
+     *                  ajax_data which is the data that was fetched.
+     * @param: errorReporter: If server reports an error, this function will be called.
+     *                        Takes one param msg with an error message.
+     */
+    this.get_change_feed = function(last_fetched_index, callback, errorReporter){
+        $j.getJSON(
+            'ajax_change_feed',
+            { 'last_fetched_index': last_fetched_index })
+            .done(function(ajax_data, status) {
+                callback(ajax_data);
+            })
+            .fail(function(ajax_data, status) {
+                errorReporter("An error occurred waiting for the changelog.");
+            });
+    }
+
     /**
      * Set a scheduling comment on a section.
      *
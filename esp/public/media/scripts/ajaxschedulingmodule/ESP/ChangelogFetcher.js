@@ -18,14 +18,40 @@ function ChangelogFetcher(matrix, api_client){
     });
 
     /**
-     * Poll for changes every interval milliseconds.
+     * Keep up with changes, waiting on the server's change feed and falling
+     * back to polling every interval milliseconds if that doesn't work.
      *
      * @param interval: The time in milliseconds between polling the server
      */
     this.pollForChanges = function(interval){
-        // run getChanges() immediately, then set up the recurring call
-        this.getChanges();
-        window.setInterval(this.getChanges.bind(this), interval);
+        this.interval = interval;
+        this.waitForChanges();
+    };
+
+    /**
+     * Fetch changes from the change feed, apply them, and ask again.  If the
+     * server answered quickly with nothing new (e.g. it is configured not to
+     * wait), don't ask more often than once per interval.
+     */
+    this.waitForChanges = function(){
+        var start = Date.now();
+        this.api_client.get_change_feed(
+            this.last_applied_index,
+            function(data) {
+                this.applyChangeLog(data);
+                var delay = 0;
+                if (!data.changelog || data.changelog.length == 0) {
+                    delay = Math.max(0, this.interval - (Date.now() - start));
+                }
+                window.setTimeout(this.waitForChanges.bind(this), delay);
+            }.bind(this),
+            function(msg) {
+                console.log(msg);
+                // run getChanges() immediately, then set up the recurring call
+                this.getChanges();
+                window.setInterval(this.getChanges.bind(this), this.interval);
+            }.bind(this)
+        );
     };
 
     /**
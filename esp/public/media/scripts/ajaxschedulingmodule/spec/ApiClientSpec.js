@@ -49,6 +49,51 @@ describe("ApiClient", function(){
         });
     });
 
+    describe("get_change_feed", function(){
+        var request, callback, errorReporter;
+
+        beforeEach(function(){
+            jasmine.Ajax.useMock();
+            callback = jasmine.createSpy('callback');
+            errorReporter = jasmine.createSpy('errorReporter');
+
+            a.get_change_feed(0, callback, errorReporter);
+            request = mostRecentAjaxRequest();
+        });
+
+        it("requests the change feed", function(){
+            expect(request.url).toContain("ajax_change_feed");
+        });
+
+        describe("when there is an error", function(){
+            beforeEach(function(){
+                request.response({
+                    status: 500,
+                    responseText: 'an error has occurred'
+                });
+            });
+
+            it("does not execute the callback", function(){
+                expect(callback).not.toHaveBeenCalled();
+                expect(errorReporter).toHaveBeenCalledWith("An error occurred waiting for the changelog.");
+            });
+        });
+
+        describe("when the request comes back with success", function(){
+            beforeEach(function(){
+                request.response({
+                    status: 200,
+                    responseText: '{"changelog":[], "other":[]}'
+                });
+            });
+
+            it("executes the callback", function(){
+                expect(callback).toHaveBeenCalled();
+                expect(errorReporter).not.toHaveBeenCalled();
+            });
+        });
+    });
+
     describe("schedule_section", function(){
         it("makes an ajax request", function(){
             spyOn(a, "send_request");
@@ -38,10 +38,34 @@ describe("ChangelogFetcher", function() {
     });
 
     describe("pollForChanges", function(){
-        it("sets an interval", function(){
+        it("waits on the change feed", function(){
+            spyOn(c.api_client, "get_change_feed");
+            c.pollForChanges(1234567);
+
+            expect(c.api_client.get_change_feed).toHaveBeenCalled();
+            args = c.api_client.get_change_feed.argsForCall[0];
+            expect(args[0]).toEqual(c.last_applied_index);
+        });
+
+        it("doesn't ask again sooner than the interval when nothing changed", function(){
+            spyOn(window, "setTimeout");
+            c.pollForChanges(1234567);
+
+            expect(window.setTimeout).toHaveBeenCalled();
+            args = window.setTimeout.argsForCall[0];
+            expect(args[1]).toBeGreaterThan(0);
+            expect(args[1]).not.toBeGreaterThan(1234567);
+        });
+
+        it("falls back to polling if the change feed fails", function(){
             spyOn(window, "setInterval");
+            spyOn(c.api_client, "get_change_log");
+            spyOn(c.api_client, "get_change_feed").andCallFake(function(index, callback, errorReporter){
+                errorReporter("An error occurred waiting for the changelog.");
+            });
             c.pollForChanges(1234567);
 
+            expect(c.api_client.get_change_log).toHaveBeenCalled();
             expect(window.setInterval).toHaveBeenCalled();
             args = window.setInterval.argsForCall[0];
             expect(args[1]).toEqual(1234567);
@@ -13,6 +13,10 @@ function FakeApiClient() {
         console.log("hi i'm here")
         callback();
     };
+
+    this.get_change_feed = function(index, callback){
+        callback({changelog: []});
+    };
 };
 
 function FakeFailingApiClient() {
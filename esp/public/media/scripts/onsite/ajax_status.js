@@ -115,9 +115,37 @@ function handle_full(new_data, text_status, jqxhr)
         handle_completed();
 }
 
+//  The server sends the enrollments that changed since enrollment_feed.cursor.
+//  Every so often we ask for all of them instead, in case we have missed a
+//  change (e.g. a section being closed); the server answers those with a 304
+//  if nothing has changed.
+var enrollment_feed = {
+    cursor: null,
+    refreshes: 0,
+    full_every: 6,
+};
+
+function apply_enrollment_changes(added, removed)
+{
+    //  Drop the removed pairs, and any copies of the added ones so they
+    //  don't show up twice.
+    var changed = {};
+    for (var i in removed)
+        changed[removed[i][0] + "," + removed[i][1]] = true;
+    for (var i in added)
+        changed[added[i][0] + "," + added[i][1]] = true;
+    data.enrollments = data.enrollments.filter(function (pair) {
+        return !changed[pair[0] + "," + pair[1]];
+    }).concat(added);
+}
+
 function handle_enrollment(new_data, text_status, jqxhr)
 {
-    data.enrollments = new_data;
+    if (new_data.reset || !data.enrollments)
+        data.enrollments = new_data.added;
+    else
+        apply_enrollment_changes(new_data.added, new_data.removed);
+    enrollment_feed.cursor = new_data.cursor;
     data_status.enrollment_received = true;
     if (check_status())
         handle_completed();
@@ -1371,8 +1399,13 @@ function fetch_all(avoid_catalog)
     {
         data_status.catalog_received = true;
     }
+    var since = enrollment_feed.cursor;
+    if (since === null || enrollment_feed.refreshes % enrollment_feed.full_every == 0)
+        since = "";
+    enrollment_feed.refreshes++;
     $j.ajax({
         url: program_base_url + "enrollment_status",
+        data: {since: since},
         dataType: 'json',
         success: handle_enrollment
     });
@@ -1408,6 +1441,69 @@ function refresh_counts() {
     fetch_all(true);
 }
 
+//  Wait for enrollment counts to change and apply them as they come in.
+//  The server holds each request open until something changes, and then
+//  sends only the sections that did.  If that stops working, we still have
+//  the periodic refresh_counts() to fall back on.
+var counts_feed = {
+    cursor: null,
+    retry_delay: 60000,
+    min_delay: 5000,
+};
+
+function apply_count_changes(new_data)
+{
+    if (new_data.reset || !data.counts)
+        data.counts = new_data.counts;
+    else
+    {
+        var positions = {};
+        for (var i in data.counts)
+            positions[data.counts[i][0]] = i;
+        for (var i in new_data.counts)
+        {
+            var sec_id = new_data.counts[i][0];
+            if (positions[sec_id] !== undefined)
+                data.counts[positions[sec_id]] = new_data.counts[i];
+            else
+                data.counts.push(new_data.counts[i]);
+        }
+    }
+    counts_feed.cursor = new_data.cursor;
+    if (new_data.counts.length == 0 || !data.sections)
+        return;
+
+    populate_counts();
+    if (state.display_mode == "status")
+        set_current_student(null);
+    else if (state.display_mode == "classchange")
+        set_current_student(state.student_id);
+}
+
+function wait_for_counts()
+{
+    var start = Date.now();
+    var params = {};
+    if (counts_feed.cursor !== null)
+        params.since = counts_feed.cursor;
+    $j.ajax({
+        url: program_base_url + "counts_feed",
+        data: params,
+        dataType: 'json',
+        success: function (new_data) {
+            apply_count_changes(new_data);
+            //  Don't hammer the server if it isn't holding requests open.
+            var delay = 0;
+            if (new_data.counts.length == 0)
+                delay = Math.max(0, counts_feed.min_delay - (Date.now() - start));
+            setTimeout(wait_for_counts, delay);
+        },
+        error: function () {
+            setTimeout(wait_for_counts, counts_feed.retry_delay);
+        }
+    });
+}
+
 $j(document).on("scroll", function(){
     $j("#student_selector_area").css("left", window.scrollX);
 });
@@ -1477,6 +1573,7 @@ $j(document).ready(function () {
     setup_sidebar();
     setup_search();
     fetch_all();
+    wait_for_counts();
     
     //  Update enrollment counts and list of students once per minute.
     setInterval(refresh_counts, 300000);